@@ -0,0 +1,77 @@
+"""Start the HTTP API server before running the api messaging actions"""
+
+# Application imports
+from ism.core.base_action import BaseAction
+from ism_comms.api.client import ApiSender
+from ism_comms.api.server import start_server
+from ism_comms.core.runtime import start_runtime
+from ism_comms.core.store import MessageStore
+
+
+class ActionBeforeIoApi(BaseAction):
+    """Start the server and outbound client defined under [comms][api] in the properties file.
+
+    e.g.
+        comms:
+          api:
+            codec: json
+            inbound:
+              host: 127.0.0.1
+              port: 8080
+              path: /messages
+              queue_size: 10000
+            outbound:
+              url: http://localhost:8081/messages
+              recipients:
+                UnitTest: http://localhost:8082/messages
+
+    A port of 0 picks any free port, and the properties are updated with the one used.
+    The inbound and outbound actions are activated for whichever sides are configured.
+    See ism_comms.api.server for the responses to inbound requests.
+
+    With [comms][runtime] set, the server and client run on the comms runtime instead
+    and the api actions stay inactive. The server queues onto the runtime and the
+    client is registered as its api sender, so the ism_comms.core actions must be
+    imported too. See ism_comms.core.runtime.
+    """
+
+    def execute(self):
+
+        if self.active():
+
+            try:
+                settings = self.properties['comms']['api']
+            except KeyError as e:
+                self.logger.error(f'Failed to read [comms][api] entries from properties. KeyError ({e})')
+                raise
+
+            try:
+                runtime = start_runtime(self.properties)
+            except Exception as err:
+                self.logger.error(f'Error starting the comms runtime ({err}).')
+                raise
+
+            if settings.get('inbound'):
+                try:
+                    server = start_server(self.properties)
+                except Exception as err:
+                    self.logger.error(f'Error starting the HTTP API server ({err}).')
+                    raise
+                settings['inbound']['port'] = server.port
+                self.logger.info(f'HTTP API server listening on ({server.host}:{server.port}{server.path})')
+                if runtime is None:
+                    self.activate('ActionIoApiInbound')
+
+            if settings.get('outbound'):
+                if runtime is None:
+                    self.activate('ActionIoApiOutbound')
+                else:
+                    sender = ApiSender(settings, self.logger)
+                    runtime.register_sender('api', sender.send, sender.routes)
+                    runtime.on_stop(sender.client.close)
+
+            # Bring a messages table made by an earlier release up to date, see ism_comms.core.store
+            MessageStore(self.dao, self.properties['database']['rdbms']).upgrade(self.logger)
+
+            # Job done so disable this action, or we'd be stuck in the STARTING phase
+            self.deactivate()
@@ -0,0 +1,59 @@
+"""Action flushes messages accepted by the HTTP API server into the messages table"""
+
+# Application imports
+from ism.core.base_action import BaseAction
+from ism_comms.api.server import get_server, stop_server
+from ism_comms.core.dedup import get_filter
+from ism_comms.core.metrics import get_metrics
+from ism_comms.core.scheduler import wake
+from ism_comms.core.store import DUPLICATE, INSERTED, MessageStore
+
+
+class ActionIoApiInbound(BaseAction):
+    """Insert the messages queued by the HTTP API server into the messages table.
+
+    Up to [comms][api][inbound][budget] messages (default 1000) are taken off the queue
+    per tick and inserted in one transaction. The server answers requests without
+    waiting for this action, and returns 429 when the queue is full. Messages that
+    fail to insert, e.g. a message_id already used by another sender, are logged and
+    dropped as the client has already been told they were accepted. A message already
+    received from the same (sender, sender_id), e.g. a client retrying, is counted as
+    a duplicate and dropped, see ism_comms.core.dedup.
+
+    The action is activated by ActionBeforeIoApi when [comms][api][inbound] is set.
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.started = False
+
+    def execute(self):
+
+        if self.active():
+
+            server = get_server(self.properties)
+            if server is None:
+                return
+            self.started = True
+            self.flush(server)
+
+        elif self.started:
+            # Deactivated, or the phase has moved on from RUNNING. Stop accepting, then keep what was accepted.
+            server = get_server(self.properties)
+            stop_server(self.properties)
+            if server is not None:
+                while self.flush(server):
+                    pass
+            self.started = False
+
+    def flush(self, server) -> int:
+        """Insert one batch from the queue, and return the number taken"""
+
+        rows = server.drain(self.properties['comms']['api']['inbound'].get('budget', 1000))
+        if rows:
+            store = MessageStore(self.dao, self.properties['database']['rdbms'])
+            statuses = store.insert_unique(rows, self.logger, get_filter(self.properties, store))
+            get_metrics(self.properties).count('duplicates', self.action_name, statuses.count(DUPLICATE))
+            if INSERTED in statuses:
+                wake(self.properties, 'inbound')
+        return len(rows)
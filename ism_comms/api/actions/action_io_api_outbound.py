@@ -0,0 +1,99 @@
+"""Action POSTs outbound messages from the messages table"""
+
+# Standard library imports
+import http.client
+import time
+
+# Application imports
+from ism.core.base_action import BaseAction
+from ism_comms.api.client import ConnectionPool
+from ism_comms.core.codecs import get_codec
+from ism_comms.core.scheduler import AdaptivePolling
+from ism_comms.core.store import MessageStore, recipient_filter
+
+
+class ActionIoApiOutbound(AdaptivePolling, BaseAction):
+    """POST each pending outbound message to its recipient's URL.
+
+    The URL is looked up by recipient in [comms][api][outbound][recipients], falling
+    back to [comms][api][outbound][url]. Up to [comms][api][outbound][batch_size]
+    messages (default 0, no limit) are sent per tick over keep-alive connections, and
+    the ones answered with a 2xx status are marked processed in bulk.
+
+    Anything else leaves the message pending. The URL's server is then skipped for
+    [comms][api][outbound][retry_interval] seconds (default 5) so a server that is
+    down or busy (429) isn't retried on every tick. Messages for a server being skipped,
+    or for a recipient without a URL, are left out of the batch fetched, so they don't
+    hold up the messages for the other servers.
+
+    The action is activated by ActionBeforeIoApi when [comms][api][outbound] is set.
+    Polling adapts to the traffic when [comms][polling] is set, see
+    ism_comms.core.scheduler.
+    """
+
+    poll_topic = 'outbound'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.client = None
+        self.retry_at = {}
+
+    def execute(self):
+
+        if self.active():
+
+            if self.client is None:
+                self.client = ConnectionPool(self.properties['comms']['api']['outbound'].get('timeout', 5))
+            self.poll(self.send_messages)
+
+        elif self.client is not None:
+            # Deactivated, or the phase has moved on from RUNNING
+            self.client.close()
+            self.client = None
+
+    def send_messages(self) -> int:
+        """POST a batch of pending outbound messages, returning the number sent"""
+
+        settings = self.properties['comms']['api']
+        outbound = settings['outbound']
+        recipients = outbound.get('recipients') or {}
+        now = time.monotonic()
+        blocked = {origin for origin, retry_at in self.retry_at.items() if retry_at > now}
+        default = outbound.get('url')
+        store = MessageStore(self.dao, self.properties['database']['rdbms'])
+        results = store.fetch_pending(
+            'outbound',
+            outbound.get('batch_size', 0),
+            **recipient_filter(
+                {recipient: self.client.origin(url) for recipient, url in recipients.items()},
+                None if default is None else self.client.origin(default),
+                blocked
+            )
+        )
+        if not results:
+            return 0
+
+        codec = get_codec(settings.get('codec', 'json'))
+        send_time = int(time.time())
+        sent = []
+        for record in results:
+            url = recipients.get(record.recipient, default)
+            origin = self.client.origin(url)
+            if self.retry_at.get(origin, 0) > now:
+                continue
+
+            data = codec.encode(record.message(send_time))
+            try:
+                status = self.client.post(url, data, codec.content_type)
+            except (OSError, http.client.HTTPException) as e:
+                self.logger.warning(f'Failed to POST message ({record.message_id}) to ({url}). ({e})')
+                self.retry_at[origin] = now + outbound.get('retry_interval', 5)
+                continue
+            if 200 <= status < 300:
+                sent.append(record.message_id)
+            else:
+                self.logger.warning(f'POST of message ({record.message_id}) to ({url}) returned ({status}).')
+                self.retry_at[origin] = now + outbound.get('retry_interval', 5)
+
+        store.mark_processed(sent, sent=send_time)
+        return len(sent)
@@ -0,0 +1,259 @@
+"""Keep-alive HTTP client used to POST outbound messages.
+
+One persistent connection is kept per origin, i.e. scheme, host and port, so a batch
+of messages to the same recipient reuses a single TCP (or TLS) connection. If a reused
+connection turns out to have been closed by the server while idle, the request is
+retried once on a fresh connection. The first request may have been received before
+the connection failed, so this can deliver a message twice. That's safe because the
+body carries the message's sender and sender_id, which don't change on a retry, and
+the receiver drops any message it has already stored from the same (sender, sender_id)
+as a duplicate, see ism_comms.core.dedup.
+
+AsyncConnectionPool does the same on the comms runtime's event loop, see
+ism_comms.core.runtime, keeping a list of idle connections per origin so that batches
+for the same origin can be sent side by side.
+"""
+
+# Standard library imports
+import asyncio
+import http.client
+import ssl
+import time
+from urllib.parse import urlsplit
+
+# Application imports
+from ism_comms.core.codecs import get_codec
+
+
+class ConnectionPool:
+    """Persistent HTTP connections keyed by origin.
+
+    :param timeout Socket timeout in seconds for connecting and each request.
+    """
+
+    def __init__(self, timeout=5):
+        self.timeout = timeout
+        self.connections = {}
+
+    @staticmethod
+    def origin(url: str) -> tuple:
+        parts = urlsplit(url)
+        return parts.scheme, parts.netloc
+
+    def connection(self, origin: tuple) -> http.client.HTTPConnection:
+        scheme, netloc = origin
+        connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return connection_class(netloc, timeout=self.timeout)
+
+    def post(self, url: str, body: bytes, content_type: str) -> int:
+        """POST the body and return the response status.
+
+        :raises OSError or http.client.HTTPException if the server can't be reached.
+        """
+
+        origin = self.origin(url)
+        parts = urlsplit(url)
+        target = f'{parts.path or "/"}{"?" + parts.query if parts.query else ""}'
+        headers = {'Content-Type': content_type}
+
+        connection = self.connections.pop(origin, None)
+        reused = connection is not None
+        while True:
+            if connection is None:
+                connection = self.connection(origin)
+            try:
+                connection.request('POST', target, body, headers)
+                response = connection.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                if not reused:
+                    raise
+                # The idle connection had been dropped, so try once more on a new one
+                connection = None
+                reused = False
+                continue
+
+            if response.will_close:
+                connection.close()
+            else:
+                self.connections[origin] = connection
+            return response.status
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+        self.connections = {}
+
+
+class AsyncConnectionPool:
+    """Persistent HTTP connections keyed by origin, for use on an event loop.
+
+    Responses are read by Content-Length, chunks, or until the server closes.
+
+    :param timeout Timeout in seconds for connecting and each request.
+    """
+
+    def __init__(self, timeout=5):
+        self.timeout = timeout
+        self.connections = {}
+
+    async def connect(self, origin: tuple) -> tuple:
+        scheme, netloc = origin
+        parts = urlsplit(f'{scheme}://{netloc}')
+        secure = scheme == 'https'
+        return await asyncio.open_connection(
+            parts.hostname,
+            parts.port or (443 if secure else 80),
+            ssl=ssl.create_default_context() if secure else None
+        )
+
+    async def post(self, url: str, body: bytes, content_type: str) -> int:
+        """POST the body and return the response status.
+
+        :raises OSError, asyncio.TimeoutError or http.client.HTTPException if the server can't be reached.
+        """
+
+        origin = ConnectionPool.origin(url)
+        parts = urlsplit(url)
+        target = f'{parts.path or "/"}{"?" + parts.query if parts.query else ""}'
+        request = (
+            f'POST {target} HTTP/1.1\r\n'
+            f'Host: {parts.netloc}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\n\r\n'
+        ).encode('latin-1') + body
+
+        idle = self.connections.setdefault(origin, [])
+        connection = idle.pop() if idle else None
+        reused = connection is not None
+        while True:
+            if connection is None:
+                connection = await asyncio.wait_for(self.connect(origin), self.timeout)
+            reader, writer = connection
+            try:
+                writer.write(request)
+                status, keep_alive = await asyncio.wait_for(self.response(reader), self.timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, http.client.HTTPException):
+                writer.close()
+                if not reused:
+                    raise
+                # The idle connection had been dropped, so try once more on a new one
+                connection = None
+                reused = False
+                continue
+
+            if keep_alive:
+                idle.append(connection)
+            else:
+                writer.close()
+            return status
+
+    @staticmethod
+    async def response(reader: asyncio.StreamReader) -> tuple:
+        """Read a response, returning its status and whether the connection can be reused"""
+
+        status_line = await reader.readline()
+        try:
+            version, status, _ = status_line.decode('latin-1').split(' ', 2)
+            status = int(status)
+        except ValueError:
+            raise http.client.BadStatusLine(status_line)
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection == 'keep-alive' or (version == 'HTTP/1.1' and connection != 'close')
+        if 'content-length' in headers:
+            await reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                await reader.readexactly(size + 2)
+                if not size:
+                    break
+        else:
+            await reader.read()
+            keep_alive = False
+        return status, keep_alive
+
+    async def close(self):
+        for idle in self.connections.values():
+            for _, writer in idle:
+                writer.close()
+        self.connections = {}
+
+
+class ApiSender:
+    """Send the api transport's outbound batches for the comms runtime, see ism_comms.core.runtime.
+
+    Messages are routed like ActionIoApiOutbound's, by [comms][api][outbound][recipients]
+    then [url]. Each origin's messages are sent in order over one connection, and the
+    origins side by side. An origin that fails is skipped for [retry_interval] seconds,
+    and routes() reports it, so ActionIoRuntimeOutbound doesn't fetch its messages.
+
+    :param settings The [comms][api] properties.
+    :param logger The ISM's logger.
+    """
+
+    def __init__(self, settings: dict, logger):
+        self.outbound = settings['outbound']
+        self.codec = get_codec(settings.get('codec', 'json'))
+        self.logger = logger
+        self.client = AsyncConnectionPool(self.outbound.get('timeout', 5))
+        self.retry_at = {}
+
+    async def send(self, records: list, send_time: int) -> list:
+        """POST a batch of OutboundRecords, returning the message_ids accepted with a 2xx status"""
+
+        recipients = self.outbound.get('recipients') or {}
+        now = time.monotonic()
+        by_origin = {}
+        for record in records:
+            url = recipients.get(record.recipient, self.outbound.get('url'))
+            if url is None:
+                continue
+            origin = ConnectionPool.origin(url)
+            if self.retry_at.get(origin, 0) <= now:
+                by_origin.setdefault(origin, []).append((url, record))
+
+        sent = await asyncio.gather(*(self.send_origin(origin, batch, send_time) for origin, batch in by_origin.items()))
+        return [message_id for origin_sent in sent for message_id in origin_sent]
+
+    def routes(self) -> tuple:
+        """The origin of each recipient with its own URL, the default origin or None, and the origins backing off.
+
+        Called from the ISM thread, see ism_comms.core.runtime.CommsRuntime.register_sender().
+        """
+
+        recipients = self.outbound.get('recipients') or {}
+        default = self.outbound.get('url')
+        now = time.monotonic()
+        return (
+            {recipient: ConnectionPool.origin(url) for recipient, url in recipients.items()},
+            None if default is None else ConnectionPool.origin(default),
+            {origin for origin, retry_at in self.retry_at.copy().items() if retry_at > now}
+        )
+
+    async def send_origin(self, origin: tuple, batch: list, send_time: int) -> list:
+        sent = []
+        for url, record in batch:
+            data = self.codec.encode(record.message(send_time))
+            try:
+                status = await self.client.post(url, data, self.codec.content_type)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, http.client.HTTPException) as e:
+                self.logger.warning(f'Failed to POST message ({record.message_id}) to ({url}). ({e})')
+                self.retry_at[origin] = time.monotonic() + self.outbound.get('retry_interval', 5)
+                break
+            if not 200 <= status < 300:
+                self.logger.warning(f'POST of message ({record.message_id}) to ({url}) returned ({status}).')
+                self.retry_at[origin] = time.monotonic() + self.outbound.get('retry_interval', 5)
+                break
+            sent.append(record.message_id)
+        return sent
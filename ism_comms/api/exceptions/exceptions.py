@@ -0,0 +1,8 @@
+"""Custom Exceptions for the state machine ism_comms.api actions"""
+
+
+class ApiServerNotStarted(Exception):
+
+    def __init__(self, message='The HTTP API server failed to start'):
+        self.message = message
+        super().__init__(self.message)
@@ -0,0 +1,259 @@
+"""Asyncio HTTP server that accepts inbound messages for one state machine.
+
+ActionBeforeIoApi starts the server from the [comms][api][inbound] properties and
+ActionIoApiInbound looks it up by the run directory, so several state machines can run
+in one process. The server runs its own event loop in a background thread and never
+touches the database: a request is decoded, checked and put on a bounded queue, and
+the inbound action flushes the queue into the messages table on its own tick. Bodies
+are decoded in a worker thread, as a large payload may be spilled to the blob store,
+which writes and syncs a file, and that would hold up every other connection on the loop.
+
+A POST of one encoded message to the configured path answers:
+    * 202 - Accepted onto the queue.
+    * 400 - The body couldn't be decoded or is missing message fields.
+    * 404 / 405 - Wrong path or method.
+    * 413 - The body is larger than max_body.
+    * 429 - The queue is full, with a Retry-After header. The client should resend.
+
+Connections are kept alive per HTTP/1.1. Accepted messages are only held in memory
+until the next flush, so they are lost if the process dies in between.
+
+With [comms][runtime] set the server shares the comms runtime's event loop instead of
+running its own, and queues onto the runtime's inbound queue, which ActionIoRuntimeInbound
+flushes. See ism_comms.core.runtime.
+"""
+
+# Standard library imports
+import asyncio
+from http import HTTPStatus
+import queue
+import threading
+
+# Application imports
+from ism_comms.api.exceptions.exceptions import ApiServerNotStarted
+from ism_comms.core.blobs import get_blob_settings
+from ism_comms.core.codecs import get_codec
+from ism_comms.core.runtime import start_runtime
+from ism_comms.core.store import inbound_row
+
+_servers = {}
+
+
+def start_server(properties: dict):
+    """Start the server described by [comms][api][inbound] for this run"""
+
+    key = properties['runtime']['run_dir']
+    stop_server(properties)
+    server = ApiServer(
+        properties['comms']['api'],
+        properties['comms'].get('priority'),
+        get_blob_settings(properties),
+        start_runtime(properties)
+    )
+    server.start()
+    _servers[key] = server
+    return server
+
+
+def get_server(properties: dict):
+    """Return the server started for this run, or None"""
+    return _servers.get(properties['runtime']['run_dir'])
+
+
+def stop_server(properties: dict):
+    server = _servers.pop(properties['runtime']['run_dir'], None)
+    if server is not None:
+        server.stop()
+
+
+class ApiServer:
+    """The inbound HTTP server of one state machine.
+
+    :param settings The [comms][api] properties.
+    :param priorities The [comms][priority] properties, see ism_comms.core.store.inbound_row().
+    :param blobs The blob store settings, see ism_comms.core.store.inbound_row().
+    :param runtime The comms runtime to serve on, or None to run a loop of its own.
+    """
+
+    def __init__(self, settings: dict, priorities=None, blobs=None, runtime=None):
+        inbound = settings['inbound']
+        self.host = inbound.get('host', '127.0.0.1')
+        self.port = inbound.get('port', 0)
+        self.path = inbound.get('path', '/messages')
+        self.max_body = inbound.get('max_body', 1048576)
+        self.runtime = runtime
+        self.queue = runtime.inbound if runtime else queue.Queue(maxsize=inbound.get('queue_size', 10000))
+        self.codec = get_codec(settings.get('codec', 'json'))
+        self.priorities = priorities
+        self.blobs = blobs
+        self.rejected = 0
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.error = None
+        self.connections = set()
+        self.handlers = set()
+
+    def start(self, timeout=5):
+        """Start the event loop thread and wait until the socket is listening"""
+
+        if self.runtime is not None:
+            try:
+                self.runtime.call(self.listen(), timeout)
+            except Exception as e:
+                self.error = e
+                raise ApiServerNotStarted(f'HTTP API server failed to start on ({self.host}:{self.port}). ({e})')
+            self.loop = self.runtime.loop
+            self.runtime.on_stop(self.close)
+            return
+
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(ready,), name='ism_comms_api', daemon=True)
+        self.thread.start()
+        if not ready.wait(timeout) or self.error:
+            raise ApiServerNotStarted(f'HTTP API server failed to start on ({self.host}:{self.port}). ({self.error})')
+
+    def run(self, ready: threading.Event):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.listen())
+        except Exception as e:
+            self.error = e
+            self.loop.close()
+            ready.set()
+            return
+
+        ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.run_until_complete(self.close())
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+
+    async def listen(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        # Pick up the actual port when asked for any free one
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self, timeout=1):
+        """Close the listening socket and any open connections, giving their handlers time to finish"""
+
+        self.server.close()
+        for writer in list(self.connections):
+            writer.close()
+        if self.handlers:
+            await asyncio.wait(list(self.handlers), timeout=timeout)
+        await self.server.wait_closed()
+
+    def stop(self):
+        """Close the listening socket and any open connections, then end the thread"""
+
+        if self.runtime is not None:
+            if self.runtime.running():
+                self.runtime.call(self.close(), 5)
+            return
+        if self.thread is None or not self.thread.is_alive():
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+
+    def drain(self, budget: int) -> list:
+        """Take up to budget accepted messages off the queue without blocking"""
+
+        if self.runtime is not None:
+            return self.queue.drain(budget)
+        rows = []
+        try:
+            while len(rows) < budget:
+                rows.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return rows
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve the requests on one connection until the client closes it or asks to"""
+
+        self.connections.add(writer)
+        self.handlers.add(asyncio.current_task())
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self.respond(writer, HTTPStatus.BAD_REQUEST, False)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection == 'keep-alive' or (version == 'HTTP/1.1' and connection != 'close')
+
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    await self.respond(writer, HTTPStatus.BAD_REQUEST, False)
+                    break
+                if length > self.max_body:
+                    await self.respond(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                await self.respond(writer, await self.accept(method, target, body), keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            self.handlers.discard(asyncio.current_task())
+            writer.close()
+
+    async def accept(self, method: str, target: str, body: bytes) -> HTTPStatus:
+        """Decode a request body off the loop and queue it for the inbound action"""
+
+        if target.split('?', 1)[0] != self.path:
+            return HTTPStatus.NOT_FOUND
+        if method != 'POST':
+            return HTTPStatus.METHOD_NOT_ALLOWED
+        try:
+            if self.runtime is not None:
+                row = await self.runtime.run_blocking(self.decode, body)
+            else:
+                row = await self.loop.run_in_executor(None, self.decode, body)
+        except Exception:
+            return HTTPStatus.BAD_REQUEST
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self.rejected += 1
+            return HTTPStatus.TOO_MANY_REQUESTS
+        return HTTPStatus.ACCEPTED
+
+    def decode(self, body: bytes) -> tuple:
+        """The messages table row for a request body, spilling a large payload to the blob store"""
+        return inbound_row(self.codec.decode(body, self.blobs), self.priorities, self.blobs)
+
+    @staticmethod
+    async def respond(writer: asyncio.StreamWriter, status: HTTPStatus, keep_alive: bool):
+        retry = 'Retry-After: 1\r\n' if status == HTTPStatus.TOO_MANY_REQUESTS else ''
+        writer.write(
+            f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+            f'Content-Length: 0\r\n'
+            f'{retry}'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1')
+        )
+        await writer.drain()
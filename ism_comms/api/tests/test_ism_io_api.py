@@ -0,0 +1,479 @@
+"""This module tests the HTTP API ism_comms.api action pack for the python state machine.
+
+
+"""
+
+# Standard library imports
+import asyncio
+import json
+import os
+import shutil
+import socket
+import threading
+from time import perf_counter, sleep
+import unittest
+import yaml
+
+# Local application imports
+from ism.ISM import ISM
+from ism_comms.api.client import ConnectionPool
+from ism_comms.api.server import ApiServer, stop_server
+from ism_comms.core.runtime import BatchQueue, CommsRuntime, get_runtime, stop_runtime
+
+
+class TestIsmIoApi(unittest.TestCase):
+    """This action pack implements HTTP API based IO.
+
+    The tests run over the loopback interface on ports picked by the OS.
+    """
+    path_sep = os.path.sep
+    dir = os.path.dirname(os.path.abspath(__file__))
+    sqlite3_properties = f'{dir}{path_sep}resources{path_sep}sqlite3_properties.yaml'
+
+    # Test support methods
+    def setUp(self):
+        self.properties = self.get_properties(self.sqlite3_properties)
+        self.test_inbound = self.properties['test']['support']['inbound']
+        self.test_outbound = self.properties['test']['support']['outbound']
+        self.test_archive = self.properties['test']['support']['archive']
+
+    def tearDown(self):
+        self.clear_test_files(self.test_inbound)
+        self.clear_test_files(self.test_outbound)
+        self.clear_test_files(self.test_archive)
+
+    @staticmethod
+    def clear_test_files(directory):
+        if not os.path.exists(directory):
+            return
+        for filename in os.listdir(directory):
+            file_path = os.path.join(directory, filename)
+            try:
+                if os.path.isfile(file_path) or os.path.islink(file_path):
+                    os.unlink(file_path)
+                elif os.path.isdir(file_path):
+                    shutil.rmtree(file_path)
+            except Exception as e:
+                print('Failed to delete %s. Reason: %s' % (file_path, e))
+
+    @staticmethod
+    def get_properties(properties_file: str) -> dict:
+        """Read in the properties file"""
+        with open(properties_file, 'r') as file:
+            return yaml.safe_load(file)
+
+    @staticmethod
+    def stop(ism):
+        """Stop the ISM and its server, and the comms runtime if it has one, once the main loop has exited"""
+        ism.stop()
+        ism.ism_thread.join(5)
+        stop_server(ism.properties)
+        stop_runtime(ism.properties)
+
+    def query_test_support_pack(self, msg: dict) -> list:
+
+        sender_id = msg['payload']['sender_id']
+
+        self.send_test_support_msg(msg)
+
+        # Wait for the reply.
+        self.assertTrue(
+            self.wait_for_test_message_reply(sender_id),
+            'Failed to find expected reply to test support message.'
+        )
+
+        with open(f'{self.test_outbound}{os.path.sep}{sender_id}.json', 'r') as file:
+            return json.loads(file.read()).get('query_result', {})
+
+    def send_test_support_msg(self, msg: dict):
+
+        sender_id = msg['payload']['sender_id']
+
+        if not os.path.exists(self.test_inbound):
+            os.makedirs(self.test_inbound)
+
+        with open(f'{self.test_inbound}{os.path.sep}{sender_id}.json', 'w') as message:
+            message.write(json.dumps(msg))
+        with open(f'{self.test_inbound}{os.path.sep}{sender_id}.smp', 'w') as semaphore:
+            semaphore.write('')
+
+    def wait_for_test_message_reply(self, sender_id, retries=10) -> bool:
+        """Wait for an expected reply to a test support message"""
+
+        expected_file = f'{self.test_outbound}{os.path.sep}{sender_id}.json'
+
+        while retries > 0:
+            if os.path.exists(expected_file):
+                return True
+            retries -= 1
+            sleep(1)
+
+        return False
+
+    @staticmethod
+    def wait_for_port(ism) -> int:
+        """ActionBeforeIoApi replaces port 0 with the port the server is listening on"""
+
+        retries = 500
+        while not ism.properties['comms']['api']['inbound']['port'] and retries:
+            retries -= 1
+            sleep(.01)
+        return ism.properties['comms']['api']['inbound']['port']
+
+    @staticmethod
+    def message(message_id: int, sender='test_api') -> bytes:
+        return json.dumps(
+            {
+                "message_id": message_id,
+                "sender": sender,
+                "sender_id": message_id,
+                "action": "ActionDummy",
+                "payload": {"index": message_id},
+                "sent": "Thursday lunchtime"
+            }
+        ).encode()
+
+    # The tests
+    def test_inbound_api_sqlite3(self):
+        """Test that requests POSTed over a keep-alive connection are accepted and flushed into the messages table.
+
+        The server answers from its own thread, so the requests shouldn't be held up by the ISM tick.
+        """
+
+        sender_id = 1
+        count = 2000
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.api.actions')
+        ism.start()
+
+        url = f'http://127.0.0.1:{self.wait_for_port(ism)}/messages'
+        client = ConnectionPool()
+        start = perf_counter()
+        statuses = [client.post(url, self.message(message_id), 'application/json') for message_id in range(1, count + 1)]
+        elapsed = perf_counter() - start
+        client.close()
+
+        self.assertEqual([202] * count, statuses)
+        self.assertGreater(count / elapsed, 1000, f'expected over 1000 requests/s, took ({elapsed:.2f}s)')
+
+        # Test support actions can answer during the STARTING phase, so give the inbound action time to run
+        sleep(1)
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT COUNT(*), COUNT(DISTINCT message_id) FROM messages WHERE sender = 'test_api'",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual([count, count], result[0], 'expected each message to be inserted exactly once')
+
+        self.stop(ism)
+
+    def test_server_responses(self):
+        """Confirm the server's answers to bad requests, and 429 once its queue is full"""
+
+        server = ApiServer({'inbound': {'port': 0, 'queue_size': 2, 'max_body': 1024}})
+        server.start()
+        url = f'http://127.0.0.1:{server.port}'
+        client = ConnectionPool()
+
+        self.assertEqual(202, client.post(f'{url}/messages', self.message(1), 'application/json'))
+        self.assertEqual(400, client.post(f'{url}/messages', b'{"message_id": 2}', 'application/json'))
+        self.assertEqual(400, client.post(f'{url}/messages', b'not json', 'application/json'))
+        self.assertEqual(404, client.post(f'{url}/other', self.message(2), 'application/json'))
+        self.assertEqual(413, client.post(f'{url}/messages', b' ' * 1025, 'application/json'))
+        self.assertEqual(202, client.post(f'{url}/messages', self.message(2), 'application/json'))
+        self.assertEqual(429, client.post(f'{url}/messages', self.message(3), 'application/json'))
+        self.assertEqual(1, server.rejected)
+
+        self.assertEqual([1, 2], [row[0] for row in server.drain(10)])
+        self.assertEqual(202, client.post(f'{url}/messages', self.message(3), 'application/json'))
+
+        client.close()
+        server.stop()
+        self.assertFalse(server.thread.is_alive())
+
+    def test_outbound_api_sqlite3(self):
+        """Confirm that ActionIoApiOutbound POSTs a pending outbound message to its recipient's URL."""
+
+        sender_id = 3
+
+        # Stand in for the recipient with a server of our own
+        recipient = ApiServer({'inbound': {'port': 0}})
+        recipient.start()
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['api']['outbound'] = {
+            'recipients': {'UnitTest': f'http://127.0.0.1:{recipient.port}/messages'}
+        }
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.api.actions')
+        # Test action pack contains insert into messages table.
+        ism.import_action_pack('ism_comms.file.tests.test_file_io_outbound')
+        ism.start()
+
+        retries = 500
+        rows = []
+        while not rows and retries:
+            retries -= 1
+            sleep(.01)
+            rows = recipient.drain(1)
+        self.assertEqual(1, len(rows), 'expected the outbound message to be POSTed')
+        self.assertEqual('ActionDummy', rows[0][3])
+        self.assertEqual({'test_msg': 'test value'}, json.loads(rows[0][4]))
+
+        sleep(1)
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT processed FROM messages WHERE direction = 'outbound'",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual([[1]], result, 'expected the outbound message to be marked processed')
+
+        self.stop(ism)
+        recipient.stop()
+
+    def test_outbound_api_dead_server_sqlite3(self):
+        """Confirm that messages for a server that's down don't hold up those for a server that's up.
+
+        The dead server's messages have the higher priority and outnumber the batch size,
+        so they would fill every batch if they were fetched while it's skipped.
+        """
+
+        sender_id = 4
+
+        recipient = ApiServer({'inbound': {'port': 0}})
+        recipient.start()
+        # A port with nothing listening on it
+        with socket.socket() as closed:
+            closed.bind(('127.0.0.1', 0))
+            dead_port = closed.getsockname()[1]
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['api']['outbound'] = {
+            'batch_size': 2,
+            'retry_interval': 60,
+            'recipients': {
+                'UnitTest': f'http://127.0.0.1:{recipient.port}/messages',
+                'Dead': f'http://127.0.0.1:{dead_port}/messages'
+            }
+        }
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.api.actions')
+        ism.import_action_pack('ism_comms.file.tests.test_file_io_outbound')
+        for message_id in range(2, 7):
+            ism.dao.execute_sql_statement(
+                f"INSERT INTO messages VALUES({message_id}, 'Dead', 'ActionIoApiOutbound', {message_id}, "
+                f"'ActionDummy', '{{}}', 12345, 0, 'outbound', 0, 5)"
+            )
+        ism.start()
+
+        retries = 500
+        rows = []
+        while not rows and retries:
+            retries -= 1
+            sleep(.01)
+            rows = recipient.drain(1)
+        self.assertEqual(1, len(rows), 'expected the message for the live server to be POSTed')
+
+        sleep(1)
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT recipient, processed, COUNT(*) FROM messages WHERE direction = 'outbound' "
+                       "GROUP BY recipient, processed ORDER BY recipient",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual([['Dead', 0, 5], ['UnitTest', 1, 1]], result)
+
+        self.stop(ism)
+        recipient.stop()
+
+    def test_batch_queue(self):
+        """Confirm a coroutine waits for room on a full queue, and drain takes batches in order"""
+
+        runtime = CommsRuntime({'workers': 1})
+        runtime.start()
+        batch_queue = BatchQueue(maxsize=2)
+
+        async def put_all():
+            for item in range(5):
+                await batch_queue.put(item)
+
+        putting = runtime.spawn(put_all())
+        sleep(.1)
+        self.assertFalse(putting.done(), 'expected put() to wait for room')
+        self.assertEqual([0], batch_queue.drain(1))
+        taken = [0]
+        while len(taken) < 5:
+            taken.extend(batch_queue.drain())
+            sleep(.01)
+        putting.result(1)
+        self.assertEqual(list(range(5)), taken)
+
+        runtime.stop()
+        self.assertFalse(runtime.running())
+
+    def test_runtime_concurrent_connections(self):
+        """Confirm the API server on the comms runtime serves many open connections at once with a fixed number of threads.
+
+        Every client connects before any sends, so all the connections are open together.
+        """
+
+        count = 200
+        workers = 2
+        threads = threading.active_count()
+        runtime = CommsRuntime({'workers': workers})
+        runtime.start()
+        server = ApiServer({'inbound': {'port': 0}}, runtime=runtime)
+        server.start()
+
+        async def clients() -> tuple:
+            connections = [await asyncio.open_connection('127.0.0.1', server.port) for _ in range(count)]
+            open_threads = threading.active_count()
+            for message_id, (_, writer) in enumerate(connections, 1):
+                body = self.message(message_id)
+                writer.write(
+                    f'POST /messages HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body
+                )
+            statuses = [(await reader.readline()).split()[1] for reader, _ in connections]
+            for _, writer in connections:
+                writer.close()
+            return statuses, open_threads
+
+        statuses, open_threads = asyncio.run(clients())
+        self.assertEqual([b'202'] * count, statuses)
+        self.assertLessEqual(
+            open_threads - threads, 1 + workers, 'expected one loop thread and its workers whatever the connections'
+        )
+        self.assertEqual(list(range(1, count + 1)), sorted(row[0] for row in server.drain(count)))
+
+        runtime.stop()
+        self.assertFalse(runtime.running())
+        self.assertEqual(threads, threading.active_count())
+
+    def test_runtime_api_sqlite3(self):
+        """Test that with [comms][runtime] set the api transport runs on the runtime's loop.
+
+        Messages POSTed to the ISM are inserted by ActionIoRuntimeInbound, and an outbound
+        message is POSTed by the api sender and marked processed by ActionIoRuntimeOutbound.
+        """
+
+        sender_id = 4
+        count = 100
+
+        # Stand in for the recipient with a server of our own
+        recipient = ApiServer({'inbound': {'port': 0}})
+        recipient.start()
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['runtime'] = {'workers': 2}
+        ism.properties['comms']['api']['outbound'] = {
+            'recipients': {'UnitTest': f'http://127.0.0.1:{recipient.port}/messages'}
+        }
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.core')
+        ism.import_action_pack('ism_comms.api.actions')
+        # Test action pack contains insert into messages table.
+        ism.import_action_pack('ism_comms.file.tests.test_file_io_outbound')
+        ism.start()
+
+        url = f'http://127.0.0.1:{self.wait_for_port(ism)}/messages'
+        client = ConnectionPool()
+        # Clear of the message_id of the outbound message
+        message_ids = range(1001, count + 1001)
+        statuses = [client.post(url, self.message(message_id), 'application/json') for message_id in message_ids]
+        client.close()
+        self.assertEqual([202] * count, statuses)
+
+        retries = 500
+        rows = []
+        while not rows and retries:
+            retries -= 1
+            sleep(.01)
+            rows = recipient.drain(1)
+        self.assertEqual(1, len(rows), 'expected the outbound message to be POSTed')
+        self.assertEqual({'test_msg': 'test value'}, json.loads(rows[0][4]))
+
+        sleep(1)
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT direction, COUNT(*), SUM(processed) FROM messages "
+                       "WHERE sender = 'test_api' OR direction = 'outbound' GROUP BY direction ORDER BY direction",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual(['inbound', count], result[0][:2], 'expected each message to be inserted exactly once')
+        self.assertEqual(['outbound', 1, 1], result[1], 'expected the outbound message to be marked processed')
+
+        self.stop(ism)
+        recipient.stop()
+
+    def test_runtime_stop_in_flight_sqlite3(self):
+        """Test that a send still in progress when the ISM stops is marked processed.
+
+        ActionIoRuntimeInbound runs before ActionIoRuntimeOutbound, so the runtime must
+        outlast the inbound action until the outbound one has waited for its sends.
+        """
+
+        ism = ISM({'properties_file': self.sqlite3_properties})
+        ism.properties['comms']['runtime'] = {'default_transport': 'slow', 'stop_timeout': 5}
+
+        ism.import_action_pack('ism_comms.core')
+        ism.import_action_pack('ism_comms.api.actions')
+        # Test action pack contains insert into messages table.
+        ism.import_action_pack('ism_comms.file.tests.test_file_io_outbound')
+        ism.start()
+
+        retries = 500
+        runtime = None
+        while runtime is None and retries:
+            retries -= 1
+            sleep(.01)
+            runtime = get_runtime(ism.properties)
+        self.assertIsNotNone(runtime, 'expected the comms runtime to be started')
+
+        sending = threading.Event()
+
+        async def slow(records, send_time):
+            sending.set()
+            await asyncio.sleep(1)
+            return [record.message_id for record in records]
+
+        runtime.register_sender('slow', slow)
+        self.assertTrue(sending.wait(5), 'expected the outbound message to be handed to the sender')
+
+        self.stop(ism)
+        self.assertFalse(runtime.running(), 'expected the runtime to be stopped once both actions let go')
+        rows = ism.dao.execute_sql_query("SELECT processed FROM messages WHERE direction = 'outbound'")
+        self.assertEqual([1], [row[0] for row in rows], 'expected the message sent during the stop to be processed')
+
+
+if __name__ == '__main__':
+    unittest.main()
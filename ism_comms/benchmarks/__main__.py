@@ -0,0 +1,6 @@
+"""Run the comms benchmarks, see ism_comms.benchmarks.runner"""
+
+# Local application imports
+from ism_comms.benchmarks.runner import main
+
+main()
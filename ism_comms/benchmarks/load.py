@@ -0,0 +1,118 @@
+"""Synthetic load for the comms benchmarks.
+
+The generator drops inbound message files, each with its semaphore, into the inbound
+directory at a set rate, appends them to a shared sqlq queue, or inserts outbound rows
+into the messages table. Payloads are padded to a set size so runs with small and large
+messages can be compared. produce() runs a generator in a process of its own, to time
+messages crossing from one process to another.
+"""
+
+# Standard library imports
+import json
+import os
+import time
+
+# Application imports
+from ism_comms.core.transaction import execute_many
+from ism_comms.sqlq.shared_queue import SharedQueue
+
+
+class LoadGenerator:
+    """Writes numbered messages, remembering when each one was sent.
+
+    :param payload_size Approximate size in bytes of each message payload.
+    :param sender The sender address written into the messages.
+    :param action The action the inbound messages address.
+    :param clock The clock the send times are read from, time.time to compare them across processes.
+    """
+
+    def __init__(self, payload_size=256, sender='ism_comms_benchmark', action='ActionBenchmarkDummy',
+                 clock=time.perf_counter):
+        self.payload = {'data': 'x' * payload_size}
+        self.sender = sender
+        self.action = action
+        self.clock = clock
+        self.sent = {}
+
+    def message(self, message_id: int) -> dict:
+        return {
+            'message_id': message_id,
+            'sender': self.sender,
+            'sender_id': message_id,
+            'action': self.action,
+            'payload': self.payload,
+            'sent': int(time.time())
+        }
+
+    def write_inbound(self, directory: str, message_ids, message_extension='.json', semaphore_extension='.smp'):
+        """Write a message file then its semaphore for each ID, recording the time each was ready"""
+
+        for message_id in message_ids:
+            path = f'{directory}{os.path.sep}bench{message_id}'
+            with open(f'{path}{message_extension}', 'w') as file:
+                file.write(json.dumps(self.message(message_id)))
+            with open(f'{path}{semaphore_extension}', 'w') as semaphore:
+                semaphore.write('')
+            self.sent[message_id] = self.clock()
+
+    def enqueue(self, shared_queue, recipient: str, message_ids):
+        """Append a message for each ID to a shared sqlq queue in one transaction, recording the time it committed"""
+
+        shared_queue.append([(recipient, json.dumps(self.message(message_id)).encode()) for message_id in message_ids])
+        now = self.clock()
+        for message_id in message_ids:
+            self.sent[message_id] = now
+
+    def due(self, count: int, rate: float, started: float, written: int) -> int:
+        """Return how many more of the count messages are due by now at rate per second, 0 for all at once"""
+
+        if not rate:
+            return count - written
+        return min(count, int((time.perf_counter() - started) * rate) + 1) - written
+
+    def insert_outbound(self, dao, rdbms: str, count: int, recipient='ism_comms_benchmark'):
+        """Insert count pending outbound messages in one transaction"""
+
+        payload = json.dumps(self.payload)
+        execute_many(
+            dao,
+            rdbms,
+            dao.prepare_parameterised_statement(
+                'INSERT INTO messages (recipient, sender, sender_id, action, payload, sent, direction, processed) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+            ),
+            [
+                (recipient, self.sender, sender_id, self.action, payload, 0, 'outbound', 0)
+                for sender_id in range(1, count + 1)
+            ]
+        )
+
+
+def produce(transport: str, target: str, count: int, rate: float, payload_size: int, connection, recipient=None):
+    """Send count messages at rate per second over a transport, then send the times they were sent down connection.
+
+    Meant to run in its own process, see ism_comms.benchmarks.runner.
+
+    :param transport file, to write message files into the target directory, or sqlq,
+    to append to the shared queue at the target path for the recipient.
+    :param connection The sending end of a multiprocessing.Pipe.
+    """
+
+    generator = LoadGenerator(payload_size, clock=time.time)
+    shared_queue = SharedQueue({'path': target, 'name': f'{generator.sender}_producer'}) if transport == 'sqlq' else None
+    written = 0
+    started = time.perf_counter()
+    while written < count:
+        due = generator.due(count, rate, started, written)
+        if due <= 0:
+            time.sleep(.0005)
+            continue
+        message_ids = range(written + 1, written + due + 1)
+        if shared_queue is None:
+            generator.write_inbound(target, message_ids)
+        else:
+            generator.enqueue(shared_queue, recipient, message_ids)
+        written += due
+    if shared_queue is not None:
+        shared_queue.close()
+    connection.send(generator.sent)
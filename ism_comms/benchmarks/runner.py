@@ -0,0 +1,404 @@
+"""Run the end-to-end comms benchmarks and write the results as JSON.
+
+    python -m ism_comms.benchmarks --count 2000 --rate 500 --payload-size 1024 --output run.json
+
+Each run builds a state machine from the properties in ism_comms/benchmarks/resources,
+with the core and file action packs, and drives its main loop on this thread one tick
+at a time rather than starting the ISM thread. The messages table is observed between
+actions, so the timings have no thread scheduling in them and are as precise as the
+action that did the work. The cost of observing is included in the latencies.
+
+Scenarios, run against each RDBMS asked for:
+    * inbound - Drops count message files into the inbound directory at rate per second
+    (0 for all at once) and measures:
+        pickup_latency - From the semaphore being written to the row being inserted.
+        dispatch_latency - From the row being inserted to ActionIoCheckMsgTable marking it processed.
+        insert_rate - Rows per second of time spent in ActionIoFileInbound, i.e. reading,
+        inserting and archiving.
+        throughput - Messages per second from the first written to the last dispatched.
+    * outbound - Inserts count pending outbound rows and measures the rate message files
+    are emitted by ActionIoFileOutbound, per second of wall clock and of action time.
+    * cross_process - With --cross-process, for each transport listed, a producer process
+    sends count messages at rate per second and the same latencies and throughput as
+    inbound are measured, with the send times taken from the wall clock. The file
+    transport's producer writes message files into the inbound directory. The sqlq
+    transport's appends them to a shared queue database, read by ActionIoSqlqInbound,
+    in one transaction per batch due. e.g.
+
+    python -m ism_comms.benchmarks --count 2000 --rate 1000 --cross-process file sqlq
+
+    * durability - With --durability, the inbound and outbound scenarios are run again
+    with [comms][file][durability] set to each mode listed, to compare the messages per
+    second with no syncing, group commit and a sync per file, see
+    ism_comms.file.durability. e.g.
+
+    python -m ism_comms.benchmarks --count 2000 --durability none batch strict
+
+    * sftp_sessions - With --sftp-sessions, the files per second uploaded and read
+    over SFTP by each number of pooled sessions listed, against a local server that
+    delays each request by --sftp-latency seconds. It doesn't use a state machine, so
+    it's run once rather than per RDBMS, see ism_comms.benchmarks.sftp. e.g.
+
+    python -m ism_comms.benchmarks --rdbms sqlite3 --count 200 --sftp-sessions 1 2 4
+
+With --memory each scenario also records peak_memory_mb, the most memory allocated by
+Python on this thread's process at once, as traced by tracemalloc. Tracing slows small
+messages down noticeably, so compare rates from runs without it. --blob-threshold sets
+[comms][blobs][threshold], to compare large payloads inline and spilled to disk. e.g.
+
+    python -m ism_comms.benchmarks --count 20 --payload-size 20000000 --memory --blob-threshold 1048576
+
+mysql is skipped, with the reason in the results, when no server can be reached. Two
+result files can be compared with any JSON diff; the parameters and platform are
+recorded alongside the numbers.
+"""
+
+# Standard library imports
+import argparse
+from datetime import datetime, timezone
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+# Third party imports
+import yaml
+
+# Local application imports
+from ism.ISM import ISM
+from ism_comms.benchmarks.load import LoadGenerator, produce
+from ism_comms.core.store import MessageStore
+from ism_comms.file.durability import MODES
+from ism_comms.sqlq.shared_queue import resolve_path
+
+RESOURCES = f'{os.path.dirname(os.path.abspath(__file__))}{os.path.sep}resources'
+
+# The action that reads each transport's inbound messages
+INBOUND_ACTIONS = {
+    'file': 'ActionIoFileInbound',
+    'sqlq': 'ActionIoSqlqInbound'
+}
+
+
+def percentiles(samples: list) -> dict:
+    """Summarise latencies in seconds as milliseconds"""
+
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def at(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'mean': round(sum(ordered) / len(ordered) * 1000, 3),
+        'p50': at(.5),
+        'p90': at(.9),
+        'p99': at(.99),
+        'max': round(ordered[-1] * 1000, 3)
+    }
+
+
+class Benchmark:
+    """A state machine set up for benchmarking, driven one tick at a time.
+
+    :param rdbms sqlite3 or mysql, picks the properties file from resources.
+    :param password The database password, for mysql.
+    :param file_settings Overrides for the [comms][file] properties, e.g. inbound_batch_size.
+    :param comms_settings Overrides for the other [comms] properties, e.g. blobs.
+    """
+
+    def __init__(self, rdbms: str, password=None, file_settings=None, comms_settings=None):
+        args = {'properties_file': f'{RESOURCES}{os.path.sep}{rdbms}_properties.yaml'}
+        if password:
+            args['database'] = {'password': password}
+        self.ism = ISM(args)
+        self.ism.properties['comms']['file'].update(file_settings or {})
+        self.ism.properties['comms'].update(comms_settings or {})
+        self.ism.import_action_pack('ism_comms.core')
+        self.ism.import_action_pack('ism_comms.file.actions')
+        if 'sqlq' in self.ism.properties['comms']:
+            self.ism.import_action_pack('ism_comms.sqlq.actions')
+        self.rdbms = self.ism.properties['database']['rdbms']
+        self.store = MessageStore(self.ism.dao, self.rdbms)
+        self.actions = {action.__class__.__name__: action for action in self.ism.actions}
+        self.busy = {}
+
+        # Run the STARTING phase, ActionBeforeIoFile creates the directories
+        ticks = 100
+        while self.ism.get_execution_phase() != 'RUNNING' and ticks:
+            self.tick()
+            ticks -= 1
+        self.busy = {}
+
+    def tick(self, observers=None):
+        """Execute every action once, timing each and calling any observer set for it"""
+
+        for action in self.ism.actions:
+            name = action.__class__.__name__
+            started = time.perf_counter()
+            action.execute()
+            self.busy[name] = self.busy.get(name, 0) + time.perf_counter() - started
+            if observers and name in observers:
+                observers[name]()
+
+    def observer(self, inserted: dict, dispatched: dict, clock=time.perf_counter):
+        """Return a callable that records the time rows are first seen inserted and processed"""
+
+        floor = [0]
+
+        def observe():
+            """Time the rows seen inserted or processed since the last look"""
+            now = clock()
+            for message_id, processed in self.ism.dao.execute_sql_query(
+                    self.store.statement(
+                        'SELECT message_id, processed FROM messages WHERE direction = ? AND message_id > ?'
+                    ),
+                    ('inbound', floor[0])
+            ):
+                inserted.setdefault(message_id, now)
+                if processed:
+                    dispatched.setdefault(message_id, now)
+            while floor[0] + 1 in dispatched:
+                floor[0] += 1
+
+        return observe
+
+    def run_inbound(self, count: int, rate: float, payload_size: int, timeout: float) -> dict:
+        generator = LoadGenerator(payload_size)
+        inbound = self.ism.properties['comms']['file']['inbound']
+        inserted = {}
+        dispatched = {}
+        observe = self.observer(inserted, dispatched)
+
+        observers = {'ActionIoFileInbound': observe, 'ActionIoCheckMsgTable': observe}
+        written = 0
+        started = time.perf_counter()
+        while len(dispatched) < count and time.perf_counter() - started < timeout:
+            due = generator.due(count, rate, started, written)
+            if due > 0:
+                generator.write_inbound(inbound, range(written + 1, written + due + 1))
+                written += due
+            self.tick(observers)
+        finished = time.perf_counter()
+
+        inbound_busy = self.busy.get('ActionIoFileInbound', 0)
+        return {
+            'messages': count,
+            'inserted': len(inserted),
+            'dispatched': len(dispatched),
+            'pickup_latency_ms': percentiles([inserted[i] - generator.sent[i] for i in inserted]),
+            'dispatch_latency_ms': percentiles([dispatched[i] - inserted[i] for i in dispatched]),
+            'insert_rate': round(len(inserted) / inbound_busy, 1) if inbound_busy else None,
+            'throughput': round(len(dispatched) / (finished - started), 1),
+            'elapsed_s': round(finished - started, 3),
+            'action_time_s': {name: round(seconds, 3) for name, seconds in self.busy.items()}
+        }
+
+    def run_cross_process(self, transport: str, count: int, rate: float, payload_size: int, timeout: float) -> dict:
+        """Time the messages sent by a producer process over the transport until they're dispatched"""
+
+        inserted = {}
+        dispatched = {}
+        observe = self.observer(inserted, dispatched, time.time)
+        observers = {INBOUND_ACTIONS[transport]: observe, 'ActionIoCheckMsgTable': observe}
+        if transport == 'sqlq':
+            target = self.ism.properties['comms']['sqlq']['path']
+            recipient = self.ism.properties['comms']['sqlq']['name']
+        else:
+            target = self.ism.properties['comms']['file']['inbound']
+            recipient = None
+
+        receiving, sending = multiprocessing.Pipe(duplex=False)
+        producer = multiprocessing.Process(
+            target=produce,
+            args=(transport, target, count, rate, payload_size, sending, recipient),
+            daemon=True
+        )
+        started = time.perf_counter()
+        producer.start()
+        while len(dispatched) < count and time.perf_counter() - started < timeout:
+            self.tick(observers)
+        finished = time.perf_counter()
+        sent = receiving.recv() if receiving.poll(timeout) else {}
+        producer.join(5)
+
+        inbound_busy = self.busy.get(INBOUND_ACTIONS[transport], 0)
+        return {
+            'messages': count,
+            'inserted': len(inserted),
+            'dispatched': len(dispatched),
+            'pickup_latency_ms': percentiles([inserted[i] - sent[i] for i in inserted if i in sent]),
+            'dispatch_latency_ms': percentiles([dispatched[i] - inserted[i] for i in dispatched]),
+            'insert_rate': round(len(inserted) / inbound_busy, 1) if inbound_busy else None,
+            'throughput': round(len(dispatched) / (finished - started), 1),
+            'elapsed_s': round(finished - started, 3),
+            'action_time_s': {name: round(seconds, 3) for name, seconds in self.busy.items()}
+        }
+
+    def run_outbound(self, count: int, payload_size: int, timeout: float) -> dict:
+        LoadGenerator(payload_size).insert_outbound(self.ism.dao, self.rdbms, count)
+        pending_sql = self.store.statement('SELECT COUNT(*) FROM messages WHERE processed = ? AND direction = ?')
+
+        self.busy = {}
+        pending = count
+        started = time.perf_counter()
+        while pending and time.perf_counter() - started < timeout:
+            self.tick()
+            pending = self.ism.dao.execute_sql_query(pending_sql, (0, 'outbound'))[0][0]
+        finished = time.perf_counter()
+
+        outbound = self.ism.properties['comms']['file']['outbound']
+        smp = self.ism.properties['comms']['file']['semaphore_extension']
+        emitted = len([name for name in os.listdir(outbound) if name.endswith(smp)])
+        outbound_busy = self.busy.get('ActionIoFileOutbound', 0)
+        return {
+            'messages': count,
+            'emitted': emitted,
+            'emission_rate': round(emitted / (finished - started), 1),
+            'emission_rate_per_action_second': round(emitted / outbound_busy, 1) if outbound_busy else None,
+            'elapsed_s': round(finished - started, 3),
+            'action_time_s': {name: round(seconds, 3) for name, seconds in self.busy.items()}
+        }
+
+
+def measure(scenario, memory=False) -> dict:
+    """Run a scenario, adding its peak traced memory to the results if memory is set"""
+
+    if not memory:
+        return scenario()
+    tracemalloc.start()
+    try:
+        results = scenario()
+        results['peak_memory_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+    finally:
+        tracemalloc.stop()
+    return results
+
+
+def sqlq_settings(rdbms: str, root_dir: str) -> dict:
+    """[comms][sqlq] for the cross_process scenario, with a new queue database for the run"""
+
+    path = resolve_path(f'sqlq{os.path.sep}benchmark_{rdbms}.db', root_dir)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(f'{path}{suffix}'):
+            os.remove(f'{path}{suffix}')
+    return {'path': path, 'name': 'ism_comms_benchmark', 'outbound': False}
+
+
+def run(rdbms_names, count=1000, rate=0, payload_size=256, timeout=120, password=None, file_settings=None,
+        comms_settings=None, memory=False, cross_process=(), durability=(), sftp_sessions=(),
+        sftp_latency=.005) -> dict:
+    """Run the scenarios against each RDBMS, each scenario on a fresh state machine
+
+    :param cross_process The transports to run the cross_process scenario over, file or sqlq.
+    :param durability The [comms][file][durability] modes to run the durability scenario with.
+    :param sftp_sessions The SFTP session pool sizes to run the sftp_sessions scenario with.
+    :param sftp_latency Seconds the local SFTP server delays each request by.
+    """
+
+    results = {
+        'benchmark': 'ism_comms',
+        'started': datetime.now(timezone.utc).isoformat(),
+        'platform': {
+            'python': platform.python_version(),
+            'system': platform.platform(),
+            'processor': platform.processor() or platform.machine(),
+            'cpus': os.cpu_count()
+        },
+        'parameters': {
+            'count': count,
+            'rate': rate,
+            'payload_size': payload_size,
+            'file_settings': file_settings or {},
+            'comms_settings': comms_settings or {},
+            'cross_process': list(cross_process),
+            'durability': list(durability),
+            'sftp_sessions': list(sftp_sessions),
+            'sftp_latency': sftp_latency
+        },
+        'results': {}
+    }
+    for rdbms in rdbms_names:
+        try:
+            benchmark = Benchmark(rdbms, password, file_settings, comms_settings)
+            inbound = measure(lambda: benchmark.run_inbound(count, rate, payload_size, timeout), memory)
+            benchmark = Benchmark(rdbms, password, file_settings, comms_settings)
+            outbound = measure(lambda: benchmark.run_outbound(count, payload_size, timeout), memory)
+            results['results'][rdbms] = {'inbound': inbound, 'outbound': outbound}
+            for transport in cross_process:
+                settings = dict(comms_settings or {})
+                if transport == 'sqlq':
+                    settings['sqlq'] = sqlq_settings(rdbms, benchmark.ism.properties['runtime']['root_dir'])
+                benchmark = Benchmark(rdbms, password, file_settings, settings)
+                results['results'][rdbms].setdefault('cross_process', {})[transport] = measure(
+                    lambda: benchmark.run_cross_process(transport, count, rate, payload_size, timeout), memory
+                )
+            for mode in durability:
+                settings = {**(file_settings or {}), 'durability': mode}
+                benchmark = Benchmark(rdbms, password, settings, comms_settings)
+                inbound = measure(lambda: benchmark.run_inbound(count, rate, payload_size, timeout), memory)
+                benchmark = Benchmark(rdbms, password, settings, comms_settings)
+                outbound = measure(lambda: benchmark.run_outbound(count, payload_size, timeout), memory)
+                results['results'][rdbms].setdefault('durability', {})[mode] = {'inbound': inbound, 'outbound': outbound}
+        except Exception as e:
+            if rdbms == 'sqlite3':
+                raise
+            results['results'][rdbms] = {'skipped': f'{type(e).__name__}: {e}'}
+    if sftp_sessions:
+        # Imported here as it needs paramiko, which the other scenarios don't
+        from ism_comms.benchmarks.sftp import run_sessions
+        results['results']['sftp_sessions'] = measure(
+            lambda: run_sessions(sftp_sessions, count, payload_size, sftp_latency), memory
+        )
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='End-to-end benchmarks for the ism_comms file action pack')
+    parser.add_argument('--count', type=int, default=1000, help='Messages per scenario')
+    parser.add_argument('--rate', type=float, default=0, help='Inbound messages per second, 0 for all at once')
+    parser.add_argument('--payload-size', type=int, default=256, help='Approximate payload size in bytes')
+    parser.add_argument('--rdbms', nargs='+', default=['sqlite3', 'mysql'], choices=['sqlite3', 'mysql'])
+    parser.add_argument('--password', default=os.environ.get('ISM_BENCHMARK_DB_PASSWORD'),
+                        help='mysql password, defaults to $ISM_BENCHMARK_DB_PASSWORD')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='Override a [comms][file] property, e.g. --set inbound_batch_size=500')
+    parser.add_argument('--blob-threshold', type=int, help='Spill payloads larger than this many bytes to disk')
+    parser.add_argument('--memory', action='store_true', help='Record the peak memory of each scenario')
+    parser.add_argument('--cross-process', nargs='+', default=[], choices=list(INBOUND_ACTIONS),
+                        help='Time messages sent from another process over these transports')
+    parser.add_argument('--durability', nargs='+', default=[], choices=list(MODES),
+                        help='Run the inbound and outbound scenarios again with each file durability mode')
+    parser.add_argument('--sftp-sessions', nargs='+', type=int, default=[],
+                        help='Time SFTP transfers with each of these numbers of pooled sessions')
+    parser.add_argument('--sftp-latency', type=float, default=.005,
+                        help='Seconds the local SFTP server delays each request by')
+    parser.add_argument('--timeout', type=float, default=120, help='Max seconds per scenario')
+    parser.add_argument('--output', help='File to write the JSON results to, defaults to stdout')
+    args = parser.parse_args(argv)
+
+    file_settings = {}
+    for setting in args.set:
+        key, _, value = setting.partition('=')
+        file_settings[key] = yaml.safe_load(value)
+
+    comms_settings = {}
+    if args.blob_threshold:
+        comms_settings['blobs'] = {'threshold': args.blob_threshold}
+
+    results = run(
+        args.rdbms, args.count, args.rate, args.payload_size, args.timeout, args.password, file_settings,
+        comms_settings, args.memory, args.cross_process, args.durability, args.sftp_sessions, args.sftp_latency
+    )
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text)
+    else:
+        sys.stdout.write(f'{text}\n')
+    return results
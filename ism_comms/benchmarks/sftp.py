@@ -0,0 +1,85 @@
+"""Files a second moved over SFTP against the number of sessions in a host's pool.
+
+    python -m ism_comms.benchmarks --rdbms sqlite3 --count 200 --sftp-sessions 1 2 4
+
+For each pool size, count message files are uploaded with their semaphores, then
+claimed, read and removed as ActionIoSftpInbound would, with the work shared between
+the pool's sessions by SessionPool.map(). The host is a LocalSftpServer serving a
+temporary directory on a loopback port, see ism_comms.sftp.tests.server, with each
+request delayed by --sftp-latency seconds to stand in for a remote host. So the rates
+show how well the transfers overlap, not the speed of a real link.
+
+Needs the paramiko package, like the sftp action pack.
+"""
+
+# Standard library imports
+import os
+import tempfile
+import time
+
+# Local application imports
+from ism_comms.sftp.sessions import SessionPool
+from ism_comms.sftp.tests.server import LocalSftpServer
+from ism_comms.sftp.transfers import RemoteInbound, upload
+
+PASSWORD = 'benchmark'
+
+
+def transfer_rates(port: int, sessions: int, count: int, payload: bytes, password=PASSWORD) -> dict:
+    """Upload, then claim and read, count files through a pool of sessions to the server on port.
+
+    :return The files read back, the errors and the files per second each way.
+    """
+
+    pool = SessionPool(
+        'benchmark',
+        {
+            'host': '127.0.0.1',
+            'port': port,
+            'username': 'benchmark',
+            'password': password,
+            'host_key_policy': 'auto_add',
+            'sessions': sessions
+        }
+    )
+    remote = RemoteInbound('/inbound', f'node{sessions}', '.json', '.smp')
+    try:
+        started = time.perf_counter()
+        uploaded = pool.map(
+            lambda sftp, index: upload(sftp, '/inbound', f'benchmark_{sessions}_{index}', payload, '.json', '.smp'),
+            list(range(count))
+        )
+        upload_seconds = time.perf_counter() - started
+
+        with pool.session() as sftp:
+            remote.prepare(sftp)
+            file_names = remote.list_ready(sftp)
+        started = time.perf_counter()
+        read = pool.map(remote.claim_and_read, [(file_name, False) for file_name in file_names])
+        finished = pool.map(remote.finish, file_names)
+        read_seconds = time.perf_counter() - started
+    finally:
+        pool.close()
+
+    return {
+        'sessions': sessions,
+        'files': count,
+        'read': sum(data is not None for _, data, _ in read),
+        'errors': sum(error is not None for *_, error in uploaded + read + finished),
+        'upload_rate': round(count / upload_seconds, 1),
+        'read_rate': round(len(file_names) / read_seconds, 1) if file_names else 0
+    }
+
+
+def run_sessions(sessions, count=200, payload_size=256, latency=.005) -> dict:
+    """Measure transfer_rates() for each pool size against a LocalSftpServer, keyed by the number of sessions"""
+
+    payload = b'x' * payload_size
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(f'{root}{os.path.sep}inbound')
+        server = LocalSftpServer(root, PASSWORD, latency)
+        server.start()
+        try:
+            return {str(size): transfer_rates(server.port, size, count, payload) for size in sessions}
+        finally:
+            server.stop()
@@ -0,0 +1,132 @@
+"""This module tests the ism_comms benchmark suite runs and reports its results.
+
+
+"""
+
+# Standard library imports
+import importlib.util
+import json
+import os
+import tempfile
+import unittest
+
+# Local application imports
+from ism_comms.benchmarks.runner import main, percentiles
+
+
+class TestBenchmarks(unittest.TestCase):
+    """A small run of each scenario, to show the suite still works. The numbers aren't checked."""
+
+    def test_percentiles(self):
+        summary = percentiles([i / 1000 for i in range(1, 101)])
+        self.assertEqual(100, summary['count'])
+        self.assertEqual(51, summary['p50'])
+        self.assertEqual(100, summary['p99'])
+        self.assertEqual(100, summary['max'])
+        self.assertEqual({'count': 0}, percentiles([]))
+
+    def test_benchmark_sqlite3(self):
+        """Run both scenarios on sqlite3 at a set rate and check the JSON written"""
+
+        count = 50
+        with tempfile.TemporaryDirectory() as directory:
+            output = f'{directory}{os.path.sep}results.json'
+            main([
+                '--count', str(count), '--rate', '500', '--rdbms', 'sqlite3',
+                '--set', 'inbound_batch_size=20', '--output', output
+            ])
+            with open(output, 'r') as file:
+                results = json.load(file)
+
+        self.assertEqual({'inbound_batch_size': 20}, results['parameters']['file_settings'])
+        inbound = results['results']['sqlite3']['inbound']
+        self.assertEqual((count, count, count), (inbound['messages'], inbound['inserted'], inbound['dispatched']))
+        self.assertEqual(count, inbound['pickup_latency_ms']['count'])
+        self.assertEqual(count, inbound['dispatch_latency_ms']['count'])
+        self.assertGreater(inbound['insert_rate'], 0)
+        outbound = results['results']['sqlite3']['outbound']
+        self.assertEqual(count, outbound['emitted'])
+        self.assertGreater(outbound['emission_rate'], 0)
+
+    def test_benchmark_blobs_sqlite3(self):
+        """Run with payloads spilled to the blob store and the peak memory recorded"""
+
+        count = 10
+        with tempfile.TemporaryDirectory() as directory:
+            output = f'{directory}{os.path.sep}results.json'
+            main([
+                '--count', str(count), '--payload-size', '5000', '--rdbms', 'sqlite3',
+                '--blob-threshold', '1000', '--memory', '--output', output
+            ])
+            with open(output, 'r') as file:
+                results = json.load(file)
+
+        self.assertEqual({'blobs': {'threshold': 1000}}, results['parameters']['comms_settings'])
+        inbound = results['results']['sqlite3']['inbound']
+        self.assertEqual((count, count), (inbound['inserted'], inbound['dispatched']))
+        self.assertGreater(inbound['peak_memory_mb'], 0)
+        self.assertIn('peak_memory_mb', results['results']['sqlite3']['outbound'])
+
+    def test_benchmark_cross_process_sqlite3(self):
+        """Run the cross_process scenario over the file and sqlq transports"""
+
+        count = 50
+        with tempfile.TemporaryDirectory() as directory:
+            output = f'{directory}{os.path.sep}results.json'
+            main([
+                '--count', str(count), '--rate', '500', '--rdbms', 'sqlite3',
+                '--cross-process', 'file', 'sqlq', '--output', output
+            ])
+            with open(output, 'r') as file:
+                results = json.load(file)
+
+        self.assertEqual(['file', 'sqlq'], results['parameters']['cross_process'])
+        for transport, scenario in results['results']['sqlite3']['cross_process'].items():
+            self.assertEqual(
+                (count, count, count),
+                (scenario['inserted'], scenario['dispatched'], scenario['pickup_latency_ms']['count']),
+                f'expected every message sent over ({transport}) to be timed'
+            )
+            self.assertGreater(scenario['throughput'], 0)
+
+    def test_benchmark_durability_sqlite3(self):
+        """Run the inbound and outbound scenarios under each file durability mode"""
+
+        count = 50
+        with tempfile.TemporaryDirectory() as directory:
+            output = f'{directory}{os.path.sep}results.json'
+            main([
+                '--count', str(count), '--rdbms', 'sqlite3', '--durability', 'none', 'batch', 'strict',
+                '--output', output
+            ])
+            with open(output, 'r') as file:
+                results = json.load(file)
+
+        self.assertEqual(['none', 'batch', 'strict'], results['parameters']['durability'])
+        for mode, scenarios in results['results']['sqlite3']['durability'].items():
+            self.assertEqual(count, scenarios['inbound']['dispatched'], f'expected every message read with ({mode})')
+            self.assertEqual(count, scenarios['outbound']['emitted'], f'expected every message written with ({mode})')
+
+
+    @unittest.skipUnless(importlib.util.find_spec('paramiko'), 'The sftp_sessions scenario needs paramiko')
+    def test_benchmark_sftp_sessions(self):
+        """Run the sftp_sessions scenario with two pool sizes"""
+
+        count = 20
+        with tempfile.TemporaryDirectory() as directory:
+            output = f'{directory}{os.path.sep}results.json'
+            main([
+                '--count', str(count), '--rdbms', 'sqlite3', '--sftp-sessions', '1', '2', '--output', output
+            ])
+            with open(output, 'r') as file:
+                results = json.load(file)
+
+        self.assertEqual([1, 2], results['parameters']['sftp_sessions'])
+        for sessions, scenario in results['results']['sftp_sessions'].items():
+            self.assertEqual(
+                (count, 0), (scenario['read'], scenario['errors']), f'expected ({sessions}) sessions to read every file'
+            )
+            self.assertGreater(scenario['read_rate'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+"""Start the comms runtime before running the transports hosted on it"""
+
+# Application imports
+from ism.core.base_action import BaseAction
+from ism_comms.core.runtime import start_runtime
+
+
+class ActionBeforeIoRuntime(BaseAction):
+    """Start the event loop thread defined under [comms][runtime] in the properties file.
+
+    e.g.
+        comms:
+          runtime:
+            queue_size: 10000
+            workers: 4
+            inbound_budget: 1000
+            outbound_batch_size: 0
+            routes:
+              UnitTest: api
+
+    Does nothing but deactivate itself when [comms][runtime] isn't set. Otherwise the
+    runtime inbound and outbound actions are activated. A transport's Before action may
+    have started the runtime already, in which case the same one is used. See
+    ism_comms.core.runtime.
+    """
+
+    def execute(self):
+
+        if self.active():
+
+            try:
+                runtime = start_runtime(self.properties)
+            except Exception as err:
+                self.logger.error(f'Error starting the comms runtime ({err}).')
+                raise
+
+            if runtime is not None:
+                self.logger.info(f'Comms runtime started with ({runtime.settings.get("workers", 4)}) worker threads')
+                self.activate('ActionIoRuntimeInbound')
+                self.activate('ActionIoRuntimeOutbound')
+
+            # Job done so disable this action, or we'd be stuck in the STARTING phase
+            self.deactivate()
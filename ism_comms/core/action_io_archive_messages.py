@@ -0,0 +1,104 @@
+"""Move processed messages out of the messages table and into messages_archive.
+
+Keeps the messages table that the comms actions poll small, so the cost of polling it
+stays flat however long the ISM has been running.
+"""
+
+# Standard library imports
+import time
+
+# Application imports
+from ism.core.base_action import BaseAction
+from ism_comms.core.store import MessageStore
+
+
+class ActionIoArchiveMessages(BaseAction):
+    """Archive processed messages in bounded chunks.
+
+    Configured under [comms][retention]:
+        * max_age - Archive processed messages received more than this many seconds ago.
+        * max_rows - Archive the oldest processed messages beyond this many, oldest by
+        the time they were received. Inbound message_ids are set by the sender.
+        * chunk_size - Max messages moved per tick. Default 1000.
+        * interval - Seconds between checks once the backlog is cleared. Default 60.
+
+    Nothing is archived unless max_age or max_rows is set.
+    """
+
+    columns = 'message_id, recipient, sender, sender_id, action, payload, sent, received, direction, processed, ' \
+              'priority'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.next_run = 0
+        self.store = None
+
+    def execute(self):
+
+        if self.active():
+
+            retention = self.properties.get('comms', {}).get('retention', {})
+            max_age = retention.get('max_age')
+            max_rows = retention.get('max_rows')
+            if not (max_age or max_rows) or time.time() < self.next_run:
+                return
+            chunk_size = retention.get('chunk_size', 1000)
+
+            self.store = MessageStore(self.dao, self.properties['database']['rdbms'])
+            message_ids = set()
+            if max_age:
+                message_ids.update(self.get_expired_message_ids(int(time.time() - max_age), chunk_size))
+            if max_rows:
+                message_ids.update(self.get_excess_message_ids(max_rows, chunk_size))
+            message_ids = sorted(message_ids)[:chunk_size]
+
+            if message_ids:
+                self.archive_messages(message_ids)
+
+            # Keep going on the next tick if there's more to do, otherwise wait
+            if len(message_ids) < chunk_size:
+                self.next_run = time.time() + retention.get('interval', 60)
+
+    def archive_messages(self, message_ids: list):
+        """Copy the messages to the archive and delete them in one transaction"""
+
+        placeholders = ', '.join('?' * len(message_ids))
+        with self.store.transaction() as cursor:
+            cursor.execute(
+                self.store.statement(
+                    f'INSERT INTO messages_archive ({self.columns}) '
+                    f'SELECT {self.columns} FROM messages WHERE message_id IN ({placeholders})'
+                ),
+                message_ids
+            )
+            cursor.execute(
+                self.store.statement(f'DELETE FROM messages WHERE message_id IN ({placeholders})'),
+                message_ids
+            )
+
+    def get_excess_message_ids(self, max_rows: int, chunk_size: int) -> list:
+        """Return the IDs of the oldest processed messages beyond max_rows"""
+
+        sql = self.store.statement('SELECT COUNT(*) FROM messages WHERE processed = ?')
+        excess = self.dao.execute_sql_query(sql, (1,))[0][0] - max_rows
+        if excess <= 0:
+            return []
+
+        sql = self.store.statement(
+            'SELECT message_id FROM messages WHERE processed = ? ORDER BY received, message_id LIMIT ?'
+        )
+        return [row[0] for row in self.dao.execute_sql_query(sql, (1, min(excess, chunk_size)))]
+
+    def get_expired_message_ids(self, received_before: int, chunk_size: int) -> list:
+        """Return the IDs of processed messages received before the epoch seconds passed in"""
+
+        sql = self.store.statement(
+            {
+                # received is TEXT epoch seconds, compared as text so the index can be used
+                'sqlite3': 'SELECT message_id FROM messages WHERE processed = ? AND received < ? '
+                           'ORDER BY received, message_id LIMIT ?',
+                'mysql': 'SELECT message_id FROM messages WHERE processed = ? AND received < FROM_UNIXTIME(?) '
+                         'ORDER BY received, message_id LIMIT ?'
+            }[self.properties['database']['rdbms'].lower()]
+        )
+        return [row[0] for row in self.dao.execute_sql_query(sql, (1, received_before, chunk_size))]
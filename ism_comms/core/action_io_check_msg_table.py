@@ -3,54 +3,140 @@
 If they have then enable the action addressed by the message and set its payload.
 """
 
-# Standard library imports
-import json
-
 # Application imports
 from ism.core.base_action import BaseAction
+from ism_comms.core.metrics import get_metrics
+from ism_comms.core.scheduler import AdaptivePolling
+from ism_comms.core.store import MessageStore
+
+
+class ActionIoCheckMsgTable(AdaptivePolling, BaseAction):
+    """Dispatch pending inbound messages to the actions they address.
+
+    Messages are grouped by action and each action is activated once per tick, however
+    many messages it has waiting. [comms][dispatch][coalesce] decides what an action
+    with more than one message receives as its payload:
+        * latest - (default) The payload of the most recent of its highest priority
+        messages. The IDs of the messages it replaces are logged as a warning, as
+        they're marked processed.
+        * list - A JSON array of every payload, highest priority first then oldest first.
+        * reject - Only the first message, by priority then age. Further messages, and
+        any message for an action that is still active from an earlier dispatch, stay
+        pending until the action has been deactivated. Active actions are left out of
+        the fetch, so their waiting messages don't fill a bounded batch.
+
+    latest is the default because it keeps the payload a single message, which is what
+    existing actions expect. Actions that can take a burst of messages should use list.
+
+    Messages are ordered by priority, highest first, then by the time they were received,
+    as inbound message_ids are set by the sender. By default every pending message is
+    dispatched each tick. Setting [comms][dispatch][batch_size] bounds the batch, which
+    is then shared between the priority lanes by weight, see
+    ism_comms.core.store.MessageStore.fetch_by_priority(). Lane weights can be set in
+    [comms][dispatch][weights], by priority, and default to the priority plus one. So
+    under a flood of bulk messages a control message waits at most a tick or two. The
+    batch's payloads are set in one transaction and each action is activated with
+    BaseAction.activate(), see dispatch().
+    The time spent and messages dispatched are recorded when [comms][metrics] is set.
 
+    With [comms][polling] set the table is polled adaptively, and the inbound transports
+    wake this action when they've inserted messages, see ism_comms.core.scheduler. A
+    poll is never repeated within a tick, as a second dispatch could replace a payload
+    before the action it was set for has run.
+    """
 
-class ActionIoCheckMsgTable(BaseAction):
+    poll_topic = 'inbound'
+    poll_repeat = False
 
     def execute(self):
 
         if self.active():
+            self.poll(self.dispatch_pending)
 
-            # Look in the messages table
-            sql = self.dao.prepare_parameterised_statement(
-                'SELECT message_id, action, payload FROM messages WHERE processed = ?'
-            )
-            msgs = self.dao.execute_sql_query(
-                sql,
-                (
-                    0,
-                )
-            )
-
-            for msg in msgs:
-
-                # Update the action's payload
-                sql = self.dao.prepare_parameterised_statement(
-                    'UPDATE actions SET payload = ? WHERE action = ?'
-                )
-                self.dao.execute_sql_statement(
-                    sql,
-                    (
-                        json.dumps(msg['payload']),
-                        msg['action']
-                    )
-                )
-                # Enable the test action
-                self.activate(msg['action'])
-
-                # Mark the message as processed
-                sql = self.dao.prepare_parameterised_statement(
-                    'UPDATE messages SET processed = ? WHERE message_id = ?'
-                )
-                self.dao.execute_sql_statement(
-                    sql,
-                    (
-                        True,
-                        msg['message_id']
+    def dispatch_pending(self) -> int:
+        """Dispatch the pending inbound messages, returning the number dispatched"""
+
+        # Look in the messages table
+        metrics = get_metrics(self.properties)
+        store = MessageStore(self.dao, self.properties['database']['rdbms'])
+        settings = self.properties.get('comms', {}).get('dispatch', {})
+        policy = settings.get('coalesce', 'latest')
+        db_started = metrics.clock()
+        busy = self.get_active_actions() if policy == 'reject' else ()
+        if settings.get('batch_size'):
+            msgs = store.fetch_by_priority('inbound', settings['batch_size'], settings.get('weights'), busy)
+        else:
+            msgs = store.fetch_pending('inbound', skip_actions=busy)
+
+        metrics.observe('db_seconds', self.action_name, db_started)
+        metrics.gauge('backlog', self.action_name, len(msgs))
+        if not msgs:
+            return 0
+
+        # Group the messages by the action they address
+        grouped = {}
+        for msg in msgs:
+            grouped.setdefault(msg.action, []).append(msg)
+
+        payloads, message_ids = self.coalesce(grouped, policy)
+        if payloads:
+            db_started = metrics.clock()
+            self.dispatch(store, payloads, message_ids)
+            metrics.observe('db_seconds', self.action_name, db_started)
+            metrics.count('rows', self.action_name, len(message_ids))
+        return len(message_ids)
+
+    def coalesce(self, grouped: dict, policy: str) -> tuple:
+        """Apply the coalescing policy to the grouped messages.
+
+        :return A list of (payload, action) to deliver and the list of message IDs consumed.
+        """
+
+        payloads = []
+        message_ids = []
+
+        if policy == 'reject':
+            # The fetch left out the actions that are still active
+            for action, msgs in grouped.items():
+                payloads.append((msgs[0].payload, action))
+                message_ids.append(msgs[0].message_id)
+            return payloads, message_ids
+
+        for action, msgs in grouped.items():
+            if policy == 'list':
+                payload = f'[{",".join("null" if msg.payload is None else msg.payload for msg in msgs)}]'
+            else:
+                # The most recent of the highest priority messages, they're fetched highest first
+                latest = [msg for msg in msgs if msg.priority == msgs[0].priority][-1]
+                payload = latest.payload
+                if len(msgs) > 1:
+                    self.logger.warning(
+                        f'Delivered message ({latest.message_id}) to ({action}) and dropped the other messages '
+                        f'({", ".join(str(msg.message_id) for msg in msgs if msg is not latest)}). '
+                        f'Set [comms][dispatch][coalesce] to list to deliver them all.'
                     )
-                )
+            payloads.append((payload, action))
+            message_ids.extend(msg.message_id for msg in msgs)
+        return payloads, message_ids
+
+    def dispatch(self, store: MessageStore, payloads: list, message_ids: list):
+        """Set the payloads, activate the actions and then mark the messages processed.
+
+        The payloads are set in one transaction, and the batch is only marked processed
+        once every action has been activated. So a failure part way through leaves the
+        messages pending to be dispatched again, rather than lost.
+        """
+
+        with store.transaction() as cursor:
+            cursor.executemany(store.statement('UPDATE actions SET payload = ? WHERE action = ?'), payloads)
+        for _, action in payloads:
+            self.activate(action)
+        store.mark_processed(message_ids)
+
+    def get_active_actions(self) -> list:
+        """Return the names of the actions that are currently active"""
+
+        sql = MessageStore(self.dao, self.properties['database']['rdbms']).statement(
+            'SELECT action FROM actions WHERE active = ?'
+        )
+        return sorted(row[0] for row in self.dao.execute_sql_query(sql, (1,)) or ())
@@ -0,0 +1,70 @@
+"""Export the comms metrics to a Prometheus textfile, a JSON snapshot or the comms_metrics table"""
+
+# Standard library imports
+import json
+import os
+import time
+
+# Application imports
+from ism.core.base_action import BaseAction
+from ism_comms.core.metrics import get_metrics, write_atomically
+from ism_comms.core.transaction import execute_many
+
+
+class ActionIoExportMetrics(BaseAction):
+    """Write out the metrics recorded by the comms actions, see ism_comms.core.metrics.
+
+    Runs every [comms][metrics][interval] seconds (default 15), and does nothing while
+    metrics are disabled. The files default to ism_comms.prom and ism_comms_metrics.json
+    in the run directory.
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.next_run = 0
+
+    def execute(self):
+
+        if self.active():
+
+            metrics = get_metrics(self.properties)
+            if not metrics.enabled or time.time() < self.next_run:
+                return
+            settings = self.properties['comms']['metrics']
+            self.next_run = time.time() + settings.get('interval', 15)
+            self.export(metrics, settings)
+
+    def export(self, metrics, settings: dict):
+
+        exports = settings.get('export', ['json'])
+        if isinstance(exports, str):
+            exports = [exports]
+
+        for export in exports:
+            try:
+                if export == 'prometheus':
+                    write_atomically(self.path(settings.get('prometheus_file', 'ism_comms.prom')), metrics.prometheus())
+                elif export == 'json':
+                    write_atomically(
+                        self.path(settings.get('json_file', 'ism_comms_metrics.json')),
+                        json.dumps(metrics.snapshot())
+                    )
+                elif export == 'table':
+                    execute_many(
+                        self.dao,
+                        self.properties['database']['rdbms'],
+                        self.dao.prepare_parameterised_statement(
+                            'INSERT INTO comms_metrics (name, action, kind, value, count) VALUES (?, ?, ?, ?, ?)'
+                        ),
+                        metrics.rows()
+                    )
+                else:
+                    self.logger.error(f'Metrics export ({export}) not recognised.')
+            except Exception as e:
+                # Losing a snapshot mustn't stop the comms actions
+                self.logger.error(f'Failed to export metrics to ({export}). ({e})')
+
+    def path(self, path: str) -> str:
+        if os.path.isabs(path):
+            return path
+        return f'{self.properties["runtime"]["run_dir"]}{os.path.sep}{path}'
@@ -0,0 +1,64 @@
+"""Action flushes the messages received by the transports on the comms runtime into the messages table"""
+
+# Application imports
+from ism.core.base_action import BaseAction
+from ism_comms.core.dedup import get_filter
+from ism_comms.core.metrics import get_metrics
+from ism_comms.core.runtime import release_runtime, use_runtime
+from ism_comms.core.scheduler import wake
+from ism_comms.core.store import DUPLICATE, INSERTED, MessageStore
+
+
+class ActionIoRuntimeInbound(BaseAction):
+    """Insert the rows on the comms runtime's inbound queue into the messages table.
+
+    Up to [comms][runtime][inbound_budget] rows (default 1000) are drained per tick and
+    inserted in one transaction. The transports have already answered their senders,
+    so rows that fail to insert are logged and dropped, and duplicates are counted and
+    dropped, as with ActionIoApiInbound.
+
+    When the ISM leaves the RUNNING phase the action lets go of the runtime, which is
+    stopped, closing the servers on it, once ActionIoRuntimeOutbound has let go too.
+    The queue is flushed every tick until then, and whatever was queued before the stop
+    is inserted.
+
+    The action is activated by ActionBeforeIoRuntime when [comms][runtime] is set.
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.runtime = None
+
+    def execute(self):
+
+        if self.active():
+
+            runtime = use_runtime(self.properties, self.action_name)
+            if runtime is None:
+                return
+            self.runtime = runtime
+            self.flush(runtime)
+
+        elif self.runtime is not None:
+            # Deactivated, or the phase has moved on from RUNNING. Keep what's been received until the runtime stops.
+            stopped = release_runtime(self.properties, self.action_name) or not self.runtime.running()
+            while self.flush(self.runtime):
+                pass
+            if stopped:
+                self.runtime = None
+
+    def flush(self, runtime) -> int:
+        """Insert one batch from the queue, and return the number taken"""
+
+        rows = runtime.inbound.drain(self.properties['comms']['runtime'].get('inbound_budget', 1000))
+        if rows:
+            metrics = get_metrics(self.properties)
+            store = MessageStore(self.dao, self.properties['database']['rdbms'])
+            db_started = metrics.clock()
+            statuses = store.insert_unique(rows, self.logger, get_filter(self.properties, store))
+            metrics.observe('db_seconds', self.action_name, db_started)
+            metrics.count('rows', self.action_name, statuses.count(INSERTED))
+            metrics.count('duplicates', self.action_name, statuses.count(DUPLICATE))
+            if INSERTED in statuses:
+                wake(self.properties, 'inbound')
+        return len(rows)
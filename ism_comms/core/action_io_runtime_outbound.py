@@ -0,0 +1,157 @@
+"""Action hands outbound messages from the messages table to the transports on the comms runtime"""
+
+# Standard library imports
+from concurrent.futures import wait
+import time
+
+# Application imports
+from ism.core.base_action import BaseAction
+from ism_comms.core.metrics import get_metrics
+from ism_comms.core.runtime import release_runtime, use_runtime
+from ism_comms.core.scheduler import AdaptivePolling
+from ism_comms.core.store import MessageStore, recipient_filter
+
+
+class ActionIoRuntimeOutbound(AdaptivePolling, BaseAction):
+    """Hand pending outbound messages to the senders registered on the comms runtime.
+
+    Each tick the message_ids the senders have finished with are taken off the
+    runtime's completed queue, and those sent are marked processed in bulk. Then up to
+    [comms][runtime][outbound_batch_size] pending messages (default 0, no limit) that
+    aren't already with a sender are routed and handed over without waiting for them
+    to be sent. A message goes to the transport named for its recipient in
+    [comms][runtime][routes], or [comms][runtime][default_transport], or the only
+    transport registered. Messages a sender doesn't send stay pending and are handed
+    over again on a later tick.
+
+    Messages that can't be sent now are left out of the fetch, so they can't fill a
+    bounded batch and hold up the rest. They are those for recipients without a
+    registered transport, logged once per recipient, and those the transport's sender
+    reports it can't send to, e.g. a server it's backing off from, see
+    ism_comms.core.runtime.CommsRuntime.register_sender().
+
+    When the ISM leaves the RUNNING phase the sends in progress are given up to
+    [comms][runtime][stop_timeout] seconds (default 5) to finish, and those sent are
+    marked processed, before the action lets go of the runtime. Any still with a sender
+    after that may be sent and not marked processed, so are sent again next time and
+    dropped by the receiver as duplicates.
+
+    The action is activated by ActionBeforeIoRuntime when [comms][runtime] is set.
+    Polling adapts to the traffic when [comms][polling] is set, see
+    ism_comms.core.scheduler.
+    """
+
+    poll_topic = 'outbound'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.started = False
+        self.in_flight = set()
+        self.sending = []
+        self.unroutable = set()
+
+    def execute(self):
+
+        if self.active():
+
+            runtime = use_runtime(self.properties, self.action_name)
+            if runtime is None:
+                return
+            self.started = True
+            self.poll(lambda: self.send_messages(runtime))
+
+        elif self.started:
+            # Deactivated, or the phase has moved on from RUNNING. Record whatever has been sent.
+            runtime = use_runtime(self.properties, self.action_name)
+            if runtime is not None:
+                wait(self.sending, runtime.settings.get('stop_timeout', 5))
+                self.complete(runtime)
+            release_runtime(self.properties, self.action_name)
+            self.in_flight.clear()
+            self.sending = []
+            self.started = False
+
+    def complete(self, runtime) -> int:
+        """Mark the messages the senders have sent processed, returning the number"""
+
+        store = MessageStore(self.dao, self.properties['database']['rdbms'])
+        count = 0
+        for handed, sent, send_time, error in runtime.completed.drain():
+            if error is not None:
+                self.logger.error(f'Failed to send messages ({handed}). ({error})')
+            self.in_flight.difference_update(handed)
+            store.mark_processed(sent, sent=send_time)
+            count += len(sent)
+        return count
+
+    def send_messages(self, runtime) -> int:
+        """Record the messages sent and hand over a batch of pending ones, returning the number of either"""
+
+        metrics = get_metrics(self.properties)
+        settings = self.properties['comms']['runtime']
+        db_started = metrics.clock()
+        sent = self.complete(runtime)
+
+        routes = settings.get('routes') or {}
+        default = settings.get('default_transport')
+        if default is None and len(runtime.senders) == 1:
+            default = next(iter(runtime.senders))
+        batch_size = settings.get('outbound_batch_size', 0)
+        store = MessageStore(self.dao, self.properties['database']['rdbms'])
+        results = store.fetch_pending(
+            'outbound',
+            batch_size + len(self.in_flight) if batch_size else 0,
+            **self.recipient_filter(runtime, routes, default)
+        )
+        metrics.observe('db_seconds', self.action_name, db_started)
+        results = [record for record in results if record.message_id not in self.in_flight]
+        metrics.gauge('backlog', self.action_name, len(results))
+        metrics.count('rows', self.action_name, sent)
+        if not results:
+            return sent
+
+        batches = {}
+        for record in results:
+            batches.setdefault(routes.get(record.recipient, default), []).append(record)
+
+        send_time = int(time.time())
+        self.sending = [future for future in self.sending if not future.done()]
+        for transport, records in batches.items():
+            self.in_flight.update(record.message_id for record in records)
+            self.sending.append(runtime.send(transport, records, send_time))
+        return sent + sum(len(records) for records in batches.values())
+
+    def recipient_filter(self, runtime, routes: dict, default) -> dict:
+        """The fetch_pending() arguments that leave out the messages no sender can take now.
+
+        Each recipient's destination is its transport and, if the transport's sender
+        reports its own routes, the destination within it, e.g. a server's origin.
+        """
+
+        transport_routes = {transport: routes_now() for transport, routes_now in runtime.routes.items()}
+        blocked = {
+            (transport, blocked_to)
+            for transport, (_, _, transport_blocked) in transport_routes.items()
+            for blocked_to in transport_blocked
+        }
+
+        def destination(transport, recipient=None):
+            if transport not in runtime.senders:
+                return None
+            if transport not in transport_routes:
+                return transport
+            sender_routes, sender_default, _ = transport_routes[transport]
+            to = sender_routes.get(recipient, sender_default) if recipient is not None else sender_default
+            return None if to is None else (transport, to)
+
+        recipients = set(routes)
+        for sender_routes, _, _ in transport_routes.values():
+            recipients.update(sender_routes)
+        destinations = {recipient: destination(routes.get(recipient, default), recipient) for recipient in recipients}
+        for recipient, to in destinations.items():
+            if to is not None:
+                self.unroutable.discard(recipient)
+            elif recipient not in self.unroutable:
+                self.logger.error(f'No transport on the comms runtime can send to recipient ({recipient}).')
+                self.unroutable.add(recipient)
+        return recipient_filter(destinations, destination(default), blocked)
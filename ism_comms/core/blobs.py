@@ -0,0 +1,157 @@
+"""Keep large message payloads out of the messages table.
+
+A payload is held in the messages table as JSON text, copied into the actions table by
+ActionIoCheckMsgTable and parsed again by the action it's for. That's fine for small
+messages, but a payload of tens of MB bloats the database and is copied and parsed at
+every step. With [comms][blobs][threshold] set, the inbound transports write any
+payload larger than threshold bytes to a content addressed blob store on disk, and
+the message carries a small reference in its place. The JSON codec spills a large
+payload straight from the received bytes, see ism_comms.core.codecs. e.g.
+    comms:
+      blobs:
+        threshold: 1048576
+        directory: blobs
+
+The directory defaults to comms/blobs in the run directory. A blob is named by the
+SHA-256 of its content, so a payload received twice is stored once, and the reference
+is a JSON object, {"$blob": "<sha256>", "size": <bytes>}.
+
+The action the message is for reads its payload with open_payload(), which parses an
+inline payload as usual but turns a reference into a BlobHandle, so the action decides
+whether to memory-map, stream or read the payload:
+
+    payload = open_payload(self.get_payload()[0][0], self.properties)
+    if isinstance(payload, BlobHandle):
+        with payload.open() as stream:
+            ...
+
+Blobs are left on disk when their messages are archived. References are only meaningful
+on this node, so an action forwarding a payload should send its content, not the
+reference.
+"""
+
+# Standard library imports
+from hashlib import sha256
+import json
+import mmap
+import os
+
+# The key that marks a payload as a blob reference
+BLOB_KEY = '$blob'
+
+
+def blob_directory(properties: dict) -> str:
+    """The blob store directory, relative paths are put under the run directory"""
+
+    directory = properties.get('comms', {}).get('blobs', {}).get('directory', 'blobs')
+    if os.path.isabs(directory):
+        return directory
+    sep = os.path.sep
+    return f'{properties["runtime"]["run_dir"]}{sep}comms{sep}{directory}'
+
+
+def get_blob_settings(properties: dict):
+    """Return the threshold and directory to spill payloads with, or None if [comms][blobs][threshold] isn't set"""
+
+    threshold = properties.get('comms', {}).get('blobs', {}).get('threshold')
+    if not threshold:
+        return None
+    return {'threshold': threshold, 'directory': blob_directory(properties)}
+
+
+def blob_path(directory: str, digest: str) -> str:
+    return os.path.join(directory, digest[:2], digest)
+
+
+def put_blob(directory: str, data: bytes) -> str:
+    """Store the data, unless a blob with the same content is already stored.
+
+    :return The SHA-256 hex digest naming the blob.
+    """
+
+    digest = sha256(data).hexdigest()
+    path = blob_path(directory, digest)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_file = f'{path}.{os.getpid()}.tmp'
+        with open(temp_file, 'wb') as file:
+            file.write(data)
+        os.replace(temp_file, path)
+    return digest
+
+
+def spill_payload(payload, settings):
+    """Return the payload, or a reference to it in the blob store if it's larger than the threshold.
+
+    :param payload The payload text from a decoded message, or None.
+    :param settings From get_blob_settings(), None to never spill.
+    """
+
+    if settings is None or payload is None or len(payload) <= settings['threshold']:
+        return payload
+    data = payload.encode()
+    if len(data) <= settings['threshold']:
+        return payload
+    return blob_reference(data, settings)
+
+
+def blob_reference(data, settings) -> str:
+    """Store the encoded payload and return the reference to carry in its place.
+
+    :param data The payload's JSON text as bytes, or a memoryview of them.
+    :param settings From get_blob_settings().
+    """
+
+    return json.dumps({BLOB_KEY: put_blob(settings['directory'], data), 'size': len(data)})
+
+
+class BlobHandle:
+    """A payload left in the blob store, read only when the action asks for it"""
+
+    __slots__ = ('digest', 'size', 'path')
+
+    def __init__(self, directory: str, digest: str, size: int):
+        self.digest = digest
+        self.size = size
+        self.path = blob_path(directory, digest)
+
+    def open(self):
+        """A binary file object, to stream the payload"""
+        return open(self.path, 'rb')
+
+    def mmap(self) -> mmap.mmap:
+        """The payload memory-mapped read only. Close it when done."""
+
+        with self.open() as file:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self) -> bytes:
+        with self.open() as file:
+            return file.read()
+
+    def json(self):
+        """The payload parsed as JSON, as it would have been inline"""
+
+        with self.open() as file:
+            return json.load(file)
+
+
+def open_payload(payload, properties: dict):
+    """Parse a message payload, turning any blob references in it into BlobHandles.
+
+    :param payload The payload text, e.g. from the actions table. A JSON array from
+    [comms][dispatch][coalesce] list can hold a reference per message.
+    """
+
+    if payload is None:
+        return None
+    value = json.loads(payload)
+
+    def resolve(item):
+        if isinstance(item, dict) and len(item) == 2 and BLOB_KEY in item:
+            return BlobHandle(blob_directory(properties), item[BLOB_KEY], item['size'])
+        return item
+
+    if isinstance(value, list):
+        return [resolve(item) for item in value]
+    return resolve(value)
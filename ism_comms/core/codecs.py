@@ -0,0 +1,244 @@
+"""Registry of the codecs used to put comms messages on the wire.
+
+A transport picks its codec by name from its properties, e.g. [comms][file][codec],
+and a reader can pick the decoder from a file's extension. Each codec also names the
+HTTP content type it is sent with.
+
+Codecs convert between bytes and a message dict with the fields:
+    message_id, recipient, sender, sender_id, action, payload, sent, priority
+
+priority is optional, a decoded message without one gets its sender's default (see
+ism_comms.core.store.inbound_row).
+
+The payload is always the JSON text held in the messages table, or None. It is never
+re-encoded on the way out: the JSON codec checks it parses to an object or array and
+splices it into the envelope as is, and the binary codecs carry it as a string field.
+Any other payload text is sent by the JSON codec as a JSON string, so every codec
+decodes to the same field values and types.
+
+decode() takes the blob store settings from ism_comms.core.blobs.get_blob_settings().
+The JSON codec finds a payload object or array larger than the threshold by scanning
+its brackets and strings, writes those bytes to the blob store and parses only the
+rest of the message, so the payload is never held as Python objects. Its content is
+not otherwise checked. The binary codecs leave the payload text for
+ism_comms.core.store.inbound_row() to spill.
+
+    * json - (.json) Human readable, the payload is a JSON object in the message.
+    * msgpack - (.msgpack) Needs the msgpack package.
+    * protobuf - (.pb) Needs the protobuf package. Uses the schema in PROTO_FIELDS.
+"""
+
+# Standard library imports
+import json
+import re
+
+# Application imports
+from ism_comms.core.blobs import blob_reference
+from ism_comms.core.exceptions import CodecNotAvailable
+
+# Message fields in wire order, with their protobuf field types. The sent timestamp is
+# an integer from this package's outbound actions but free text from other senders, so
+# protobuf carries it in a oneof of the two. New fields go on the end to keep the numbers.
+PROTO_FIELDS = (
+    ('message_id', 'TYPE_INT64'),
+    ('recipient', 'TYPE_STRING'),
+    ('sender', 'TYPE_STRING'),
+    ('sender_id', 'TYPE_INT64'),
+    ('action', 'TYPE_STRING'),
+    ('payload', 'TYPE_STRING'),
+    ('sent', 'TYPE_INT64'),
+    ('sent_text', 'TYPE_STRING'),
+    ('priority', 'TYPE_INT64')
+)
+SENT_FIELDS = ('sent', 'sent_text')
+
+# A JSON string or bracket, the tokens scanned to find where a payload ends
+JSON_TOKEN = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]', re.DOTALL)
+JSON_OBJECT_START = re.compile(rb'\s*{')
+JSON_KEY_END = re.compile(rb'\s*:\s*')
+PAYLOAD_KEY = b'"payload"'
+
+
+def find_json_payload(data: bytes):
+    """Return the (start, end) offsets of a JSON message's payload, or None.
+
+    Only a payload object or array is found, and only its strings and brackets are
+    scanned, so it isn't parsed. None is also returned for anything that isn't a JSON
+    object with a complete payload, to be parsed and reported as usual.
+    """
+
+    if not JSON_OBJECT_START.match(data):
+        return None
+    depth = 0
+    start = None
+    for token in JSON_TOKEN.finditer(data):
+        text = token.group()
+        if text in (b'{', b'['):
+            depth += 1
+        elif text in (b'}', b']'):
+            depth -= 1
+            if start is not None and depth == 1:
+                return start, token.end()
+            if depth == 0:
+                return None
+        elif depth == 1 and start is None and text == PAYLOAD_KEY:
+            separator = JSON_KEY_END.match(data, token.end())
+            if separator:
+                if data[separator.end():separator.end() + 1] not in (b'{', b'['):
+                    return None
+                start = separator.end()
+    return None
+
+
+class JsonCodec:
+
+    name = 'json'
+    extension = '.json'
+    content_type = 'application/json'
+
+    @staticmethod
+    def decode(data: bytes, blobs=None) -> dict:
+        if blobs is not None and len(data) > blobs['threshold']:
+            span = find_json_payload(data)
+            if span and span[1] - span[0] > blobs['threshold']:
+                start, end = span
+                message = json.loads(b''.join((data[:start], b'null', data[end:])))
+                message['payload'] = blob_reference(memoryview(data)[start:end], blobs)
+                return message
+        message = json.loads(data)
+        payload = message.get('payload')
+        if payload is not None and not isinstance(payload, str):
+            payload = json.dumps(payload)
+        message['payload'] = payload
+        return message
+
+    @staticmethod
+    def encode(message: dict) -> bytes:
+        payload = message.get('payload')
+        if payload is None:
+            payload = 'null'
+        else:
+            # Only splice text that is a JSON object or array, anything else is sent as a string
+            try:
+                if not isinstance(json.loads(payload), (dict, list)):
+                    raise ValueError
+            except (TypeError, ValueError):
+                payload = json.dumps(payload)
+        envelope = json.dumps({key: value for key, value in message.items() if key != 'payload'})
+        separator = ', ' if len(envelope) > 2 else ''
+        return f'{envelope[:-1]}{separator}"payload": {payload}}}'.encode()
+
+
+class MsgpackCodec:
+
+    name = 'msgpack'
+    extension = '.msgpack'
+    content_type = 'application/msgpack'
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError as e:
+            raise CodecNotAvailable(f'The msgpack codec needs the msgpack package ({e})')
+        self.msgpack = msgpack
+
+    def decode(self, data: bytes, blobs=None) -> dict:
+        return self.msgpack.unpackb(data, raw=False)
+
+    def encode(self, message: dict) -> bytes:
+        return self.msgpack.packb(message, use_bin_type=True)
+
+
+class ProtobufCodec:
+
+    name = 'protobuf'
+    extension = '.pb'
+    content_type = 'application/x-protobuf'
+
+    def __init__(self):
+        try:
+            from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+        except ImportError as e:
+            raise CodecNotAvailable(f'The protobuf codec needs the protobuf package ({e})')
+
+        # Build the message class at runtime so there's no generated code to keep in step.
+        # proto2 so that absent fields, e.g. a null payload, can be told apart from empty ones.
+        file_proto = descriptor_pb2.FileDescriptorProto(
+            name='ism_comms_message.proto',
+            package='ism_comms',
+            syntax='proto2'
+        )
+        message_proto = file_proto.message_type.add(name='Message')
+        message_proto.oneof_decl.add(name='sent_value')
+        for number, (name, field_type) in enumerate(PROTO_FIELDS, start=1):
+            field = message_proto.field.add(
+                name=name,
+                number=number,
+                type=getattr(descriptor_pb2.FieldDescriptorProto, field_type),
+                label=descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL
+            )
+            if name in SENT_FIELDS:
+                field.oneof_index = 0
+        pool = descriptor_pool.DescriptorPool()
+        pool.Add(file_proto)
+        descriptor = pool.FindMessageTypeByName('ism_comms.Message')
+        if hasattr(message_factory, 'GetMessageClass'):
+            self.message_class = message_factory.GetMessageClass(descriptor)
+        else:
+            self.message_class = message_factory.MessageFactory(pool).GetPrototype(descriptor)
+
+    def decode(self, data: bytes, blobs=None) -> dict:
+        message = self.message_class.FromString(data)
+        decoded = {
+            name: getattr(message, name) if message.HasField(name) else None
+            for name, field_type in PROTO_FIELDS
+            if name not in SENT_FIELDS
+        }
+        sent = message.WhichOneof('sent_value')
+        decoded['sent'] = getattr(message, sent) if sent else None
+        return decoded
+
+    def encode(self, message: dict) -> bytes:
+        fields = {}
+        for name, field_type in PROTO_FIELDS:
+            value = None if name in SENT_FIELDS else message.get(name)
+            if value is not None:
+                fields[name] = value if field_type == 'TYPE_INT64' else str(value)
+        sent = message.get('sent')
+        if isinstance(sent, int):
+            fields['sent'] = sent
+        elif sent is not None:
+            fields['sent_text'] = str(sent)
+        return self.message_class(**fields).SerializeToString()
+
+
+CODECS = {
+    JsonCodec.name: JsonCodec,
+    MsgpackCodec.name: MsgpackCodec,
+    ProtobufCodec.name: ProtobufCodec
+}
+
+EXTENSIONS = {codec.extension: name for name, codec in CODECS.items()}
+
+_instances = {}
+
+
+def get_codec(name: str):
+    """Return the shared instance of the named codec"""
+
+    try:
+        return _instances[name]
+    except KeyError:
+        pass
+    try:
+        _instances[name] = CODECS[name.lower()]()
+    except KeyError:
+        raise CodecNotAvailable(f'Message codec ({name}) not recognised')
+    return _instances[name]
+
+
+def get_codec_for_extension(extension: str):
+    """Return the codec for a file extension, e.g. .pb, or None if the extension isn't registered"""
+
+    name = EXTENSIONS.get(extension)
+    return get_codec(name) if name else None
@@ -0,0 +1,91 @@
+"""Suppress duplicate inbound messages.
+
+A sender that re-sends a message, or a crash between committing a batch and archiving
+its files, would otherwise put the same message into the messages table twice, or fail
+the insert on its message_id. Inbound messages are identified by (sender, sender_id),
+which a unique index on the messages table enforces. MessageStore.insert_unique()
+drops rows already in the table and reports them as duplicates rather than failures.
+MySQL has no partial indexes, so there the index is on (sender, sender_id, direction)
+and holds outbound messages to it too.
+
+Looking each message up first would cost a query per message, so a bloom filter of
+the (sender, sender_id) pairs seen so far sits in front of the index. It's built from
+the messages table on first use and answers "definitely new" for most new messages,
+which then go straight into the batch insert. Only the few it reports as possibly seen
+are looked up. e.g.
+    comms:
+      dedup:
+        filter: true
+        capacity: 100000
+        error_rate: 0.01
+
+The filter is rebuilt at twice the capacity once it holds more pairs than capacity.
+Set filter to false to look up every message instead. Duplicates are only caught while
+the first copy is in the messages table, i.e. until ActionIoArchiveMessages moves it.
+"""
+
+# Standard library imports
+from hashlib import blake2b
+import math
+
+# Bloom filters, by run directory
+_filters = {}
+
+
+class BloomFilter:
+    """A fixed size set of keys that answers membership with no false negatives.
+
+    :param capacity Number of keys it's sized for.
+    :param error_rate The false positive rate at capacity.
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.01):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.size = max(8, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key: tuple):
+        """The bit positions for a key, by double hashing one digest"""
+
+        digest = blake2b(repr(key).encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        for index in range(self.hashes):
+            yield (first + index * second) % self.size
+
+    def add(self, key: tuple):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: tuple) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+
+def message_key(row: tuple) -> tuple:
+    """The (sender, sender_id) identifying an inbound row from inbound_row()"""
+    return row[1], int(row[2])
+
+
+def get_filter(properties: dict, store):
+    """Return the bloom filter for this run, built from the messages table, or None if [comms][dedup][filter] is off.
+
+    :param store The MessageStore to build it from.
+    """
+
+    settings = properties.get('comms', {}).get('dedup', {})
+    if not settings.get('filter', True):
+        return None
+    key = properties['runtime']['run_dir']
+    seen = _filters.get(key)
+    if seen is None or seen.count > seen.capacity:
+        capacity = settings.get('capacity', 100000)
+        if seen is not None:
+            capacity = max(capacity, seen.capacity * 2)
+        seen = _filters[key] = BloomFilter(capacity, settings.get('error_rate', 0.01))
+        for sender, sender_id in store.inbound_keys():
+            seen.add((sender, int(sender_id)))
+    return seen
@@ -0,0 +1,8 @@
+"""Custom Exceptions for the state machine ism_comms.core modules"""
+
+
+class CodecNotAvailable(Exception):
+
+    def __init__(self, message='Message codec not recognised or its package is not installed'):
+        self.message = message
+        super().__init__(self.message)
@@ -0,0 +1,219 @@
+"""Counters, gauges and histograms recorded on the comms actions' hot paths.
+
+The transport actions record what each tick did, e.g. scan time, files seen, bytes
+read, decode time, DB time, rows affected and backlog depth, labelled with the action
+that did it. ActionIoExportMetrics writes them out every [comms][metrics][interval]
+seconds (default 15) in the formats listed in [comms][metrics][export]:
+
+    * prometheus - A textfile for the node exporter's textfile collector, at
+    [comms][metrics][prometheus_file].
+    * json - A snapshot of every metric, at [comms][metrics][json_file].
+    * table - A row per metric in the comms_metrics table.
+
+e.g.
+    comms:
+      metrics:
+        enabled: true
+        interval: 15
+        export: [prometheus, json]
+        prometheus_file: /var/lib/node_exporter/ism_comms.prom
+
+Relative file paths are put under the run directory. Metrics are off unless
+[comms][metrics] is set, and then get_metrics() hands out NULL_METRICS, whose methods
+do nothing, so the cost of leaving the calls in is a few no-op calls per tick.
+"""
+
+# Standard library imports
+from bisect import bisect_left
+import json
+import os
+import time
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+# Metric name prefix and help text, by metric name
+PREFIX = 'ism_comms_'
+HELP = {
+    'tick_seconds': 'Time spent in ticks that did some work',
+    'scan_seconds': 'Time spent looking for inbound files',
+    'decode_seconds': 'Time spent reading and decoding messages',
+    'encode_seconds': 'Time spent encoding and writing messages',
+    'db_seconds': 'Time spent in the database',
+    'files_seen': 'Inbound files found ready to read',
+    'bytes_read': 'Bytes of inbound messages read',
+    'bytes_written': 'Bytes of outbound messages written',
+    'rows': 'Messages inserted, sent or dispatched',
+    'quarantined': 'Inbound files that could not be decoded',
+    'duplicates': 'Inbound messages dropped as already received',
+    'backlog': 'Messages or files found waiting at the last tick',
+    'queue_depth': 'Decoded files waiting to be inserted',
+    'in_flight': 'Files held by the decode pool',
+    'poll_interval': 'Seconds until the next poll, after backing off'
+}
+
+_registries = {}
+
+
+class Histogram:
+    """Cumulative bucket counts, plus the count and sum of the observations"""
+
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """The metrics recorded for one state machine, keyed by (metric name, action name)"""
+
+    enabled = True
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def clock() -> float:
+        return time.perf_counter()
+
+    def count(self, name: str, action: str, value=1):
+        key = (name, action)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name: str, action: str, value):
+        self.gauges[(name, action)] = value
+
+    def observe(self, name: str, action: str, started: float):
+        """Record the seconds since started, a value from clock()"""
+
+        key = (name, action)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(time.perf_counter() - started)
+
+    def snapshot(self) -> dict:
+        """Every metric as plain data, e.g. for JSON"""
+
+        return {
+            'time': time.time(),
+            'counters': [
+                {'name': name, 'action': action, 'value': value}
+                for (name, action), value in sorted(self.counters.items())
+            ],
+            'gauges': [
+                {'name': name, 'action': action, 'value': value}
+                for (name, action), value in sorted(self.gauges.items())
+            ],
+            'histograms': [
+                {
+                    'name': name,
+                    'action': action,
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'buckets': dict(zip([*map(str, BUCKETS), '+Inf'], cumulative(histogram.counts)))
+                }
+                for (name, action), histogram in sorted(self.histograms.items())
+            ]
+        }
+
+    def prometheus(self) -> str:
+        """Every metric in the Prometheus text exposition format"""
+
+        lines = []
+        for kind, metrics in (('counter', self.counters), ('gauge', self.gauges), ('histogram', self.histograms)):
+            names = sorted({name for name, action in metrics})
+            for name in names:
+                suffix = '_total' if kind == 'counter' else ''
+                metric = f'{PREFIX}{name}{suffix}'
+                lines.append(f'# HELP {metric} {HELP.get(name, name)}')
+                lines.append(f'# TYPE {metric} {kind}')
+                for (metric_name, action), value in sorted(metrics.items()):
+                    if metric_name != name:
+                        continue
+                    label = f'action="{action}"'
+                    if kind != 'histogram':
+                        lines.append(f'{metric}{{{label}}} {value}')
+                        continue
+                    for bound, total in zip([*map(str, BUCKETS), '+Inf'], cumulative(value.counts)):
+                        lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {total}')
+                    lines.append(f'{metric}_sum{{{label}}} {value.sum}')
+                    lines.append(f'{metric}_count{{{label}}} {value.count}')
+        return '\n'.join(lines) + '\n'
+
+    def rows(self) -> list:
+        """Every metric as (name, action, kind, value, count) rows for the comms_metrics table.
+
+        Histograms are stored as their sum and count.
+        """
+
+        return [
+            *((name, action, 'counter', value, None) for (name, action), value in sorted(self.counters.items())),
+            *((name, action, 'gauge', value, None) for (name, action), value in sorted(self.gauges.items())),
+            *(
+                (name, action, 'histogram', histogram.sum, histogram.count)
+                for (name, action), histogram in sorted(self.histograms.items())
+            )
+        ]
+
+
+class NullMetrics:
+    """Stands in for Metrics when they're disabled, so recording costs next to nothing"""
+
+    enabled = False
+
+    @staticmethod
+    def clock() -> float:
+        return 0.0
+
+    def count(self, name, action, value=1):
+        pass
+
+    def gauge(self, name, action, value):
+        pass
+
+    def observe(self, name, action, started):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+def cumulative(counts: list) -> list:
+    total = 0
+    totals = []
+    for count in counts:
+        total += count
+        totals.append(total)
+    return totals
+
+
+def get_metrics(properties: dict):
+    """Return the metrics for this run, or NULL_METRICS if [comms][metrics] isn't enabled"""
+
+    settings = properties.get('comms', {}).get('metrics')
+    if not settings or not settings.get('enabled', True):
+        return NULL_METRICS
+    key = properties['runtime']['run_dir']
+    metrics = _registries.get(key)
+    if metrics is None:
+        metrics = _registries[key] = Metrics()
+    return metrics
+
+
+def write_atomically(path: str, text: str):
+    """Write the file under a temporary name then rename it, so readers never see it part written"""
+
+    temp_file = f'{path}.tmp'
+    with open(temp_file, 'w') as file:
+        file.write(text)
+    os.replace(temp_file, path)
@@ -0,0 +1,283 @@
+"""An asyncio event loop that hosts the network transports of one state machine.
+
+The ISM runs each action once per tick on its own thread, so a transport written as an
+action can only move messages once a tick, and only while no other action is running.
+With [comms][runtime] set, transports that support it run as coroutines on one event
+loop in a background thread instead, e.g. the HTTP API server and client. They serve
+every connection concurrently, whatever the ISM is doing, and only meet the ISM thread
+at two queues:
+
+    * inbound - Transports put the rows of the messages they receive, see
+    ism_comms.core.store.inbound_row(), and ActionIoRuntimeInbound drains them into the
+    messages table in batches.
+    * outbound - ActionIoRuntimeOutbound hands each batch of pending outbound messages
+    to the sender the transport registered, and drains the IDs of those sent back from
+    the completed queue to mark them processed.
+
+e.g.
+    comms:
+      runtime:
+        queue_size: 10000
+        workers: 4
+        inbound_budget: 1000
+        routes:
+          UnitTest: api
+
+Both queues are bounded by queue_size. A transport that can't wait, e.g. one that must
+answer a request, uses put_nowait() and tells the sender to retry, one that can awaits
+put(). Blocking calls, e.g. file IO, are run with run_blocking() in a pool of at most
+workers threads (default 4), so the thread count stays the same however many
+connections are open.
+
+The runtime is started by ActionBeforeIoRuntime, or by the first transport's Before
+action to ask for it. The runtime actions each hold it with use_runtime() and let go
+with release_runtime() when the ISM leaves the RUNNING phase, and it's stopped once
+the last of them has, so neither stops it while the other still needs it. Anything
+still running when the process exits is stopped at exit, and tests can call
+stop_runtime() after ism.stop().
+"""
+
+# Standard library imports
+import asyncio
+import atexit
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+
+_runtimes = {}
+
+
+def start_runtime(properties: dict):
+    """Start the runtime for this run if [comms][runtime] is set, returning it, or None.
+
+    Returns the running one if it's already been started.
+    """
+
+    settings = properties.get('comms', {}).get('runtime')
+    if settings is None:
+        return None
+    key = properties['runtime']['run_dir']
+    runtime = _runtimes.get(key)
+    if runtime is None or not runtime.running():
+        runtime = _runtimes[key] = CommsRuntime(settings)
+        runtime.start()
+    return runtime
+
+
+def get_runtime(properties: dict):
+    """Return the runtime started for this run, or None"""
+    return _runtimes.get(properties['runtime']['run_dir'])
+
+
+def use_runtime(properties: dict, user: str):
+    """Return the runtime started for this run, or None, holding it for user until release_runtime()"""
+
+    runtime = get_runtime(properties)
+    if runtime is not None:
+        runtime.users.add(user)
+    return runtime
+
+
+def release_runtime(properties: dict, user: str) -> bool:
+    """Let go of the runtime for user, stopping it if no other user holds it.
+
+    :return True if the runtime has stopped, or there wasn't one.
+    """
+
+    runtime = get_runtime(properties)
+    if runtime is None:
+        return True
+    runtime.users.discard(user)
+    if runtime.users:
+        return False
+    stop_runtime(properties)
+    return True
+
+
+def stop_runtime(properties: dict):
+    runtime = _runtimes.pop(properties['runtime']['run_dir'], None)
+    if runtime is not None:
+        runtime.stop()
+
+
+@atexit.register
+def stop_all():
+    """Stop every runtime still running when the process exits"""
+
+    while _runtimes:
+        _, runtime = _runtimes.popitem()
+        runtime.stop()
+
+
+class BatchQueue:
+    """A bounded queue shared by the event loop and the ISM thread, taken from in batches.
+
+    Unlike queue.Queue, a coroutine can wait for room with put() without blocking the
+    loop, and drain() takes a whole batch under one lock.
+
+    :param maxsize Most items held at once.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.waiters = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def put_nowait(self, item):
+        """Add an item from any thread.
+
+        :raises queue.Full if there's no room.
+        """
+
+        with self.lock:
+            if len(self.items) >= self.maxsize:
+                raise queue.Full
+            self.items.append(item)
+
+    async def put(self, item):
+        """Add an item from a coroutine, waiting for room if the queue is full"""
+
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                if len(self.items) < self.maxsize:
+                    self.items.append(item)
+                    return
+                waiter = loop.create_future()
+                self.waiters.append((loop, waiter))
+            await waiter
+
+    def drain(self, limit=0) -> list:
+        """Take up to limit items (0, all of them) without blocking, and wake any put() waiting for room"""
+
+        with self.lock:
+            count = min(limit, len(self.items)) if limit else len(self.items)
+            batch = [self.items.popleft() for _ in range(count)]
+            waiters = self.waiters if batch else []
+            if batch:
+                self.waiters = []
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(release, waiter)
+            except RuntimeError:
+                # The loop has closed
+                pass
+        return batch
+
+
+def release(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class CommsRuntime:
+    """One event loop thread, its queues and its pool of threads for blocking calls.
+
+    :param settings The [comms][runtime] properties.
+    """
+
+    def __init__(self, settings: dict):
+        self.settings = settings
+        self.inbound = BatchQueue(settings.get('queue_size', 10000))
+        self.completed = BatchQueue(settings.get('queue_size', 10000))
+        self.senders = {}
+        self.routes = {}
+        self.users = set()
+        self.loop = None
+        self.thread = None
+        self.executor = None
+        self.stop_hooks = []
+
+    def start(self, timeout=5):
+        """Start the event loop thread and wait until it's running"""
+
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(ready,), name='ism_comms_runtime', daemon=True)
+        self.thread.start()
+        ready.wait(timeout)
+
+    def run(self, ready: threading.Event):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.executor = ThreadPoolExecutor(self.settings.get('workers', 4), thread_name_prefix='ism_comms_runtime')
+        self.loop.set_default_executor(self.executor)
+        self.loop.call_soon(ready.set)
+        try:
+            self.loop.run_forever()
+        finally:
+            for hook in reversed(self.stop_hooks):
+                try:
+                    self.loop.run_until_complete(hook())
+                except Exception:
+                    pass
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self.executor.shutdown(wait=False)
+            self.loop.close()
+
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def stop(self):
+        """Run the stop hooks, cancel every task and end the thread"""
+
+        if not self.running():
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(self.settings.get('stop_timeout', 5))
+
+    def on_stop(self, hook):
+        """Have a coroutine function awaited when the runtime stops, e.g. to close a server. Last added runs first."""
+        self.stop_hooks.append(hook)
+
+    def spawn(self, coroutine):
+        """Schedule a coroutine on the loop from any thread, returning a concurrent.futures.Future for its result"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def call(self, coroutine, timeout=None):
+        """Run a coroutine on the loop from another thread and wait for its result"""
+        return self.spawn(coroutine).result(timeout)
+
+    async def run_blocking(self, function, *args):
+        """Await a blocking call made in the runtime's thread pool"""
+        return await self.loop.run_in_executor(self.executor, function, *args)
+
+    def register_sender(self, transport: str, sender, routes=None):
+        """Register the coroutine function that sends a transport's outbound messages.
+
+        sender(records, send_time) is awaited with a list of OutboundRecords and the time
+        to stamp them with, and returns the message_ids sent. Any it leaves out stay
+        pending and are handed over again.
+
+        :param routes Optional. Called on the ISM thread, returns the transport's
+        (routes, default, blocked), as passed to ism_comms.core.store.recipient_filter(),
+        so messages it can't send now aren't fetched and handed to it.
+        """
+        self.senders[transport] = sender
+        if routes is not None:
+            self.routes[transport] = routes
+
+    def send(self, transport: str, records: list, send_time: int):
+        """Hand a batch of outbound messages to a transport's sender from the ISM thread.
+
+        (message_ids handed over, message_ids sent, send_time, error) is put on the
+        completed queue once the sender returns, with none sent and the error if it raises.
+        """
+
+        async def send_batch():
+            sent, error = [], None
+            try:
+                sent = list(await self.senders[transport](records, send_time))
+            except Exception as e:
+                error = e
+            await self.completed.put(([record.message_id for record in records], sent, send_time, error))
+
+        return self.spawn(send_batch())
@@ -0,0 +1,115 @@
+"""Adaptive polling for the comms actions.
+
+The ISM runs every active action on every tick, so by default a comms action scans
+its directory or queries the messages table on every tick, even after hours with
+nothing to do. Setting [comms][polling] makes the actions that use AdaptivePolling
+pace themselves instead:
+
+    * idle backoff - A poll that finds nothing delays the next one by min_interval
+    seconds, doubling (times backoff) after each further empty poll up to max_interval.
+    * busy drain - A poll that finds work is repeated straight away, within the same
+    tick for up to drain_budget seconds, then on the following ticks until a poll
+    comes back empty.
+    * wake - wake(properties, topic) makes the actions polling that topic poll on their
+    next tick whatever their backoff. e.g. an action that inserts an outbound message
+    can call wake(self.properties, 'outbound') so it goes out without waiting.
+
+e.g.
+    comms:
+      polling:
+        min_interval: 0.01
+        max_interval: 1
+        backoff: 2
+        drain_budget: 0.05
+
+The topics are 'inbound', woken by the inbound transports once they've inserted
+messages for ActionIoCheckMsgTable to dispatch, and 'outbound', for the outbound
+transports. A skipped tick costs a clock read, and the action's own active() check
+still runs on every tick so deactivating it takes effect straight away.
+"""
+
+# Standard library imports
+import time
+
+# Application imports
+from ism_comms.core.metrics import get_metrics
+
+# Wake counts, by run directory then topic
+_signals = {}
+
+
+def wake(properties: dict, topic: str):
+    """Have the actions polling the topic poll on their next tick"""
+
+    signals = _signals.setdefault(properties['runtime']['run_dir'], {})
+    signals[topic] = signals.get(topic, 0) + 1
+
+
+class AdaptivePolling:
+    """Mixin for comms actions that poll for work, listed before BaseAction.
+
+    The action passes its poll to self.poll() rather than calling it directly. The
+    poll returns the number of messages or files it found, and poll() decides whether
+    it's due and how soon to call it again. Without [comms][polling] the poll is
+    called once on every tick, as before.
+    """
+
+    # The topic passed to wake() to cut short this action's backoff, None for none
+    poll_topic = None
+
+    # Whether a poll that found work can be repeated within the same tick
+    poll_repeat = True
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.poll_interval = 0.0
+        self.next_poll = 0.0
+        self.wakes_seen = 0
+
+    def poll(self, work) -> int:
+        """Call work() if a poll is due, and again while it finds work and the drain budget lasts.
+
+        :param work Callable making one poll and returning the number of items it found.
+        :return The number of items found this tick.
+        """
+
+        settings = self.properties.get('comms', {}).get('polling')
+        if not settings or not settings.get('enabled', True):
+            return work() or 0
+
+        started = time.monotonic()
+        if not self.woken() and started < self.next_poll:
+            return 0
+
+        budget = settings.get('drain_budget', 0) if self.poll_repeat else 0
+        total = 0
+        while True:
+            found = work() or 0
+            total += found
+            if not found or time.monotonic() - started >= budget:
+                break
+
+        if found:
+            self.poll_interval = 0.0
+        elif total or not self.poll_interval:
+            # Drained, or the first empty poll since there was work
+            self.poll_interval = settings.get('min_interval', 0.01)
+        else:
+            self.poll_interval = min(
+                self.poll_interval * settings.get('backoff', 2),
+                settings.get('max_interval', 1)
+            )
+        self.next_poll = time.monotonic() + self.poll_interval
+        get_metrics(self.properties).gauge('poll_interval', self.action_name, self.poll_interval)
+        return total
+
+    def woken(self) -> bool:
+        """True if wake() has been called for this action's topic since it last looked"""
+
+        if self.poll_topic is None:
+            return False
+        wakes = _signals.get(self.properties['runtime']['run_dir'], {}).get(self.poll_topic, 0)
+        if wakes == self.wakes_seen:
+            return False
+        self.wakes_seen = wakes
+        return True
@@ -0,0 +1,498 @@
+"""Access to the messages table shared by every comms transport.
+
+The transport actions all need the same few operations on the messages table, e.g.
+insert a batch of inbound messages, fetch the pending outbound ones and mark a batch
+processed. MessageStore keeps them in one place so a new transport gets batched,
+indexed access without writing any SQL of its own.
+
+    store = MessageStore(self.dao, self.properties['database']['rdbms'])
+    for record in store.fetch_pending('outbound', batch_size):
+        send(record.recipient, codec.encode(record.message(send_time)))
+    store.mark_processed(sent_ids, sent=send_time)
+
+Statements are prepared for the RDBMS once and cached, so the per tick cost is the
+query alone. Pending messages come back as OutboundRecord and InboundRecord objects,
+which use __slots__ to keep a large batch compact, rather than bare tuples.
+
+Each message has a priority, higher first, taken from the message or else from its
+sender's default in [comms][priority] and stored in the priority column. e.g.
+    comms:
+      priority:
+        default: 0
+        senders:
+          ops_console: 10
+
+Pending messages are fetched highest priority first. fetch_by_priority() treats each
+priority as a lane and shares a bounded batch between the lanes by weight, so a flood
+in one lane can't hold up the others.
+
+Inbound transports insert with insert_unique(), which drops messages already received
+from the same (sender, sender_id), see ism_comms.core.dedup.
+
+The schema files create the messages table IF NOT EXISTS, so a table made by an earlier
+release keeps its old definition. Each pack's Before action calls upgrade() to add the
+priority column and the indexes such a table is missing.
+"""
+
+# Application imports
+from ism_comms.core.blobs import spill_payload
+from ism_comms.core.dedup import message_key
+from ism_comms.core.transaction import execute_many, transaction
+
+# Max message IDs in one "... WHERE message_id IN (...)"
+UPDATE_CHUNK_SIZE = 500
+
+# The columns an inbound transport fills in, in the order inbound_row() returns them
+INBOUND_COLUMNS = ('message_id', 'sender', 'sender_id', 'action', 'payload', 'sent', 'priority')
+
+# Most priority lanes looked for by fetch_by_priority()
+MAX_LANES = 32
+
+# The outcome of insert_unique() for each row
+INSERTED = 'inserted'
+DUPLICATE = 'duplicate'
+FAILED = 'failed'
+
+# Statements prepared for each RDBMS, keyed by (rdbms, sql)
+_statements = {}
+
+
+def inbound_row(message: dict, priorities=None, blobs=None) -> tuple:
+    """Return the params to insert a decoded inbound message, in INBOUND_COLUMNS order.
+
+    :param priorities The [comms][priority] properties, for a message without a priority.
+    :param blobs From ism_comms.core.blobs.get_blob_settings(), to spill a large payload to the blob store.
+    """
+
+    priority = message.get('priority')
+    if priority is None:
+        priorities = priorities or {}
+        priority = priorities.get('senders', {}).get(message['sender'], priorities.get('default', 0))
+    return (
+        message['message_id'],
+        message['sender'],
+        message['sender_id'],
+        message['action'],
+        spill_payload(message['payload'], blobs),
+        message['sent'],
+        int(priority)
+    )
+
+
+def recipient_filter(routes: dict, default=None, blocked=()) -> dict:
+    """The fetch_pending() arguments that leave out the messages a transport can't send now.
+
+    :param routes The destination of each recipient with one of its own, e.g. a host or URL.
+    :param default The destination of every other recipient, None if they have none.
+    :param blocked The destinations that can't be sent to now, e.g. while backing off.
+    :return recipients or exclude, to pass to fetch_pending() as keyword arguments.
+    """
+
+    unavailable = [recipient for recipient, to in routes.items() if to is None or to in blocked]
+    if default is None or default in blocked:
+        return {'recipients': [recipient for recipient in routes if recipient not in unavailable]}
+    return {'exclude': unavailable}
+
+
+def lane_weight(priority: int, weights=None) -> int:
+    """The share of a batch given to a priority lane, from [comms][dispatch][weights] or priority + 1"""
+
+    weight = (weights or {}).get(priority)
+    return max(1, priority + 1 if weight is None else weight)
+
+
+class OutboundRecord:
+    """A pending outbound message, as returned by MessageStore.fetch_pending('outbound')"""
+
+    __slots__ = ('message_id', 'recipient', 'sender', 'sender_id', 'action', 'payload', 'priority')
+
+    def __init__(self, message_id, recipient, sender, sender_id, action, payload, priority=0):
+        self.message_id = message_id
+        self.recipient = recipient
+        self.sender = sender
+        self.sender_id = sender_id
+        self.action = action
+        self.payload = payload
+        self.priority = priority
+
+    def message(self, sent) -> dict:
+        """Return the message to encode for sending, stamped with the time it was sent.
+
+        The priority is left out at the default of 0, so those messages are unchanged for older readers.
+        """
+
+        message = {
+            "message_id": self.message_id,
+            "recipient": self.recipient,
+            "sender": self.sender,
+            "sender_id": self.sender_id,
+            "action": self.action,
+            "payload": self.payload,
+            "sent": sent
+        }
+        if self.priority:
+            message["priority"] = self.priority
+        return message
+
+
+class InboundRecord:
+    """A pending inbound message, as returned by MessageStore.fetch_pending('inbound')"""
+
+    __slots__ = ('message_id', 'action', 'payload', 'priority')
+
+    def __init__(self, message_id, action, payload, priority=0):
+        self.message_id = message_id
+        self.action = action
+        self.payload = payload
+        self.priority = priority
+
+
+# The columns and indexes added to the messages table since it was first released, see MessageStore.upgrade()
+UPGRADE_COLUMNS = {
+    'priority': 'ALTER TABLE messages ADD COLUMN priority INTEGER NOT NULL DEFAULT 0'
+}
+UPGRADE_INDEXES = {
+    'sqlite3': {
+        'messages_pending':
+            'CREATE INDEX IF NOT EXISTS messages_pending ON messages (direction, priority DESC, received) '
+            'WHERE processed = 0',
+        'messages_received': 'CREATE INDEX IF NOT EXISTS messages_received ON messages (received) WHERE processed = 1',
+        'messages_sender':
+            'CREATE UNIQUE INDEX IF NOT EXISTS messages_sender ON messages (sender, sender_id) '
+            "WHERE direction = 'inbound'"
+    },
+    'mysql': {
+        'messages_pending': 'CREATE INDEX messages_pending ON messages (processed, direction(16), priority, received)',
+        'messages_received': 'CREATE INDEX messages_received ON messages (processed, received)',
+        'messages_sender': 'CREATE UNIQUE INDEX messages_sender ON messages (sender(191), sender_id, direction(16))'
+    }
+}
+
+# The queries listing the columns and the indexes the messages table has
+SCHEMA_QUERIES = {
+    'sqlite3': (
+        "SELECT name FROM pragma_table_info('messages')",
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'messages'"
+    ),
+    'mysql': (
+        "SELECT COLUMN_NAME FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'messages'",
+        "SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'messages'"
+    )
+}
+
+# The columns selected and record type for the pending messages in each direction
+PENDING = {
+    'outbound': ('message_id, recipient, sender, sender_id, action, payload, priority', OutboundRecord),
+    'inbound': ('message_id, action, payload, priority', InboundRecord)
+}
+
+
+class MessageStore:
+    """The messages table operations used by the transport actions.
+
+    :param dao The ISM DAO in use by the action.
+    :param rdbms The RDBMS name from the properties file. e.g. sqlite3 or mysql.
+    """
+
+    def __init__(self, dao, rdbms: str):
+        self.dao = dao
+        self.rdbms = rdbms.lower()
+
+    def statement(self, sql: str) -> str:
+        """Return the statement prepared for this RDBMS, preparing it on first use"""
+
+        key = (self.rdbms, sql)
+        prepared = _statements.get(key)
+        if prepared is None:
+            prepared = _statements[key] = self.dao.prepare_parameterised_statement(sql)
+        return prepared
+
+    def transaction(self):
+        """Context manager yielding a cursor, committed as one transaction, see ism_comms.core.transaction"""
+        return transaction(self.dao, self.rdbms)
+
+    def upgrade(self, logger) -> list:
+        """Add the columns and indexes missing from a messages table created by an earlier release.
+
+        Each is added in its own transaction, the columns first as the indexes use them.
+        One that fails, e.g. the unique messages_sender index over rows received twice,
+        is logged and the rest are still added.
+
+        :return The names of the columns and indexes added.
+        """
+
+        column_sql, index_sql = SCHEMA_QUERIES[self.rdbms]
+        with self.transaction() as cursor:
+            cursor.execute(column_sql)
+            columns = {row[0] for row in cursor.fetchall()}
+            cursor.execute(index_sql)
+            indexes = {row[0] for row in cursor.fetchall()}
+
+        changes = [(name, sql) for name, sql in UPGRADE_COLUMNS.items() if name not in columns]
+        changes += [(name, sql) for name, sql in UPGRADE_INDEXES[self.rdbms].items() if name not in indexes]
+        added = []
+        for name, sql in changes:
+            try:
+                with self.transaction() as cursor:
+                    cursor.execute(sql)
+            except Exception as e:
+                logger.error(f'Failed to add ({name}) to the messages table. ({e})')
+                continue
+            added.append(name)
+        if added:
+            logger.info(f'Upgraded the messages table with ({", ".join(added)}).')
+        return added
+
+    def insert_many(self, rows: list, logger) -> list:
+        """Insert a batch of inbound message rows in a single transaction.
+
+        If the batch fails as a whole (e.g. one duplicate message_id) then fall back to
+        inserting row by row, so one bad message doesn't block the rest. Each row is its
+        own transaction and errors are logged whatever the DAO's raise_on_sql_error.
+
+        :param rows Tuples from inbound_row().
+        :param logger The calling action's logger.
+        :return A flag per row, true if it was inserted.
+        """
+
+        sql = self.statement(
+            f'INSERT INTO messages ({", ".join(INBOUND_COLUMNS)}) VALUES ({", ".join("?" * len(INBOUND_COLUMNS))})'
+        )
+        try:
+            execute_many(self.dao, self.rdbms, sql, rows)
+            return [True] * len(rows)
+        except Exception as e:
+            logger.warning(f'Batch insert of ({len(rows)}) inbound messages failed ({e}). Inserting singly.')
+
+        inserted = []
+        for row in rows:
+            try:
+                with self.transaction() as cursor:
+                    cursor.execute(sql, row)
+                inserted.append(True)
+            except Exception as e:
+                logger.error(f'Failed to insert inbound message ({row[0]}) from ({row[1]}). ({e})')
+                inserted.append(False)
+        return inserted
+
+    def insert_unique(self, rows: list, logger, seen=None) -> list:
+        """Insert the inbound message rows that haven't been received before, by (sender, sender_id).
+
+        Rows that the bloom filter has never seen go straight into the batch insert, the
+        rest are looked up first. A row that fails to insert because another copy got
+        there first is also a duplicate. Inserted rows are added to the filter.
+
+        :param rows Tuples from inbound_row().
+        :param logger The calling action's logger.
+        :param seen The bloom filter from ism_comms.core.dedup.get_filter(), None to look up every row.
+        :return INSERTED, DUPLICATE or FAILED for each row.
+        """
+
+        statuses = [DUPLICATE] * len(rows)
+        keys = [message_key(row) for row in rows]
+        batch = {}
+        for index, key in enumerate(keys):
+            if key in batch:
+                continue
+            if seen is not None and key not in seen:
+                batch[key] = index
+            elif not self.received(*key):
+                batch[key] = index
+
+        indexes = list(batch.values())
+        inserted = self.insert_many([rows[index] for index in indexes], logger) if indexes else []
+        for index, ok in zip(indexes, inserted):
+            if ok:
+                statuses[index] = INSERTED
+                if seen is not None:
+                    seen.add(keys[index])
+            elif not self.received(*keys[index]):
+                statuses[index] = FAILED
+        return statuses
+
+    def received(self, sender: str, sender_id: int) -> bool:
+        """True if an inbound message from the sender with this sender_id is in the messages table"""
+
+        return bool(
+            self.dao.execute_sql_query(
+                self.statement(
+                    "SELECT 1 FROM messages WHERE sender = ? AND sender_id = ? AND direction = 'inbound' LIMIT 1"
+                ),
+                (sender, sender_id)
+            )
+        )
+
+    def inbound_keys(self) -> list:
+        """The (sender, sender_id) of every inbound message in the messages table"""
+
+        return self.dao.execute_sql_query("SELECT sender, sender_id FROM messages WHERE direction = 'inbound'") or []
+
+    def fetch_pending(self, direction: str, limit=0, recipients=None, exclude=(), skip_actions=()) -> list:
+        """Return up to limit unprocessed messages in the direction, 0 for no limit.
+
+        Messages are ordered highest priority first, then by the time they were
+        received, as inbound message_ids are set by the sender.
+
+        A transport that can't send to some recipients now, e.g. their server is down,
+        leaves their messages out of the fetch, so they can't fill a bounded batch and
+        hold up the messages for everyone else. See recipient_filter().
+
+        :param recipients Only fetch messages for these recipients, None for any recipient.
+        :param exclude Don't fetch messages for these recipients. Include None to leave out
+        messages without a recipient.
+        :param skip_actions Don't fetch messages for these actions, e.g. while they're busy.
+        :return OutboundRecords or InboundRecords.
+        """
+
+        columns, record = PENDING[direction]
+        sql = f'SELECT {columns} FROM messages WHERE processed = ? AND direction = ?'
+        params = (0, direction)
+        if recipients is not None:
+            if not recipients:
+                return []
+            sql = f'{sql} AND recipient IN ({", ".join("?" * len(recipients))})'
+            params = (*params, *recipients)
+        if exclude:
+            # NOT IN is never true for a NULL recipient, so those are only kept if None isn't excluded
+            names = [recipient for recipient in exclude if recipient is not None]
+            condition = f'recipient NOT IN ({", ".join("?" * len(names))})' if names else 'recipient IS NOT NULL'
+            if None not in exclude:
+                condition = f'(recipient IS NULL OR {condition})'
+            sql = f'{sql} AND {condition}'
+            params = (*params, *names)
+        if skip_actions:
+            sql = f'{sql} AND action NOT IN ({", ".join("?" * len(skip_actions))})'
+            params = (*params, *skip_actions)
+        sql = f'{sql} ORDER BY priority DESC, received, message_id'
+        if limit:
+            sql = f'{sql} LIMIT ?'
+            params = (*params, limit)
+        return [record(*row) for row in self.dao.execute_sql_query(self.statement(sql), params) or ()]
+
+    def fetch_by_priority(self, direction: str, limit: int, weights=None, skip_actions=()) -> list:
+        """Return up to limit unprocessed messages, shared between the priority lanes by weight.
+
+        Working down from the highest priority, each lane with messages waiting gets at
+        least one place and its weighted share (see lane_weight()) of the places left.
+        Places a lane doesn't fill go to the lanes below it, then any still free go back
+        to the highest lanes. So the top lane can't take the whole batch while lower
+        lanes have work, as long as limit is at least the number of lanes in use.
+
+        :param weights Lane weights by priority, e.g. [comms][dispatch][weights].
+        :param skip_actions Don't fetch messages for these actions, see fetch_pending().
+        :return Records, by lane from the highest, oldest first in each lane.
+        """
+
+        columns, record = PENDING[direction]
+        skip_sql = f' AND action NOT IN ({", ".join("?" * len(skip_actions))})' if skip_actions else ''
+        skip_actions = tuple(skip_actions)
+        lane_sql = self.statement(
+            f'SELECT MAX(priority) FROM messages WHERE processed = ? AND direction = ? AND priority < ?{skip_sql}'
+        )
+        fetch_sql = self.statement(
+            f'SELECT {columns} FROM messages WHERE processed = ? AND direction = ? AND priority = ?{skip_sql} '
+            f'ORDER BY received, message_id LIMIT ? OFFSET ?'
+        )
+
+        with self.transaction() as cursor:
+            # Find the lanes with messages waiting, one index lookup each
+            lanes = []
+            below = None
+            while len(lanes) < MAX_LANES:
+                cursor.execute(lane_sql, (0, direction, 2 ** 62 if below is None else below, *skip_actions))
+                below = cursor.fetchone()[0]
+                if below is None:
+                    break
+                lanes.append(below)
+
+            fetched = {}
+            drained = set()
+            remaining = limit
+            total_weight = sum(lane_weight(lane, weights) for lane in lanes)
+            for lane in lanes:
+                weight = lane_weight(lane, weights)
+                share = max(1, remaining * weight // total_weight)
+                total_weight -= weight
+                cursor.execute(fetch_sql, (0, direction, lane, *skip_actions, share, 0))
+                fetched[lane] = [record(*row) for row in cursor.fetchall()]
+                remaining -= len(fetched[lane])
+                if len(fetched[lane]) < share:
+                    drained.add(lane)
+                if remaining <= 0:
+                    break
+
+            # Top up from the highest lanes that had more waiting
+            for lane in fetched:
+                if remaining <= 0:
+                    break
+                if lane in drained:
+                    continue
+                cursor.execute(fetch_sql, (0, direction, lane, *skip_actions, remaining, len(fetched[lane])))
+                rows = cursor.fetchall()
+                fetched[lane].extend(record(*row) for row in rows)
+                remaining -= len(rows)
+
+        return [message for lane in fetched.values() for message in lane]
+
+    def mark_processed(self, message_ids: list, sent=None, cursor=None):
+        """Mark messages as processed with one UPDATE per chunk of IDs.
+
+        :param sent If set, also update the sent field. e.g. with the epoch seconds an outbound batch went out.
+        :param cursor Run the updates on this cursor, as part of the caller's transaction.
+        Otherwise they're run in a transaction of their own.
+        """
+
+        if cursor is None:
+            if message_ids:
+                with self.transaction() as cursor:
+                    self.mark_processed(message_ids, sent, cursor)
+            return
+
+        columns = 'processed = ?' if sent is None else 'sent = ?, processed = ?'
+        values = (1,) if sent is None else (sent, 1)
+        for chunk in chunks(message_ids):
+            cursor.execute(
+                self.statement(f'UPDATE messages SET {columns} WHERE message_id IN ({placeholders(len(chunk))})'),
+                (*values, *chunk)
+            )
+
+    def claim(self, message_ids: list) -> list:
+        """Mark the messages processed, but only those still pending, in one transaction.
+
+        For when more than one reader can see the same pending messages. The rows are
+        locked before they're read (BEGIN IMMEDIATE on sqlite3, SELECT ... FOR UPDATE
+        on mysql) so two readers can't both claim a message.
+
+        :return The IDs claimed by this call, a message another reader got to first is left out.
+        """
+
+        if not message_ids:
+            return []
+
+        claimed = []
+        lock = ' FOR UPDATE' if self.rdbms == 'mysql' else ''
+        with self.transaction() as cursor:
+            if self.rdbms == 'sqlite3':
+                cursor.execute('BEGIN IMMEDIATE')
+            for chunk in chunks(message_ids):
+                cursor.execute(
+                    self.statement(
+                        f'SELECT message_id FROM messages WHERE processed = ? '
+                        f'AND message_id IN ({placeholders(len(chunk))}){lock}'
+                    ),
+                    (0, *chunk)
+                )
+                claimed.extend(row[0] for row in cursor.fetchall())
+            self.mark_processed(claimed, cursor=cursor)
+        return claimed
+
+
+def chunks(message_ids: list):
+    for index in range(0, len(message_ids), UPDATE_CHUNK_SIZE):
+        yield message_ids[index:index + UPDATE_CHUNK_SIZE]
+
+
+def placeholders(count: int) -> str:
+    return ', '.join('?' * count)
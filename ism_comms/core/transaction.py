@@ -0,0 +1,61 @@
+"""Run groups of SQL statements against the control database in a single transaction.
+
+The ISM DAOs open, commit and close a connection for every statement they run. That is
+fine for control traffic but far too slow when a comms action has thousands of rows to
+write in one tick, so these helpers borrow the DAO's connection details and hand back a
+cursor for the duration of one transaction.
+
+The statements on the messages table that every transport action needs are in
+ism_comms.core.store.
+"""
+
+# Standard library imports
+from contextlib import contextmanager
+
+
+def open_connection(dao, rdbms: str):
+    """Open a connection to the control database using the DAO's own settings.
+
+    :param dao The ISM DAO in use by the action.
+    :param rdbms The RDBMS name from the properties file. e.g. sqlite3 or mysql.
+    :return The open connection, which is also left on dao.cnx.
+    """
+
+    {
+        'sqlite3': dao.open_connection,
+        'mysql': dao.open_connection_to_database
+    }[rdbms.lower()]()
+    return dao.cnx
+
+
+@contextmanager
+def transaction(dao, rdbms: str):
+    """Yield a cursor and commit everything executed on it as one transaction.
+
+    The transaction is rolled back and the exception re-raised if anything fails.
+    """
+
+    cnx = open_connection(dao, rdbms)
+    try:
+        cursor = cnx.cursor()
+        yield cursor
+        cnx.commit()
+    except Exception:
+        cnx.rollback()
+        raise
+    finally:
+        dao.close_connection()
+
+
+def execute_many(dao, rdbms: str, sql: str, rows: list):
+    """Execute a parameterised statement once per row of params in a single transaction.
+
+    :param sql Statement already prepared with dao.prepare_parameterised_statement.
+    :param rows List of parameter tuples.
+    """
+
+    if not rows:
+        return
+    with transaction(dao, rdbms) as cursor:
+        cursor.executemany(sql, rows)
+
@@ -7,6 +7,8 @@ import secrets
 
 # Application imports
 from ism.core.base_action import BaseAction
+from ism_comms.core.store import MessageStore
+from ism_comms.file.shards import shard_names
 
 
 class ActionBeforeIoFile(BaseAction):
@@ -16,6 +18,23 @@ class ActionBeforeIoFile(BaseAction):
     If:
         1) The paths are absolute, then they are created as defined.
         2) The paths are relative, then they are created under the run root.
+
+    If [comms][file][inbound_shards] is set, the hash shard subdirectories are
+    created under the inbound directory.
+
+    The [comms][file][quarantine] directory for inbound files that can't be decoded
+    is created in the same way, and defaults to quarantine. So is the bundle directory
+    when [comms][file][archive_bundles] is set, defaulting to bundles, and then
+    ActionIoFileBundleArchive is activated.
+
+    If [comms][file][segment_inbound] or [comms][file][segment_outbound] is set, the
+    segment directory is created in the same way and the matching segment action,
+    ActionIoSegmentInbound or ActionIoSegmentOutbound, is activated. Segments replace
+    the outbound message files, so ActionIoFileOutbound is deactivated when
+    segment_outbound is set. Inbound message files are still read alongside segments.
+
+    A messages table created by an earlier release is given the priority column and
+    the indexes it's missing, see ism_comms.core.store.MessageStore.upgrade().
     """
 
     def execute(self):
@@ -35,7 +54,7 @@ class ActionBeforeIoFile(BaseAction):
 
             # Are they relative or absolute?
             path_type = 'Abs'
-            for path in paths:
+            for path in paths.values():
                 if not os.path.isabs(path):
                     path_type = 'Rel'
 
@@ -50,8 +69,50 @@ class ActionBeforeIoFile(BaseAction):
                         # Update the properties to show the absolute path now it's been resolved and created
                         self.properties['comms']['file'][name] = directory
                 else:
-                    for path in paths:
+                    for path in paths.values():
                         Path(path).mkdir(parents=True, exist_ok=True)
+
+                # Create the inbound shards
+                inbound = self.properties['comms']['file']['inbound']
+                for shard in shard_names(self.properties['comms']['file'].get('inbound_shards', 0)):
+                    if shard:
+                        Path(f'{inbound}{os.path.sep}{shard}').mkdir(exist_ok=True)
+
+                # Create the quarantine directory for malformed inbound files
+                path = self.properties['comms']['file'].get('quarantine', 'quarantine')
+                if not os.path.isabs(path):
+                    sep = os.path.sep
+                    path = f'{self.properties["runtime"]["run_dir"]}{sep}comms{sep}file{sep}{path}'
+                    self.properties['comms']['file']['quarantine'] = path
+                Path(path).mkdir(parents=True, exist_ok=True)
+
+                # Create the archive bundle directory and activate its action
+                bundles = self.properties['comms']['file'].get('archive_bundles')
+                if bundles is not None:
+                    path = bundles.get('directory', 'bundles')
+                    if not os.path.isabs(path):
+                        sep = os.path.sep
+                        path = f'{self.properties["runtime"]["run_dir"]}{sep}comms{sep}file{sep}{path}'
+                    bundles['directory'] = path
+                    Path(path).mkdir(parents=True, exist_ok=True)
+                    self.activate('ActionIoFileBundleArchive')
+
+                # Create the segment directories and activate their actions
+                for name, action in (
+                        ('segment_inbound', 'ActionIoSegmentInbound'),
+                        ('segment_outbound', 'ActionIoSegmentOutbound')
+                ):
+                    path = self.properties['comms']['file'].get(name)
+                    if path is None:
+                        continue
+                    if not os.path.isabs(path):
+                        sep = os.path.sep
+                        path = f'{self.properties["runtime"]["run_dir"]}{sep}comms{sep}file{sep}{path}'
+                        self.properties['comms']['file'][name] = path
+                    Path(path).mkdir(parents=True, exist_ok=True)
+                    self.activate(action)
+                    if name == 'segment_outbound':
+                        self.deactivate('ActionIoFileOutbound')
             except OSError as err:
                 self.logger.error(f'Error creating directory for ({path}). Error message: ({err})')
                 raise
@@ -59,6 +120,9 @@ class ActionBeforeIoFile(BaseAction):
                 self.logger.error(f'Error reading key during messaging dir creation ({err}).')
                 raise
 
+            # Bring a messages table made by an earlier release up to date, see ism_comms.core.store
+            MessageStore(self.dao, self.properties['database']['rdbms']).upgrade(self.logger)
+
             # Create the security token
             num_bytes = self.properties.get('security', {}).get('token_bytes', 16)
             BaseAction.security_token = {
@@ -0,0 +1,108 @@
+"""Action packs the archived message files into rolling compressed bundles"""
+
+# Standard library imports
+import time
+
+# Application imports
+from ism.core.base_action import BaseAction
+from ism_comms.core.transaction import execute_many, transaction
+from ism_comms.file.batches import EXTENSION
+from ism_comms.file.bundles import BundleArchiver
+
+
+class ActionIoFileBundleArchive(BaseAction):
+    """Move the files in the archive directory into tar.gz bundles, see ism_comms.file.bundles.
+
+    Configured under [comms][file][archive_bundles], e.g.
+        archive_bundles:
+          directory: bundles
+          max_bytes: 67108864
+          max_age: 3600
+          retention_days: 30
+          tick_budget_ms: 20
+
+    Each tick does at most tick_budget_ms (default 20) of work, so it never holds up the
+    inbound action for long, and a backlog is worked through over following ticks.
+    Set retention_days to 0 (the default) to keep bundles forever. Bundles are fsynced
+    as they're rolled when [comms][file][durability] is batch or strict.
+
+    The action is activated by ActionBeforeIoFile, which creates the bundle directory.
+    """
+
+    # Index rows written and files removed per transaction
+    chunk_size = 500
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.archiver = None
+
+    def execute(self):
+
+        if self.active():
+
+            try:
+                settings = self.properties['comms']['file']['archive_bundles']
+                if self.archiver is None:
+                    self.archiver = BundleArchiver(
+                        self.properties['comms']['file']['archive'],
+                        settings['directory'],
+                        self.properties['comms']['file']['message_extension'],
+                        settings.get('max_bytes', 67108864),
+                        settings.get('max_age', 3600),
+                        durability=self.properties['comms']['file'].get('durability'),
+                        batch_extension=self.properties['comms']['file'].get('batch_extension', EXTENSION)
+                    )
+            except KeyError as e:
+                self.logger.error(f'Failed to read [comms][file][archive_bundles] entries from properties. KeyError ({e})')
+                raise
+            deadline = time.perf_counter() + settings.get('tick_budget_ms', 20) / 1000
+
+            self.archiver.add(deadline)
+            if self.archiver.due():
+                self.roll(settings)
+            self.finish(deadline)
+
+        elif self.archiver is not None:
+            # Deactivated, or the phase has moved on from RUNNING
+            self.roll(self.properties['comms']['file']['archive_bundles'])
+            self.archiver.close_cursor()
+            self.finish()
+            self.archiver = None
+
+    def roll(self, settings: dict):
+        """Complete the open bundle, then apply the retention policy"""
+
+        self.archiver.roll()
+        retention_days = settings.get('retention_days', 0)
+        if not retention_days:
+            return
+        expired = self.archiver.expire(retention_days * 86400)
+        if expired:
+            self.logger.info(f'Deleted ({len(expired)}) archive bundles past their retention.')
+            with transaction(self.dao, self.properties['database']['rdbms']) as cursor:
+                for bundle in expired:
+                    cursor.execute(
+                        self.dao.prepare_parameterised_statement('DELETE FROM archive_index WHERE bundle = ?'),
+                        (bundle,)
+                    )
+
+    def finish(self, deadline=None):
+        """Index the files of rolled bundles and remove them from the archive, until the deadline if given"""
+
+        while self.archiver.finishing and (deadline is None or time.perf_counter() < deadline):
+            finished = self.archiver.next_finished(self.chunk_size)
+            rows = [
+                (bundle, file_name, sender, sender_id, message_id)
+                for bundle, file_name, messages in finished
+                for sender, sender_id, message_id in messages
+                if sender is not None
+            ]
+            execute_many(
+                self.dao,
+                self.properties['database']['rdbms'],
+                self.dao.prepare_parameterised_statement(
+                    'INSERT INTO archive_index (bundle, member, sender, sender_id, message_id) VALUES (?, ?, ?, ?, ?)'
+                ),
+                rows
+            )
+            self.archiver.remove(finished)
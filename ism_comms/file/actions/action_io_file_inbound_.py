@@ -1,18 +1,37 @@
 """Action finds and loads any inbound message files, then archives them"""
 
 # Standard library imports
-import json
 import os
+import time
 
 # Application imports
 from ism.core.base_action import BaseAction
 from ism.exceptions.exceptions import OrphanedSemaphoreFile
+from ism_comms.core.blobs import get_blob_settings
+from ism_comms.core.dedup import get_filter
+from ism_comms.core.metrics import get_metrics
+from ism_comms.core.scheduler import AdaptivePolling, wake
+from ism_comms.core.store import DUPLICATE, FAILED, INSERTED, MessageStore
+from ism_comms.file.batches import inbound_codecs
+from ism_comms.file.claims import InboundClaims
+from ism_comms.file.durability import SyncBatch
+from ism_comms.file.shards import DirectoryScanner, shard_names
+from ism_comms.file.watcher import WatchedDirectory
+from ism_comms.file.workers import decode_files, open_decode_pool
 
 
-class ActionIoFileInbound(BaseAction):
+class ActionIoFileInbound(AdaptivePolling, BaseAction):
     """Scan the inbound message directory and read any
     found messages into the database messages table.
 
+    Up to [comms][file][inbound_batch_size] files (default 0, no limit) are read per
+    tick, inserted in one transaction and archived. Duplicates are archived without
+    being inserted, see ism_comms.core.dedup. Files whose rows fail to insert are read
+    again after [comms][file][inbound_retry_interval] seconds (default 60), and files
+    that can't be decoded, or semaphores without one, go to [comms][file][quarantine].
+    The other inbound settings are described in ism_comms.file.batches, watcher,
+    shards, claims, workers and durability.
+
     MSG Format:
 
     CREATE TABLE messages (
@@ -25,55 +44,256 @@ class ActionIoFileInbound(BaseAction):
         sent TEXT NOT NULL, -- Timestamp msg sent by sender
         received TEXT NOT NULL DEFAULT (strftime('%s', 'now')), -- Timestamp ism loaded message into database
         direction TEXT NOT NULL DEFAULT 'inbound', -- In or outbound message
-        processed BOOLEAN NOT NULL DEFAULT '0' -- Has the message been processed
+        processed BOOLEAN NOT NULL DEFAULT '0', -- Has the message been processed
+        priority INTEGER NOT NULL DEFAULT 0 -- Dispatch priority, highest first
     );
 
     """
 
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.scanner = None
+        self.watcher = None
+        self.pool = None
+        self.claims = None
+        self.failed = {}
+        self.saturated = False
+        # Set when inotify can't be used, so the action polls without changing the properties
+        self.inotify_failed = False
+
     def execute(self):
 
         if self.active():
+            self.poll(self.read_messages)
+
+        elif any(held is not None for held in (self.scanner, self.watcher, self.pool, self.claims)):
+            # Deactivated, or the phase has moved on from RUNNING
+            self.close()
+
+    def read_messages(self) -> int:
+        """Read a batch of inbound message files into the messages table, returning the number found"""
+
+        #  Get the directory paths from the properties
+        try:
+            settings = self.properties['comms']['file']
+            inbound = str(settings.get('inbound'))
+            archive = settings['archive']
+            smp = settings['semaphore_extension']
+            codec_names, ready = inbound_codecs(settings)
+        except KeyError as e:
+            self.logger.error(f'Failed to read [comms][file] entries from properties. KeyError ({e})')
+            raise
+        batch_size = settings.get('inbound_batch_size', 0)
+        semaphore = settings.get('inbound_semaphore', True)
+        extensions = tuple(extension for extension, _ in codec_names)
+        if self.scanner is None:
+            self.scanner = DirectoryScanner(inbound, shard_names(settings.get('inbound_shards', 0)), ready)
+
+        metrics = get_metrics(self.properties)
+        tick_started = metrics.clock()
+
+        # With a decode pool, only look for as many files as it has room for
+        if self.pool is None:
+            self.pool = open_decode_pool(settings)
+        pool = self.pool
+        limit = batch_size
+        if pool is not None:
+            capacity = pool.capacity()
+            limit = min(batch_size, capacity) if batch_size else capacity
+            if not capacity and not self.saturated:
+                self.logger.info(f'Inbound decode pool is full. ({pool.stats()})')
+            self.saturated = not capacity
+
+        # Are there any inbound files?
+        scan_started = metrics.clock()
+        file_names = [] if pool is not None and not limit else self.find(inbound, limit)
+        if self.failed:
+            retries = self.due_retries()
+            file_names = [file_name for file_name in file_names if file_name not in self.failed]
+            if self.claims is not None:
+                # Claimed files are no longer in the inbound directory for the scan to find
+                self.claims.resumed.extend(retries)
+            else:
+                file_names.extend(file_name for file_name in retries if file_name not in file_names)
+        if settings.get('inbound_claim'):
+            file_names = self.claim(inbound, ready, file_names)
+        metrics.observe('scan_seconds', self.action_name, scan_started)
+        metrics.count('files_seen', self.action_name, len(file_names))
+        if self.watcher is not None:
+            metrics.gauge('backlog', self.action_name, len(self.watcher))
+
+        # Read and decode the message files, here or in the pool's workers
+        priorities = self.properties['comms'].get('priority')
+        blobs = get_blob_settings(self.properties)
+        decode_started = metrics.clock()
+        files = [(file_name, self.paths(inbound, file_name, semaphore)[0]) for file_name in file_names]
+        decoded = decode_files(pool, files, codec_names, priorities, blobs, batch_size)
+        if pool is None and decoded:
+            metrics.observe('decode_seconds', self.action_name, decode_started)
+        elif pool is not None and metrics.enabled:
+            stats = pool.stats()
+            metrics.gauge('queue_depth', self.action_name, stats['queue_depth'])
+            metrics.gauge('in_flight', self.action_name, stats['in_flight'])
+        if not decoded:
+            # Files handed to the pool are still work in hand
+            return len(pool.in_flight) if pool is not None else 0
+
+        # Set aside any that can't be decoded
+        rows = []
+        accepted = []
+        for file_name, found, file_rows, size, error in decoded:
+            metrics.count('bytes_read', self.action_name, size)
+            if error is not None:
+                metrics.count('quarantined', self.action_name)
+                self.quarantine(inbound, file_name, extensions, error)
+            elif found is None:
+                if not os.path.exists(f'{self.paths(inbound, file_name, semaphore)[1]}{ready}'):
+                    # Already archived, a scandir cursor can still list a name it read ahead
+                    continue
+                # Set the semaphore aside rather than lose the rest of the batch
+                metrics.count('quarantined', self.action_name)
+                self.quarantine(
+                    inbound,
+                    file_name,
+                    extensions,
+                    OrphanedSemaphoreFile(f'Semaphore file ({file_name}{smp}) without associated message file.')
+                )
+            else:
+                rows.extend(file_rows)
+                accepted.append((file_name, found, len(file_rows)))
+
+        # Write them into the DB messages table
+        db_started = metrics.clock()
+        store = MessageStore(self.dao, self.properties['database']['rdbms'])
+        statuses = store.insert_unique(rows, self.logger, get_filter(self.properties, store)) if rows else []
+        metrics.observe('db_seconds', self.action_name, db_started)
+        metrics.count('rows', self.action_name, statuses.count(INSERTED))
+        duplicates = statuses.count(DUPLICATE)
+        if duplicates:
+            metrics.count('duplicates', self.action_name, duplicates)
+            self.logger.info(f'Archived ({duplicates}) duplicate inbound message files.')
+
+        # Archive the files so we don't process them again
+        sync = SyncBatch(settings.get('durability'))
+        self.archive(inbound, archive, accepted, statuses, sync)
+        metrics.count('fsyncs', self.action_name, sync.syncs)
+        if INSERTED in statuses:
+            wake(self.properties, 'inbound')
+
+        if pool is not None:
+            for file_name, *_ in decoded:
+                pool.done(file_name)
+        metrics.observe('tick_seconds', self.action_name, tick_started)
+        return len(decoded)
+
+    def find(self, inbound: str, limit: int) -> list:
+        """The names of up to limit (0, no limit) files ready to read, from the scanner or the inotify watcher"""
 
-            #  Get the directory paths from the properties
+        watch = self.properties['comms']['file'].get('inbound_watch', 'poll') == 'inotify' and not self.inotify_failed
+        if watch and self.watcher is None:
             try:
-                inbound = str(self.properties['comms']['file'].get('inbound'))
-                archive = self.properties['comms']['file']['archive']
-                smp = self.properties['comms']['file']['semaphore_extension']
-                msg = self.properties['comms']['file']['message_extension']
-            except KeyError as e:
-                self.logger.error(f'Failed to read [comms][file] entries from properties. KeyError ({e})')
-                raise
-
-            # Are there any inbound files?
-            for file in os.listdir(inbound):
-                if file.endswith(smp):
-                    file_name = os.path.splitext(file)[0]
-                    smp_file = f'{inbound}{os.path.sep}{file_name}{smp}'
-                    msg_file = f'{inbound}{os.path.sep}{file_name}{msg}'
-                    if not os.path.exists(msg_file):
-                        raise OrphanedSemaphoreFile(f'Semaphore file ({file}) without associated message file.')
-
-                    # Message file found so read it into the DB test messages table
-                    with open(msg_file, 'r') as message_file:
-                        message = json.loads(message_file.read())
-                        sql = self.dao.prepare_parameterised_statement(
-                            f'INSERT INTO messages '
-                            f'(message_id, sender, sender_id, action, payload, sent)'
-                            f' VALUES (?, ?, ?, ?, ?, ?)'
-                        )
-                        self.dao.execute_sql_statement(
-                            sql,
-                            (
-                                message['message_id'],
-                                message['sender'],
-                                message['sender_id'],
-                                message['action'],
-                                json.dumps(message['payload']),
-                                message['sent']
-                            )
-                        )
-
-                    # Archive the file so we don't process it again
-                    destination_path = f'{archive}{os.path.sep}{file_name}'
-                    os.rename(msg_file, f'{destination_path}{msg}')
-                    os.rename(smp_file, f'{destination_path}{smp}')
+                self.watcher = WatchedDirectory(self.scanner)
+            except (OSError, AttributeError) as e:
+                self.logger.warning(f'Unable to watch ({inbound}) with inotify, reverting to polling. ({e})')
+                self.inotify_failed = True
+        elif not watch and self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+
+        if self.watcher is not None:
+            return self.watcher.take(limit)
+        return self.scanner.scan(limit, self.properties['comms']['file'].get('inbound_scan_budget', 0))
+
+    def claim(self, inbound: str, ready: str, file_names: list) -> list:
+        """Claim the files found for this node, adding any claims it has taken over or held from before"""
+
+        if self.claims is None:
+            settings = self.properties['comms']['file']['inbound_claim']
+            self.claims = InboundClaims(
+                inbound,
+                ready,
+                self.scanner.directories,
+                settings.get('node'),
+                settings.get('lease', 30),
+                settings.get('directory')
+            )
+
+        claimed, held, taken = self.claims.take(file_names, self.failed)
+        if not held:
+            self.logger.warning(
+                f'The inbound lease of node ({self.claims.node}) expired and its claims may have been taken over.'
+            )
+        if taken:
+            self.logger.warning(f'Node ({self.claims.node}) took over ({taken}) claims from expired leases.')
+        return claimed
+
+    def archive(self, inbound: str, archive: str, accepted: list, statuses: list, sync: SyncBatch):
+        """Move the files whose rows are in the messages table to the archive, setting aside those that failed"""
+
+        semaphore = self.properties['comms']['file'].get('inbound_semaphore', True)
+        smp = self.properties['comms']['file']['semaphore_extension']
+        retry_at = time.monotonic() + self.properties['comms']['file'].get('inbound_retry_interval', 60)
+        offset = 0
+        for file_name, found, count in accepted:
+            offset += count
+            if FAILED in statuses[offset - count:offset]:
+                self.failed[file_name] = retry_at
+                continue
+            message_path, ready_path = self.paths(inbound, file_name, semaphore)
+            destination_path = f'{archive}{os.path.sep}{os.path.basename(file_name)}'
+            os.rename(f'{message_path}{found}', f'{destination_path}{found}')
+            if semaphore:
+                os.rename(f'{ready_path}{smp}', f'{destination_path}{smp}')
+                sync.changed(os.path.dirname(ready_path))
+            sync.changed(os.path.dirname(message_path))
+            sync.changed(archive)
+        sync.commit()
+
+    def close(self):
+        """Release the scandir cursor, inotify descriptor, decode pool and claims, reopened if the action runs again"""
+
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+        if self.scanner is not None:
+            self.scanner.close()
+            self.scanner = None
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        if self.claims is not None:
+            self.claims.release()
+            self.claims = None
+
+    def due_retries(self) -> list:
+        """Take the files whose rows failed to insert that are due to be read again"""
+
+        now = time.monotonic()
+        due = [file_name for file_name, retry_at in self.failed.items() if retry_at <= now]
+        for file_name in due:
+            del self.failed[file_name]
+        if due:
+            self.logger.info(f'Retrying ({len(due)}) inbound message files that failed to insert.')
+        return due
+
+    def paths(self, inbound: str, file_name: str, semaphore: bool) -> tuple:
+        """The paths, without extensions, of a message file and of the file that showed it was ready"""
+
+        path = f'{inbound}{os.path.sep}{file_name}'
+        if self.claims is None:
+            return path, path
+        claimed = self.claims.path(file_name)
+        return path if semaphore else claimed, claimed
+
+    def quarantine(self, inbound: str, file_name: str, extensions, error: Exception):
+        """Move a message file that can't be decoded, or a semaphore without one, to the quarantine directory"""
+
+        quarantine = self.properties['comms']['file'].get('quarantine', self.properties['comms']['file']['archive'])
+        self.logger.error(f'Moving malformed message file ({file_name}) to ({quarantine}). ({error})')
+        destination_path = f'{quarantine}{os.path.sep}{os.path.basename(file_name)}'
+        for extension in (*extensions, self.properties['comms']['file']['semaphore_extension']):
+            for source_path in set(self.paths(inbound, file_name, True)):
+                try:
+                    os.rename(f'{source_path}{extension}', f'{destination_path}{extension}')
+                except FileNotFoundError:
+                    continue
@@ -1,16 +1,57 @@
 # Standard library imports
 import time
-import json
-import os
 
 # Application imports
 from ism.core.base_action import BaseAction
+from ism_comms.core.codecs import get_codec
+from ism_comms.core.metrics import get_metrics
+from ism_comms.core.scheduler import AdaptivePolling
+from ism_comms.core.store import MessageStore
+from ism_comms.file.batches import EXTENSION, encode_batch
+from ism_comms.file.durability import SyncBatch
+from ism_comms.file.exceptions.exceptions import RecipientNotRoutable
+from ism_comms.file.outbound import OutboundRoutes, write_message_files
 
 
-class ActionIoFileOutbound(BaseAction):
+class ActionIoFileOutbound(AdaptivePolling, BaseAction):
     """Scan the messages table in the control DB for
     outbound messages and create an outbound file if any found.
 
+    Up to [comms][file][outbound_batch_size] messages (default 0, meaning no limit) are
+    written per tick, then the whole batch is marked as sent in one UPDATE.
+
+    [comms][file][outbound_mode] selects how the files are written:
+        * legacy - (default) Write the message file then an empty semaphore file.
+        * atomic - Write the message to a hidden temporary file and publish it with a
+        single os.rename, so readers never see a partial message. The semaphore is still
+        written for older consumers unless [comms][file][outbound_semaphore] is false.
+
+    [comms][file][durability] (default none) decides whether the files are fsynced
+    before the messages are marked sent. In batch mode the tick's message files are
+    synced together before any semaphore is written or temp file renamed, and the
+    directory once after, see ism_comms.file.durability.
+
+    Each recipient's files go to the outbound directory unless it's routed elsewhere by
+    [comms][file][outbound_routes], or to a directory of its own with
+    [comms][file][outbound_per_recipient] set, see ism_comms.file.outbound. A recipient
+    whose name can't be a directory is logged, and its messages are left pending and out
+    of the batches fetched from then on, so they can't hold up the other recipients.
+
+    With [comms][file][outbound_batch] set, each recipient's messages for the tick are
+    written to one batch file, with the [comms][file][batch_extension] (default .batch),
+    and one semaphore, see ism_comms.file.batches. Readers find batch files by their
+    semaphore, so it's written whatever [comms][file][outbound_semaphore] says.
+
+    Messages are encoded with the codec named in [comms][file][codec] (default json).
+    JSON files keep the message_extension from the properties, other codecs use their
+    own extension (see ism_comms.core.codecs). The payload is written as stored, without
+    being encoded a second time.
+
+    Per tick timings and counts are recorded when [comms][metrics] is set, see
+    ism_comms.core.metrics. With [comms][polling] set the messages table is polled
+    adaptively, and wake(properties, 'outbound') has it polled on the next tick,
+    see ism_comms.core.scheduler.
+
     MSG Format:
 
         CREATE TABLE messages (
@@ -22,71 +63,113 @@ class ActionIoFileOutbound(BaseAction):
             sent TEXT NOT NULL, -- Timestamp msg sent by sender
             received TEXT NOT NULL DEFAULT (strftime('%s', 'now')), -- Timestamp ism loaded message into database
             direction TEXT NOT NULL DEFAULT 'inbound', -- In or outbound message
-            processed BOOLEAN NOT NULL DEFAULT '0' -- Has the message been processed
+            processed BOOLEAN NOT NULL DEFAULT '0', -- Has the message been processed
+            priority INTEGER NOT NULL DEFAULT 0 -- Sent highest priority first
         );
 
     File Name Format:
         <recipient>_<sender_id>.json
+        <recipient>_<first sender_id>.batch - In batch mode
     """
 
+    poll_topic = 'outbound'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.routes = None
+        self.unroutable = set()
+
     def execute(self):
 
         if self.active():
+            self.poll(self.write_messages)
 
-            #  Get the directory paths from the properties
-            try:
-                outbound = str(self.properties['comms']['file'].get('outbound'))
-                smp = self.properties['comms']['file']['semaphore_extension']
-                msg = self.properties['comms']['file']['message_extension']
-            except KeyError as e:
-                self.logger.error(f'Failed to read [comms][file] entries from properties. KeyError ({e})')
-                raise
-
-            # Query the messages table for outbound messages that aren't 'processed'
-            sql = self.dao.prepare_parameterised_statement(
-                f'SELECT message_id, recipient, sender, sender_id, action, payload '
-                f'FROM messages WHERE processed = ? AND  direction = ?'
-            )
-            results = self.dao.execute_sql_query(
-                sql,
-                (
-                    0,
-                    'outbound'
-                )
+    def write_messages(self) -> int:
+        """Write a batch of pending outbound messages to files, returning the number found"""
+
+        #  Get the directory paths from the properties
+        try:
+            outbound = str(self.properties['comms']['file'].get('outbound'))
+            smp = self.properties['comms']['file']['semaphore_extension']
+            msg = self.properties['comms']['file']['message_extension']
+        except KeyError as e:
+            self.logger.error(f'Failed to read [comms][file] entries from properties. KeyError ({e})')
+            raise
+        mode = self.properties['comms']['file'].get('outbound_mode', 'legacy')
+        semaphore = self.properties['comms']['file'].get('outbound_semaphore', True)
+        batch_size = self.properties['comms']['file'].get('outbound_batch_size', 0)
+        batch = self.properties['comms']['file'].get('outbound_batch', False)
+        codec = get_codec(self.properties['comms']['file'].get('codec', 'json'))
+        if codec.name != 'json':
+            msg = codec.extension
+
+        # Query the messages table for outbound messages that aren't 'processed'
+        metrics = get_metrics(self.properties)
+        store = MessageStore(self.dao, self.properties['database']['rdbms'])
+        db_started = metrics.clock()
+        results = store.fetch_pending('outbound', batch_size, exclude=sorted(self.unroutable, key=str))
+        metrics.observe('db_seconds', self.action_name, db_started)
+        metrics.gauge('backlog', self.action_name, len(results))
+
+        if not results:
+            return 0
+
+        if self.routes is None:
+            self.routes = OutboundRoutes(
+                outbound,
+                self.properties['comms']['file'].get('outbound_routes'),
+                self.properties['comms']['file'].get('outbound_per_recipient', False)
             )
 
-            if not results:
-                return
-
-            # Create the message files in the outbound directory
-            for record in results:
-                # Create a dict of the values
-                send_time = int(time.time())
-                message = {
-                    "message_id": record[0],
-                    "recipient": record[1],
-                    "sender": record[2],
-                    "sender_id": record[3],
-                    "action": record[4],
-                    "payload": json.dumps(record[5]),
-                    "sent": send_time
-                }
-
-                # Create the file
-                with open(f'{outbound}{os.path.sep}{record[1]}_{record[3]}{msg}', 'w') as file:
-                    file.write(json.dumps(message))
-                # Create the semaphore
-                with open(f'{outbound}{os.path.sep}{record[1]}_{record[3]}{smp}', 'w') as file:
-                    file.write('')
-
-                # Mark the message as processed and update the sent field with timestamp of epoch seconds
-                sql = self.dao.prepare_parameterised_statement(
-                    'UPDATE messages SET sent = ?, processed = ?'
-                )
-                self.dao.execute_sql_statement(
-                    sql,
+        # Group the messages by directory, and in batch mode by recipient
+        encode_started = metrics.clock()
+        sync = SyncBatch(self.properties['comms']['file'].get('durability'))
+        directories = {}
+        sent = []
+        for record in results:
+            try:
+                directory = self.routes.directory(record.recipient, sync)
+            except RecipientNotRoutable as e:
+                if record.recipient not in self.unroutable:
+                    self.logger.error(f'Unable to route outbound message ({record.message_id}). ({e})')
+                    self.unroutable.add(record.recipient)
+                continue
+            directories.setdefault(directory, {}).setdefault(record.recipient, []).append(record)
+            sent.append(record.message_id)
+
+        # Create the message files in each directory, published once they're on disk
+        send_time = int(time.time())
+        written = 0
+        batch_extension = self.properties['comms']['file'].get('batch_extension', EXTENSION)
+        for directory, recipients in directories.items():
+            if batch:
+                messages = (
                     (
-                        send_time,
-                        1
+                        f'{recipient}_{records[0].sender_id}',
+                        encode_batch(codec.name, (codec.encode(record.message(send_time)) for record in records))
                     )
+                    for recipient, records in recipients.items()
+                )
+                written += write_message_files(directory, messages, batch_extension, smp, mode, True, sync)
+            else:
+                messages = (
+                    (f'{record.recipient}_{record.sender_id}', codec.encode(record.message(send_time)))
+                    for records in recipients.values() for record in records
                 )
+                written += write_message_files(directory, messages, msg, smp, mode, semaphore, sync)
+
+        metrics.observe('encode_seconds', self.action_name, encode_started)
+        metrics.count('bytes_written', self.action_name, written)
+        metrics.count('fsyncs', self.action_name, sync.syncs)
+
+        if not sent:
+            # Only unroutable messages, now left out of the fetch
+            return len(results)
+
+        # Mark the messages as processed and update the sent field with timestamp of epoch seconds
+        db_started = metrics.clock()
+        store.mark_processed(sent, sent=send_time)
+        metrics.observe('db_seconds', self.action_name, db_started)
+        metrics.count('rows', self.action_name, len(sent))
+        return len(results)
+
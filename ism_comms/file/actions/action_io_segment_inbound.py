@@ -0,0 +1,95 @@
+"""Action reads new records from an append-only segment directory into the messages table"""
+
+# Application imports
+from ism.core.base_action import BaseAction
+from ism_comms.core.blobs import get_blob_settings
+from ism_comms.core.codecs import get_codec
+from ism_comms.core.dedup import get_filter
+from ism_comms.core.metrics import get_metrics
+from ism_comms.core.scheduler import AdaptivePolling, wake
+from ism_comms.core.store import DUPLICATE, FAILED, INSERTED, MessageStore, inbound_row
+from ism_comms.file.segment import SegmentReader
+
+
+class ActionIoSegmentInbound(AdaptivePolling, BaseAction):
+    """Read messages appended to the segments in [comms][file][segment_inbound].
+
+    Each record is one message, decoded with the codec named in [comms][file][codec]
+    (default json) as for a message file. Up to [comms][file][inbound_batch_size]
+    records (default 0, no limit) are inserted per tick in one transaction, and the
+    reader's offset is only advanced once that transaction has committed. Fully
+    consumed segments are moved to the archive directory.
+
+    Records that are corrupt or can't be decoded are logged as errors and skipped. If
+    any record of the batch can't be inserted, e.g. the database is locked, the offset
+    isn't advanced and the batch is read again on a following tick. Records already
+    received from the same (sender, sender_id) are counted as duplicates and skipped,
+    see ism_comms.core.dedup, so those inserted the first time aren't inserted again.
+
+    The action is activated by ActionBeforeIoFile when segment_inbound is set. See
+    ism_comms.file.segment for the file format. Polling adapts to the traffic when
+    [comms][polling] is set, see ism_comms.core.scheduler.
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.reader = None
+
+    def execute(self):
+
+        if self.active():
+            self.poll(self.read_records)
+
+    def read_records(self) -> int:
+        """Read a batch of segment records into the messages table, returning the number read"""
+
+        try:
+            directory = self.properties['comms']['file']['segment_inbound']
+            archive = self.properties['comms']['file']['archive']
+        except KeyError as e:
+            self.logger.error(f'Failed to read [comms][file] entries from properties. KeyError ({e})')
+            raise
+
+        if self.reader is None:
+            self.reader = SegmentReader(
+                directory,
+                self.properties['comms']['file'].get('segment_reader', 'reader'),
+                archive,
+                skip_corrupt=True
+            )
+
+        records = self.reader.read(self.properties['comms']['file'].get('inbound_batch_size', 0))
+        for segment, offset in self.reader.corrupt:
+            self.logger.error(
+                f'Skipped corrupt record at offset ({offset}) of segment ({segment}) in ({directory})'
+            )
+        if not records:
+            if self.reader.corrupt:
+                self.reader.commit()
+            return 0
+
+        codec = get_codec(self.properties['comms']['file'].get('codec', 'json'))
+        priorities = self.properties['comms'].get('priority')
+        blobs = get_blob_settings(self.properties)
+        rows = []
+        for record in records:
+            try:
+                rows.append(inbound_row(codec.decode(record, blobs), priorities, blobs))
+            except Exception as e:
+                self.logger.error(f'Skipped segment record that could not be decoded as ({codec.name}). ({e})')
+
+        if rows:
+            store = MessageStore(self.dao, self.properties['database']['rdbms'])
+            statuses = store.insert_unique(rows, self.logger, get_filter(self.properties, store))
+            get_metrics(self.properties).count('duplicates', self.action_name, statuses.count(DUPLICATE))
+            if INSERTED in statuses:
+                wake(self.properties, 'inbound')
+            if FAILED in statuses:
+                self.logger.error(
+                    f'Failed to insert ({statuses.count(FAILED)}) segment records, the batch will be read again.'
+                )
+                return 0
+
+        self.reader.commit()
+        return len(records)
+
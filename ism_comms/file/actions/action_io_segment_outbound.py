@@ -0,0 +1,74 @@
+"""Action appends outbound messages to an append-only segment directory"""
+
+# Standard library imports
+import time
+
+# Application imports
+from ism.core.base_action import BaseAction
+from ism_comms.core.codecs import get_codec
+from ism_comms.core.scheduler import AdaptivePolling
+from ism_comms.core.store import MessageStore
+from ism_comms.file.segment import SegmentWriter
+
+
+class ActionIoSegmentOutbound(AdaptivePolling, BaseAction):
+    """Append outbound messages from the messages table to the segments in
+    [comms][file][segment_outbound].
+
+    Each message is one record, encoded with the codec named in [comms][file][codec]
+    (default json) as for an outbound message file.
+    The batch is committed to the segment log before the messages are marked as sent.
+    Segments roll at [comms][file][segment_bytes] (default 64MB). With
+    [comms][file][durability] set to batch or strict the batch is fsynced as it's
+    committed.
+
+    The action is activated by ActionBeforeIoFile when segment_outbound is set, and
+    ActionIoFileOutbound is deactivated so the two don't race for the same pending
+    messages. See ism_comms.file.segment for the file format. Polling adapts to the
+    traffic when [comms][polling] is set, see ism_comms.core.scheduler.
+    """
+
+    poll_topic = 'outbound'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.writer = None
+
+    def execute(self):
+
+        if self.active():
+            self.poll(self.write_records)
+
+    def write_records(self) -> int:
+        """Append a batch of pending outbound messages to the segment log, returning the number found"""
+
+        try:
+            directory = self.properties['comms']['file']['segment_outbound']
+        except KeyError as e:
+            self.logger.error(f'Failed to read [comms][file] entries from properties. KeyError ({e})')
+            raise
+        batch_size = self.properties['comms']['file'].get('outbound_batch_size', 0)
+
+        if self.writer is None:
+            self.writer = SegmentWriter(
+                directory,
+                self.properties['comms']['file'].get('segment_bytes', 64 * 1024 * 1024),
+                self.properties['comms']['file'].get('durability')
+            )
+
+        # Query the messages table for outbound messages that aren't 'processed'
+        store = MessageStore(self.dao, self.properties['database']['rdbms'])
+        results = store.fetch_pending('outbound', batch_size)
+
+        if not results:
+            return 0
+
+        send_time = int(time.time())
+        codec = get_codec(self.properties['comms']['file'].get('codec', 'json'))
+        self.writer.append([codec.encode(record.message(send_time)) for record in results])
+        self.writer.commit()
+
+        # Mark the messages as processed and update the sent field with timestamp of epoch seconds
+        store.mark_processed([record.message_id for record in results], sent=send_time)
+        return len(results)
+
@@ -0,0 +1,86 @@
+"""Batched message files, holding every message of a tick for one recipient.
+
+With [comms][file][outbound_batch] set, ActionIoFileOutbound writes a recipient's
+messages for the tick into one file and one semaphore, rather than a pair per message:
+
+    <recipient>_<first sender_id>.batch
+    <recipient>_<first sender_id>.smp
+
+The file is framed like a segment, see ism_comms.file.segment. Each record is a header
+of its payload length and CRC32, both 4 byte big-endian unsigned ints, followed by the
+payload. The first record names the format, its version and the codec the messages are
+encoded with, e.g. "ism-batch 1 json", and every following record is one encoded message.
+
+A batch file is published like any other message file, so ActionIoFileInbound finds it
+by its semaphore and reads each message into its own row, in the same insert as the
+rest of the tick's messages. The file is only archived once all of them are in the
+messages table. The extension is set by [comms][file][batch_extension] (default
+.batch) on both sides.
+"""
+
+# Application imports
+from ism_comms.core.codecs import get_codec
+from ism_comms.file.exceptions.exceptions import MalformedBatchFile
+from ism_comms.file.segment import decode_records, encode_record
+
+# The codec name that marks the batch extension in a reader's (extension, codec name) pairs
+BATCH = 'batch'
+EXTENSION = '.batch'
+MAGIC = 'ism-batch'
+VERSION = 1
+
+
+def inbound_codecs(settings: dict) -> tuple:
+    """The message file extensions an inbound directory is read with, from [comms][file].
+
+    The configured codec comes first, then any [inbound_codecs] other senders use, then
+    batch files. The JSON codec keeps the configured message_extension, other codecs use
+    their own, see ism_comms.core.codecs. Without a semaphore, see [inbound_semaphore],
+    only the configured codec is read.
+
+    :return (extension, codec name) pairs in the order to try them, see
+    ism_comms.file.workers.decode_message_file(), and the extension that shows a
+    message is ready.
+    """
+
+    semaphore = settings.get('inbound_semaphore', True)
+    codecs = {}
+    names = [settings.get('codec', 'json')]
+    if semaphore:
+        names.extend(settings.get('inbound_codecs', []))
+    for name in names:
+        codec = get_codec(name)
+        codecs.setdefault(settings['message_extension'] if codec.name == 'json' else codec.extension, codec.name)
+    codec_names = tuple(codecs.items())
+    if not semaphore:
+        return codec_names, codec_names[0][0]
+    # Batch files are only published with a semaphore
+    return (*codec_names, (settings.get('batch_extension', EXTENSION), BATCH)), settings['semaphore_extension']
+
+
+def encode_batch(codec_name: str, messages) -> bytes:
+    """Frame the encoded messages as one batch file"""
+
+    records = [encode_record(f'{MAGIC} {VERSION} {codec_name}'.encode())]
+    records.extend(encode_record(data) for data in messages)
+    return b''.join(records)
+
+
+def decode_batch(data: bytes) -> tuple:
+    """Split a batch file into the name of its codec and the encoded messages.
+
+    :raises MalformedBatchFile if the header isn't a batch header or the file doesn't
+    end with a complete record.
+    :raises CorruptSegmentRecord if a record fails its CRC check.
+    """
+
+    payloads, end = decode_records(data, 0, len(data))
+    if end != len(data):
+        raise MalformedBatchFile(f'Batch file has ({len(data) - end}) bytes following its last complete record.')
+    try:
+        magic, version, codec_name = payloads[0].decode().split(' ')
+    except (IndexError, UnicodeDecodeError, ValueError):
+        raise MalformedBatchFile('Batch file does not start with a batch header.')
+    if magic != MAGIC or version != str(VERSION):
+        raise MalformedBatchFile(f'Batch file header ({magic} {version}) not recognised.')
+    return codec_name, payloads[1:]
@@ -0,0 +1,248 @@
+"""Pack the flat archive directory into rolling compressed bundles.
+
+ActionIoFileInbound renames every processed message file, and its semaphore, into the
+archive directory, which otherwise grows without limit. With [comms][file][archive_bundles]
+set, ActionIoFileBundleArchive moves those files into tar.gz bundles instead:
+
+    * Files are added to the open bundle, bundle-<epoch ms>.tar.gz.part, for up to
+    tick_budget_ms each tick.
+    * The bundle is rolled, i.e. closed and renamed without the .part suffix, once it
+    reaches max_bytes compressed or has been open for max_age seconds.
+    * Once rolled, its messages are indexed by (sender, sender_id) in the archive_index
+    table and their files removed from the archive directory, a chunk at a time within
+    the same tick budget.
+    * Bundles older than retention_days are deleted, along with their index rows.
+
+The files only leave the archive directory once the bundle holding them is complete,
+so a crash loses nothing. The .part bundle left behind is deleted on restart and its
+files bundled again. Each message of a batch file, see ism_comms.file.batches, is
+indexed on its own, and find_archived_message() returns just that message from the
+batch. A crash while a bundle's files are being removed can leave
+messages in two bundles, and find_archived_message() returns the newest. With
+[comms][file][durability] set to batch or strict, a bundle and its directory entry are
+fsynced as it's rolled, so the files aren't removed until it would survive a power
+loss too, see ism_comms.file.durability.
+"""
+
+# Standard library imports
+from collections import deque
+import io
+import os
+import tarfile
+import time
+
+# Application imports
+from ism_comms.core.codecs import get_codec, get_codec_for_extension
+from ism_comms.file.batches import EXTENSION, decode_batch
+from ism_comms.file.durability import NONE, SyncBatch
+
+BUNDLE_PREFIX = 'bundle-'
+BUNDLE_SUFFIX = '.tar.gz'
+PART_SUFFIX = '.part'
+
+
+def read_bundle_member(directory: str, bundle: str, member: str) -> bytes:
+    """Read one archived file back out of a bundle"""
+
+    with tarfile.open(f'{directory}{os.path.sep}{bundle}', 'r:gz') as archive:
+        return archive.extractfile(member).read()
+
+
+def find_archived_message(dao, directory: str, sender: str, sender_id: int, batch_extension=EXTENSION):
+    """Look up a message in the bundles by the sender's address and its ID for the message.
+
+    :param batch_extension The [comms][file][batch_extension] of batch files.
+    :return The message file content, or the message's record for one in a batch file,
+    or None if it isn't indexed.
+    """
+
+    results = dao.execute_sql_query(
+        dao.prepare_parameterised_statement(
+            'SELECT bundle, member FROM archive_index WHERE sender = ? AND sender_id = ? ORDER BY id DESC LIMIT 1'
+        ),
+        (sender, sender_id)
+    )
+    if not results:
+        return None
+    bundle, member = results[0]
+    data = read_bundle_member(directory, bundle, member)
+    if os.path.splitext(member)[1] != batch_extension:
+        return data
+    codec_name, messages = decode_batch(data)
+    codec = get_codec(codec_name)
+    for message in messages:
+        decoded = codec.decode(message)
+        if decoded.get('sender') == sender and decoded.get('sender_id') == sender_id:
+            return message
+    return None
+
+
+class BundleArchiver:
+    """Writes the files found in the archive directory into rolling bundles.
+
+    :param archive The flat archive directory.
+    :param directory Where the bundles are kept.
+    :param message_extension The extension of JSON message files, other codecs use their own.
+    :param max_bytes Roll the bundle once it's this size compressed.
+    :param max_age Roll the bundle once it's been open this many seconds.
+    :param rescan_interval Seconds to wait before listing the archive directory again once it's all been seen.
+    :param durability none, batch or strict, see ism_comms.file.durability.
+    :param batch_extension The extension of batch files, see ism_comms.file.batches.
+    """
+
+    def __init__(self, archive: str, directory: str, message_extension: str,
+                 max_bytes=67108864, max_age=3600, rescan_interval=1, durability=NONE, batch_extension=EXTENSION):
+        self.archive = archive
+        self.directory = directory
+        self.message_extension = message_extension
+        self.batch_extension = batch_extension
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.rescan_interval = rescan_interval
+        self.durability = durability
+        self.cursor = None
+        self.rescan_at = 0
+        self.raw = None
+        self.bundle = None
+        self.name = None
+        self.opened = 0
+        self.members = []
+        self.finishing = deque()
+        # Archive files already in a bundle but not yet removed
+        self.bundled = set()
+
+        # A bundle still being written when the process stopped is incomplete, and its files are still in the archive
+        for entry in os.listdir(directory):
+            if entry.endswith(PART_SUFFIX):
+                os.remove(f'{directory}{os.path.sep}{entry}')
+
+    def add(self, deadline: float) -> int:
+        """Add archived files to the open bundle until the deadline, a time.perf_counter() value.
+
+        :return The number of files added.
+        """
+
+        added = 0
+        while not self.full() and time.perf_counter() < deadline:
+            entry = self.next_entry()
+            if entry is None:
+                break
+            if entry.name in self.bundled:
+                continue
+            try:
+                with open(entry.path, 'rb') as file:
+                    data = file.read()
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+
+            if self.bundle is None:
+                self.open()
+            info = tarfile.TarInfo(entry.name)
+            info.size = len(data)
+            info.mtime = mtime
+            self.bundle.addfile(info, io.BytesIO(data))
+            self.members.append((entry.name, self.identify(entry.name, data)))
+            self.bundled.add(entry.name)
+            added += 1
+        return added
+
+    def next_entry(self):
+        """Return the next file from the archive directory, or None when it's all been seen for now"""
+
+        if self.cursor is None:
+            if time.monotonic() < self.rescan_at:
+                return None
+            self.cursor = os.scandir(self.archive)
+        for entry in self.cursor:
+            if entry.is_file():
+                return entry
+        self.close_cursor()
+        self.rescan_at = time.monotonic() + self.rescan_interval
+        return None
+
+    def identify(self, file_name: str, data: bytes) -> list:
+        """Return the (sender, sender_id, message_id) of each message in a file, an empty list for anything else"""
+
+        extension = os.path.splitext(file_name)[1]
+        try:
+            if extension == self.batch_extension:
+                codec_name, messages = decode_batch(data)
+                codec = get_codec(codec_name)
+            else:
+                codec = get_codec('json') if extension == self.message_extension else get_codec_for_extension(extension)
+                if codec is None:
+                    return []
+                messages = [data]
+            return [
+                (message.get('sender'), message.get('sender_id'), message.get('message_id'))
+                for message in map(codec.decode, messages)
+            ]
+        except Exception:
+            return []
+
+    def open(self):
+        self.name = f'{BUNDLE_PREFIX}{int(time.time() * 1000)}{BUNDLE_SUFFIX}'
+        self.raw = open(f'{self.directory}{os.path.sep}{self.name}{PART_SUFFIX}', 'wb')
+        self.bundle = tarfile.open(fileobj=self.raw, mode='w:gz')
+        self.opened = time.monotonic()
+
+    def full(self) -> bool:
+        return self.raw is not None and self.raw.tell() >= self.max_bytes
+
+    def due(self) -> bool:
+        """Is the open bundle full or old enough to roll?"""
+        return self.bundle is not None and (self.full() or time.monotonic() - self.opened >= self.max_age)
+
+    def roll(self):
+        """Complete the open bundle and queue its files to be indexed and removed"""
+
+        if self.bundle is None:
+            return
+        sync = SyncBatch(self.durability)
+        self.bundle.close()
+        sync.written(self.raw)
+        self.raw.close()
+        sync.barrier()
+        os.rename(
+            f'{self.directory}{os.path.sep}{self.name}{PART_SUFFIX}',
+            f'{self.directory}{os.path.sep}{self.name}'
+        )
+        sync.changed(self.directory)
+        sync.commit()
+        self.finishing.extend((self.name, *member) for member in self.members)
+        self.bundle = self.raw = self.name = None
+        self.members = []
+
+    def next_finished(self, count: int) -> list:
+        """Take up to count files from rolled bundles, as (bundle, file name, messages from identify())"""
+        return [self.finishing.popleft() for _ in range(min(count, len(self.finishing)))]
+
+    def remove(self, finished: list):
+        """Remove files, now indexed, from the archive directory"""
+
+        for bundle, file_name, _ in finished:
+            try:
+                os.remove(f'{self.archive}{os.path.sep}{file_name}')
+            except FileNotFoundError:
+                pass
+            self.bundled.discard(file_name)
+
+    def expire(self, retention: float) -> list:
+        """Delete bundles last written more than retention seconds ago.
+
+        :return The names of the bundles deleted.
+        """
+
+        expired = []
+        cutoff = time.time() - retention
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(BUNDLE_SUFFIX) and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                expired.append(entry.name)
+        return expired
+
+    def close_cursor(self):
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
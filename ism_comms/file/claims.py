@@ -0,0 +1,217 @@
+"""Share one inbound message directory between several consumers by claiming files.
+
+Two ISMs reading the same inbound directory, e.g. on a shared filesystem, would both
+find each message and race to read and archive it. With [comms][file][inbound_claim]
+set each consumer, or node, first claims the files it finds by renaming their
+semaphores into a claim directory of its own, and only reads the messages it claimed.
+A rename is atomic, so exactly one node wins each file and the rest skip it.
+
+Each node holds a lease, a file in the claims directory holding the time it expires,
+which it renews every third of the lease. When a node's lease has expired, e.g. it
+crashed, the first node to notice moves the dead node's claimed files into its own
+claim directory and reads them. A node that stops cleanly hands its unread claims back
+to the inbound directory and gives up its lease. e.g.
+    comms:
+      file:
+        inbound_claim:
+          node: ism-host-1
+          lease: 30
+
+The node name defaults to the host name and process ID, and the lease to 30 seconds.
+The claims directory defaults to .claims under the inbound directory, and must be on
+the same filesystem. A node's claim directory mirrors the inbound shards. e.g.
+<inbound>/.claims/ism-host-1/00a/msg1.smp
+
+Note that a node that stalls for longer than its lease can have its claims taken over
+while it's still reading them. The duplicate suppression in ism_comms.core.dedup keeps
+the messages table right, but set the lease well above the longest expected tick.
+
+ActionIoFileInbound makes its claims from the files each tick's scan finds with
+InboundClaims.take(), so [comms][file][inbound_claim] works with the watcher, shards
+and decode workers.
+"""
+
+# Standard library imports
+import os
+import socket
+import time
+
+LEASE_SUFFIX = '.lease'
+
+
+def default_node() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class InboundClaims:
+    """Claim, reclaim and release the files found in an inbound directory for one node.
+
+    :param inbound The inbound directory.
+    :param suffix The extension of the file that shows a message is ready. e.g. .smp
+    :param directories The shard subdirectories, [''] for a flat directory.
+    :param node This node's name, unique among the nodes sharing the directory.
+    :param lease Seconds a lease lasts without being renewed.
+    :param root The claims directory, defaults to .claims under the inbound directory.
+    """
+
+    def __init__(self, inbound: str, suffix: str, directories=('',), node=None, lease=30, root=None):
+        self.inbound = inbound
+        self.suffix = suffix
+        self.directories = directories
+        self.node = node or default_node()
+        self.lease = lease
+        self.root = root or os.path.join(inbound, '.claims')
+        self.directory = os.path.join(self.root, self.node)
+        self.lease_file = os.path.join(self.root, f'{self.node}{LEASE_SUFFIX}')
+        self.next_renewal = 0.0
+        self.held = False
+        for directory in directories:
+            os.makedirs(os.path.join(self.directory, directory), exist_ok=True)
+        # Claims left by an earlier run as the same node, read with the first files taken
+        self.resumed = self.claimed()
+
+    def path(self, file_name: str) -> str:
+        """The path of a claimed file, without its suffix"""
+        return os.path.join(self.directory, file_name)
+
+    def inbound_path(self, file_name: str) -> str:
+        """The path of an unclaimed file in the inbound directory, with its suffix"""
+        return f'{self.inbound}{os.path.sep}{file_name}{self.suffix}'
+
+    def due(self) -> bool:
+        """True when it's time to renew the lease and look for expired ones"""
+        return time.time() >= self.next_renewal
+
+    def renew(self) -> bool:
+        """Extend this node's lease.
+
+        :return False if the lease had already been taken over, i.e. it was held and the
+        lease file has gone. Claims made before then may have been reclaimed.
+        """
+
+        still_held = not self.held or os.path.exists(self.lease_file)
+        temp_file = f'{self.lease_file}.{os.getpid()}.tmp'
+        with open(temp_file, 'w') as file:
+            file.write(str(time.time() + self.lease))
+        os.replace(temp_file, self.lease_file)
+        self.held = True
+        self.next_renewal = time.time() + self.lease / 3
+        return still_held
+
+    def claim(self, file_names: list) -> list:
+        """Claim the files by moving each one into this node's claim directory.
+
+        :return The names claimed, leaving out those another node got to first.
+        """
+
+        claimed = []
+        for file_name in file_names:
+            try:
+                os.rename(self.inbound_path(file_name), f'{self.path(file_name)}{self.suffix}')
+            except FileNotFoundError:
+                continue
+            claimed.append(file_name)
+        return claimed
+
+    def take(self, file_names: list, skip=()) -> tuple:
+        """Claim the files found, with any claims resumed or taken over from expired leases.
+
+        The lease is renewed, and expired ones reclaimed, when due.
+
+        :param skip Names not to take from the resumed claims, e.g. waiting to be retried.
+        :return The names claimed, False if this node's lease had been taken over, and
+        the number of claims taken over from other nodes.
+        """
+
+        held = True
+        taken = []
+        if self.due():
+            held = self.renew()
+            taken = self.reclaim()
+            self.resumed.extend(taken)
+
+        claimed = self.claim(file_names)
+        claimed.extend(file_name for file_name in self.resumed if file_name not in skip)
+        self.resumed = []
+        return claimed, held, len(taken)
+
+    def claimed(self, node=None) -> list:
+        """The names of the files claimed by a node, this one by default"""
+
+        directory = os.path.join(self.root, node or self.node)
+        found = []
+        for shard in self.directories:
+            try:
+                with os.scandir(os.path.join(directory, shard)) as entries:
+                    found.extend(
+                        os.path.join(shard, entry.name[:-len(self.suffix)])
+                        for entry in entries if entry.name.endswith(self.suffix)
+                    )
+            except FileNotFoundError:
+                continue
+        return found
+
+    def expired(self) -> list:
+        """The names of the other nodes whose leases have expired"""
+
+        nodes = []
+        now = time.time()
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if not entry.name.endswith(LEASE_SUFFIX) or entry.name == os.path.basename(self.lease_file):
+                    continue
+                try:
+                    with open(entry.path) as file:
+                        expires = float(file.read() or 0)
+                except (FileNotFoundError, ValueError):
+                    continue
+                if expires < now:
+                    nodes.append(entry.name[:-len(LEASE_SUFFIX)])
+        return nodes
+
+    def reclaim(self) -> list:
+        """Take over the claims of every node whose lease has expired.
+
+        The lease file is removed once its node's claims have been moved, so if this
+        node stops part way through another node picks up the rest.
+
+        :return The names taken over.
+        """
+
+        taken = []
+        for node in self.expired():
+            directory = os.path.join(self.root, node)
+            for file_name in self.claimed(node):
+                try:
+                    os.rename(
+                        f'{os.path.join(directory, file_name)}{self.suffix}',
+                        f'{self.path(file_name)}{self.suffix}'
+                    )
+                except FileNotFoundError:
+                    continue
+                taken.append(file_name)
+            try:
+                os.remove(os.path.join(self.root, f'{node}{LEASE_SUFFIX}'))
+            except FileNotFoundError:
+                pass
+            for shard in (*(shard for shard in self.directories if shard), ''):
+                try:
+                    os.rmdir(os.path.join(directory, shard))
+                except OSError:
+                    pass
+        return taken
+
+    def release(self):
+        """Hand any claims not yet read back to the inbound directory and give up the lease"""
+
+        for file_name in self.claimed():
+            try:
+                os.rename(f'{self.path(file_name)}{self.suffix}', self.inbound_path(file_name))
+            except FileNotFoundError:
+                continue
+        try:
+            os.remove(self.lease_file)
+        except FileNotFoundError:
+            pass
+        self.held = False
+        self.next_renewal = 0.0
@@ -0,0 +1,107 @@
+"""When the files written by the file transports are forced to disk.
+
+By default nothing is fsynced. The data and directory entries sit in the page cache
+until the OS writes them back, so a power loss can leave a semaphore with a truncated
+message, or no message at all, behind it, and a message marked sent that never left.
+[comms][file][durability] selects a mode:
+
+    * none - (default) Never fsync.
+    * batch - Group commit. The files written in a tick are fsynced together once
+    they're all written, before any of them is published, i.e. renamed into place or
+    given a semaphore, and each directory changed is fsynced once per step rather than
+    per file. Only then are the rows marked processed, or the next step committed.
+    * strict - Each file is fsynced as it's written, and its directory as it's
+    published. The same guarantees as batch, at the cost of a sync per file.
+
+Both batch and strict mean a message marked sent, or archived, survives a power loss,
+and a semaphore is never left pointing at a message that didn't. batch costs two
+syncs per directory per tick rather than two per file.
+
+ActionIoFileInbound writes no files of its own, but with batch or strict it fsyncs
+the archive directory, and the directories the files were archived from, once the
+tick's files are moved. So archived messages aren't read again after a power loss.
+
+A file is fsynced in batch mode by opening it again, which flushes the writes made
+through any handle on Linux. Directories can't be opened on Windows, so aren't synced.
+"""
+
+# Standard library imports
+import os
+
+# Application imports
+from ism_comms.file.exceptions.exceptions import DurabilityModeNotRecognised
+
+NONE = 'none'
+BATCH = 'batch'
+STRICT = 'strict'
+MODES = (NONE, BATCH, STRICT)
+
+
+def fsync_path(path: str):
+    """fsync a file, or a directory's entries, by path"""
+
+    if os.name == 'nt' and os.path.isdir(path):
+        return
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+class SyncBatch:
+    """Collects the files and directories written in a tick and syncs them as the mode asks.
+
+    Writers call written() for each file before closing it, barrier() once the files are
+    written and before they're published, changed() for each directory a file is
+    renamed or created in, and commit() before recording the work as done.
+
+    :param mode none, batch or strict.
+    """
+
+    def __init__(self, mode=NONE):
+        mode = (mode or NONE).lower()
+        if mode not in MODES:
+            raise DurabilityModeNotRecognised(f'Durability mode ({mode}) not recognised, expected one of {MODES}')
+        self.mode = mode
+        self.files = []
+        self.directories = []
+        self.syncs = 0
+
+    def written(self, file):
+        """A file has been written through the open file object passed in"""
+
+        if self.mode == NONE:
+            return
+        file.flush()
+        if self.mode == STRICT:
+            os.fsync(file.fileno())
+            self.syncs += 1
+        else:
+            self.files.append(file.name)
+
+    def barrier(self):
+        """Sync the files written so far, before any of them is published"""
+
+        for path in self.files:
+            fsync_path(path)
+        self.syncs += len(self.files)
+        self.files = []
+
+    def changed(self, directory: str):
+        """An entry in the directory has been created, renamed or removed"""
+
+        if self.mode == STRICT:
+            fsync_path(directory)
+            self.syncs += 1
+        elif self.mode == BATCH and directory not in self.directories:
+            self.directories.append(directory)
+
+    def commit(self):
+        """Sync everything outstanding, before the work is recorded as done"""
+
+        self.barrier()
+        for directory in self.directories:
+            fsync_path(directory)
+        self.syncs += len(self.directories)
+        self.directories = []
@@ -6,3 +6,31 @@ class MissingPropertyKey(EnvironmentError):
     def __init(self, message='Property not found in properties file:'):
         self.message = message
         super().__init__(self.message)
+
+
+class CorruptSegmentRecord(Exception):
+
+    def __init__(self, message='Segment record failed its CRC check'):
+        self.message = message
+        super().__init__(self.message)
+
+
+class DurabilityModeNotRecognised(Exception):
+
+    def __init__(self, message='Durability mode not recognised, expected none, batch or strict'):
+        self.message = message
+        super().__init__(self.message)
+
+
+class MalformedBatchFile(Exception):
+
+    def __init__(self, message='Batch file not recognised'):
+        self.message = message
+        super().__init__(self.message)
+
+
+class RecipientNotRoutable(Exception):
+
+    def __init__(self, message='Recipient name can not be used as an outbound directory'):
+        self.message = message
+        super().__init__(self.message)
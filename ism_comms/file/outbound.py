@@ -0,0 +1,120 @@
+"""Write a batch of outbound message files, published once they're on disk.
+
+The files are written in three steps so that, whatever the durability mode, a reader
+never finds a semaphore before its message is complete:
+
+    1. Each message is written, to a hidden temp file in atomic mode.
+    2. In atomic mode, once the messages are synced, each temp file is renamed into place.
+    3. Once the messages and their names are synced, the semaphores are created.
+
+With a SyncBatch in batch mode that's one sync per file and two or three per directory
+per batch, see ism_comms.file.durability.
+
+OutboundRoutes picks the directory each recipient's files are written to. By default
+every recipient shares the outbound directory. A recipient can be given its own with
+[comms][file][outbound_routes], and [comms][file][outbound_per_recipient] gives every
+other recipient <outbound>/<recipient>. e.g.
+    comms:
+      file:
+        outbound_routes:
+          ism_b: /var/spool/ism_b
+          ism_c: ism_c_inbox
+        outbound_per_recipient: true
+
+Relative routes are under the outbound directory. Directories are created the first
+time a message is written for their recipient.
+"""
+
+# Standard library imports
+import os
+
+# Application imports
+from ism_comms.file.durability import SyncBatch
+from ism_comms.file.exceptions.exceptions import RecipientNotRoutable
+
+
+class OutboundRoutes:
+    """The outbound directory for each recipient, created on first use.
+
+    :param outbound The resolved outbound directory.
+    :param routes The [comms][file][outbound_routes] mapping of recipient to directory.
+    :param per_recipient Route recipients without a route to <outbound>/<recipient>.
+    """
+
+    def __init__(self, outbound: str, routes=None, per_recipient=False):
+        self.outbound = outbound
+        self.routes = {
+            recipient: path if os.path.isabs(path) else f'{outbound}{os.path.sep}{path}'
+            for recipient, path in (routes or {}).items()
+        }
+        self.per_recipient = per_recipient
+        self.created = {outbound}
+
+    def directory(self, recipient: str, sync=None) -> str:
+        """The directory to write the recipient's files to.
+
+        :param sync The SyncBatch to record a new directory's parent as changed in.
+
+        :raises RecipientNotRoutable if the recipient would be its own directory but
+        it has no name, or its name isn't a single path component.
+        """
+
+        directory = self.routes.get(recipient)
+        if directory is None:
+            if not self.per_recipient:
+                return self.outbound
+            separators = ('/', os.path.sep, os.path.altsep)
+            if not isinstance(recipient, str) or recipient in ('', '.', '..') or \
+                    any(sep and sep in recipient for sep in separators):
+                raise RecipientNotRoutable(f'Recipient ({recipient}) can not be used as an outbound directory name.')
+            directory = f'{self.outbound}{os.path.sep}{recipient}'
+        if directory not in self.created:
+            os.makedirs(directory, exist_ok=True)
+            self.created.add(directory)
+            if sync is not None:
+                sync.changed(os.path.dirname(directory))
+        return directory
+
+
+def write_message_files(outbound: str, messages, extension: str, semaphore_extension: str,
+                        mode='legacy', semaphore=True, sync=None) -> int:
+    """Write (file name, data) pairs into the outbound directory, returning the bytes written.
+
+    The pairs can come from a generator, so only one message need be encoded at a time.
+
+    :param mode legacy or atomic, see ActionIoFileOutbound.
+    :param semaphore Whether to write semaphores in atomic mode. They're always written in legacy mode.
+    :param sync The SyncBatch to sync the files with, committed before returning. None for no syncing.
+    """
+
+    if sync is None:
+        sync = SyncBatch()
+
+    files = []
+    written = 0
+    for name, data in messages:
+        file_name = f'{outbound}{os.path.sep}{name}'
+        # Write to a hidden temp file in atomic mode, to be published in one step
+        path = f'{outbound}{os.path.sep}.{name}{extension}.tmp' if mode == 'atomic' else f'{file_name}{extension}'
+        with open(path, 'wb') as file:
+            file.write(data)
+            sync.written(file)
+        files.append((path, file_name))
+        written += len(data)
+
+    if mode == 'atomic':
+        sync.barrier()
+        for path, file_name in files:
+            os.rename(path, f'{file_name}{extension}')
+            sync.changed(outbound)
+    else:
+        sync.changed(outbound)
+
+    if semaphore or mode != 'atomic':
+        sync.commit()
+        for _, file_name in files:
+            with open(f'{file_name}{semaphore_extension}', 'w') as file:
+                file.write('')
+            sync.changed(outbound)
+    sync.commit()
+    return written
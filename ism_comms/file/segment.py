@@ -0,0 +1,217 @@
+"""Append-only segment files for high-volume file IO.
+
+Instead of one message file and one semaphore per message, a producer appends records
+to a rolling series of segment files in a directory:
+
+    <directory>/000000000000.seg
+    <directory>/000000000001.seg
+    <directory>/committed
+
+Each record is a header of its payload length and CRC32, both 4 byte big-endian
+unsigned ints, followed by the payload. Segments roll once they reach segment_bytes.
+
+The small committed file holds "<segment> <offset>", the end of the last complete
+batch. The writer replaces it with an atomic rename once the batch is flushed, so a
+reader never sees a partial record. Each reader records its own position in
+<directory>/<reader>.offset once the records it read have been committed to the DB.
+
+With a durability of batch or strict the writer fsyncs the segments appended to before
+the committed file is replaced, then the new committed file and the directory, once
+per batch either way, see ism_comms.file.durability.
+"""
+
+# Standard library imports
+import mmap
+import os
+import struct
+import zlib
+
+# Application imports
+from ism_comms.file.durability import NONE, SyncBatch
+from ism_comms.file.exceptions.exceptions import CorruptSegmentRecord
+
+HEADER = struct.Struct('>II')
+COMMITTED = 'committed'
+SUFFIX = '.seg'
+
+
+def encode_record(payload: bytes) -> bytes:
+    """Frame a payload as a segment record"""
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_records(buffer, offset: int, end: int, limit=0, corrupt=None) -> tuple:
+    """Decode the complete records in buffer[offset:end].
+
+    :param buffer Any object supporting the buffer protocol. e.g. bytes or an mmap.
+    :param limit Max records to decode, 0 for no limit.
+    :param corrupt If a list, the offsets of records that fail their CRC check are
+    appended to it and the records skipped. Otherwise CorruptSegmentRecord is raised.
+    :return A list of payloads and the offset following the last record decoded.
+    """
+
+    payloads = []
+    while offset + HEADER.size <= end and (not limit or len(payloads) < limit):
+        length, crc = HEADER.unpack_from(buffer, offset)
+        start = offset + HEADER.size
+        if start + length > end:
+            break
+        payload = bytes(buffer[start:start + length])
+        if zlib.crc32(payload) == crc:
+            payloads.append(payload)
+        elif corrupt is None:
+            raise CorruptSegmentRecord(f'CRC mismatch in segment record at offset ({offset}).')
+        else:
+            corrupt.append(offset)
+        offset = start + length
+    return payloads, offset
+
+
+def segment_path(directory: str, segment: int) -> str:
+    return f'{directory}{os.path.sep}{segment:012d}{SUFFIX}'
+
+
+def read_position(path: str) -> tuple:
+    """Read a "<segment> <offset>" position file, or (0, 0) if there isn't one"""
+    try:
+        with open(path, 'r') as file:
+            segment, offset = file.read().split()
+            return int(segment), int(offset)
+    except FileNotFoundError:
+        return 0, 0
+
+
+def write_position(path: str, position: tuple, sync=None):
+    """Atomically replace a position file, synced as part of the SyncBatch if one's passed in"""
+    temp = f'{path}.tmp'
+    with open(temp, 'w') as file:
+        file.write(f'{position[0]} {position[1]}')
+        if sync is not None:
+            sync.written(file)
+    if sync is not None:
+        sync.barrier()
+    os.replace(temp, path)
+    if sync is not None:
+        sync.changed(os.path.dirname(path))
+
+
+class SegmentWriter:
+    """Append records to the segments in a directory.
+
+    Only one writer may append to a directory at a time. On start up anything written
+    after the last commit, e.g. by a writer that crashed mid batch, is discarded.
+
+    :param durability none, batch or strict, see ism_comms.file.durability.
+    """
+
+    def __init__(self, directory: str, segment_bytes=64 * 1024 * 1024, durability=NONE):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.sync = SyncBatch(durability)
+        self.segment, self.offset = read_position(f'{directory}{os.path.sep}{COMMITTED}')
+        self.file = open(segment_path(directory, self.segment), 'ab')
+        self.file.truncate(self.offset)
+
+    def append(self, payloads: list):
+        """Append a batch of payloads. They are not visible to readers until commit()"""
+
+        for payload in payloads:
+            if self.offset >= self.segment_bytes:
+                self.roll()
+            record = encode_record(payload)
+            self.file.write(record)
+            self.offset += len(record)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def commit(self):
+        """Flush the appended records and publish the new end of the log"""
+        self.file.flush()
+        self.sync.written(self.file)
+        self.sync.barrier()
+        write_position(f'{self.directory}{os.path.sep}{COMMITTED}', (self.segment, self.offset), self.sync)
+        self.sync.commit()
+
+    def roll(self):
+        """Start the next segment"""
+        self.sync.written(self.file)
+        self.sync.changed(self.directory)
+        self.file.close()
+        self.segment += 1
+        self.offset = 0
+        self.file = open(segment_path(self.directory, self.segment), 'wb')
+
+
+class SegmentReader:
+    """Read the committed records from a directory of segments.
+
+    :param directory The segment directory.
+    :param name Identifies this reader's offset file in the directory.
+    :param archive If set, fully consumed segments are moved to this directory as
+    <name>_<segment>.seg. Only archive when this is the only reader of the directory.
+    :param skip_corrupt If true, read() skips corrupt records rather than raising
+    CorruptSegmentRecord, and lists their (segment, offset) in self.corrupt. A record
+    whose header is damaged can't be stepped over, so the rest of its segment is lost.
+    """
+
+    def __init__(self, directory: str, name: str, archive=None, skip_corrupt=False):
+        self.directory = directory
+        self.name = name
+        self.archive = archive
+        self.skip_corrupt = skip_corrupt
+        self.corrupt = []
+        self.offset_file = f'{directory}{os.path.sep}{name}.offset'
+        self.position = read_position(self.offset_file)
+        self.next_position = self.position
+
+    def commit(self):
+        """Record that everything returned by read() has been processed"""
+
+        write_position(self.offset_file, self.next_position)
+        if self.archive:
+            for segment in range(self.position[0], self.next_position[0]):
+                path = segment_path(self.directory, segment)
+                if os.path.exists(path):
+                    os.rename(path, f'{self.archive}{os.path.sep}{self.name}_{segment:012d}{SUFFIX}')
+        self.position = self.next_position
+
+    def read(self, limit=0) -> list:
+        """Return up to limit payloads following the committed position, 0 for no limit.
+
+        Calling read() again before commit() reads the same records again.
+        """
+
+        committed = read_position(f'{self.directory}{os.path.sep}{COMMITTED}')
+        segment, offset = self.position
+        payloads = []
+        self.corrupt = []
+        while (segment, offset) < committed and (not limit or len(payloads) < limit):
+            path = segment_path(self.directory, segment)
+            with open(path, 'rb') as file:
+                end = committed[1] if segment == committed[0] else os.fstat(file.fileno()).st_size
+                if end > offset:
+                    corrupt = [] if self.skip_corrupt else None
+                    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                        records, offset = decode_records(
+                            buffer, offset, end, limit and limit - len(payloads), corrupt
+                        )
+                    payloads.extend(records)
+                    if corrupt:
+                        self.corrupt.extend((segment, position) for position in corrupt)
+                    # Committed data only holds whole records, so a record that runs past the end is damaged
+                    if offset < end and not (limit and len(payloads) >= limit):
+                        if not self.skip_corrupt:
+                            raise CorruptSegmentRecord(
+                                f'Segment record at offset ({offset}) of ({path}) runs past the committed end.'
+                            )
+                        self.corrupt.append((segment, offset))
+                        offset = end
+            if offset < end or segment == committed[0]:
+                break
+            segment, offset = segment + 1, 0
+
+        self.next_position = (segment, offset)
+        return payloads
@@ -0,0 +1,101 @@
+"""Hash sharding and incremental scanning of the inbound message directory.
+
+With a large backlog a single flat inbound directory makes every listing O(n) and slows
+down directory lookups. When [comms][file][inbound_shards] is set, ActionBeforeIoFile
+creates that many subdirectories under the inbound directory and producers drop each
+message, and its semaphore, into the subdirectory chosen by shard_for().
+
+ActionIoFileInbound polls with a DirectoryScanner, an os.scandir cursor that visits
+the shards round robin and examines at most [comms][file][inbound_scan_budget] entries
+per tick (default 0, no limit). So a tick costs the same whatever the size of the
+backlog.
+"""
+
+# Standard library imports
+import os
+import zlib
+
+
+def shard_names(shards: int) -> list:
+    """Return the names of the shard subdirectories, or [''] for a flat directory"""
+    if not shards:
+        return ['']
+    return [f'{index:03x}' for index in range(shards)]
+
+
+def shard_for(file_name: str, shards: int) -> str:
+    """Return the shard subdirectory a producer should write a message into.
+
+    :param file_name The message file name without its extension, so that the
+    message and its semaphore always land in the same shard.
+    :param shards The number of shards configured by the consumer.
+    """
+    if not shards:
+        return ''
+    return f'{zlib.crc32(file_name.encode()) % shards:03x}'
+
+
+class DirectoryScanner:
+    """Incrementally scan the inbound directory, or its shards, for semaphore files.
+
+    An os.scandir cursor is held open between calls and the directories are visited
+    round robin, so the cost of one call depends on its limit and budget rather than
+    on the size of the backlog.
+
+    Names are returned relative to the root directory and without the suffix. e.g.
+    00a/msg1 for <root>/00a/msg1.smp
+    """
+
+    def __init__(self, root: str, directories: list, suffix: str):
+        self.root = root
+        self.directories = directories
+        self.suffix = suffix
+        self.index = 0
+        self.cursor = None
+
+    def close(self):
+        """Release the scandir cursor, the next scan starts the current directory again"""
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+
+    def list_all(self) -> list:
+        """Return every semaphore in every directory, leaving the cursor untouched"""
+
+        found = []
+        for directory in self.directories:
+            with os.scandir(os.path.join(self.root, directory)) as entries:
+                found.extend(
+                    os.path.join(directory, entry.name[:-len(self.suffix)])
+                    for entry in entries if entry.name.endswith(self.suffix)
+                )
+        return found
+
+    def scan(self, limit=0, budget=0) -> list:
+        """Return the next semaphores found from the cursor position.
+
+        Each directory is visited at most once per call.
+
+        :param limit Max semaphores to return, 0 for no limit.
+        :param budget Max directory entries to examine, 0 for no limit.
+        """
+
+        found = []
+        examined = 0
+        visited = 0
+        while visited < len(self.directories):
+            directory = self.directories[self.index]
+            if self.cursor is None:
+                self.cursor = os.scandir(os.path.join(self.root, directory))
+            for entry in self.cursor:
+                examined += 1
+                if entry.name.endswith(self.suffix):
+                    found.append(os.path.join(directory, entry.name[:-len(self.suffix)]))
+                    if limit and len(found) >= limit:
+                        return found
+                if budget and examined >= budget:
+                    return found
+            self.close()
+            self.index = (self.index + 1) % len(self.directories)
+            visited += 1
+        return found
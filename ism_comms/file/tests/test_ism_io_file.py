@@ -5,15 +5,149 @@
 
 # Standard library imports
 import json
+from multiprocessing import Pool
 import ntpath
 import os
 import shutil
-from time import sleep
+import tarfile
+import tempfile
+from time import perf_counter, sleep
 import unittest
+from unittest import mock
 import yaml
 
 # Local application imports
 from ism.ISM import ISM
+from ism.core.base_action import BaseAction
+from ism_comms.core.action_io_check_msg_table import ActionIoCheckMsgTable
+from ism_comms.core.blobs import BlobHandle, get_blob_settings, open_payload, spill_payload
+from ism_comms.core.codecs import get_codec, get_codec_for_extension
+from ism_comms.core.dedup import BloomFilter, get_filter
+from ism_comms.core.metrics import NULL_METRICS, get_metrics
+from ism_comms.core.scheduler import AdaptivePolling, wake
+from ism_comms.core.store import (
+    DUPLICATE, FAILED, INSERTED, InboundRecord, MessageStore, OutboundRecord, inbound_row, recipient_filter
+)
+from ism_comms.file.batches import decode_batch, encode_batch
+from ism_comms.file.bundles import BUNDLE_SUFFIX, BundleArchiver, find_archived_message, read_bundle_member
+from ism_comms.file.claims import InboundClaims
+from ism_comms.file.durability import SyncBatch
+from ism_comms.file.exceptions.exceptions import CorruptSegmentRecord, MalformedBatchFile, RecipientNotRoutable
+from ism_comms.file.outbound import OutboundRoutes, write_message_files
+from ism_comms.file.segment import SegmentReader, SegmentWriter, encode_record, read_position, segment_path
+from ism_comms.file.shards import DirectoryScanner, shard_for
+from ism_comms.file.workers import DecodePool, decode_message_file
+
+
+def claim_messages(inbound: str, archive: str, node: str, delay: float) -> list:
+    """Claim and archive message semaphores from a shared inbound directory as one node, in a process of its own.
+
+    :param delay Seconds of work per message.
+    :return The names this node archived.
+    """
+
+    claims = InboundClaims(inbound, '.smp', node=node, lease=5)
+    scanner = DirectoryScanner(inbound, [''], '.smp')
+    archived = []
+    idle = 0
+    while idle < 5:
+        file_names = []
+        if claims.due():
+            claims.renew()
+            file_names.extend(claims.reclaim())
+        found = scanner.scan(10)
+        file_names.extend(claims.claim(found))
+        if not found and not file_names:
+            idle += 1
+            sleep(.01)
+            continue
+        idle = 0
+        for file_name in file_names:
+            sleep(delay)
+            os.rename(f'{claims.path(file_name)}.smp', f'{archive}{os.path.sep}{file_name}.smp')
+            archived.append(file_name)
+    scanner.close()
+    claims.release()
+    return archived
+
+
+class PowerLossModel:
+    """Records a writer's file operations, to work out what a power loss after any of them could leave on disk.
+
+    A file's content is sure to survive if it was fsynced after it was written, and its
+    name if the directory was fsynced after the name was created or renamed. Any name
+    created may survive anyway, e.g. written back by the filesystem's own journal
+    commit, with or without its content. Linux only, as fsynced descriptors are mapped
+    back to their paths through /proc.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.real = {'open': open, 'rename': os.rename, 'fsync': os.fsync}
+
+    def open(self, path, mode='r', *args, **kwargs):
+        if 'w' in mode:
+            self.events.append(('write', path))
+        return self.real['open'](path, mode, *args, **kwargs)
+
+    def rename(self, source, destination):
+        self.real['rename'](source, destination)
+        self.events.append(('rename', source, destination))
+
+    def fsync(self, descriptor):
+        self.real['fsync'](descriptor)
+        path = os.readlink(f'/proc/self/fd/{descriptor}')
+        self.events.append(('sync_directory' if os.path.isdir(path) else 'sync', path))
+
+    def recording(self, module: str):
+        """Patch the file operations of the module under test, and fsync"""
+        patches = mock.patch(f'{module}.open', self.open, create=True)
+        patches.start()
+        self.stop = [patches.stop]
+        for name in ('rename', 'fsync'):
+            patch = mock.patch(f'os.{name}', getattr(self, name))
+            patch.start()
+            self.stop.append(patch.stop)
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for stop in reversed(self.stop):
+            stop()
+
+    def names(self, count: int) -> set:
+        """The paths a power loss after the first count events might leave"""
+
+        names = set()
+        for kind, path, *destination in self.events[:count]:
+            if kind == 'write':
+                names.add(path)
+            elif kind == 'rename':
+                names.discard(path)
+                names.add(destination[0])
+        return names
+
+    def survivors(self, count: int) -> dict:
+        """The paths a power loss after the first count events is sure to leave, and whether each one's content is"""
+
+        names = {}
+        durable_names = {}
+        durable_content = set()
+        for index, (kind, path, *destination) in enumerate(self.events[:count]):
+            if kind == 'write':
+                names[path] = index
+            elif kind == 'rename':
+                names[destination[0]] = names.pop(path)
+            elif kind == 'sync':
+                durable_content.add(names[path])
+            else:
+                durable_names[path] = {name: file for name, file in names.items() if os.path.dirname(name) == path}
+        return {
+            name: file in durable_content
+            for directory in durable_names.values() for name, file in directory.items()
+        }
 
 
 class TestIsmIoFile(unittest.TestCase):
@@ -151,6 +285,30 @@ class TestIsmIoFile(unittest.TestCase):
 
         return True
 
+    @staticmethod
+    def send_inbound_msg_files(count: int, properties: dict, first_id=1, shards=0):
+        """Write count generated messages, with their semaphores, into the inbound dir or its shards"""
+
+        while not os.path.exists(properties["comms"]["file"]["inbound"]):
+            sleep(.01)
+
+        for message_id in range(first_id, first_id + count):
+            inbound = os.path.join(properties["comms"]["file"]["inbound"], shard_for(f'msg{message_id}', shards))
+            while not os.path.exists(inbound):
+                sleep(.01)
+            msg = {
+                "message_id": message_id,
+                "sender": "test_inbound_msg_files",
+                "sender_id": message_id,
+                "action": "ActionDummy",
+                "payload": {"index": message_id},
+                "sent": "Thursday lunchtime"
+            }
+            with open(f'{inbound}{os.path.sep}msg{message_id}.json', 'w') as file:
+                file.write(json.dumps(msg))
+            with open(f'{inbound}{os.path.sep}msg{message_id}.smp', 'w') as semaphore:
+                semaphore.write('')
+
     # The tests
     def test_import_comms_before_file_actions_sqlite3(self):
         """Test that the ism imports the file based comms actions.
@@ -303,6 +461,478 @@ class TestIsmIoFile(unittest.TestCase):
         # main thread exits, as this gives a cleaner shutdown.
         ism.stop()
 
+    def test_inbound_msg_file_batch_sqlite3(self):
+        """Test that ActionIoFileInbound ingests a backlog of messages in bounded batches.
+
+        Every message should be inserted exactly once and archived.
+        """
+
+        sender_id = 5
+        count = 25
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['file']['inbound_batch_size'] = 10
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.start()
+
+        self.send_inbound_msg_files(count, ism.properties)
+        for message_id in range(1, count + 1):
+            self.assertTrue(
+                self.wait_for_message_archive(f'msg{message_id}', ism.properties),
+                f'Expected message file msg{message_id} to be archived'
+            )
+
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT COUNT(*), COUNT(DISTINCT message_id) FROM messages",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+
+        self.assertEqual([count, count], result[0], 'expected each message to be inserted exactly once')
+
+        ism.stop()
+
+    def test_inbound_msg_file_failed_retry_sqlite3(self):
+        """Test that a message file whose row fails to insert is left in the inbox and read again after the interval"""
+
+        sender_id = 14
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['file']['inbound_retry_interval'] = .5
+
+        # Fail the first insert, as if the database were locked
+        insert_many = MessageStore.insert_many
+        failed = []
+
+        def insert_many_once(store, rows, logger):
+            if not failed:
+                failed.append(len(rows))
+                return [False] * len(rows)
+            return insert_many(store, rows, logger)
+
+        with mock.patch.object(MessageStore, 'insert_many', insert_many_once):
+            ism.import_action_pack('ism.tests.support')
+            ism.import_action_pack('ism_comms.file.actions')
+            ism.start()
+
+            self.send_inbound_msg_files(1, ism.properties, first_id=30)
+            self.assertTrue(
+                self.wait_for_message_archive('msg30', ism.properties),
+                'expected the message file to be archived once it was read again'
+            )
+            msg = {
+                "action": "ActionRunSqlQuery",
+                "payload": {
+                    "sql": "SELECT message_id FROM messages WHERE sender = 'test_inbound_msg_files'",
+                    "sender_id": sender_id
+                }
+            }
+            result = self.query_test_support_pack(msg)
+
+            self.assertEqual([1], failed, 'expected the first insert to fail')
+            self.assertEqual([[30]], result)
+
+            ism.stop()
+
+    def test_inbound_msg_file_orphaned_semaphore_sqlite3(self):
+        """Test that a semaphore without a message file is quarantined without holding up the rest of its batch"""
+
+        sender_id = 22
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.start()
+
+        inbound = ism.properties['comms']['file']['inbound']
+        while not os.path.exists(inbound):
+            sleep(.01)
+        with open(f'{inbound}{os.path.sep}orphan.smp', 'w') as semaphore:
+            semaphore.write('')
+        self.send_inbound_msg_files(3, ism.properties, first_id=40)
+
+        for message_id in range(40, 43):
+            self.assertTrue(
+                self.wait_for_message_archive(f'msg{message_id}', ism.properties),
+                f'Expected message file msg{message_id} to be archived'
+            )
+        quarantine = ism.properties['comms']['file']['quarantine']
+        retries = 100
+        while not os.path.exists(f'{quarantine}{os.path.sep}orphan.smp') and retries:
+            retries -= 1
+            sleep(.1)
+        self.assertTrue(os.path.exists(f'{quarantine}{os.path.sep}orphan.smp'), 'expected the semaphore quarantined')
+        self.assertFalse(os.path.exists(f'{inbound}{os.path.sep}orphan.smp'))
+
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT COUNT(*) FROM messages WHERE sender = 'test_inbound_msg_files'",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual([3], result[0], 'expected the messages alongside the orphan to be inserted')
+
+        ism.stop()
+
+    def test_inbound_msg_file_duplicate_sqlite3(self):
+        """Test that one message that can't be inserted doesn't hold back the rest of its batch.
+
+        With raise_on_sql_error set, a duplicate message_id fails the batch insert. The other
+        messages should be inserted singly and archived, and the duplicate left in the inbox.
+        """
+
+        sender_id = 14
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.dao.raise_on_sql_error = True
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.dao.execute_sql_statement(
+            "INSERT INTO messages (message_id, sender, sender_id, action, payload, sent) "
+            "VALUES (2, 'test_duplicate', 2, 'ActionDummy', NULL, '0')"
+        )
+        ism.start()
+
+        self.send_inbound_msg_files(3, ism.properties)
+        for message_id in (1, 3):
+            self.assertTrue(
+                self.wait_for_message_archive(f'msg{message_id}', ism.properties),
+                f'Expected message file msg{message_id} to be archived'
+            )
+        self.assertTrue(
+            os.path.exists(f'{ism.properties["comms"]["file"]["inbound"]}{os.path.sep}msg2.json'),
+            'expected the duplicate message file to be left in the inbound directory'
+        )
+
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT message_id, sender FROM messages ORDER BY message_id",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual(
+            [[1, 'test_inbound_msg_files'], [2, 'test_duplicate'], [3, 'test_inbound_msg_files']],
+            result[:3]
+        )
+
+        ism.stop()
+
+    def test_inbound_msg_file_dedup_sqlite3(self):
+        """Test that a message received twice from the same (sender, sender_id) is only inserted once.
+
+        The fourth message is already in the table, as if a crash had left its file in the
+        inbox after the batch committed. It and the re-sent messages should be archived.
+        """
+
+        sender_id = 21
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.dao.raise_on_sql_error = True
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.dao.execute_sql_statement(
+            "INSERT INTO messages (message_id, sender, sender_id, action, payload, sent) "
+            "VALUES (4, 'test_inbound_msg_files', 4, 'ActionDummy', NULL, '0')"
+        )
+        ism.start()
+
+        self.send_inbound_msg_files(4, ism.properties)
+        for message_id in range(1, 5):
+            self.assertTrue(
+                self.wait_for_message_archive(f'msg{message_id}', ism.properties),
+                f'Expected message file msg{message_id} to be archived'
+            )
+        for message_id in range(1, 5):
+            os.remove(f'{ism.properties["comms"]["file"]["archive"]}{os.path.sep}msg{message_id}.smp')
+        self.send_inbound_msg_files(4, ism.properties)
+        for message_id in range(1, 5):
+            self.assertTrue(
+                self.wait_for_message_archive(f'msg{message_id}', ism.properties),
+                f'Expected re-sent message file msg{message_id} to be archived'
+            )
+
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT COUNT(*), COUNT(DISTINCT sender_id) FROM messages "
+                       "WHERE sender = 'test_inbound_msg_files'",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual([4, 4], result[0], 'expected each message to be inserted exactly once')
+
+        ism.stop()
+
+    def test_inbound_msg_file_blobs_sqlite3(self):
+        """Test that a payload over [comms][blobs][threshold] is spilled to the blob store and read back lazily"""
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['blobs'] = {'threshold': 1000}
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.start()
+
+        self.send_inbound_msg_files(2, ism.properties)
+        large = {"data": "x" * 5000}
+        message = {
+            "message_id": 3,
+            "sender": "test_inbound_msg_files",
+            "sender_id": 3,
+            "action": "ActionDummy",
+            "payload": large,
+            "sent": "Thursday lunchtime"
+        }
+        with open(f'{ism.properties["comms"]["file"]["inbound"]}{os.path.sep}msg3.json', 'w') as file:
+            file.write(json.dumps(message))
+        with open(f'{ism.properties["comms"]["file"]["inbound"]}{os.path.sep}msg3.smp', 'w') as semaphore:
+            semaphore.write('')
+        for message_id in range(1, 4):
+            self.assertTrue(
+                self.wait_for_message_archive(f'msg{message_id}', ism.properties),
+                f'Expected message file msg{message_id} to be archived'
+            )
+        ism.stop()
+
+        payloads = ism.dao.execute_sql_query('SELECT payload FROM messages ORDER BY message_id')
+        self.assertEqual({"index": 1}, open_payload(payloads[0][0], ism.properties), 'expected small payloads inline')
+        self.assertLess(len(payloads[2][0]), 100, 'expected a reference in place of the large payload')
+        handle = open_payload(payloads[2][0], ism.properties)
+        self.assertIsInstance(handle, BlobHandle)
+        self.assertEqual(large, handle.json())
+
+    def test_inbound_msg_file_inotify_sqlite3(self):
+        """Test that ActionIoFileInbound picks up messages reported by the inotify watcher.
+
+        Messages already waiting when the ISM starts are found by the startup scan, later
+        messages by the watcher.
+        """
+
+        sender_id = 6
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['file']['inbound_watch'] = 'inotify'
+        ism.properties['comms']['file']['inbound_batch_size'] = 3
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.start()
+
+        self.send_inbound_msg_files(5, ism.properties)
+        self.assertTrue(self.wait_for_message_archive('msg5', ism.properties))
+        self.send_inbound_msg_files(5, ism.properties, first_id=6)
+        for message_id in range(1, 11):
+            self.assertTrue(
+                self.wait_for_message_archive(f'msg{message_id}', ism.properties),
+                f'Expected message file msg{message_id} to be archived'
+            )
+
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT COUNT(*) FROM messages",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+
+        self.assertEqual(10, result[0][0], 'expected all ten messages in the messages table')
+        self.assertEqual('inotify', ism.properties['comms']['file']['inbound_watch'])
+
+        ism.stop()
+
+        # Once deactivated, the action's next tick should release the inotify descriptor
+        ism.ism_thread.join(5)
+        action = next(action for action in ism.actions if action.action_name == 'ActionIoFileInbound')
+        fd = action.watcher.fd
+        ism.dao.execute_sql_statement("UPDATE actions SET active = 0 WHERE action = 'ActionIoFileInbound'")
+        action.execute()
+        self.assertIsNone(action.watcher, 'expected the watcher to be closed')
+        self.assertIsNone(action.scanner, 'expected the scanner to be closed')
+        self.assertRaises(OSError, os.fstat, fd)
+
+    def test_inbound_msg_file_sharded_sqlite3(self):
+        """Test that ActionIoFileInbound ingests messages from hash sharded inbound subdirectories.
+
+        ActionBeforeIoFile should create the shards, and a small scan budget should still
+        drain every shard.
+        """
+
+        sender_id = 7
+        count = 20
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['file']['inbound_shards'] = 4
+        ism.properties['comms']['file']['inbound_batch_size'] = 3
+        ism.properties['comms']['file']['inbound_scan_budget'] = 5
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.start()
+
+        self.send_inbound_msg_files(count, ism.properties, shards=4)
+        for message_id in range(1, count + 1):
+            self.assertTrue(
+                self.wait_for_message_archive(f'msg{message_id}', ism.properties),
+                f'Expected message file msg{message_id} to be archived'
+            )
+
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT COUNT(*) FROM messages",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+
+        self.assertEqual(count, result[0][0], 'expected every sharded message in the messages table')
+        self.assertEqual(4, len(os.listdir(ism.properties['comms']['file']['inbound'])))
+
+        ism.stop()
+
+    def test_inbound_claims(self):
+        """Confirm that nodes claiming from one inbound directory each get a share and no file twice.
+
+        A node that dies holding claims has them taken over once its lease expires, and
+        adding nodes should scale the throughput close to linearly.
+        """
+
+        count = 200
+        delay = .01
+
+        def run(nodes: int) -> float:
+            root = tempfile.mkdtemp()
+            inbound = f'{root}{os.path.sep}inbound'
+            archive = f'{root}{os.path.sep}archive'
+            os.makedirs(inbound)
+            os.makedirs(archive)
+            self.send_inbound_msg_files(count, {'comms': {'file': {'inbound': inbound}}})
+
+            # A node that crashed holding claims
+            dead = InboundClaims(inbound, '.smp', node='dead', lease=.1)
+            dead.renew()
+            self.assertEqual(['msg1', 'msg2'], dead.claim(['msg1', 'msg2']))
+            self.assertEqual([], InboundClaims(inbound, '.smp', node='other').claim(['msg1']))
+            sleep(.2)
+
+            started = perf_counter()
+            with Pool(nodes) as pool:
+                archived = pool.starmap(
+                    claim_messages,
+                    [(inbound, archive, f'node{index}', delay) for index in range(nodes)]
+                )
+            elapsed = perf_counter() - started
+
+            names = [name for node in archived for name in node]
+            self.assertEqual(count, len(names), 'expected no message archived twice')
+            self.assertEqual({f'msg{index}' for index in range(1, count + 1)}, set(names))
+            self.assertEqual([], [name for name in os.listdir(inbound) if name.endswith('.smp')])
+            self.assertFalse(os.path.exists(f'{inbound}{os.path.sep}.claims{os.path.sep}dead.lease'))
+            return elapsed
+
+        single = run(1)
+        parallel = run(4)
+        self.assertGreater(single / parallel, 2.5, f'expected near linear scaling, 1 node ({single}s) 4 ({parallel}s)')
+
+        # A node that stops hands its claims back
+        inbound = tempfile.mkdtemp()
+        self.send_inbound_msg_files(3, {'comms': {'file': {'inbound': inbound}}})
+        claims = InboundClaims(inbound, '.smp', node='node')
+        claims.renew()
+        self.assertEqual(['msg1', 'msg3'], claims.claim(['msg1', 'msg3']))
+        self.assertEqual(['msg1', 'msg3'], sorted(claims.claimed()))
+        claims.release()
+        self.assertEqual([], claims.claimed())
+        self.assertEqual(
+            ['msg1.smp', 'msg2.smp', 'msg3.smp'],
+            sorted(name for name in os.listdir(inbound) if name.endswith('.smp'))
+        )
+
+    def test_inbound_claims_sqlite3(self):
+        """Test that two ISMs reading one sharded inbound directory insert each message exactly once.
+
+        Messages claimed by a node whose lease has expired should be taken over.
+        """
+
+        count = 100
+        root = tempfile.mkdtemp()
+
+        isms = []
+        for node in ('node_a', 'node_b'):
+            ism = ISM({'properties_file': self.sqlite3_properties})
+            for name in ('inbound', 'outbound', 'archive'):
+                ism.properties['comms']['file'][name] = f'{root}{os.path.sep}{name}'
+            ism.properties['comms']['file']['inbound_shards'] = 2
+            ism.properties['comms']['file']['inbound_claim'] = {'node': node, 'lease': 5}
+            ism.import_action_pack('ism_comms.file.actions')
+            isms.append(ism)
+            sleep(.01)
+
+        properties = isms[0].properties
+        for shard in ('000', '001'):
+            os.makedirs(f'{root}{os.path.sep}inbound{os.path.sep}{shard}')
+        self.send_inbound_msg_files(count, properties, shards=2)
+        claims = InboundClaims(
+            properties['comms']['file']['inbound'], '.smp', ['000', '001'], node='node_dead', lease=.1
+        )
+        claims.renew()
+        dead = claims.claim([os.path.join(shard_for('msg1', 2), 'msg1'), os.path.join(shard_for('msg2', 2), 'msg2')])
+        self.assertEqual(2, len(dead))
+
+        for ism in isms:
+            ism.start()
+        for message_id in range(1, count + 1):
+            self.assertTrue(
+                self.wait_for_message_archive(f'msg{message_id}', properties),
+                f'Expected message file msg{message_id} to be archived'
+            )
+        for ism in isms:
+            ism.stop()
+
+        sender_ids = [
+            [row[0] for row in ism.dao.execute_sql_query(
+                "SELECT sender_id FROM messages WHERE sender = 'test_inbound_msg_files'"
+            )]
+            for ism in isms
+        ]
+        self.assertEqual(count, sum(len(node) for node in sender_ids), 'expected no message inserted twice')
+        self.assertEqual(list(range(1, count + 1)), sorted(sender_id for node in sender_ids for sender_id in node))
+
     def test_outbound_msg_file(self):
         """Confirm that the action ActionIoFileOutbound creates an outbound message file.
 
@@ -337,7 +967,7 @@ class TestIsmIoFile(unittest.TestCase):
             'sender': 'ActionIoFileOutbound',
             'sender_id': 1,
             'action': 'ActionDummy',
-            'payload': '"{\\"test_msg\\": \\"test value\\"}"'
+            'payload': {'test_msg': 'test value'}
         }
         self.assertDictEqual(
             expected_msg,
@@ -349,6 +979,1508 @@ class TestIsmIoFile(unittest.TestCase):
         # main thread exits, as this gives a cleaner shutdown.
         ism.stop()
 
+    def test_outbound_msg_file_atomic(self):
+        """Confirm that ActionIoFileOutbound in atomic mode publishes complete files without semaphores.
+
+        Only the outbound messages written should be marked as processed.
+        """
+
+        sender_id = 8
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['file']['outbound_mode'] = 'atomic'
+        ism.properties['comms']['file']['outbound_semaphore'] = False
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.import_action_pack('ism_comms.file.tests.test_file_io_outbound')
+        for message_id in (2, 3):
+            ism.dao.execute_sql_statement(
+                f"INSERT INTO messages VALUES({message_id}, 'UnitTest', 'ActionIoFileOutbound', {message_id}, "
+                f"'ActionDummy', '{{}}', 12345, 0, 'outbound', 0, 0)"
+            )
+        ism.dao.execute_sql_statement(
+            "INSERT INTO messages VALUES(4, NULL, 'UnitTest', 4, 'ActionDummy', '{}', 12345, 0, 'inbound', 0, 0)"
+        )
+        ism.start()
+
+        # Published files are complete, so wait for the last one to appear before querying
+        while not os.path.exists(f'{ism.properties["comms"]["file"]["outbound"]}{os.path.sep}UnitTest_3.json'):
+            sleep(.01)
+
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT message_id, processed FROM messages ORDER BY message_id",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+
+        self.assertEqual([[1, 1], [2, 1], [3, 1], [4, 0]], result, 'expected only the outbound messages processed')
+        outbound = ism.properties['comms']['file']['outbound']
+        self.assertEqual(
+            ['UnitTest_1.json', 'UnitTest_2.json', 'UnitTest_3.json'],
+            sorted(os.listdir(outbound)),
+            'expected published message files without semaphores or temp files'
+        )
+
+        ism.stop()
+
+    def test_outbound_msg_file_batch_routes_sqlite3(self):
+        """Confirm that ActionIoFileOutbound writes a batch file per routed recipient, and ActionIoFileInbound reads them.
+
+        A recipient that can't be a directory name should be left pending, and every
+        message in an inbound batch file inserted.
+        """
+
+        sender_id = 9
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['file'].update({
+            'outbound_per_recipient': True,
+            'outbound_routes': {'Other': 'other_inbox'},
+            'outbound_batch': True
+        })
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.import_action_pack('ism_comms.file.tests.test_file_io_outbound')
+        for message_id, recipient in ((2, 'UnitTest'), (3, 'UnitTest'), (4, 'Other'), (5, 'Other'), (6, '..')):
+            ism.dao.execute_sql_statement(
+                f"INSERT INTO messages VALUES({message_id}, '{recipient}', 'ActionIoFileOutbound', {message_id}, "
+                f"'ActionDummy', '{{}}', 12345, 0, 'outbound', 0, 0)"
+            )
+        ism.start()
+
+        outbound = ism.properties['comms']['file']['outbound']
+        directories = {
+            'UnitTest': f'{outbound}{os.path.sep}UnitTest',
+            'Other': f'{outbound}{os.path.sep}other_inbox'
+        }
+        retries = 500
+        while retries and not all(
+                os.path.exists(f'{directories[recipient]}{os.path.sep}{name}.smp')
+                for recipient, name in (('UnitTest', 'UnitTest_1'), ('Other', 'Other_4'))
+        ):
+            retries -= 1
+            sleep(.01)
+
+        self.assertEqual(['UnitTest_1.batch', 'UnitTest_1.smp'], sorted(os.listdir(directories['UnitTest'])))
+        self.assertEqual(['Other_4.batch', 'Other_4.smp'], sorted(os.listdir(directories['Other'])))
+        with open(f'{directories["UnitTest"]}{os.path.sep}UnitTest_1.batch', 'rb') as file:
+            codec_name, messages = decode_batch(file.read())
+        self.assertEqual('json', codec_name)
+        self.assertEqual([1, 2, 3], [json.loads(message)['message_id'] for message in messages])
+
+        # A batch file sent to this ISM
+        messages = [
+            json.dumps({
+                'message_id': message_id,
+                'sender': 'test_batch',
+                'sender_id': message_id,
+                'action': 'ActionDummy',
+                'payload': {'index': message_id},
+                'sent': 12345
+            }).encode()
+            for message_id in range(101, 111)
+        ]
+        inbound = ism.properties['comms']['file']['inbound']
+        write_message_files(inbound, [('batch_101', encode_batch('json', messages))], '.batch', '.smp')
+        self.assertTrue(self.wait_for_message_archive('batch_101', ism.properties), 'expected the batch to be archived')
+
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT message_id, processed FROM messages WHERE direction = 'outbound' ORDER BY message_id",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual(
+            [[1, 1], [2, 1], [3, 1], [4, 1], [5, 1], [6, 0]],
+            result,
+            'expected the unroutable message left pending'
+        )
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT COUNT(*), COUNT(DISTINCT message_id) FROM messages WHERE sender = 'test_batch'",
+                "sender_id": sender_id + 1
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual([10, 10], result[0], 'expected each message in the batch file to be inserted once')
+
+        ism.stop()
+
+    def test_outbound_msg_file_unroutable_sqlite3(self):
+        """Confirm that messages for a recipient that can't be a directory don't hold up the other recipients.
+
+        The unroutable messages, one of them without a recipient, have the higher priority
+        and outnumber the batch size, so they would fill every batch if they were still
+        fetched once found to be unroutable.
+        """
+
+        sender_id = 11
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['file'].update({
+            'outbound_per_recipient': True,
+            'outbound_batch_size': 2
+        })
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.import_action_pack('ism_comms.file.tests.test_file_io_outbound')
+        for message_id in range(2, 7):
+            ism.dao.execute_sql_statement(
+                f"INSERT INTO messages VALUES({message_id}, '..', 'ActionIoFileOutbound', {message_id}, "
+                f"'ActionDummy', '{{}}', 12345, 0, 'outbound', 0, 5)"
+            )
+        ism.dao.execute_sql_statement(
+            "INSERT INTO messages VALUES(7, NULL, 'ActionIoFileOutbound', 7, "
+            "'ActionDummy', '{}', 12345, 0, 'outbound', 0, 5)"
+        )
+        ism.start()
+
+        semaphore = f'{ism.properties["comms"]["file"]["outbound"]}{os.path.sep}UnitTest{os.path.sep}UnitTest_1.smp'
+        retries = 500
+        while not os.path.exists(semaphore) and retries:
+            retries -= 1
+            sleep(.01)
+        self.assertTrue(os.path.exists(semaphore), 'expected the routable message to be written')
+
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT recipient, processed, COUNT(*) FROM messages WHERE direction = 'outbound' "
+                       "GROUP BY recipient, processed ORDER BY recipient",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual([[None, 0, 1], ['..', 0, 5], ['UnitTest', 1, 1]], result)
+
+        ism.stop()
+
+    def test_batch_files(self):
+        """Confirm that batch files round trip through the outbound writer and inbound decoder, and reject damage."""
+
+        outbound = f'{self.test_archive}{os.path.sep}batches'
+        other = f'{self.test_archive}{os.path.sep}other_inbox'
+        routes = OutboundRoutes(outbound, {'Other': other}, per_recipient=True)
+        os.makedirs(outbound, exist_ok=True)
+        directory = routes.directory('UnitTest')
+        self.assertEqual(f'{outbound}{os.path.sep}UnitTest', directory)
+        self.assertTrue(os.path.isdir(directory), 'expected the recipient directory to be created on first use')
+        self.assertEqual(other, routes.directory('Other'))
+        self.assertTrue(os.path.isdir(other))
+        for recipient in ('..', 'a/b', '', None):
+            with self.assertRaises(RecipientNotRoutable):
+                routes.directory(recipient)
+        self.assertEqual(outbound, OutboundRoutes(outbound).directory('UnitTest'))
+
+        codec = get_codec('msgpack')
+        messages = [
+            codec.encode({
+                'message_id': message_id,
+                'recipient': 'UnitTest',
+                'sender': 'test_batch_files',
+                'sender_id': message_id,
+                'action': 'ActionDummy',
+                'payload': '{}',
+                'sent': 12345
+            })
+            for message_id in range(1, 11)
+        ]
+        data = encode_batch(codec.name, messages)
+        written = write_message_files(directory, [('UnitTest_1', data)], '.batch', '.smp')
+        self.assertEqual(len(data), written)
+        self.assertEqual(['UnitTest_1.batch', 'UnitTest_1.smp'], sorted(os.listdir(directory)))
+
+        found, rows, size = decode_message_file(
+            f'{directory}{os.path.sep}UnitTest_1', (('.json', 'json'), ('.batch', 'batch'))
+        )
+        self.assertEqual(('.batch', len(data)), (found, size))
+        self.assertEqual(list(range(1, 11)), [row[2] for row in rows], 'expected one row per message, in order')
+
+        self.assertEqual(('msgpack', messages), decode_batch(data))
+        self.assertEqual(('json', []), decode_batch(encode_batch('json', [])))
+        with self.assertRaises(MalformedBatchFile):
+            decode_batch(data[:-1])
+        with self.assertRaises(MalformedBatchFile):
+            decode_batch(encode_record(b'not a batch'))
+        damaged = bytearray(data)
+        damaged[-1] ^= 0xff
+        with self.assertRaises(CorruptSegmentRecord):
+            decode_batch(bytes(damaged))
+
+
+    def test_archive_processed_messages_sqlite3(self):
+        """Confirm that ActionIoArchiveMessages moves the oldest processed messages to messages_archive.
+
+        Age is by received time, not message_id, which the sender sets. Unprocessed
+        messages must never be archived.
+        """
+
+        sender_id = 9
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['retention'] = {'max_rows': 2, 'chunk_size': 2}
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.core')
+        ism.import_action_pack('ism_comms.file.actions')
+        # Messages 6 and 7 arrived first
+        for message_id in range(1, 8):
+            received = 1600000000 + (message_id if message_id > 5 else message_id + 10)
+            ism.dao.execute_sql_statement(
+                f"INSERT INTO messages VALUES({message_id}, NULL, 'UnitTest', {message_id}, 'ActionDummy', "
+                f"'{{}}', 12345, '{received}', 'inbound', {int(message_id != 3)}, 0)"
+            )
+        # Leave message 3 unprocessed rather than let it be dispatched
+        ism.dao.execute_sql_statement("UPDATE actions SET active = 0 WHERE action = 'ActionIoCheckMsgTable'")
+        ism.start()
+
+        # Test support actions can answer during the STARTING phase, so give the archive action time to run
+        sleep(1)
+
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT 'messages', message_id FROM messages "
+                       "UNION ALL SELECT 'archive', message_id FROM messages_archive ORDER BY 1, 2",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+
+        self.assertEqual(
+            [['archive', 1], ['archive', 2], ['archive', 6], ['archive', 7],
+             ['messages', 3], ['messages', 4], ['messages', 5]],
+            result,
+            'expected all but the newest two processed messages archived'
+        )
+
+        ism.stop()
+
+
+    def test_dispatch_inbound_msg_sqlite3(self):
+        """Confirm that ActionIoCheckMsgTable delivers an inbound message's payload to its action.
+
+        The message addresses the test support action ActionRunSqlQuery, so a reply from the
+        test support pack shows the payload arrived intact.
+        """
+
+        sender_id = 10
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.core')
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.start()
+
+        while not os.path.exists(ism.properties["comms"]["file"]["inbound"]):
+            sleep(.01)
+        msg = {
+            "message_id": 1,
+            "sender": "test_dispatch_inbound_msg",
+            "sender_id": 1,
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT sender FROM messages",
+                "sender_id": sender_id
+            },
+            "sent": "Thursday lunchtime"
+        }
+        with open(f'{ism.properties["comms"]["file"]["inbound"]}{os.path.sep}dispatch.json', 'w') as file:
+            file.write(json.dumps(msg))
+        with open(f'{ism.properties["comms"]["file"]["inbound"]}{os.path.sep}dispatch.smp', 'w') as semaphore:
+            semaphore.write('')
+
+        self.assertTrue(
+            self.wait_for_test_message_reply(sender_id),
+            'Failed to find reply from the action addressed by the inbound message.'
+        )
+        with open(f'{self.test_outbound}{os.path.sep}{sender_id}.json', 'r') as file:
+            result = json.loads(file.read()).get('query_result', {})
+
+        self.assertEqual([['test_dispatch_inbound_msg']], result)
+
+        ism.stop()
+
+    def test_dispatch_coalesce_list_sqlite3(self):
+        """Confirm that ActionIoCheckMsgTable activates an action once with every waiting payload.
+
+        With the list coalescing policy the action's payload should be a JSON array of
+        the message payloads, oldest first by received time rather than message_id.
+        """
+
+        sender_id = 11
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['dispatch'] = {'coalesce': 'list'}
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.core')
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.dao.execute_sql_statement("INSERT INTO actions VALUES(NULL,'ActionDummy','RUNNING',NULL,0)")
+        # Message 3 arrived first
+        for message_id, received in ((1, 1600000002), (2, 1600000003), (3, 1600000001)):
+            ism.dao.execute_sql_statement(
+                f"INSERT INTO messages VALUES({message_id}, NULL, 'UnitTest', {message_id}, 'ActionDummy', "
+                f"'{{\"index\": {message_id}}}', 12345, '{received}', 'inbound', 0, 0)"
+            )
+        ism.start()
+
+        # Test support actions can answer during the STARTING phase, so give the dispatch time to run
+        sleep(1)
+
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT active, payload, (SELECT SUM(processed) FROM messages) FROM actions "
+                       "WHERE action = 'ActionDummy'",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+
+        self.assertEqual(1, result[0][0], 'expected ActionDummy to be activated')
+        self.assertEqual([{'index': 3}, {'index': 1}, {'index': 2}], json.loads(result[0][1]))
+        self.assertEqual(3, result[0][2], 'expected all three messages marked processed')
+
+        ism.stop()
+
+
+    def test_dispatch_coalesce_reject_sqlite3(self):
+        """Confirm that the reject policy leaves active actions out of the fetch, so they can't starve the others.
+
+        ActionBusy's older messages would fill the batch, so ActionDummy's message should
+        only be dispatched if they're skipped.
+        """
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['dispatch'] = {'coalesce': 'reject', 'batch_size': 2}
+        ism.import_action_pack('ism_comms.core')
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.dao.execute_sql_statement("INSERT INTO actions VALUES(NULL,'ActionBusy','RUNNING',NULL,1)")
+        ism.dao.execute_sql_statement("INSERT INTO actions VALUES(NULL,'ActionDummy','RUNNING',NULL,0)")
+        for message_id, action in ((1, 'ActionBusy'), (2, 'ActionBusy'), (3, 'ActionBusy'), (4, 'ActionDummy')):
+            ism.dao.execute_sql_statement(
+                f"INSERT INTO messages VALUES({message_id}, NULL, 'UnitTest', {message_id}, '{action}', "
+                f"'{{\"index\": {message_id}}}', 12345, '{1600000000 + message_id}', 'inbound', 0, 0)"
+            )
+
+        dispatcher = ActionIoCheckMsgTable({'dao': ism.dao, 'properties': ism.properties})
+        self.assertEqual(1, dispatcher.dispatch_pending())
+        self.assertEqual(
+            [[1, None], [1, '{"index": 4}']],
+            [list(row) for row in ism.dao.execute_sql_query(
+                "SELECT active, payload FROM actions WHERE action IN ('ActionBusy', 'ActionDummy') ORDER BY action"
+            )]
+        )
+        self.assertEqual(
+            [[1, 0], [2, 0], [3, 0], [4, 1]],
+            [list(row) for row in ism.dao.execute_sql_query('SELECT message_id, processed FROM messages ORDER BY 1')],
+            'expected the busy action\'s messages left pending'
+        )
+
+        # Both are now active, so nothing is dispatched
+        self.assertEqual(0, dispatcher.dispatch_pending())
+
+    def test_codecs_round_trip(self):
+        """Confirm that every registered codec round trips a message without re-encoding the payload."""
+
+        message = {
+            'message_id': 1,
+            'recipient': 'UnitTest',
+            'sender': 'test_codecs',
+            'sender_id': 2,
+            'action': 'ActionDummy',
+            'payload': '{"test_msg": "test value"}',
+            'sent': '1614556800'
+        }
+        for name in ('json', 'msgpack', 'protobuf'):
+            codec = get_codec(name)
+            self.assertIs(codec, get_codec_for_extension(codec.extension))
+            decoded = codec.decode(codec.encode(message))
+            self.assertEqual(
+                {'test_msg': 'test value'},
+                json.loads(decoded['payload']),
+                f'expected {name} to carry the payload unchanged'
+            )
+            self.assertEqual(message['sender_id'], decoded['sender_id'])
+            self.assertEqual(message['action'], decoded['action'])
+        self.assertIn('"payload": {"test_msg": "test value"}', get_codec('json').encode(message).decode())
+
+    def test_inbound_msg_file_msgpack_sqlite3(self):
+        """Test that ActionIoFileInbound picks the decoder from the message file extension.
+
+        With msgpack listed in inbound_codecs, a msgpack message file should be inserted
+        alongside a JSON one, with its payload as JSON text.
+        """
+
+        sender_id = 13
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['file']['inbound_codecs'] = ['msgpack']
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.start()
+
+        # ActionBeforeIoFile resolves the relative paths under the run directory
+        retries = 100
+        while not os.path.exists(ism.properties['comms']['file']['inbound']) and retries:
+            retries -= 1
+            sleep(.1)
+        self.assertTrue(os.path.exists(ism.properties['comms']['file']['inbound']), 'expected the inbound directory')
+        self.send_inbound_msg_files(1, ism.properties, first_id=2)
+
+        inbound = ism.properties['comms']['file']['inbound']
+        codec = get_codec('msgpack')
+        with open(f'{inbound}{os.path.sep}msg1{codec.extension}', 'wb') as file:
+            file.write(
+                codec.encode(
+                    {
+                        "message_id": 1,
+                        "sender": "test_inbound_msgpack",
+                        "sender_id": 1,
+                        "action": "ActionDummy",
+                        "payload": '{"index": 1}',
+                        "sent": "Thursday lunchtime"
+                    }
+                )
+            )
+        with open(f'{inbound}{os.path.sep}msg1.smp', 'w') as semaphore:
+            semaphore.write('')
+
+        archive = ism.properties['comms']['file']['archive']
+        retries = 100
+        archived = (f'{archive}{os.path.sep}msg1{codec.extension}', f'{archive}{os.path.sep}msg2.json')
+        while not all(os.path.exists(path) for path in archived) and retries:
+            retries -= 1
+            sleep(.1)
+        self.assertTrue(all(os.path.exists(path) for path in archived), 'expected both messages archived')
+
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT sender, payload FROM messages ORDER BY message_id",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual('test_inbound_msgpack', result[0][0], 'expected the msgpack message to be inserted')
+        self.assertEqual({'index': 1}, json.loads(result[0][1]))
+        self.assertEqual('test_inbound_msg_files', result[1][0], 'expected the JSON message to be inserted')
+
+        ism.stop()
+
+    def check_inbound_workers(self, worker_type: str, sender_id: int):
+        """Send a backlog with one malformed file to an ISM decoding with a worker pool.
+
+        The good messages should each be inserted once and the malformed one quarantined.
+        """
+
+        count = 40
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['file']['inbound_workers'] = 4
+        ism.properties['comms']['file']['inbound_worker_type'] = worker_type
+        ism.properties['comms']['file']['inbound_queue_size'] = 8
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.start()
+
+        self.send_inbound_msg_files(count, ism.properties)
+        inbound = ism.properties['comms']['file']['inbound']
+        with open(f'{inbound}{os.path.sep}bad.json', 'w') as file:
+            file.write('{"message_id": ')
+        with open(f'{inbound}{os.path.sep}bad.smp', 'w') as semaphore:
+            semaphore.write('')
+
+        for message_id in range(1, count + 1):
+            self.assertTrue(
+                self.wait_for_message_archive(f'msg{message_id}', ism.properties),
+                f'Expected message file msg{message_id} to be archived'
+            )
+        quarantine = ism.properties['comms']['file']['quarantine']
+        retries = 100
+        while not os.path.exists(f'{quarantine}{os.path.sep}bad.smp') and retries:
+            retries -= 1
+            sleep(.1)
+        self.assertTrue(os.path.exists(f'{quarantine}{os.path.sep}bad.json'), 'expected the malformed file quarantined')
+        self.assertFalse(os.path.exists(f'{inbound}{os.path.sep}bad.smp'))
+
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT COUNT(*), COUNT(DISTINCT message_id) FROM messages WHERE sender = 'test_inbound_msg_files'",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual([count, count], result[0], 'expected each message to be inserted exactly once')
+
+        ism.stop()
+
+    def test_inbound_msg_file_workers_sqlite3(self):
+        """Test that ActionIoFileInbound decodes files in a thread pool and quarantines malformed ones"""
+        self.check_inbound_workers('thread', 15)
+
+    def test_inbound_msg_file_worker_processes_sqlite3(self):
+        """Test that ActionIoFileInbound decodes files in a process pool and quarantines malformed ones"""
+        self.check_inbound_workers('process', 16)
+
+    def test_decode_pool_back_pressure(self):
+        """Confirm the decode pool takes no more files than its queue size until they're drained and done"""
+
+        directory = f'{self.test_archive}{os.path.sep}decode_pool'
+        os.makedirs(directory, exist_ok=True)
+        for message_id in (1, 2, 3):
+            with open(f'{directory}{os.path.sep}msg{message_id}.json', 'w') as file:
+                file.write(json.dumps({
+                    "message_id": message_id,
+                    "sender": "test_decode_pool",
+                    "sender_id": message_id,
+                    "action": "ActionDummy",
+                    "payload": {"index": message_id},
+                    "sent": 12345
+                }))
+
+        pool = DecodePool(2, queue_size=2)
+        codecs = (('.json', 'json'),)
+        self.assertEqual(2, pool.capacity())
+        pool.submit('msg1', f'{directory}{os.path.sep}msg1', codecs)
+        pool.submit('msg2', f'{directory}{os.path.sep}msg2', codecs)
+        pool.submit('msg2', f'{directory}{os.path.sep}msg2', codecs)
+        self.assertEqual(0, pool.capacity(), 'expected the pool to be full')
+
+        decoded = []
+        retries = 100
+        while len(decoded) < 2 and retries:
+            retries -= 1
+            sleep(.01)
+            decoded.extend(pool.drain())
+        self.assertEqual(['msg1', 'msg2'], sorted(file_name for file_name, *_ in decoded))
+        self.assertEqual(0, pool.capacity(), 'expected drained files to hold their place until done')
+        for file_name, found, row, size, error in decoded:
+            self.assertIsNone(error)
+            self.assertEqual('.json', found)
+            self.assertEqual(os.path.getsize(f'{directory}{os.path.sep}{file_name}.json'), size)
+            pool.done(file_name)
+        self.assertEqual(2, pool.capacity())
+
+        pool.submit('msg4', f'{directory}{os.path.sep}msg4', codecs)
+        retries = 100
+        decoded = []
+        while not decoded and retries:
+            retries -= 1
+            sleep(.01)
+            decoded = pool.drain()
+        self.assertEqual([('msg4', None, None, 0, None)], decoded, 'expected a missing message file to be reported')
+
+        stats = pool.stats()
+        self.assertEqual(2, stats['saturated_ticks'])
+        self.assertEqual(1, stats['in_flight'])
+        pool.close()
+
+    def test_archive_bundles_sqlite3(self):
+        """Test that ActionIoFileBundleArchive packs archived files into a bundle and indexes the messages.
+
+        A message should then be found in its bundle by (sender, sender_id), and the
+        archive directory left empty.
+        """
+
+        sender_id = 17
+        count = 30
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['file']['archive_bundles'] = {'max_age': 1}
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.start()
+
+        self.send_inbound_msg_files(count, ism.properties)
+        archive = ism.properties['comms']['file']['archive']
+        bundles = ism.properties['comms']['file']['archive_bundles']['directory']
+        retries = 100
+        while retries and not (
+                os.path.exists(archive) and os.path.exists(bundles)
+                and not os.listdir(archive)
+                and [name for name in os.listdir(bundles) if name.endswith(BUNDLE_SUFFIX)]
+        ):
+            retries -= 1
+            sleep(.1)
+        self.assertEqual([], os.listdir(archive), 'expected the archive directory to be emptied into bundles')
+
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT bundle, member, message_id, (SELECT COUNT(*) FROM archive_index) FROM archive_index "
+                       "WHERE sender = 'test_inbound_msg_files' AND sender_id = 7",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual(1, len(result), 'expected the message to be indexed once')
+        bundle, member, message_id, indexed = result[0]
+        self.assertEqual(('msg7.json', 7, count), (member, message_id, indexed))
+        self.assertEqual(7, json.loads(read_bundle_member(bundles, bundle, member))['message_id'])
+
+        ism.stop()
+
+    def test_archive_bundles_batch_sqlite3(self):
+        """Test that ActionIoFileBundleArchive indexes each message of a batch file, and it's found in its bundle."""
+
+        sender_id = 18
+        count = 10
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['file']['archive_bundles'] = {'max_age': 1}
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.start()
+
+        messages = [
+            json.dumps({
+                'message_id': message_id,
+                'sender': 'test_batch_bundle',
+                'sender_id': message_id,
+                'action': 'ActionDummy',
+                'payload': {'index': message_id},
+                'sent': 12345
+            }).encode()
+            for message_id in range(1, count + 1)
+        ]
+        inbound = ism.properties['comms']['file']['inbound']
+        write_message_files(inbound, [('batch_1', encode_batch('json', messages))], '.batch', '.smp')
+        archive = ism.properties['comms']['file']['archive']
+        bundles = ism.properties['comms']['file']['archive_bundles']['directory']
+        retries = 100
+        while retries and not (
+                os.path.exists(archive) and os.path.exists(bundles)
+                and not os.listdir(archive)
+                and [name for name in os.listdir(bundles) if name.endswith(BUNDLE_SUFFIX)]
+        ):
+            retries -= 1
+            sleep(.1)
+        self.assertEqual([], os.listdir(archive), 'expected the batch file to be bundled')
+
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT member, COUNT(*) FROM archive_index WHERE sender = 'test_batch_bundle' GROUP BY member",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual([['batch_1.batch', count]], result, 'expected each message in the batch indexed')
+        self.assertEqual(messages[6], find_archived_message(ism.dao, bundles, 'test_batch_bundle', 7))
+
+        ism.stop()
+
+    def test_bundle_archiver(self):
+        """Confirm bundles roll by size, incomplete bundles are discarded and old bundles expire"""
+
+        archive = f'{self.test_archive}{os.path.sep}bundle_archive'
+        directory = f'{self.test_archive}{os.path.sep}bundles'
+        os.makedirs(archive, exist_ok=True)
+        os.makedirs(directory, exist_ok=True)
+        with open(f'{directory}{os.path.sep}bundle-1{BUNDLE_SUFFIX}.part', 'w') as file:
+            file.write('incomplete')
+        for message_id in range(1, 21):
+            with open(f'{archive}{os.path.sep}msg{message_id}.json', 'w') as file:
+                file.write(json.dumps({
+                    "message_id": message_id,
+                    "sender": "test_bundle_archiver",
+                    "sender_id": message_id,
+                    "payload": os.urandom(2048).hex()
+                }))
+            with open(f'{archive}{os.path.sep}msg{message_id}.smp', 'w') as semaphore:
+                semaphore.write('')
+
+        archiver = BundleArchiver(archive, directory, '.json', max_bytes=16384)
+        self.assertEqual([], os.listdir(directory), 'expected the incomplete bundle to be deleted')
+
+        # Roll when full, or once everything left has been added
+        while os.listdir(archive):
+            archiver.rescan_at = 0
+            if not archiver.add(perf_counter() + 1) or archiver.due():
+                archiver.roll()
+            archiver.remove(archiver.next_finished(100))
+
+        names = sorted(os.listdir(directory))
+        self.assertGreater(len(names), 1, 'expected the bundles to roll by size')
+        self.assertTrue(all(name.endswith(BUNDLE_SUFFIX) for name in names))
+        members = []
+        for name in names:
+            with tarfile.open(f'{directory}{os.path.sep}{name}', 'r:gz') as bundle:
+                members.extend(bundle.getnames())
+        self.assertEqual(40, len(members))
+        self.assertEqual(40, len(set(members)), 'expected each file to be bundled once')
+
+        # Each message of a batch file is identified, and the file removed once
+        batch = encode_batch(
+            'json', [json.dumps({"sender": "test_bundle_archiver", "sender_id": i}).encode() for i in (21, 22)]
+        )
+        with open(f'{archive}{os.path.sep}batch21.batch', 'wb') as file:
+            file.write(batch)
+        archiver.rescan_at = 0
+        self.assertEqual(1, archiver.add(perf_counter() + 1))
+        archiver.roll()
+        finished = archiver.next_finished(100)
+        self.assertEqual(
+            [('batch21.batch', [('test_bundle_archiver', 21, None), ('test_bundle_archiver', 22, None)])],
+            [(file_name, messages) for _, file_name, messages in finished]
+        )
+        archiver.remove(finished)
+        self.assertEqual([], os.listdir(archive))
+        names = sorted(os.listdir(directory))
+
+        os.utime(f'{directory}{os.path.sep}{names[0]}', (0, 0))
+        self.assertEqual([names[0]], archiver.expire(86400))
+        self.assertEqual(names[1:], sorted(os.listdir(directory)))
+        archiver.close_cursor()
+
+    def test_metrics_export_sqlite3(self):
+        """Test that the comms actions' metrics are exported as a Prometheus textfile, JSON and table rows"""
+
+        sender_id = 18
+        count = 10
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['metrics'] = {'interval': .2, 'export': ['prometheus', 'json', 'table']}
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.core')
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.start()
+
+        self.send_inbound_msg_files(count, ism.properties)
+        for message_id in range(1, count + 1):
+            self.assertTrue(
+                self.wait_for_message_archive(f'msg{message_id}', ism.properties),
+                f'Expected message file msg{message_id} to be archived'
+            )
+
+        snapshot_file = f'{ism.properties["runtime"]["run_dir"]}{os.path.sep}ism_comms_metrics.json'
+        retries = 50
+        counters = {}
+        while counters.get(('rows', 'ActionIoFileInbound')) != count and retries:
+            retries -= 1
+            sleep(.1)
+            if os.path.exists(snapshot_file):
+                with open(snapshot_file, 'r') as file:
+                    snapshot = json.load(file)
+                counters = {(counter['name'], counter['action']): counter['value'] for counter in snapshot['counters']}
+        self.assertEqual(count, counters.get(('rows', 'ActionIoFileInbound')), 'expected the inserted rows counted')
+        self.assertEqual(count, counters.get(('files_seen', 'ActionIoFileInbound')))
+        self.assertGreater(counters.get(('bytes_read', 'ActionIoFileInbound')), 0)
+        self.assertIn(
+            ('db_seconds', 'ActionIoFileInbound'),
+            [(histogram['name'], histogram['action']) for histogram in snapshot['histograms']]
+        )
+
+        with open(f'{ism.properties["runtime"]["run_dir"]}{os.path.sep}ism_comms.prom', 'r') as file:
+            prometheus = file.read()
+        self.assertIn('# TYPE ism_comms_db_seconds histogram', prometheus)
+        self.assertIn('ism_comms_scan_seconds_count{action="ActionIoFileInbound"}', prometheus)
+
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT MAX(value) FROM comms_metrics WHERE name = 'rows' AND action = 'ActionIoFileInbound'",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual(count, result[0][0], 'expected the metrics exported to the comms_metrics table')
+
+        ism.stop()
+
+    def test_metrics(self):
+        """Confirm histogram buckets, the Prometheus format and that disabled metrics are a no-op"""
+
+        # Metrics are kept per run directory, so use a new one each time
+        properties = {'runtime': {'run_dir': tempfile.mkdtemp()}, 'comms': {}}
+        self.assertIs(NULL_METRICS, get_metrics(properties))
+        properties['comms']['metrics'] = {'enabled': False}
+        self.assertIs(NULL_METRICS, get_metrics(properties))
+        NULL_METRICS.observe('db_seconds', 'ActionTest', NULL_METRICS.clock())
+
+        properties['comms']['metrics'] = {}
+        self.assertIs(NULL_METRICS, get_metrics(properties), 'expected an empty [comms][metrics] to be disabled')
+        properties['comms']['metrics'] = {'enabled': True}
+        metrics = get_metrics(properties)
+        self.assertIs(metrics, get_metrics(properties))
+        metrics.count('rows', 'ActionTest', 3)
+        metrics.count('rows', 'ActionTest')
+        metrics.gauge('backlog', 'ActionTest', 7)
+        metrics.observe('db_seconds', 'ActionTest', metrics.clock())
+        metrics.observe('db_seconds', 'ActionTest', metrics.clock() - 60)
+
+        prometheus = metrics.prometheus()
+        self.assertIn('ism_comms_rows_total{action="ActionTest"} 4', prometheus)
+        self.assertIn('ism_comms_backlog{action="ActionTest"} 7', prometheus)
+        self.assertIn('ism_comms_db_seconds_bucket{action="ActionTest",le="0.0001"} 1', prometheus)
+        self.assertIn('ism_comms_db_seconds_bucket{action="ActionTest",le="10"} 1', prometheus)
+        self.assertIn('ism_comms_db_seconds_bucket{action="ActionTest",le="+Inf"} 2', prometheus)
+        self.assertIn('ism_comms_db_seconds_count{action="ActionTest"} 2', prometheus)
+        self.assertEqual(
+            [('rows', 'ActionTest', 'counter', 4, None), ('backlog', 'ActionTest', 'gauge', 7, None)],
+            metrics.rows()[:2]
+        )
+
+    def test_message_store_sqlite3(self):
+        """Confirm the MessageStore bulk operations, records and statement cache on the messages table"""
+
+        # The state machine isn't started, it's only used to create the tables
+        ism = ISM({'properties_file': self.sqlite3_properties})
+        ism.import_action_pack('ism_comms.file.actions')
+        store = MessageStore(ism.dao, ism.properties['database']['rdbms'])
+
+        rows = [
+            inbound_row(
+                {
+                    "message_id": message_id,
+                    "sender": "store_test",
+                    "sender_id": message_id,
+                    "action": "ActionStoreTest",
+                    "payload": json.dumps({"index": message_id}),
+                    "sent": 0
+                }
+            )
+            for message_id in range(1, 1101)
+        ]
+        self.assertEqual([True] * len(rows), store.insert_many(rows, ism.logger))
+        inserted = store.insert_many([rows[0], (2000, 'store_test', 2000, 'ActionStoreTest', None, 0, 0)], ism.logger)
+        self.assertEqual([False, True], inserted, 'expected only the duplicate message_id to fail')
+
+        pending = store.fetch_pending('inbound')
+        self.assertEqual(1101, len(pending))
+        self.assertIsInstance(pending[0], InboundRecord)
+        self.assertEqual((1, 'ActionStoreTest'), (pending[0].message_id, pending[0].action))
+        self.assertFalse(hasattr(pending[0], '__dict__'), 'expected a __slots__ record')
+        self.assertEqual(10, len(store.fetch_pending('inbound', 10)))
+
+        # Claiming spans more than one chunk of IDs, and skips those already processed
+        store.mark_processed([1, 2, 3])
+        claimed = store.claim(list(range(1, 1001)))
+        self.assertEqual(list(range(4, 1001)), sorted(claimed))
+        self.assertEqual([], store.claim(list(range(1, 1001))), 'expected nothing left to claim')
+        self.assertEqual(101, len(store.fetch_pending('inbound')))
+
+        ism.dao.execute_sql_statement(
+            store.statement(
+                'INSERT INTO messages (recipient, sender, sender_id, action, payload, sent, direction) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)'
+            ),
+            ('store_recipient', 'store_test', 7, 'ActionStoreTest', '{"a": 1}', 0, 'outbound')
+        )
+        record, = store.fetch_pending('outbound')
+        self.assertIsInstance(record, OutboundRecord)
+        self.assertEqual([record.message_id], [r.message_id for r in store.fetch_pending('outbound', exclude=['x'])])
+        self.assertEqual([], store.fetch_pending('outbound', exclude=['store_recipient']))
+        self.assertEqual([], store.fetch_pending('outbound', recipients=[]))
+        self.assertEqual(1, len(store.fetch_pending('outbound', **recipient_filter({'store_recipient': 'a'}, None))))
+        self.assertEqual([], store.fetch_pending('outbound', **recipient_filter({'store_recipient': 'a'}, 'b', {'a'})))
+        self.assertEqual(
+            {
+                "message_id": record.message_id,
+                "recipient": "store_recipient",
+                "sender": "store_test",
+                "sender_id": 7,
+                "action": "ActionStoreTest",
+                "payload": '{"a": 1}',
+                "sent": 99
+            },
+            record.message(99)
+        )
+        store.mark_processed([record.message_id], sent=99)
+        self.assertEqual([], store.fetch_pending('outbound'))
+
+        sql = 'SELECT COUNT(*) FROM messages WHERE processed = ?'
+        self.assertIs(
+            store.statement(sql),
+            MessageStore(ism.dao, 'SQLITE3').statement(sql),
+            'expected the statement prepared once per RDBMS'
+        )
+
+    def test_message_store_upgrade_sqlite3(self):
+        """Confirm MessageStore.upgrade adds the priority column and indexes to an earlier messages table"""
+
+        ism = ISM({'properties_file': self.sqlite3_properties})
+        ism.import_action_pack('ism_comms.file.actions')
+        store = MessageStore(ism.dao, ism.properties['database']['rdbms'])
+        self.assertEqual([], store.upgrade(ism.logger), 'expected nothing to add to a new table')
+
+        # The table as it was before the priority column and indexes, with a message received twice
+        ism.dao.execute_sql_statement('DROP TABLE messages')
+        ism.dao.execute_sql_statement(
+            'CREATE TABLE messages (message_id INTEGER NOT NULL PRIMARY KEY, recipient TEXT, sender TEXT NOT NULL, '
+            'sender_id INTEGER NOT NULL, action TEXT NOT NULL, payload TEXT, sent TEXT NOT NULL, '
+            "received TEXT NOT NULL DEFAULT (strftime('%s', 'now')), direction TEXT NOT NULL DEFAULT 'inbound', "
+            "processed BOOLEAN NOT NULL DEFAULT '0')"
+        )
+        for message_id in (1, 2):
+            ism.dao.execute_sql_statement(
+                'INSERT INTO messages (message_id, sender, sender_id, action, sent) '
+                f"VALUES ({message_id}, 'upgrade_test', 1, 'ActionUpgradeTest', 0)"
+            )
+        self.assertEqual(
+            ['priority', 'messages_pending', 'messages_received'],
+            store.upgrade(ism.logger),
+            'expected the unique sender index to wait for the duplicate to go'
+        )
+        self.assertEqual([0, 0], [record.priority for record in store.fetch_pending('inbound')])
+
+        ism.dao.execute_sql_statement('DELETE FROM messages WHERE message_id = 2')
+        self.assertEqual(['messages_sender'], store.upgrade(ism.logger))
+        self.assertEqual([], store.upgrade(ism.logger))
+        self.assertEqual(
+            ['messages_pending', 'messages_received', 'messages_sender'],
+            sorted(row[0] for row in ism.dao.execute_sql_query(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'messages'"
+            ))
+        )
+
+    def test_dedup_sqlite3(self):
+        """Confirm that MessageStore.insert_unique drops messages already received, with and without the filter"""
+
+        ism = ISM({'properties_file': self.sqlite3_properties})
+        ism.import_action_pack('ism_comms.file.actions')
+        store = MessageStore(ism.dao, ism.properties['database']['rdbms'])
+
+        bloom = BloomFilter(1000, 0.01)
+        for index in range(1000):
+            bloom.add(('sender', index))
+        self.assertTrue(all(('sender', index) in bloom for index in range(1000)), 'expected no false negatives')
+        false_positives = sum(('other', index) in bloom for index in range(10000))
+        self.assertLess(false_positives, 300, 'expected close to the configured error rate')
+
+        def row(message_id, sender, sender_id):
+            return message_id, sender, sender_id, 'ActionDedupTest', None, 0, 0
+
+        store.insert_many([row(1, 'dedup', 1), row(2, 'dedup', 2)], ism.logger)
+        seen = get_filter(ism.properties, store)
+        self.assertIn(('dedup', 1), seen, 'expected the filter built from the messages table')
+        self.assertIs(seen, get_filter(ism.properties, store))
+
+        for dedup_filter in (seen, None):
+            offset = 10 if dedup_filter is None else 0
+            statuses = store.insert_unique(
+                [
+                    row(3 + offset, 'dedup', 3 + offset),
+                    row(4 + offset, 'dedup', 1),
+                    row(5 + offset, 'dedup', 3 + offset),
+                    row(1, 'other', 1),
+                    row(6 + offset, 'other', 2 + offset)
+                ],
+                ism.logger,
+                dedup_filter
+            )
+            self.assertEqual([INSERTED, DUPLICATE, DUPLICATE, FAILED, INSERTED], statuses)
+        self.assertIn(('dedup', 3), seen, 'expected inserted messages added to the filter')
+
+        result = ism.dao.execute_sql_query("SELECT COUNT(*) FROM messages WHERE sender = 'dedup'")
+        self.assertEqual(4, result[0][0])
+
+    def test_blob_store(self):
+        """Confirm payloads over the threshold are stored once by content and opened as lazy handles"""
+
+        properties = {'runtime': {'run_dir': tempfile.mkdtemp()}, 'comms': {}}
+        self.assertIsNone(get_blob_settings(properties))
+        properties['comms']['blobs'] = {'threshold': 10}
+        settings = get_blob_settings(properties)
+        self.assertTrue(settings['directory'].startswith(properties['runtime']['run_dir']))
+
+        self.assertEqual('{"a": 1}', spill_payload('{"a": 1}', settings))
+        self.assertIsNone(spill_payload(None, settings))
+        payload = json.dumps({"data": "é" * 100})
+        reference = spill_payload(payload, settings)
+        self.assertEqual(reference, spill_payload(payload, settings))
+        self.assertEqual(1, sum(len(files) for _, _, files in os.walk(settings['directory'])), 'expected one blob')
+
+        handle = open_payload(reference, properties)
+        self.assertEqual(len(payload.encode()), handle.size)
+        self.assertEqual(json.loads(payload), handle.json())
+        self.assertEqual(payload.encode(), handle.read())
+        with handle.open() as stream:
+            self.assertEqual(payload.encode()[:5], stream.read(5))
+        mapped = handle.mmap()
+        self.assertEqual(payload.encode(), mapped[:])
+        mapped.close()
+
+        # The JSON codec spills a large payload from the message bytes, and leaves a small one inline
+        codec = get_codec('json')
+        payload = b'{"data":"%s" ,  "n":[1, {"}": "]"}]}' % (b'\\"{' * 20)
+        data = b'{"message_id": 1, "sender": "s", "payload": %s, "sent": 2}' % payload
+        message = codec.decode(data, settings)
+        self.assertEqual([1, 's', 2], [message['message_id'], message['sender'], message['sent']])
+        spilled = open_payload(message['payload'], properties)
+        self.assertIsInstance(spilled, BlobHandle)
+        self.assertEqual(payload, spilled.read(), 'expected the payload bytes as received')
+        self.assertEqual(json.loads(payload), spilled.json())
+        small = b'{"message_id": 1, "payload": {"a": 1}}'
+        self.assertEqual('{"a": 1}', codec.decode(small, settings)['payload'])
+        self.assertEqual('x' * 20, codec.decode(b'{"payload": "%s"}' % (b'x' * 20), settings)['payload'])
+
+        # A coalesced list can mix references and inline payloads
+        handles = open_payload(f'[{reference}, {{"a": 1}}, null]', properties)
+        self.assertIsInstance(handles[0], BlobHandle)
+        self.assertEqual([{"a": 1}, None], handles[1:])
+
+    def test_priority_lanes_sqlite3(self):
+        """Confirm that a bounded batch is shared between the priority lanes so none of them starve"""
+
+        ism = ISM({'properties_file': self.sqlite3_properties})
+        ism.import_action_pack('ism_comms.file.actions')
+        store = MessageStore(ism.dao, ism.properties['database']['rdbms'])
+
+        priorities = {'default': 1, 'senders': {'console': 5}}
+        self.assertEqual(5, inbound_row(self.priority_message(1, 'console'), priorities)[-1])
+        self.assertEqual(1, inbound_row(self.priority_message(1, 'bulk'), priorities)[-1])
+        self.assertEqual(0, inbound_row(self.priority_message(1, 'console'))[-1])
+        self.assertEqual(9, inbound_row({**self.priority_message(1, 'console'), 'priority': 9}, priorities)[-1])
+
+        # A flood of bulk messages, then a few from the console
+        rows = [inbound_row(self.priority_message(message_id, 'bulk')) for message_id in range(1, 101)]
+        rows.extend(inbound_row(self.priority_message(index, 'bulk'), {'default': 1}) for index in range(101, 111))
+        rows.extend(inbound_row(self.priority_message(index, 'console'), priorities) for index in (111, 112, 113))
+        store.insert_many(rows, ism.logger)
+
+        self.assertEqual([111, 112, 113, 101], [record.message_id for record in store.fetch_pending('inbound', 4)])
+        # Lane 5 only has 3 of its 6 places' worth, the other places are split 2:1 between lanes 1 and 0
+        batch = store.fetch_by_priority('inbound', 10)
+        self.assertEqual([5, 5, 5, 1, 1, 1, 1, 0, 0, 0], [record.priority for record in batch])
+        self.assertEqual([111, 112, 113, 101, 102, 103, 104, 1, 2, 3], [record.message_id for record in batch])
+
+        # A weight can favour a lane, and places the drained lanes don't use go to the others
+        batch = store.fetch_by_priority('inbound', 50, {0: 4})
+        self.assertEqual(50, len(batch))
+        self.assertEqual(3, [record.priority for record in batch].count(5))
+        self.assertEqual(10, [record.priority for record in batch].count(1))
+        store.mark_processed([record.message_id for record in store.fetch_pending('inbound')])
+        self.assertEqual([], store.fetch_by_priority('inbound', 10))
+
+        # The priority is carried through every codec
+        for name in ('json', 'msgpack', 'protobuf'):
+            codec = get_codec(name)
+            message = self.priority_message(1, 'console')
+            self.assertIsNone(codec.decode(codec.encode(message)).get('priority'))
+            self.assertEqual(7, codec.decode(codec.encode({**message, 'priority': 7}))['priority'])
+
+    @staticmethod
+    def priority_message(message_id: int, sender: str) -> dict:
+        return {
+            "message_id": message_id,
+            "sender": sender,
+            "sender_id": message_id,
+            "action": "ActionDummy",
+            "payload": None,
+            "sent": 0
+        }
+
+    def test_priority_dispatch_sqlite3(self):
+        """Test that inbound files get their sender's default priority and are dispatched in bounded batches"""
+
+        sender_id = 20
+        count = 20
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['priority'] = {'senders': {'test_inbound_msg_files': 3}}
+        ism.properties['comms']['dispatch'] = {'batch_size': 5}
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.core')
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.start()
+
+        self.send_inbound_msg_files(count, ism.properties)
+        for message_id in range(1, count + 1):
+            self.assertTrue(
+                self.wait_for_message_archive(f'msg{message_id}', ism.properties),
+                f'Expected message file msg{message_id} to be archived'
+            )
+
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT priority, COUNT(*), SUM(processed) FROM messages "
+                       "WHERE sender = 'test_inbound_msg_files' GROUP BY priority",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual([[3, count, count]], result, 'expected every message dispatched at the sender\'s priority')
+
+        ism.stop()
+
+    def test_adaptive_polling(self):
+        """Confirm that empty polls back off to the ceiling, busy polls drain and wake() cuts the backoff short"""
+
+        class Poller(AdaptivePolling, BaseAction):
+            poll_topic = 'outbound'
+
+        properties = {'runtime': {'run_dir': tempfile.mkdtemp()}, 'comms': {}}
+        poller = Poller({'dao': None, 'properties': properties})
+        work = []
+
+        def poll_once():
+            work.append(None)
+            return 0
+
+        # Without [comms][polling] every tick polls
+        for _ in range(3):
+            poller.poll(poll_once)
+        self.assertEqual(3, len(work))
+
+        properties['comms']['polling'] = {'min_interval': .05, 'max_interval': .2, 'backoff': 2}
+        intervals = []
+        for _ in range(4):
+            poller.next_poll = 0
+            poller.poll(poll_once)
+            intervals.append(poller.poll_interval)
+        self.assertEqual([.05, .1, .2, .2], intervals)
+        work.clear()
+        poller.poll(poll_once)
+        self.assertEqual([], work, 'expected the poll skipped while backing off')
+        wake(properties, 'inbound')
+        poller.poll(poll_once)
+        self.assertEqual([], work, 'expected a wake for another topic ignored')
+        wake(properties, 'outbound')
+        poller.poll(poll_once)
+        self.assertEqual(1, len(work), 'expected a wake to cut the backoff short')
+
+        # A busy poll is repeated within the drain budget, then resets the backoff
+        backlog = [3]
+
+        def drain_once():
+            found = min(backlog[0], 1)
+            backlog[0] -= found
+            return found
+
+        properties['comms']['polling']['drain_budget'] = 10
+        poller.next_poll = 0
+        self.assertEqual(3, poller.poll(drain_once))
+        self.assertEqual(.05, poller.poll_interval)
+        backlog[0] = 3
+        poller.next_poll = 0
+        poller.poll_repeat = False
+        self.assertEqual(1, poller.poll(drain_once), 'expected one poll per tick without poll_repeat')
+        self.assertEqual(0, poller.poll_interval, 'expected a busy poll to be repeated on the next tick')
+
+    def test_adaptive_polling_sqlite3(self):
+        """Test that messages still flow through the file actions with adaptive polling set"""
+
+        sender_id = 19
+        count = 20
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['polling'] = {'min_interval': .01, 'max_interval': .25, 'drain_budget': .05}
+        ism.properties['comms']['file']['inbound_batch_size'] = 5
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.core')
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.start()
+
+        # Let the actions back off before the burst arrives
+        sleep(1)
+        self.send_inbound_msg_files(count, ism.properties)
+        for message_id in range(1, count + 1):
+            self.assertTrue(
+                self.wait_for_message_archive(f'msg{message_id}', ism.properties),
+                f'Expected message file msg{message_id} to be archived'
+            )
+
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT COUNT(*) FROM messages WHERE direction = 'inbound' AND processed = 1 "
+                       "AND sender = 'test_inbound_msg_files'",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual(count, result[0][0], 'expected every message dispatched')
+
+        ism.stop()
+
+    def test_segment_writer_reader(self):
+        """Confirm that segment records roll across segments and are only read once committed.
+
+        A restarted writer should discard anything appended after the last commit.
+        """
+
+        directory = f'{self.test_archive}{os.path.sep}segments'
+        os.makedirs(directory)
+
+        writer = SegmentWriter(directory, segment_bytes=64)
+        writer.append([f'record {index}'.encode() for index in range(10)])
+        writer.commit()
+        writer.append([b'uncommitted'])
+
+        reader = SegmentReader(directory, 'test')
+        self.assertEqual([b'record 0', b'record 1', b'record 2'], reader.read(3))
+        self.assertEqual([b'record 0', b'record 1', b'record 2'], reader.read(3), 'expected re-read before commit')
+        reader.commit()
+        self.assertEqual([f'record {index}'.encode() for index in range(3, 10)], reader.read())
+        reader.commit()
+        self.assertGreater(len(os.listdir(directory)), 3, 'expected the writer to roll segments')
+
+        writer.close()
+        writer = SegmentWriter(directory, segment_bytes=64)
+        writer.append([b'record 10'])
+        writer.commit()
+        writer.close()
+        self.assertEqual([b'record 10'], SegmentReader(directory, 'test').read())
+
+        # Damage the payload of record 11, a reader skipping corrupt records steps over it
+        writer = SegmentWriter(directory, segment_bytes=1024)
+        writer.append([b'record 11', b'record 12'])
+        writer.commit()
+        writer.close()
+        segment, offset = read_position(f'{directory}{os.path.sep}committed')
+        with open(segment_path(directory, segment), 'r+b') as file:
+            file.seek(offset - 2 * len(encode_record(b'record 11')) + 8)
+            file.write(b'X')
+        self.assertRaises(CorruptSegmentRecord, SegmentReader(directory, 'test').read)
+        reader = SegmentReader(directory, 'test', skip_corrupt=True)
+        self.assertEqual([b'record 10', b'record 12'], reader.read())
+        self.assertEqual(1, len(reader.corrupt), 'expected the damaged record to be reported')
+
+    def test_outbound_durability_crash_injection(self):
+        """Cut the power after each file operation of an outbound batch, in each durability mode.
+
+        In batch and strict modes any semaphore that might survive has a message that's sure to,
+        and once the batch is written, when the messages would be marked sent, they all survive.
+        Batch mode should make fewer syncs than strict. Without syncing a semaphore can be left
+        with a truncated message, and nothing is sure to survive.
+        """
+
+        count = 20
+        messages = [(f'UnitTest_{index}', json.dumps({'index': index}).encode()) for index in range(count)]
+        syncs = {}
+        for durability in ('none', 'batch', 'strict'):
+            for mode in ('legacy', 'atomic'):
+                outbound = f'{self.test_archive}{os.path.sep}{durability}_{mode}'
+                os.makedirs(outbound)
+                sync = SyncBatch(durability)
+                with PowerLossModel().recording('ism_comms.file.outbound') as model:
+                    write_message_files(outbound, messages, '.json', '.smp', mode, True, sync)
+                syncs[durability, mode] = sync.syncs
+
+                orphans = []
+                for count_before_loss in range(len(model.events) + 1):
+                    survivors = model.survivors(count_before_loss)
+                    orphans.extend(
+                        (count_before_loss, path) for path in model.names(count_before_loss)
+                        if path.endswith('.smp') and not survivors.get(f'{path[:-len(".smp")]}.json')
+                    )
+
+                written = model.survivors(len(model.events))
+                if durability == 'none':
+                    self.assertTrue(orphans, 'expected semaphores that could outlive their messages')
+                    self.assertEqual({}, written)
+                    continue
+                self.assertEqual([], orphans, f'({durability}, {mode}) could leave semaphores without their messages')
+                for name, _ in messages:
+                    self.assertTrue(
+                        written.get(f'{outbound}{os.path.sep}{name}.json'),
+                        f'({durability}, {mode}) lost ({name}.json) once the batch was written'
+                    )
+                    # Semaphores are empty, so only their names need survive
+                    self.assertIn(f'{outbound}{os.path.sep}{name}.smp', written)
+
+        self.assertEqual(0, syncs['none', 'legacy'])
+        self.assertEqual(count + 2, syncs['batch', 'legacy'], 'expected one sync a file and two for the directory')
+        self.assertGreater(syncs['strict', 'legacy'], syncs['batch', 'legacy'])
+        self.assertGreater(syncs['strict', 'atomic'], syncs['batch', 'atomic'])
+
+    def test_segment_inbound_outbound_sqlite3(self):
+        """Confirm that the segment actions move messages through append-only segment directories.
+
+        A producer's records should be inserted into the messages table, skipping a
+        duplicate and a record that isn't a message. Outbound messages should be appended
+        to the outbound segments instead of being written as message files.
+        """
+
+        sender_id = 12
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['file']['segment_inbound'] = 'segments_in'
+        ism.properties['comms']['file']['segment_outbound'] = 'segments_out'
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.file.actions')
+        ism.import_action_pack('ism_comms.file.tests.test_file_io_outbound')
+        ism.start()
+
+        # ActionBeforeIoFile resolves the relative paths under the run directory
+        while not os.path.isabs(ism.properties['comms']['file']['segment_inbound']):
+            sleep(.01)
+        writer = SegmentWriter(ism.properties['comms']['file']['segment_inbound'])
+        writer.append(
+            [
+                json.dumps(
+                    {
+                        "message_id": message_id,
+                        "sender": "test_segment_inbound",
+                        "sender_id": message_id,
+                        "action": "ActionDummy",
+                        "payload": {"index": message_id},
+                        "sent": "Thursday lunchtime"
+                    }
+                ).encode()
+                for message_id in (10, 11, 12, 10, 13, 14)
+            ] + [b'not a message']
+        )
+        writer.commit()
+        writer.close()
+
+        reader = SegmentReader(ism.properties['comms']['file']['segment_outbound'], 'test')
+        records = reader.read()
+        retries = 100
+        while not records and retries:
+            retries -= 1
+            sleep(.1)
+            records = reader.read()
+        self.assertEqual('ActionDummy', json.loads(records[0])['action'], 'expected outbound message in segment')
+        self.assertEqual({'test_msg': 'test value'}, json.loads(records[0])['payload'])
+
+        sleep(1)
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT message_id FROM messages WHERE sender = 'test_segment_inbound'",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+
+        self.assertEqual([[10], [11], [12], [13], [14]], result)
+        self.assertEqual(
+            [],
+            os.listdir(ism.properties['comms']['file']['outbound']),
+            'expected no outbound message files while the segments are in use'
+        )
+
+        ism.stop()
+
+    def test_segment_inbound_failed_insert_sqlite3(self):
+        """Confirm that ActionIoSegmentInbound reads a batch again when its insert fails, rather than skipping it."""
+
+        sender_id = 13
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['file']['segment_inbound'] = 'segments_in'
+
+        # Fail the first insert of the batch, as if the database were locked
+        insert_many = MessageStore.insert_many
+        failed = []
+
+        def insert_many_once(store, rows, logger):
+            if not failed and any(row[1] == 'test_segment_retry' for row in rows):
+                failed.append(len(rows))
+                return [False] * len(rows)
+            return insert_many(store, rows, logger)
+
+        with mock.patch.object(MessageStore, 'insert_many', insert_many_once):
+            ism.import_action_pack('ism.tests.support')
+            ism.import_action_pack('ism_comms.file.actions')
+            ism.start()
+
+            while not os.path.isabs(ism.properties['comms']['file']['segment_inbound']):
+                sleep(.01)
+            directory = ism.properties['comms']['file']['segment_inbound']
+            writer = SegmentWriter(directory)
+            writer.append(
+                [
+                    json.dumps(
+                        {
+                            "message_id": message_id,
+                            "sender": "test_segment_retry",
+                            "sender_id": message_id,
+                            "action": "ActionDummy",
+                            "payload": {"index": message_id},
+                            "sent": "Thursday lunchtime"
+                        }
+                    ).encode()
+                    for message_id in (20, 21, 22)
+                ]
+            )
+            writer.commit()
+            writer.close()
+
+            sleep(1)
+            msg = {
+                "action": "ActionRunSqlQuery",
+                "payload": {
+                    "sql": "SELECT message_id FROM messages WHERE sender = 'test_segment_retry'",
+                    "sender_id": sender_id
+                }
+            }
+            result = self.query_test_support_pack(msg)
+
+            self.assertEqual([3], failed, 'expected the first insert to fail')
+            self.assertEqual([[20], [21], [22]], result, 'expected the batch inserted when read again')
+            self.assertEqual(
+                read_position(f'{directory}{os.path.sep}committed'),
+                read_position(f'{directory}{os.path.sep}reader.offset')
+            )
+
+            ism.stop()
+
 
 if __name__ == '__main__':
     unittest.main()
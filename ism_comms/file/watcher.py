@@ -0,0 +1,158 @@
+"""Linux inotify watcher for the inbound message directory.
+
+Rather than listing the inbound directory on every tick, the watcher asks the kernel to
+report semaphore files as they are closed after writing (IN_CLOSE_WRITE) or renamed into
+the directory (IN_MOVED_TO). Events are read without blocking, so draining the watcher
+on an idle tick costs a single read() that returns EAGAIN.
+
+If the kernel event queue overflows (IN_Q_OVERFLOW) events have been lost, and the
+caller must fall back to a full scan of the directory.
+
+ActionIoFileInbound lists the inbound directory on every tick by default. Setting
+[comms][file][inbound_watch] to inotify (Linux only) makes it take the semaphore files
+reported by this watcher from a WatchedDirectory instead, so idle ticks don't touch the
+directory. It still makes a full scan at startup and after an overflow, and reverts to
+polling if inotify isn't available.
+"""
+
+# Standard library imports
+from collections import deque
+import ctypes
+import ctypes.util
+import errno
+from itertools import islice
+import os
+import struct
+import weakref
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+
+class InotifyWatcher:
+    """Queue the names of semaphore files written into a directory, or its shards.
+
+    :param root The directory to watch.
+    :param suffix Only files ending with this suffix are queued. e.g. .smp
+    :param directories Subdirectories of root to watch instead of root itself. Queued
+    names are relative to root and keep the suffix. e.g. 00a/msg1.smp
+    """
+
+    def __init__(self, root: str, suffix: str, directories=('',)):
+        self.root = root
+        self.suffix = suffix
+        self.overflowed = False
+        self.ready = deque()
+        self.watches = {}
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f'inotify_init1 failed: {os.strerror(err)}')
+        # Release the descriptor if the watcher is dropped without being closed
+        self.finalizer = weakref.finalize(self, os.close, self.fd)
+        for directory in directories:
+            self.add_watch(directory)
+
+    def add_watch(self, directory: str):
+        """Watch a subdirectory of root"""
+
+        path = os.path.join(self.root, directory)
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            err = ctypes.get_errno()
+            self.close()
+            raise OSError(err, f'inotify_add_watch failed for ({path}): {os.strerror(err)}')
+        self.watches[wd] = directory
+
+    def close(self):
+        """Release the inotify file descriptor"""
+        if self.fd is not None:
+            self.finalizer()
+            self.fd = None
+
+    def read_events(self) -> int:
+        """Drain any pending kernel events into the ready queue.
+
+        :return The number of file names queued.
+        """
+
+        queued = 0
+        while True:
+            try:
+                buffer = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return queued
+            except OSError as err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+                offset += EVENT_HEADER.size
+                if mask & IN_Q_OVERFLOW:
+                    self.overflowed = True
+                elif length:
+                    name = os.fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+                    if name.endswith(self.suffix):
+                        self.ready.append(os.path.join(self.watches.get(wd, ''), name))
+                        queued += 1
+                offset += length
+
+    def reset(self):
+        """Forget queued names and any overflow, e.g. after the caller has run a full scan"""
+        self.ready.clear()
+        self.overflowed = False
+
+
+class WatchedDirectory:
+    """The ready files in a scanned directory, or its shards, queued as the watcher reports them.
+
+    Every file is queued by a full scan when the watcher starts and whenever the kernel
+    event queue has overflowed. Names are held until taken, so any that don't fit in one
+    batch are taken by the following ones.
+
+    :param scanner The directory's ism_comms.file.shards.DirectoryScanner.
+    :raises OSError or AttributeError if inotify isn't available.
+    """
+
+    def __init__(self, scanner):
+        self.scanner = scanner
+        self.watcher = InotifyWatcher(scanner.root, scanner.suffix, scanner.directories)
+        self.pending = {}
+        self.rescan = True
+
+    def __len__(self):
+        return len(self.pending)
+
+    def take(self, limit=0) -> list:
+        """Take up to limit (0, no limit) names of ready files, without their suffix"""
+
+        suffix = self.scanner.suffix
+        self.watcher.read_events()
+        if self.rescan or self.watcher.overflowed:
+            self.watcher.reset()
+            self.pending.update(dict.fromkeys(self.scanner.list_all()))
+            self.rescan = False
+        while self.watcher.ready:
+            self.pending[self.watcher.ready.popleft()[:-len(suffix)]] = None
+
+        # A name can be queued by both a scan and an event, so skip any already archived
+        file_names = []
+        for file_name in list(islice(self.pending, limit or None)):
+            del self.pending[file_name]
+            if os.path.exists(f'{self.scanner.root}{os.path.sep}{file_name}{suffix}'):
+                file_names.append(file_name)
+        return file_names
+
+    def close(self):
+        self.watcher.close()
+        self.pending.clear()
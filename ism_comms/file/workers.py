@@ -0,0 +1,172 @@
+"""Read and decode inbound message files off the state machine thread.
+
+ActionIoFileInbound reads and decodes each message file on the ISM thread by default,
+so a burst of large files holds up every other RUNNING action. With
+[comms][file][inbound_workers] set, the files it finds are handed to a DecodePool
+instead. Its workers, threads or processes per [comms][file][inbound_worker_type],
+read and decode the files in parallel and queue the results, and the action only has
+to drain the queue into the database.
+
+The pool takes at most queue_size files at a time, counting both those being decoded
+and the results waiting to be drained. When it's full the action stops handing it
+files, so the backlog stays on disk rather than in memory. The queue depth, the
+number in flight and how often the pool was full are kept in DecodePool.stats().
+"""
+
+# Standard library imports
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import queue
+
+# Application imports
+from ism_comms.core.codecs import get_codec
+from ism_comms.core.store import inbound_row
+from ism_comms.file.batches import BATCH, decode_batch
+
+
+def read_message_file(path: str, extensions) -> tuple:
+    """Read the message file, trying each extension in turn until one is found.
+
+    :return The file content and extension, or (None, None) if there's no message file.
+    """
+
+    for extension in extensions:
+        try:
+            with open(f'{path}{extension}', 'rb') as message_file:
+                return message_file.read(), extension
+        except FileNotFoundError:
+            continue
+    return None, None
+
+
+def decode_message_file(path: str, codecs: tuple, priorities=None, blobs=None) -> tuple:
+    """Read and decode one message file into the params to insert its messages.
+
+    :param codecs Pairs of (extension, codec name) in the order to try them. Names
+    rather than codecs so the call can be sent to a worker process. The batch file
+    extension is paired with ism_comms.file.batches.BATCH.
+    :param priorities The [comms][priority] properties, see inbound_row().
+    :param blobs The blob store settings, see inbound_row().
+    :return The extension found, a list of rows from inbound_row(), one per message in
+    the file, and the bytes read, or (None, None, 0) if there's no message file.
+    :raises Any error from decoding the file or finding the message fields.
+    """
+
+    names = dict(codecs)
+    data, found = read_message_file(path, names)
+    if data is None:
+        return None, None, 0
+    if names[found] == BATCH:
+        codec_name, messages = decode_batch(data)
+        codec = get_codec(codec_name)
+        return found, [inbound_row(codec.decode(message, blobs), priorities, blobs) for message in messages], len(data)
+    return found, [inbound_row(get_codec(names[found]).decode(data, blobs), priorities, blobs)], len(data)
+
+
+def decode_now(path: str, codecs: tuple, priorities=None, blobs=None) -> tuple:
+    """Decode a message file on this thread, returning the fields DecodePool.drain() does after the file name"""
+
+    try:
+        return (*decode_message_file(path, codecs, priorities, blobs), None)
+    except Exception as e:
+        return None, None, 0, e
+
+
+def decode_files(pool, files: list, codecs: tuple, priorities=None, blobs=None, limit=0) -> list:
+    """Decode (file_name, path) pairs on this thread, or hand them to the pool and drain up to limit decoded.
+
+    :param pool The DecodePool, or None to decode here.
+    :return Tuples of (file_name, extension, rows, size, error), see DecodePool.drain().
+    """
+
+    if pool is None:
+        return [(file_name, *decode_now(path, codecs, priorities, blobs)) for file_name, path in files]
+    for file_name, path in files:
+        pool.submit(file_name, path, codecs, priorities, blobs)
+    return pool.drain(limit)
+
+
+def open_decode_pool(settings: dict):
+    """Start the DecodePool set by [comms][file][inbound_workers], or return None to decode on the ISM thread"""
+
+    workers = settings.get('inbound_workers', 0)
+    if not workers:
+        return None
+    return DecodePool(workers, settings.get('inbound_worker_type', 'thread'), settings.get('inbound_queue_size', 1000))
+
+
+class DecodePool:
+    """A pool of workers that decode message files into a bounded queue of results.
+
+    :param workers Number of worker threads or processes.
+    :param worker_type thread or process.
+    :param queue_size Max files taken at once, decoding or waiting to be drained.
+    """
+
+    def __init__(self, workers: int, worker_type='thread', queue_size=1000):
+        executor_class = {
+            'thread': ThreadPoolExecutor,
+            'process': ProcessPoolExecutor
+        }[worker_type.lower()]
+        self.executor = executor_class(max_workers=workers)
+        self.queue_size = queue_size
+        self.results = queue.Queue()
+        self.in_flight = set()
+        self.peak_depth = 0
+        self.saturated = 0
+
+    def capacity(self) -> int:
+        """The number of files that can be submitted now. Counts a tick with none left as saturated."""
+
+        free = self.queue_size - len(self.in_flight)
+        if free <= 0:
+            self.saturated += 1
+        return max(free, 0)
+
+    def submit(self, file_name: str, path: str, codecs: tuple, priorities=None, blobs=None):
+        """Queue a file for decoding, unless it's already in flight"""
+
+        if file_name in self.in_flight:
+            return
+        self.in_flight.add(file_name)
+        future = self.executor.submit(decode_message_file, path, codecs, priorities, blobs)
+        future.add_done_callback(lambda done: self.results.put((file_name, done)))
+
+    def drain(self, limit=0) -> list:
+        """Take up to limit decoded files off the queue (0 for all waiting) without blocking.
+
+        :return Tuples of (file_name, extension, rows, size, error). The extension and rows
+        are None if there was no message file, and error is set if decoding failed.
+        """
+
+        depth = self.results.qsize()
+        self.peak_depth = max(self.peak_depth, depth)
+        decoded = []
+        try:
+            while not limit or len(decoded) < limit:
+                file_name, future = self.results.get_nowait()
+                error = future.exception()
+                found, rows, size = (None, None, 0) if error else future.result()
+                decoded.append((file_name, found, rows, size, error))
+        except queue.Empty:
+            pass
+        return decoded
+
+    def done(self, file_name: str):
+        """Release a drained file's place in the pool once it's been archived or set aside"""
+        self.in_flight.discard(file_name)
+
+    def stats(self) -> dict:
+        return {
+            'queue_depth': self.results.qsize(),
+            'peak_queue_depth': self.peak_depth,
+            'in_flight': len(self.in_flight),
+            'queue_size': self.queue_size,
+            'saturated_ticks': self.saturated
+        }
+
+    def close(self):
+        """Stop the workers. Files still in flight are left on disk to be found again."""
+
+        self.executor.shutdown(wait=True)
+        self.in_flight.clear()
+        self.results = queue.Queue()
@@ -0,0 +1,83 @@
+"""Create the SFTP session pools before running the sftp messaging actions"""
+
+# Application imports
+from ism.core.base_action import BaseAction
+from ism_comms.core.store import MessageStore
+from ism_comms.sftp.exceptions.exceptions import SftpHostNotConfigured, SftpHostNotOutbound
+from ism_comms.sftp.sessions import open_pools
+
+
+class ActionBeforeIoSftp(BaseAction):
+    """Create a session pool for each host defined under [comms][sftp][hosts] in the properties file.
+
+    e.g.
+        comms:
+          sftp:
+            username: ism
+            key_file: ~/.ssh/id_ed25519
+            sessions: 4
+            node: node1
+            hosts:
+              hub:
+                host: hub.example.com
+                inbound: /srv/ism/outbox/node1
+                outbound: /srv/ism/inbox
+            recipients:
+              UnitTest: hub
+
+    A host with an inbound directory is polled for messages, and one with an outbound
+    directory is sent the messages for the recipients routed to it. Recipients, and the
+    default_host, can only be routed to a host with an outbound directory.
+    ActionIoSftpInbound and ActionIoSftpOutbound are activated for whichever are
+    configured. Sessions are opened on first use, so a host that's down at startup
+    doesn't stop the ISM. See ism_comms.sftp.sessions for the connection settings.
+
+    Inbound files are claimed into a directory named after the node, and claims have no
+    lease, so the files a node had claimed when it stopped are only read by an ISM with
+    the same node name. Give each ISM polling a host its own fixed node, and restart a
+    failed node under the same name to pick up its claims.
+    """
+
+    def execute(self):
+
+        if self.active():
+
+            try:
+                settings = self.properties['comms']['sftp']
+                hosts = settings['hosts']
+            except KeyError as e:
+                self.logger.error(f'Failed to read [comms][sftp] entries from properties. KeyError ({e})')
+                raise
+
+            self.check_routes(settings)
+            open_pools(self.properties)
+
+            if any(host.get('inbound') for host in hosts.values()):
+                self.activate('ActionIoSftpInbound')
+            if any(host.get('outbound') for host in hosts.values()):
+                self.activate('ActionIoSftpOutbound')
+
+            # Bring a messages table made by an earlier release up to date, see ism_comms.core.store
+            MessageStore(self.dao, self.properties['database']['rdbms']).upgrade(self.logger)
+
+            # Job done so disable this action, or we'd be stuck in the STARTING phase
+            self.deactivate()
+
+    @staticmethod
+    def check_routes(settings: dict):
+        """Check that each recipient's host, and the default_host, can be sent messages.
+
+        :raises SftpHostNotConfigured if a host isn't in [comms][sftp][hosts].
+        :raises SftpHostNotOutbound if a host has no outbound directory.
+        """
+
+        hosts = settings['hosts']
+        recipients = settings.get('recipients') or {}
+        routes = [(host, f'for recipient ({recipient})') for recipient, host in recipients.items()]
+        if settings.get('default_host'):
+            routes.append((settings['default_host'], 'default_host'))
+        for host, used_as in routes:
+            if host not in hosts:
+                raise SftpHostNotConfigured(f'SFTP host ({host}) {used_as} not in [comms][sftp][hosts]')
+            if not hosts[host].get('outbound'):
+                raise SftpHostNotOutbound(f'SFTP host ({host}) {used_as} has no outbound directory')
@@ -0,0 +1,206 @@
+"""Action claims and downloads inbound message files from remote hosts over SFTP"""
+
+# Standard library imports
+import time
+
+# Application imports
+from ism.core.base_action import BaseAction
+from ism_comms.core.blobs import get_blob_settings
+from ism_comms.core.codecs import get_codec
+from ism_comms.core.dedup import get_filter
+from ism_comms.core.metrics import get_metrics
+from ism_comms.core.scheduler import AdaptivePolling, wake
+from ism_comms.core.store import DUPLICATE, FAILED, INSERTED, MessageStore, inbound_row
+from ism_comms.file.claims import default_node
+from ism_comms.sftp.sessions import close_pools, get_pools
+from ism_comms.sftp.transfers import RemoteInbound
+
+
+class ActionIoSftpInbound(AdaptivePolling, BaseAction):
+    """Poll the inbound directory of each remote host and read any messages found into the messages table.
+
+    Each tick lists the host's inbound directory on one pooled session, then claims and
+    downloads up to [comms][sftp][inbound_batch_size] files (default 0, no limit) over
+    all of the host's sessions at once. A file is claimed by renaming it into this
+    node's claim directory on the host before it's read, so several ISMs can poll the
+    same directory without reading a message twice, see ism_comms.sftp.transfers. The
+    node name is [comms][sftp][node], defaulting to the host name and process ID. Set it
+    so a restarted ISM picks up the claims it left behind.
+
+    The batch is inserted in one transaction, and only then are its files moved to the
+    host's archive directory, if it has one, or removed. A message already received from
+    the same (sender, sender_id) isn't inserted again, see ism_comms.core.dedup. Files
+    that can't be decoded are moved to the host's quarantine directory (default
+    .quarantine under the inbound directory). Files whose rows fail to insert stay
+    claimed and are read again after [comms][sftp][inbound_retry_interval] seconds
+    (default 60).
+
+    Files are in the file pack's format, with the extensions and codec of the outbound
+    action, see ActionIoSftpOutbound. Set [comms][sftp][inbound_semaphore] to false if
+    the senders publish message files with an atomic rename and write no semaphore.
+
+    A host that can't be reached is skipped for [comms][sftp][retry_interval] seconds
+    (default 5). The action is activated by ActionBeforeIoSftp when a host has an
+    inbound directory. Polling adapts to the traffic when [comms][polling] is set, see
+    ism_comms.core.scheduler.
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.started = False
+        self.remotes = {}
+        self.resumed = {}
+        self.failed = {}
+        self.retry_at = {}
+
+    def execute(self):
+
+        if self.active():
+
+            pools = get_pools(self.properties)
+            if pools is None:
+                return
+            self.started = True
+            self.poll(lambda: self.read_messages(pools))
+
+        elif self.started:
+            # Deactivated, or the phase has moved on from RUNNING
+            close_pools(self.properties)
+            self.remotes.clear()
+            self.resumed.clear()
+            self.started = False
+
+    def read_messages(self, pools: dict) -> int:
+        """Read a batch of message files from each host into the messages table, returning the number found"""
+
+        found = 0
+        now = time.monotonic()
+        for host, pool in pools.items():
+            if pool.settings.get('inbound') and self.retry_at.get(host, 0) <= now:
+                found += self.read_host(host, pool)
+        return found
+
+    def read_host(self, host: str, pool) -> int:
+        """Claim, download and insert a batch of message files from one host"""
+
+        settings = self.properties['comms']['sftp']
+        metrics = get_metrics(self.properties)
+        codec = get_codec(settings.get('codec', 'json'))
+        remote = self.remote(host, pool, codec)
+
+        # Anything claimed by an earlier tick or run goes first, then the new files
+        scan_started = metrics.clock()
+        batch_size = settings.get('inbound_batch_size', 0)
+        failed = self.failed.setdefault(host, {})
+        retries = self.due_retries(host)
+        try:
+            with pool.session() as sftp:
+                if host not in self.resumed:
+                    self.resumed[host] = remote.prepare(sftp)
+                items = [
+                    (file_name, True)
+                    for file_name in dict.fromkeys(self.resumed.pop(host) + retries) if file_name not in failed
+                ]
+                if not batch_size or len(items) < batch_size:
+                    items.extend(
+                        (file_name, False)
+                        for file_name in remote.list_ready(sftp, batch_size and batch_size - len(items), failed)
+                    )
+        except Exception as e:
+            self.logger.warning(f'Unable to list the inbound directory on SFTP host ({host}). ({e})')
+            self.retry_at[host] = time.monotonic() + settings.get('retry_interval', 5)
+            # The retries are among the claims found when the host is next prepared
+            self.resumed.pop(host, None)
+            return 0
+        self.resumed[host] = []
+        metrics.observe('scan_seconds', self.action_name, scan_started)
+        metrics.count('files_seen', self.action_name, len(items))
+        if not items:
+            return 0
+
+        # Claim and download the files over all the host's sessions
+        decode_started = metrics.clock()
+        priorities = self.properties['comms'].get('priority')
+        blobs = get_blob_settings(self.properties)
+        rows = []
+        accepted = []
+        quarantined = []
+        for (file_name, _), data, error in pool.map(remote.claim_and_read, items):
+            if error is None and data is None:
+                # Another node claimed it first
+                continue
+            if error is not None:
+                self.logger.warning(f'Failed to read message file ({file_name}) from SFTP host ({host}). ({error})')
+                # Look for it in the claim directory next tick, in case it was claimed
+                self.resumed.pop(host, None)
+                continue
+            metrics.count('bytes_read', self.action_name, len(data))
+            try:
+                rows.append(inbound_row(codec.decode(data, blobs), priorities, blobs))
+            except Exception as e:
+                self.logger.error(f'Quarantining message file ({file_name}) from SFTP host ({host}). ({e})')
+                quarantined.append(file_name)
+                continue
+            accepted.append(file_name)
+        metrics.observe('decode_seconds', self.action_name, decode_started)
+        if quarantined:
+            metrics.count('quarantined', self.action_name, len(quarantined))
+            self.log_errors(host, pool.map(remote.quarantine, quarantined))
+
+        # Write them into the DB messages table
+        db_started = metrics.clock()
+        store = MessageStore(self.dao, self.properties['database']['rdbms'])
+        statuses = store.insert_unique(rows, self.logger, get_filter(self.properties, store)) if rows else []
+        metrics.observe('db_seconds', self.action_name, db_started)
+        metrics.count('rows', self.action_name, statuses.count(INSERTED))
+        duplicates = statuses.count(DUPLICATE)
+        if duplicates:
+            metrics.count('duplicates', self.action_name, duplicates)
+            self.logger.info(f'Archived ({duplicates}) duplicate message files from SFTP host ({host}).')
+
+        # Archive or remove the remote files so we don't read them again
+        finished = []
+        retry_interval = settings.get('inbound_retry_interval', 60)
+        for file_name, status in zip(accepted, statuses):
+            if status == FAILED:
+                failed[file_name] = time.monotonic() + retry_interval
+            else:
+                finished.append(file_name)
+        self.log_errors(host, pool.map(remote.finish, finished))
+        if INSERTED in statuses:
+            wake(self.properties, 'inbound')
+        return len(items)
+
+    def due_retries(self, host: str) -> list:
+        """Take the host's files whose rows failed to insert that are due to be read again"""
+
+        now = time.monotonic()
+        failed = self.failed.get(host, {})
+        due = [file_name for file_name, retry_at in failed.items() if retry_at <= now]
+        for file_name in due:
+            del failed[file_name]
+        if due:
+            self.logger.info(f'Retrying ({len(due)}) message files from SFTP host ({host}) that failed to insert.')
+        return due
+
+    def remote(self, host: str, pool, codec) -> RemoteInbound:
+        """The claims and paths of the host's inbound directory"""
+
+        if host not in self.remotes:
+            settings = self.properties['comms']['sftp']
+            self.remotes[host] = RemoteInbound(
+                pool.settings['inbound'],
+                settings.get('node') or default_node(),
+                settings.get('message_extension', '.json') if codec.name == 'json' else codec.extension,
+                settings.get('semaphore_extension', '.smp') if settings.get('inbound_semaphore', True) else None,
+                pool.settings.get('archive'),
+                pool.settings.get('quarantine', '.quarantine')
+            )
+        return self.remotes[host]
+
+    def log_errors(self, host: str, results: list):
+        """Log the files that couldn't be moved, which are read again when their claims are next resumed"""
+
+        for file_name, _, error in results:
+            if error is not None:
+                self.logger.error(f'Failed to move message file ({file_name}) on SFTP host ({host}). ({error})')
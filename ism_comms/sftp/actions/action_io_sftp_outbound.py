@@ -0,0 +1,136 @@
+"""Action uploads outbound messages from the messages table to remote hosts over SFTP"""
+
+# Standard library imports
+import time
+
+# Application imports
+from ism.core.base_action import BaseAction
+from ism_comms.core.codecs import get_codec
+from ism_comms.core.metrics import get_metrics
+from ism_comms.core.scheduler import AdaptivePolling
+from ism_comms.core.store import MessageStore, recipient_filter
+from ism_comms.sftp.sessions import close_pools, get_pools
+from ism_comms.sftp.transfers import upload
+
+
+class ActionIoSftpOutbound(AdaptivePolling, BaseAction):
+    """Upload each pending outbound message to its recipient's host.
+
+    The host is looked up by recipient in [comms][sftp][recipients], falling back to
+    [comms][sftp][default_host], or to the only host with an outbound directory if
+    there's just the one. Up to [comms][sftp][outbound_batch_size] messages (default 0,
+    no limit) are sent per tick. Each host's share of the batch is uploaded concurrently
+    over its pooled sessions, and the messages uploaded are marked processed in bulk.
+
+    Files are written in the file pack's format into the host's outbound directory, see
+    ism_comms.sftp.transfers. Messages are encoded with [comms][sftp][codec] (default
+    json), and JSON files take [comms][sftp][message_extension] (default .json). An
+    empty semaphore file, [comms][sftp][semaphore_extension] (default .smp), follows
+    each message unless [comms][sftp][outbound_semaphore] is false.
+
+    A message that fails to upload stays pending, and its host is skipped for
+    [comms][sftp][retry_interval] seconds (default 5). Messages for a host being skipped,
+    or for a recipient with no host, are left pending and out of the batch fetched, so
+    they don't hold up the messages for the other hosts.
+
+    The action is activated by ActionBeforeIoSftp when a host has an outbound directory.
+    Polling adapts to the traffic when [comms][polling] is set, see
+    ism_comms.core.scheduler.
+    """
+
+    poll_topic = 'outbound'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.started = False
+        self.retry_at = {}
+
+    def execute(self):
+
+        if self.active():
+
+            pools = get_pools(self.properties)
+            if pools is None:
+                return
+            self.started = True
+            self.poll(lambda: self.send_messages(pools))
+
+        elif self.started:
+            # Deactivated, or the phase has moved on from RUNNING
+            close_pools(self.properties)
+            self.started = False
+
+    def send_messages(self, pools: dict) -> int:
+        """Upload a batch of pending outbound messages, returning the number sent"""
+
+        settings = self.properties['comms']['sftp']
+        metrics = get_metrics(self.properties)
+        store = MessageStore(self.dao, self.properties['database']['rdbms'])
+        now = time.monotonic()
+        blocked = {host for host, retry_at in self.retry_at.items() if retry_at > now}
+        db_started = metrics.clock()
+        results = store.fetch_pending(
+            'outbound',
+            settings.get('outbound_batch_size', 0),
+            **recipient_filter(settings.get('recipients') or {}, self.default_host(), blocked)
+        )
+        metrics.observe('db_seconds', self.action_name, db_started)
+        metrics.gauge('backlog', self.action_name, len(results))
+        if not results:
+            return 0
+
+        codec = get_codec(settings.get('codec', 'json'))
+        extension = settings.get('message_extension', '.json') if codec.name == 'json' else codec.extension
+        semaphore = settings.get('semaphore_extension', '.smp') if settings.get('outbound_semaphore', True) else None
+
+        # Encode the messages, grouped by the host they go to
+        encode_started = metrics.clock()
+        send_time = int(time.time())
+        batches = {}
+        for record in results:
+            host = self.route(record.recipient)
+            data = codec.encode(record.message(send_time))
+            batches.setdefault(host, []).append((record, data))
+
+        # Upload each host's share over its sessions
+        sent = []
+        written = 0
+        for host, batch in batches.items():
+            pool = pools[host]
+            directory = pool.settings['outbound']
+            uploaded = pool.map(
+                lambda sftp, item: upload(
+                    sftp, directory, f'{item[0].recipient}_{item[0].sender_id}', item[1], extension, semaphore
+                ),
+                batch
+            )
+            for (record, _), size, error in uploaded:
+                if error is not None:
+                    self.logger.warning(f'Failed to upload message ({record.message_id}) to ({host}). ({error})')
+                    self.retry_at[host] = now + settings.get('retry_interval', 5)
+                    continue
+                sent.append(record.message_id)
+                written += size
+        metrics.observe('encode_seconds', self.action_name, encode_started)
+        metrics.count('bytes_written', self.action_name, written)
+
+        db_started = metrics.clock()
+        store.mark_processed(sent, sent=send_time)
+        metrics.observe('db_seconds', self.action_name, db_started)
+        metrics.count('rows', self.action_name, len(sent))
+        return len(sent)
+
+    def route(self, recipient: str):
+        """The name of the host to send a recipient's messages to, or None"""
+        return (self.properties['comms']['sftp'].get('recipients') or {}).get(recipient, self.default_host())
+
+    def default_host(self):
+        """The host for recipients without one of their own, or None"""
+
+        settings = self.properties['comms']['sftp']
+        host = settings.get('default_host')
+        if host is None:
+            outbound = [name for name, host_settings in settings['hosts'].items() if host_settings.get('outbound')]
+            if len(outbound) == 1:
+                host = outbound[0]
+        return host
@@ -0,0 +1,15 @@
+"""Custom Exceptions for the state machine ism_comms.sftp actions"""
+
+
+class SftpHostNotConfigured(Exception):
+
+    def __init__(self, message='SFTP host not found in [comms][sftp][hosts]'):
+        self.message = message
+        super().__init__(self.message)
+
+
+class SftpHostNotOutbound(Exception):
+
+    def __init__(self, message='SFTP host has no outbound directory in [comms][sftp][hosts]'):
+        self.message = message
+        super().__init__(self.message)
@@ -0,0 +1,250 @@
+"""Pools of persistent SSH/SFTP sessions shared by the sftp actions of one state machine.
+
+Opening an SSH connection costs several round trips for the key exchange and
+authentication, so the sftp actions never connect per message or per tick. Each remote
+host in [comms][sftp][hosts] gets a SessionPool holding up to [sessions] connections,
+each with one SFTP channel, opened on first use and kept open between ticks. A batch of
+transfers is shared between the pool's sessions by SessionPool.map(), so up to that many
+files are in flight to the host at once. e.g.
+    comms:
+      sftp:
+        username: ism
+        key_file: ~/.ssh/id_ed25519
+        known_hosts: ~/.ssh/known_hosts
+        sessions: 4
+        hosts:
+          hub:
+            host: hub.example.com
+            port: 22
+            inbound: /srv/ism/outbox/node1
+            outbound: /srv/ism/inbox
+
+Every setting other than hosts and recipients is a default for each host, and can be
+overridden in the host's own entry:
+
+    * host, port - The SSH server, port defaults to 22.
+    * username, password, key_file - The login. Without a password or key_file the
+    SSH agent and the default keys in ~/.ssh are tried.
+    * known_hosts - A known hosts file to check the server's key against, as well as
+    the user's own. host_key_policy sets what happens to a server that isn't in
+    either: reject (default), warning or auto_add.
+    * sessions - Max sessions to the host (default 4).
+    * timeout - Seconds to wait to connect, and for a free session (default 10).
+    * keepalive - Seconds between keepalive packets on an idle session (default 30),
+    so firewalls don't drop it. 0 turns them off.
+    * compress - Compress the SSH stream (default false).
+
+ActionBeforeIoSftp creates the pools and the inbound and outbound actions look them up
+by the run directory, so several state machines can run in one process. A session whose
+connection drops is closed and replaced on next use.
+"""
+
+# Standard library imports
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import os
+import queue
+import threading
+
+# Third party imports
+import paramiko
+
+# Settings that aren't defaults for the hosts
+NOT_DEFAULTS = ('hosts', 'recipients')
+
+# What to do with a server key not found in the known hosts
+HOST_KEY_POLICIES = {
+    'reject': paramiko.RejectPolicy,
+    'warning': paramiko.WarningPolicy,
+    'auto_add': paramiko.AutoAddPolicy
+}
+
+_pools = {}
+
+
+def host_settings(settings: dict, name: str) -> dict:
+    """The settings of one host, over the defaults in [comms][sftp]"""
+
+    defaults = {key: value for key, value in settings.items() if key not in NOT_DEFAULTS}
+    return {**defaults, **settings['hosts'][name]}
+
+
+def open_pools(properties: dict) -> dict:
+    """Create a session pool for each host in [comms][sftp][hosts] for this run.
+
+    No connections are made until the pools are used.
+    """
+
+    key = properties['runtime']['run_dir']
+    close_pools(properties)
+    settings = properties['comms']['sftp']
+    _pools[key] = {name: SessionPool(name, host_settings(settings, name)) for name in settings['hosts']}
+    return _pools[key]
+
+
+def get_pools(properties: dict):
+    """Return the session pools for this run, by host name, or None"""
+    return _pools.get(properties['runtime']['run_dir'])
+
+
+def close_pools(properties: dict):
+    pools = _pools.pop(properties['runtime']['run_dir'], None)
+    for pool in (pools or {}).values():
+        pool.close()
+
+
+class SftpSession:
+    """One SSH connection to a host and the SFTP channel opened over it.
+
+    :param settings The host's settings, see host_settings().
+    """
+
+    def __init__(self, settings: dict):
+        self.client = paramiko.SSHClient()
+        self.client.load_system_host_keys()
+        if settings.get('known_hosts'):
+            self.client.load_host_keys(os.path.expanduser(settings['known_hosts']))
+        self.client.set_missing_host_key_policy(HOST_KEY_POLICIES[settings.get('host_key_policy', 'reject')]())
+        try:
+            self.client.connect(
+                settings['host'],
+                port=settings.get('port', 22),
+                username=settings.get('username'),
+                password=settings.get('password'),
+                key_filename=os.path.expanduser(settings['key_file']) if settings.get('key_file') else None,
+                timeout=settings.get('timeout', 10),
+                compress=settings.get('compress', False)
+            )
+            transport = self.client.get_transport()
+            transport.set_keepalive(settings.get('keepalive', 30))
+            self.sftp = self.client.open_sftp()
+        except Exception:
+            self.client.close()
+            raise
+
+    def active(self) -> bool:
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def close(self):
+        self.sftp.close()
+        self.client.close()
+
+
+class SessionPool:
+    """Up to settings[sessions] persistent sessions to one host.
+
+    :param name The host's name in [comms][sftp][hosts].
+    :param settings The host's settings, see host_settings().
+    """
+
+    def __init__(self, name: str, settings: dict):
+        self.name = name
+        self.settings = settings
+        self.size = settings.get('sessions', 4)
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+        self.executor = None
+
+    @contextmanager
+    def session(self):
+        """Lend a session from the pool, opening one if none is idle and the pool isn't full.
+
+        The session goes back to the pool afterwards, unless its connection has dropped.
+
+        :raises paramiko.SSHException or OSError if a session can't be opened.
+        :raises queue.Empty if every session stays busy for [timeout] seconds.
+        """
+
+        session = self.checkout()
+        try:
+            yield session.sftp
+        finally:
+            self.checkin(session)
+
+    def checkout(self) -> SftpSession:
+        while True:
+            try:
+                session = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if session.active():
+                return session
+            self.discard(session)
+
+        with self.lock:
+            grow = self.opened < self.size
+            if grow:
+                self.opened += 1
+        if not grow:
+            return self.idle.get(timeout=self.settings.get('timeout', 10))
+        try:
+            return SftpSession(self.settings)
+        except Exception:
+            with self.lock:
+                self.opened -= 1
+            raise
+
+    def checkin(self, session: SftpSession):
+        if session.active():
+            self.idle.put(session)
+        else:
+            self.discard(session)
+
+    def discard(self, session: SftpSession):
+        session.close()
+        with self.lock:
+            self.opened -= 1
+
+    def map(self, work, items: list) -> list:
+        """Call work(sftp, item) for each item, sharing the items between the pool's sessions.
+
+        The items are dealt round robin to as many sessions as the pool allows, and each
+        session works through its share in turn, so at most one request is outstanding
+        per session apart from those pipelined within a file.
+
+        :return (item, result, error) for each item, in the order given. error is the
+        exception raised for the item, or None.
+        """
+
+        if not items:
+            return []
+        shares = [items[start::self.size] for start in range(min(self.size, len(items)))]
+        if len(shares) == 1:
+            return self.work_through(work, shares[0])
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.size, thread_name_prefix=f'sftp-{self.name}')
+        futures = [self.executor.submit(self.work_through, work, share) for share in shares]
+        done = [future.result() for future in futures]
+
+        # Put the results back in the order of the items
+        results = [None] * len(items)
+        for start, share in enumerate(done):
+            results[start::self.size] = share
+        return results
+
+    def work_through(self, work, share: list) -> list:
+        """Call work(sftp, item) for each item on one session"""
+
+        try:
+            with self.session() as sftp:
+                results = []
+                for item in share:
+                    try:
+                        results.append((item, work(sftp, item), None))
+                    except Exception as e:
+                        results.append((item, None, e))
+                return results
+        except Exception as e:
+            return [(item, None, e) for item in share]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        while True:
+            try:
+                self.discard(self.idle.get_nowait())
+            except queue.Empty:
+                break
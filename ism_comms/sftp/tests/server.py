@@ -0,0 +1,189 @@
+"""An in-process SFTP server for the sftp tests.
+
+Serves a local directory over SSH on a loopback port picked by the OS, using paramiko's
+server side, so the tests exercise the real protocol without an sshd. Any username is
+accepted with the server's password. Each connection is handled on its own threads,
+like separate sshd processes, and each request can be delayed by latency seconds to
+stand in for a remote host.
+"""
+
+# Standard library imports
+import os
+import socket
+import threading
+import time
+
+# Third party imports
+import paramiko
+
+
+class StubServer(paramiko.ServerInterface):
+    """Accept password logins and sftp subsystem requests"""
+
+    def __init__(self, password: str):
+        self.password = password
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL if password == self.password else paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class LocalSftpHandle(paramiko.SFTPHandle):
+    """An open local file, which the client stats before prefetching it"""
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class LocalSftpInterface(paramiko.SFTPServerInterface):
+    """Map SFTP requests onto a local root directory"""
+
+    def __init__(self, server, root: str, latency=0.0):
+        super().__init__(server)
+        self.root = root
+        self.latency = latency
+
+    def local(self, path: str) -> str:
+        self.wait()
+        return os.path.join(self.root, os.path.normpath(f'/{path}').lstrip('/'))
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    @staticmethod
+    def errno(e: OSError):
+        return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def list_folder(self, path):
+        try:
+            directory = self.local(path)
+            found = []
+            for name in os.listdir(directory):
+                attributes = paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(directory, name)))
+                attributes.filename = name
+                found.append(attributes)
+            return found
+        except OSError as e:
+            return self.errno(e)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.local(path)))
+        except OSError as e:
+            return self.errno(e)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            descriptor = os.open(self.local(path), flags | getattr(os, 'O_BINARY', 0), 0o644)
+        except OSError as e:
+            return self.errno(e)
+        mode = 'wb' if flags & os.O_WRONLY else 'r+b' if flags & os.O_RDWR else 'rb'
+        handle = LocalSftpHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(descriptor, mode)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self.local(path))
+        except OSError as e:
+            return self.errno(e)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        # SFTPv3 rename won't replace an existing file
+        try:
+            new = self.local(newpath)
+            if os.path.exists(new):
+                return paramiko.SFTP_FAILURE
+            os.rename(self.local(oldpath), new)
+        except OSError as e:
+            return self.errno(e)
+        return paramiko.SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        try:
+            os.replace(self.local(oldpath), self.local(newpath))
+        except OSError as e:
+            return self.errno(e)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self.local(path))
+        except OSError as e:
+            return self.errno(e)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self.local(path))
+        except OSError as e:
+            return self.errno(e)
+        return paramiko.SFTP_OK
+
+
+class LocalSftpServer:
+    """Serve root over SFTP on 127.0.0.1 until stopped.
+
+    :param root The local directory that is / on the server.
+    :param password The password for every username.
+    :param latency Seconds to delay each request by.
+    """
+
+    host_key = None
+
+    def __init__(self, root: str, password='secret', latency=0.0):
+        self.root = root
+        self.password = password
+        self.latency = latency
+        self.port = None
+        self.listener = None
+        self.thread = None
+        self.stopping = threading.Event()
+        self.transports = []
+
+    def start(self):
+        if LocalSftpServer.host_key is None:
+            LocalSftpServer.host_key = paramiko.RSAKey.generate(2048)
+        os.makedirs(self.root, exist_ok=True)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.listener.settimeout(.1)
+        self.port = self.listener.getsockname()[1]
+        self.thread = threading.Thread(target=self.accept, name='local-sftp-server', daemon=True)
+        self.thread.start()
+
+    def accept(self):
+        while not self.stopping.is_set():
+            try:
+                connection, _ = self.listener.accept()
+            except socket.timeout:
+                continue
+            connection.settimeout(None)
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, LocalSftpInterface, self.root, self.latency)
+            transport.start_server(server=StubServer(self.password))
+            self.transports.append(transport)
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join(5)
+        self.listener.close()
+        for transport in self.transports:
+            transport.close()
+        self.transports.clear()
@@ -0,0 +1,408 @@
+"""This module tests the SFTP ism_comms.sftp action pack for the python state machine.
+
+
+"""
+
+# Standard library imports
+import json
+import os
+import shutil
+import socket
+from time import sleep
+import unittest
+from unittest import mock
+import yaml
+
+# Local application imports
+from ism.ISM import ISM
+from ism_comms.benchmarks.sftp import transfer_rates
+from ism_comms.core.store import MessageStore
+from ism_comms.sftp.actions.action_before_io_sftp import ActionBeforeIoSftp
+from ism_comms.sftp.exceptions.exceptions import SftpHostNotConfigured, SftpHostNotOutbound
+from ism_comms.sftp.sessions import SessionPool, close_pools
+from ism_comms.sftp.tests.server import LocalSftpServer
+from ism_comms.sftp.transfers import RemoteInbound, upload
+
+
+class TestIsmIoSftp(unittest.TestCase):
+    """This action pack implements SFTP based IO.
+
+    The tests run against an in-process SFTP server on the loopback interface, see
+    ism_comms.sftp.tests.server, so need no sshd.
+    """
+    path_sep = os.path.sep
+    dir = os.path.dirname(os.path.abspath(__file__))
+    sqlite3_properties = f'{dir}{path_sep}resources{path_sep}sqlite3_properties.yaml'
+
+    # Test support methods
+    def setUp(self):
+        self.properties = self.get_properties(self.sqlite3_properties)
+        self.test_inbound = self.properties['test']['support']['inbound']
+        self.test_outbound = self.properties['test']['support']['outbound']
+        self.test_archive = self.properties['test']['support']['archive']
+        self.sftp_root = self.properties['test']['sftp']['root']
+        for directory in ('inbound', 'outbound'):
+            os.makedirs(f'{self.sftp_root}{os.path.sep}{directory}', exist_ok=True)
+        self.server = LocalSftpServer(self.sftp_root, self.properties['comms']['sftp']['password'])
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.clear_test_files(self.test_inbound)
+        self.clear_test_files(self.test_outbound)
+        self.clear_test_files(self.test_archive)
+        self.clear_test_files(self.sftp_root)
+
+    @staticmethod
+    def clear_test_files(directory):
+        if not os.path.exists(directory):
+            return
+        for filename in os.listdir(directory):
+            file_path = os.path.join(directory, filename)
+            try:
+                if os.path.isfile(file_path) or os.path.islink(file_path):
+                    os.unlink(file_path)
+                elif os.path.isdir(file_path):
+                    shutil.rmtree(file_path)
+            except Exception as e:
+                print('Failed to delete %s. Reason: %s' % (file_path, e))
+
+    @staticmethod
+    def get_properties(properties_file: str) -> dict:
+        """Read in the properties file"""
+        with open(properties_file, 'r') as file:
+            return yaml.safe_load(file)
+
+    @staticmethod
+    def stop(ism):
+        """Stop the ISM and close its sessions once the main loop has exited"""
+        ism.stop()
+        ism.ism_thread.join(5)
+        close_pools(ism.properties)
+
+    def start_ism(self, *packs) -> ISM:
+        """Start an ISM with the sftp actions, pointed at the test server"""
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['sftp']['hosts']['local']['port'] = self.server.port
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.sftp.actions')
+        for pack in packs:
+            ism.import_action_pack(pack)
+        ism.start()
+        return ism
+
+    def host_settings(self, sessions: int) -> dict:
+        settings = self.properties['comms']['sftp']
+        return {
+            'host': '127.0.0.1',
+            'port': self.server.port,
+            'username': settings['username'],
+            'password': settings['password'],
+            'host_key_policy': 'auto_add',
+            'sessions': sessions
+        }
+
+    def query_test_support_pack(self, msg: dict) -> list:
+
+        sender_id = msg['payload']['sender_id']
+
+        self.send_test_support_msg(msg)
+
+        # Wait for the reply.
+        self.assertTrue(
+            self.wait_for_test_message_reply(sender_id),
+            'Failed to find expected reply to test support message.'
+        )
+
+        with open(f'{self.test_outbound}{os.path.sep}{sender_id}.json', 'r') as file:
+            return json.loads(file.read()).get('query_result', {})
+
+    def send_test_support_msg(self, msg: dict):
+
+        sender_id = msg['payload']['sender_id']
+
+        if not os.path.exists(self.test_inbound):
+            os.makedirs(self.test_inbound)
+
+        with open(f'{self.test_inbound}{os.path.sep}{sender_id}.json', 'w') as message:
+            message.write(json.dumps(msg))
+        with open(f'{self.test_inbound}{os.path.sep}{sender_id}.smp', 'w') as semaphore:
+            semaphore.write('')
+
+    def wait_for_test_message_reply(self, sender_id, retries=10) -> bool:
+        """Wait for an expected reply to a test support message"""
+
+        expected_file = f'{self.test_outbound}{os.path.sep}{sender_id}.json'
+
+        while retries > 0:
+            if os.path.exists(expected_file):
+                return True
+            retries -= 1
+            sleep(1)
+
+        return False
+
+    @staticmethod
+    def message(message_id: int, sender='test_sftp') -> bytes:
+        return json.dumps(
+            {
+                "message_id": message_id,
+                "sender": sender,
+                "sender_id": message_id,
+                "action": "ActionDummy",
+                "payload": {"index": message_id},
+                "sent": "Thursday lunchtime"
+            }
+        ).encode()
+
+    # The tests
+    def test_session_pool_transfers(self):
+        """Confirm that a pool of sessions uploads, claims and reads files, and that more sessions aren't slower.
+
+        Each request to the server is delayed by a few milliseconds to stand in for a remote
+        host. The rates are measured by ism_comms.benchmarks.sftp. A file that's already
+        been claimed can't be claimed again.
+        """
+
+        self.server.latency = .005
+        count = 20
+        pool = SessionPool('local', self.host_settings(2))
+        remote = RemoteInbound('/inbound', 'node', '.json', '.smp')
+        uploaded = pool.map(
+            lambda sftp, message_id: upload(
+                sftp, '/inbound', f'UnitTest_{message_id}', self.message(message_id), '.json', '.smp'
+            ),
+            list(range(1, count + 1))
+        )
+        self.assertEqual([None] * count, [error for *_, error in uploaded])
+
+        with pool.session() as sftp:
+            remote.prepare(sftp)
+            file_names = remote.list_ready(sftp)
+        self.assertEqual(count, len(file_names))
+        read = pool.map(remote.claim_and_read, [(file_name, False) for file_name in file_names])
+        finished = pool.map(remote.finish, file_names)
+        self.assertEqual([None] * count * 2, [error for *_, error in read + finished])
+        self.assertEqual(
+            sorted(self.message(message_id) for message_id in range(1, count + 1)),
+            sorted(data for _, data, _ in read)
+        )
+        self.assertEqual(
+            [(('UnitTest_1', False), None, None)],
+            pool.map(remote.claim_and_read, [('UnitTest_1', False)]),
+            'expected a file already claimed to be skipped'
+        )
+        pool.close()
+
+        password = self.properties['comms']['sftp']['password']
+        rates = {}
+        for sessions in (1, 4):
+            results = transfer_rates(self.server.port, sessions, 100, self.message(1), password)
+            self.assertEqual((100, 0), (results['read'], results['errors']))
+            rates[sessions] = results['read_rate']
+        self.assertGreaterEqual(rates[4], rates[1], 'expected more sessions not to be slower')
+        self.assertEqual(
+            ['.claims', '.quarantine'],
+            sorted(os.listdir(f'{self.sftp_root}{os.path.sep}inbound')),
+            'expected every file to be claimed and removed'
+        )
+
+    def test_check_routes(self):
+        """Confirm that recipients, and the default_host, can only be routed to a host with an outbound directory"""
+
+        hosts = {'hub': {'outbound': '/inbox'}, 'feed': {'inbound': '/outbox'}}
+        ActionBeforeIoSftp.check_routes({'hosts': hosts, 'recipients': {'UnitTest': 'hub'}, 'default_host': 'hub'})
+        ActionBeforeIoSftp.check_routes({'hosts': hosts})
+        with self.assertRaises(SftpHostNotOutbound):
+            ActionBeforeIoSftp.check_routes({'hosts': hosts, 'recipients': {'UnitTest': 'feed'}})
+        with self.assertRaises(SftpHostNotOutbound):
+            ActionBeforeIoSftp.check_routes({'hosts': hosts, 'default_host': 'feed'})
+        with self.assertRaises(SftpHostNotConfigured):
+            ActionBeforeIoSftp.check_routes({'hosts': hosts, 'recipients': {'UnitTest': 'elsewhere'}})
+
+    def test_inbound_sftp_sqlite3(self):
+        """Test that ActionIoSftpInbound claims and downloads the remote files into the messages table.
+
+        One file is left in the node's claim directory, as if by a crash, and should be read too.
+        """
+
+        sender_id = 1
+        count = 50
+
+        inbound = f'{self.sftp_root}{os.path.sep}inbound'
+        for message_id in range(1, count + 1):
+            with open(f'{inbound}{os.path.sep}UnitTest_{message_id}.json', 'wb') as file:
+                file.write(self.message(message_id))
+            with open(f'{inbound}{os.path.sep}UnitTest_{message_id}.smp', 'w') as file:
+                file.write('')
+        claims = f'{inbound}{os.path.sep}.claims{os.path.sep}test_node'
+        os.makedirs(claims)
+        os.rename(f'{inbound}{os.path.sep}UnitTest_1.smp', f'{claims}{os.path.sep}UnitTest_1.smp')
+
+        ism = self.start_ism()
+
+        # Test support actions can answer during the STARTING phase, so give the inbound action time to run
+        sleep(2)
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT COUNT(*), COUNT(DISTINCT message_id) FROM messages WHERE sender = 'test_sftp'",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual([count, count], result[0], 'expected each message to be inserted exactly once')
+        self.assertEqual(['.claims', '.quarantine'], sorted(os.listdir(inbound)))
+        self.assertEqual([], os.listdir(claims))
+
+        self.stop(ism)
+
+    def test_inbound_sftp_failed_retry_sqlite3(self):
+        """Test that a remote file whose row fails to insert stays claimed and is read again after the interval"""
+
+        sender_id = 4
+
+        inbound = f'{self.sftp_root}{os.path.sep}inbound'
+        with open(f'{inbound}{os.path.sep}UnitTest_30.json', 'wb') as file:
+            file.write(self.message(30))
+        with open(f'{inbound}{os.path.sep}UnitTest_30.smp', 'w') as file:
+            file.write('')
+
+        # Fail the first insert, as if the database were locked
+        insert_many = MessageStore.insert_many
+        failed = []
+
+        def insert_many_once(store, rows, logger):
+            if not failed:
+                failed.append(len(rows))
+                return [False] * len(rows)
+            return insert_many(store, rows, logger)
+
+        with mock.patch.object(MessageStore, 'insert_many', insert_many_once):
+            args = {
+                'properties_file': self.sqlite3_properties
+            }
+            ism = ISM(args)
+            ism.properties['comms']['sftp']['hosts']['local']['port'] = self.server.port
+            ism.properties['comms']['sftp']['inbound_retry_interval'] = .5
+            ism.import_action_pack('ism.tests.support')
+            ism.import_action_pack('ism_comms.sftp.actions')
+            ism.start()
+
+            claims = f'{inbound}{os.path.sep}.claims{os.path.sep}test_node'
+            retries = 500
+            while (failed == [] or os.listdir(claims)) and retries:
+                retries -= 1
+                sleep(.01)
+            msg = {
+                "action": "ActionRunSqlQuery",
+                "payload": {
+                    "sql": "SELECT message_id FROM messages WHERE sender = 'test_sftp'",
+                    "sender_id": sender_id
+                }
+            }
+            result = self.query_test_support_pack(msg)
+
+            self.assertEqual([1], failed, 'expected the first insert to fail')
+            self.assertEqual([[30]], result, 'expected the message to be inserted when read again')
+            self.assertEqual([], os.listdir(claims), 'expected the claim to be finished once inserted')
+
+            self.stop(ism)
+
+    def test_outbound_sftp_sqlite3(self):
+        """Confirm that ActionIoSftpOutbound uploads a pending outbound message and marks it processed."""
+
+        sender_id = 2
+
+        # Test action pack contains insert into messages table.
+        ism = self.start_ism('ism_comms.file.tests.test_file_io_outbound')
+
+        outbound = f'{self.sftp_root}{os.path.sep}outbound'
+        retries = 50
+        while not os.path.exists(f'{outbound}{os.path.sep}UnitTest_1.smp') and retries:
+            retries -= 1
+            sleep(.1)
+        with open(f'{outbound}{os.path.sep}UnitTest_1.json') as file:
+            message = json.load(file)
+        self.assertEqual('UnitTest', message['recipient'])
+        self.assertEqual({'test_msg': 'test value'}, message['payload'])
+        self.assertEqual(['UnitTest_1.json', 'UnitTest_1.smp'], sorted(os.listdir(outbound)))
+
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT processed FROM messages WHERE direction = 'outbound'",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual([[1]], result, 'expected the outbound message to be marked processed')
+
+        self.stop(ism)
+
+    def test_outbound_sftp_dead_host_sqlite3(self):
+        """Confirm that messages for a host that's down don't hold up those for a host that's up.
+
+        The dead host's messages have the higher priority and outnumber the batch size,
+        so they would fill every batch if they were fetched while it's skipped.
+        """
+
+        sender_id = 3
+
+        # A port with nothing listening on it
+        with socket.socket() as closed:
+            closed.bind(('127.0.0.1', 0))
+            dead_port = closed.getsockname()[1]
+        hosts = dict(self.properties['comms']['sftp']['hosts'])
+        hosts['dead'] = {'host': '127.0.0.1', 'port': dead_port, 'outbound': '/outbound', 'timeout': 1}
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['sftp'].update({
+            'hosts': hosts,
+            'recipients': {'Gone': 'dead'},
+            'default_host': 'local',
+            'outbound_batch_size': 2,
+            'retry_interval': 60
+        })
+        ism.properties['comms']['sftp']['hosts']['local']['port'] = self.server.port
+        for message_id in range(2, 7):
+            ism.dao.execute_sql_statement(
+                f"INSERT INTO messages VALUES({message_id}, 'Gone', 'ActionIoSftpOutbound', {message_id}, "
+                f"'ActionDummy', '{{}}', 12345, 0, 'outbound', 0, 5)"
+            )
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.sftp.actions')
+        ism.import_action_pack('ism_comms.file.tests.test_file_io_outbound')
+        ism.start()
+
+        outbound = f'{self.sftp_root}{os.path.sep}outbound'
+        retries = 100
+        while not os.path.exists(f'{outbound}{os.path.sep}UnitTest_1.smp') and retries:
+            retries -= 1
+            sleep(.1)
+        self.assertEqual(['UnitTest_1.json', 'UnitTest_1.smp'], sorted(os.listdir(outbound)))
+
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT recipient, processed, COUNT(*) FROM messages WHERE direction = 'outbound' "
+                       "GROUP BY recipient, processed ORDER BY recipient",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual([['Gone', 0, 5], ['UnitTest', 1, 1]], result)
+
+        self.stop(ism)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+"""The remote file operations run on a pooled session for each message.
+
+Messages use the file pack's format, i.e. one file per message named
+<recipient>_<sender_id> plus the codec's extension, with an empty semaphore file
+alongside to show it's complete. See ism_comms.file.actions.action_io_file_outbound.
+
+Outbound files are written to a hidden temporary name and published with a
+posix-rename, so a reader never sees a partial message. Writes are pipelined, i.e. each
+block is sent without waiting for the server to acknowledge the last.
+
+Inbound files are claimed before they're read by renaming them into a claim directory
+of this node's own, <inbound>/.claims/<node>. A rename is atomic on the server, so when
+several nodes poll the same remote directory exactly one of them gets each file, and
+the others skip it. With semaphores it's the semaphore that's claimed and the message
+file is read where it is, as ism_comms.file.claims does locally. The claimed file is
+read with prefetching, so its blocks are requested all at once.
+"""
+
+# Standard library imports
+import posixpath
+
+
+def makedirs(sftp, path: str):
+    """Create the remote directory and any missing parents"""
+
+    parent = posixpath.dirname(path.rstrip('/'))
+    if parent and parent != path:
+        try:
+            sftp.stat(parent)
+        except FileNotFoundError:
+            makedirs(sftp, parent)
+    try:
+        sftp.mkdir(path)
+    except OSError:
+        # Already there, anything else shows up on first use
+        pass
+
+
+def upload(sftp, directory: str, file_name: str, data: bytes, extension: str, semaphore=None):
+    """Write one message file, then its semaphore if there's a semaphore extension"""
+
+    path = posixpath.join(directory, file_name)
+    temp_path = posixpath.join(directory, f'.{file_name}{extension}.tmp')
+    with sftp.open(temp_path, 'wb') as file:
+        file.set_pipelined(True)
+        file.write(data)
+    sftp.posix_rename(temp_path, f'{path}{extension}')
+    if semaphore:
+        with sftp.open(f'{path}{semaphore}', 'wb'):
+            pass
+    return len(data)
+
+
+class RemoteInbound:
+    """Claim, read and finish with the message files in one remote inbound directory.
+
+    :param directory The remote inbound directory.
+    :param node This node's name, see ism_comms.file.claims.
+    :param extension The message file extension.
+    :param semaphore The semaphore extension, or None if message files are published
+    with an atomic rename and need no semaphore.
+    :param archive A remote directory to move finished files to. They're removed if None.
+    :param quarantine The remote directory for files that can't be decoded, relative
+    to the inbound directory unless absolute.
+    """
+
+    def __init__(self, directory: str, node: str, extension: str, semaphore=None, archive=None,
+                 quarantine='.quarantine'):
+        self.directory = directory
+        self.extension = extension
+        self.semaphore = semaphore
+        self.ready = semaphore or extension
+        self.claims = posixpath.join(directory, '.claims', node)
+        self.archive = archive
+        self.quarantine_directory = posixpath.join(directory, quarantine)
+
+    def prepare(self, sftp) -> list:
+        """Create the claim and quarantine directories.
+
+        :return The names already in this node's claim directory, e.g. left by a crash,
+        to read before any new ones.
+        """
+
+        makedirs(sftp, self.claims)
+        makedirs(sftp, self.quarantine_directory)
+        if self.archive:
+            makedirs(sftp, self.archive)
+        return self.claimed(sftp)
+
+    def claimed(self, sftp) -> list:
+        return [name[:-len(self.ready)] for name in sftp.listdir(self.claims) if name.endswith(self.ready)]
+
+    def list_ready(self, sftp, limit=0, exclude=()) -> list:
+        """The names, without extension, of up to limit (0, no limit) files ready to read, leaving out those in exclude"""
+
+        file_names = []
+        for name in sftp.listdir(self.directory):
+            if name.endswith(self.ready) and not name.startswith('.') and name[:-len(self.ready)] not in exclude:
+                file_names.append(name[:-len(self.ready)])
+                if len(file_names) == limit:
+                    break
+        return file_names
+
+    def message_path(self, file_name: str) -> str:
+        """The path of a claimed message file"""
+
+        directory = self.directory if self.semaphore else self.claims
+        return posixpath.join(directory, f'{file_name}{self.extension}')
+
+    def claim_and_read(self, sftp, item: tuple):
+        """Claim a message file, unless it's already claimed, and read it.
+
+        :param item The file name and whether it's already in the claim directory.
+        :return The file content, or None if another node claimed it first.
+        """
+
+        file_name, claimed = item
+        if not claimed:
+            try:
+                sftp.rename(
+                    posixpath.join(self.directory, f'{file_name}{self.ready}'),
+                    posixpath.join(self.claims, f'{file_name}{self.ready}')
+                )
+            except FileNotFoundError:
+                return None
+        with sftp.open(self.message_path(file_name), 'rb') as file:
+            file.prefetch()
+            return file.read()
+
+    def finish(self, sftp, file_name: str):
+        """Archive or remove a claimed message file and its semaphore once its message has been stored"""
+        self.move(sftp, file_name, self.archive)
+
+    def quarantine(self, sftp, file_name: str):
+        """Move a claimed message file that can't be decoded, and its semaphore, to the quarantine directory"""
+        self.move(sftp, file_name, self.quarantine_directory)
+
+    def move(self, sftp, file_name: str, destination=None):
+        paths = [self.message_path(file_name)]
+        if self.semaphore:
+            paths.append(posixpath.join(self.claims, f'{file_name}{self.semaphore}'))
+        for path in paths:
+            if destination:
+                sftp.posix_rename(path, posixpath.join(destination, posixpath.basename(path)))
+            else:
+                sftp.remove(path)
@@ -0,0 +1,53 @@
+"""Open the shared SQLite queue before running the sqlq messaging actions"""
+
+# Application imports
+from ism.core.base_action import BaseAction
+from ism_comms.core.store import MessageStore
+from ism_comms.sqlq.shared_queue import open_queue, resolve_path
+
+
+class ActionBeforeIoSqlq(BaseAction):
+    """Open the queue database defined under [comms][sqlq] in the properties file.
+
+    e.g.
+        comms:
+          sqlq:
+            path: sqlq/queue.db
+            name: ism_a
+            inbound: true
+            outbound: true
+
+    A relative path is put under the runtime root rather than the run directory, so
+    every ISM on the host finds the same database, and the properties are updated with
+    the resolved path. The queue's tables are created if they're not already there. The
+    inbound and outbound actions are activated unless inbound or outbound is false. See
+    ism_comms.sqlq.shared_queue for the other settings.
+    """
+
+    def execute(self):
+
+        if self.active():
+
+            try:
+                settings = self.properties['comms']['sqlq']
+                settings['path'] = resolve_path(settings['path'], self.properties['runtime']['root_dir'])
+            except KeyError as e:
+                self.logger.error(f'Failed to read [comms][sqlq] entries from properties. KeyError ({e})')
+                raise
+
+            try:
+                open_queue(self.properties)
+            except Exception as err:
+                self.logger.error(f'Error opening the shared queue ({settings["path"]}). ({err})')
+                raise
+
+            if settings.get('inbound', True):
+                self.activate('ActionIoSqlqInbound')
+            if settings.get('outbound', True):
+                self.activate('ActionIoSqlqOutbound')
+
+            # Bring a messages table made by an earlier release up to date, see ism_comms.core.store
+            MessageStore(self.dao, self.properties['database']['rdbms']).upgrade(self.logger)
+
+            # Job done so disable this action, or we'd be stuck in the STARTING phase
+            self.deactivate()
@@ -0,0 +1,102 @@
+"""Action reads the messages addressed to this ISM from the shared SQLite queue into the messages table"""
+
+# Application imports
+from ism.core.base_action import BaseAction
+from ism_comms.core.blobs import get_blob_settings
+from ism_comms.core.codecs import get_codec
+from ism_comms.core.dedup import get_filter
+from ism_comms.core.metrics import get_metrics
+from ism_comms.core.scheduler import AdaptivePolling, wake
+from ism_comms.core.store import DUPLICATE, FAILED, INSERTED, MessageStore, inbound_row
+from ism_comms.sqlq.shared_queue import release_queue, use_queue
+
+
+class ActionIoSqlqInbound(AdaptivePolling, BaseAction):
+    """Read the rows after this ISM's cursor in the shared queue and insert them into the messages table.
+
+    Up to [comms][sqlq][inbound_batch_size] rows (default 1000) are read per tick and
+    inserted in one transaction, then the cursor is moved past them. A poll finds
+    nothing to do without reading the queue when no other ISM has committed to it since
+    it was last empty, see ism_comms.sqlq.shared_queue.
+
+    Messages already received from the same (sender, sender_id) are counted as
+    duplicates and dropped, see ism_comms.core.dedup. Rows that can't be decoded are
+    logged and skipped, there's no way to hand them back to the sender. If a row can't
+    be inserted, e.g. the database is locked, the cursor only moves up to the row before
+    it, and the rest are read again on a following tick.
+
+    The action is activated by ActionBeforeIoSqlq unless [comms][sqlq][inbound] is
+    false. With [comms][polling] set, empty polls back off and a backlog is drained on
+    consecutive ticks, see ism_comms.core.scheduler.
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.started = False
+
+    def execute(self):
+
+        if self.active():
+
+            shared_queue = use_queue(self.properties, self.action_name)
+            if shared_queue is None:
+                return
+            self.started = True
+            self.poll(lambda: self.read_messages(shared_queue))
+
+        elif self.started:
+            # Deactivated, or the phase has moved on from RUNNING. The queue is closed once neither action uses it.
+            release_queue(self.properties, self.action_name)
+            self.started = False
+
+    def read_messages(self, shared_queue) -> int:
+        """Read a batch of queued messages into the messages table, returning the number found"""
+
+        if not shared_queue.changed():
+            return 0
+
+        settings = self.properties['comms']['sqlq']
+        metrics = get_metrics(self.properties)
+        scan_started = metrics.clock()
+        queued = shared_queue.read(settings.get('inbound_batch_size', 1000))
+        metrics.observe('scan_seconds', self.action_name, scan_started)
+        if not queued:
+            return 0
+        metrics.count('files_seen', self.action_name, len(queued))
+
+        decode_started = metrics.clock()
+        codec = get_codec(settings.get('codec', 'json'))
+        priorities = self.properties['comms'].get('priority')
+        blobs = get_blob_settings(self.properties)
+        rows = []
+        seqs = []
+        for seq, data in queued:
+            metrics.count('bytes_read', self.action_name, len(data))
+            try:
+                rows.append(inbound_row(codec.decode(data, blobs), priorities, blobs))
+                seqs.append(seq)
+            except Exception as e:
+                metrics.count('quarantined', self.action_name)
+                self.logger.error(f'Dropped queued message ({seq}) that could not be decoded as ({codec.name}). ({e})')
+        metrics.observe('decode_seconds', self.action_name, decode_started)
+
+        db_started = metrics.clock()
+        store = MessageStore(self.dao, self.properties['database']['rdbms'])
+        statuses = store.insert_unique(rows, self.logger, get_filter(self.properties, store)) if rows else []
+        metrics.count('rows', self.action_name, statuses.count(INSERTED))
+        metrics.count('duplicates', self.action_name, statuses.count(DUPLICATE))
+
+        # Move the cursor past the rows stored, stopping short of the first that failed
+        last = queued[-1][0]
+        if FAILED in statuses:
+            failed = seqs[statuses.index(FAILED)]
+            self.logger.error(
+                f'Failed to insert ({statuses.count(FAILED)}) queued messages, reading again from ({failed}).'
+            )
+            last = max((seq for seq, _ in queued if seq < failed), default=None)
+        if last is not None:
+            shared_queue.advance(last)
+        metrics.observe('db_seconds', self.action_name, db_started)
+        if INSERTED in statuses:
+            wake(self.properties, 'inbound')
+        return 0 if FAILED in statuses else len(queued)
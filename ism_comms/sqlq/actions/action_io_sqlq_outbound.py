@@ -0,0 +1,85 @@
+"""Action appends outbound messages from the messages table to the shared SQLite queue"""
+
+# Standard library imports
+import time
+
+# Application imports
+from ism.core.base_action import BaseAction
+from ism_comms.core.codecs import get_codec
+from ism_comms.core.metrics import get_metrics
+from ism_comms.core.scheduler import AdaptivePolling
+from ism_comms.core.store import MessageStore
+from ism_comms.sqlq.shared_queue import release_queue, use_queue
+
+
+class ActionIoSqlqOutbound(AdaptivePolling, BaseAction):
+    """Append pending outbound messages to the shared queue, addressed to their recipients.
+
+    Up to [comms][sqlq][outbound_batch_size] messages (default 0, no limit) are encoded
+    with [comms][sqlq][codec] (default json) and appended in one transaction per tick,
+    then marked processed in bulk. If the ISM stops between the two, the batch is sent
+    again and the receivers drop the copies as duplicates.
+
+    Messages without a recipient can't be addressed in the queue. They're logged once,
+    left pending and no longer fetched until the ISM restarts.
+
+    The action is activated by ActionBeforeIoSqlq unless [comms][sqlq][outbound] is
+    false. Polling adapts to the traffic when [comms][polling] is set, see
+    ism_comms.core.scheduler.
+    """
+
+    poll_topic = 'outbound'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.started = False
+        self.unaddressed = False
+
+    def execute(self):
+
+        if self.active():
+
+            shared_queue = use_queue(self.properties, self.action_name)
+            if shared_queue is None:
+                return
+            self.started = True
+            self.poll(lambda: self.send_messages(shared_queue))
+
+        elif self.started:
+            # Deactivated, or the phase has moved on from RUNNING. The queue is closed once neither action uses it.
+            release_queue(self.properties, self.action_name)
+            self.started = False
+
+    def send_messages(self, shared_queue) -> int:
+        """Append a batch of pending outbound messages to the queue, returning the number sent"""
+
+        settings = self.properties['comms']['sqlq']
+        metrics = get_metrics(self.properties)
+        store = MessageStore(self.dao, self.properties['database']['rdbms'])
+        db_started = metrics.clock()
+        results = store.fetch_pending(
+            'outbound', settings.get('outbound_batch_size', 0), exclude=(None,) if self.unaddressed else ()
+        )
+        metrics.observe('db_seconds', self.action_name, db_started)
+        unaddressed = [record.message_id for record in results if record.recipient is None]
+        if unaddressed:
+            self.logger.error(f'Unable to queue outbound messages ({unaddressed}) without a recipient.')
+            self.unaddressed = True
+            results = [record for record in results if record.recipient is not None]
+        metrics.gauge('backlog', self.action_name, len(results))
+        if not results:
+            return 0
+
+        encode_started = metrics.clock()
+        codec = get_codec(settings.get('codec', 'json'))
+        send_time = int(time.time())
+        messages = [(record.recipient, codec.encode(record.message(send_time))) for record in results]
+        shared_queue.append(messages)
+        metrics.observe('encode_seconds', self.action_name, encode_started)
+        metrics.count('bytes_written', self.action_name, sum(len(data) for _, data in messages))
+
+        db_started = metrics.clock()
+        store.mark_processed([record.message_id for record in results], sent=send_time)
+        metrics.observe('db_seconds', self.action_name, db_started)
+        metrics.count('rows', self.action_name, len(results))
+        return len(results)
@@ -0,0 +1,192 @@
+"""A message queue in a SQLite database shared by the state machines on one host.
+
+Two ISMs on the same host can exchange messages through the file pack, but each message
+then costs several files created, listed and renamed, and waits for the receiver's next
+directory scan. With the sqlq pack the co-located ISMs share one SQLite database in WAL
+mode instead. A sender appends a batch of encoded messages to the queue table in one
+transaction, and a receiver reads the rows addressed to it in the order they were
+appended. e.g.
+    comms:
+      sqlq:
+        path: sqlq/queue.db
+        name: ism_a
+
+Every ISM sharing the queue names the same path, relative to [runtime][root_dir] unless
+absolute, and its own name. Rows are addressed to the recipient of the outbound message,
+so an ISM receives the messages whose recipient is its name. WAL mode relies on shared
+memory, so the database must be on a local filesystem.
+
+Each receiver keeps a cursor, the sequence number of the last row it has stored, in the
+cursors table. Rows are read with "seq > cursor" from the (recipient, seq) index, so a
+poll costs the same however many rows other ISMs have queued. Sequence numbers come from
+an AUTOINCREMENT key, so they only ever go up, and SQLite runs one write transaction at
+a time, so a row can't become visible behind the cursor. The cursor is only moved once
+the rows are in the receiver's messages table. If the ISM stops in between, the rows are
+read again and dropped as duplicates by ism_comms.core.dedup. Rows behind the cursor are
+deleted as it moves, unless [retain] is set.
+
+The inbound and outbound actions share the one connection, each holding it with
+use_queue() while active, and it's closed once neither does.
+
+Before it queries the queue a receiver checks PRAGMA data_version, which only changes
+when another connection commits to the database. An idle poll is then a single pragma
+that reads no pages. Set [data_version] to false to query on every poll.
+
+Other settings:
+    * synchronous - The PRAGMA synchronous level (default normal). With WAL, normal
+    only loses the last transactions if the host loses power, full syncs every commit.
+    * busy_timeout - Milliseconds to wait for another ISM's write lock (default 5000).
+"""
+
+# Standard library imports
+from contextlib import contextmanager
+import os
+import sqlite3
+import time
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS queue ('
+    'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+    'recipient TEXT NOT NULL, '
+    'data BLOB NOT NULL, '
+    'enqueued REAL NOT NULL'
+    ')',
+    'CREATE INDEX IF NOT EXISTS queue_recipient ON queue (recipient, seq)',
+    'CREATE TABLE IF NOT EXISTS cursors (consumer TEXT NOT NULL PRIMARY KEY, seq INTEGER NOT NULL)'
+)
+
+_queues = {}
+
+
+def resolve_path(path: str, root_dir: str) -> str:
+    """Place a relative queue path under the runtime root and create its directory"""
+
+    if not os.path.isabs(path):
+        path = f'{root_dir}{os.path.sep}{path}'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def open_queue(properties: dict):
+    """Open the shared queue described by [comms][sqlq] for this run"""
+
+    key = properties['runtime']['run_dir']
+    close_queue(properties)
+    _queues[key] = SharedQueue(properties['comms']['sqlq'])
+    return _queues[key]
+
+
+def get_queue(properties: dict):
+    """Return the shared queue opened for this run, or None"""
+    return _queues.get(properties['runtime']['run_dir'])
+
+
+def use_queue(properties: dict, user: str):
+    """Return the shared queue opened for this run, or None, holding it for user until release_queue()"""
+
+    shared_queue = get_queue(properties)
+    if shared_queue is not None:
+        shared_queue.users.add(user)
+    return shared_queue
+
+
+def release_queue(properties: dict, user: str):
+    """Let go of the shared queue for user, closing it if no other user holds it"""
+
+    shared_queue = get_queue(properties)
+    if shared_queue is None:
+        return
+    shared_queue.users.discard(user)
+    if not shared_queue.users:
+        close_queue(properties)
+
+
+def close_queue(properties: dict):
+    shared_queue = _queues.pop(properties['runtime']['run_dir'], None)
+    if shared_queue is not None:
+        shared_queue.close()
+
+
+class SharedQueue:
+    """This ISM's connection to the shared queue, as sender and as receiver.
+
+    :param settings The [comms][sqlq] properties, with the path already resolved.
+    """
+
+    def __init__(self, settings: dict):
+        self.name = settings['name']
+        self.retain = settings.get('retain', False)
+        self.watch = settings.get('data_version', True)
+        self.cnx = sqlite3.connect(
+            settings['path'],
+            timeout=settings.get('busy_timeout', 5000) / 1000,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        self.cnx.execute('PRAGMA journal_mode=WAL')
+        self.cnx.execute(f'PRAGMA synchronous={settings.get("synchronous", "normal")}')
+        with self.transaction():
+            for sql in SCHEMA:
+                self.cnx.execute(sql)
+            self.cnx.execute('INSERT OR IGNORE INTO cursors (consumer, seq) VALUES (?, 0)', (self.name,))
+        self.cursor = self.cnx.execute('SELECT seq FROM cursors WHERE consumer = ?', (self.name,)).fetchone()[0]
+        self.data_version = None
+        self.backlog = True
+        self.users = set()
+
+    @contextmanager
+    def transaction(self):
+        """A write transaction, taking the write lock up front so it can't fail part way on a busy database"""
+
+        self.cnx.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.cnx
+            self.cnx.execute('COMMIT')
+        except Exception:
+            self.cnx.execute('ROLLBACK')
+            raise
+
+    def append(self, messages: list):
+        """Append (recipient, data) pairs to the queue in one transaction"""
+
+        if not messages:
+            return
+        enqueued = time.time()
+        with self.transaction():
+            self.cnx.executemany(
+                'INSERT INTO queue (recipient, data, enqueued) VALUES (?, ?, ?)',
+                [(recipient, data, enqueued) for recipient, data in messages]
+            )
+
+    def changed(self) -> bool:
+        """False if nothing has been committed by another connection since a poll last found the queue empty"""
+
+        if not self.watch:
+            return True
+        data_version = self.cnx.execute('PRAGMA data_version').fetchone()[0]
+        changed = data_version != self.data_version
+        self.data_version = data_version
+        return changed or self.backlog
+
+    def read(self, limit=0) -> list:
+        """The next rows for this ISM after its cursor, as (seq, data), up to limit (0, no limit)"""
+
+        rows = self.cnx.execute(
+            'SELECT seq, data FROM queue WHERE recipient = ? AND seq > ? ORDER BY seq LIMIT ?',
+            (self.name, self.cursor, limit or -1)
+        ).fetchall()
+        self.backlog = bool(rows)
+        return rows
+
+    def advance(self, seq: int):
+        """Move the cursor past the rows up to seq, once they've been stored, deleting them unless retained"""
+
+        with self.transaction():
+            self.cnx.execute('UPDATE cursors SET seq = ? WHERE consumer = ? AND seq < ?', (seq, self.name, seq))
+            if not self.retain:
+                self.cnx.execute('DELETE FROM queue WHERE recipient = ? AND seq <= ?', (self.name, seq))
+        self.cursor = max(self.cursor, seq)
+
+    def close(self):
+        self.cnx.close()
+
@@ -0,0 +1,328 @@
+"""This module tests the shared SQLite queue ism_comms.sqlq action pack for the python state machine.
+
+
+"""
+
+# Standard library imports
+import json
+import os
+import shutil
+import sqlite3
+from time import sleep
+import unittest
+from unittest import mock
+import yaml
+
+# Local application imports
+from ism.ISM import ISM
+from ism_comms.core.store import MessageStore
+from ism_comms.sqlq.shared_queue import (
+    SharedQueue, close_queue, get_queue, open_queue, release_queue, resolve_path, use_queue
+)
+
+
+class TestIsmIoSqlq(unittest.TestCase):
+    """This action pack implements IO between co-located state machines through a shared SQLite database.
+
+    The test process stands in for the other state machine on the host.
+    """
+    path_sep = os.path.sep
+    dir = os.path.dirname(os.path.abspath(__file__))
+    sqlite3_properties = f'{dir}{path_sep}resources{path_sep}sqlite3_properties.yaml'
+
+    # Test support methods
+    def setUp(self):
+        self.properties = self.get_properties(self.sqlite3_properties)
+        self.test_inbound = self.properties['test']['support']['inbound']
+        self.test_outbound = self.properties['test']['support']['outbound']
+        self.test_archive = self.properties['test']['support']['archive']
+        self.queue_path = resolve_path(
+            self.properties['comms']['sqlq']['path'],
+            self.properties['runtime']['root_dir']
+        )
+
+    def tearDown(self):
+        self.clear_test_files(self.test_inbound)
+        self.clear_test_files(self.test_outbound)
+        self.clear_test_files(self.test_archive)
+        self.clear_test_files(os.path.dirname(self.queue_path))
+
+    @staticmethod
+    def clear_test_files(directory):
+        if not os.path.exists(directory):
+            return
+        for filename in os.listdir(directory):
+            file_path = os.path.join(directory, filename)
+            try:
+                if os.path.isfile(file_path) or os.path.islink(file_path):
+                    os.unlink(file_path)
+                elif os.path.isdir(file_path):
+                    shutil.rmtree(file_path)
+            except Exception as e:
+                print('Failed to delete %s. Reason: %s' % (file_path, e))
+
+    @staticmethod
+    def get_properties(properties_file: str) -> dict:
+        """Read in the properties file"""
+        with open(properties_file, 'r') as file:
+            return yaml.safe_load(file)
+
+    @staticmethod
+    def stop(ism):
+        """Stop the ISM and close its queue connection once the main loop has exited"""
+        ism.stop()
+        ism.ism_thread.join(5)
+        close_queue(ism.properties)
+
+    def shared_queue(self, name: str, **settings) -> SharedQueue:
+        """A connection to the queue as another state machine on the host"""
+        return SharedQueue({'path': self.queue_path, 'name': name, **settings})
+
+    def query_test_support_pack(self, msg: dict) -> list:
+
+        sender_id = msg['payload']['sender_id']
+
+        self.send_test_support_msg(msg)
+
+        # Wait for the reply.
+        self.assertTrue(
+            self.wait_for_test_message_reply(sender_id),
+            'Failed to find expected reply to test support message.'
+        )
+
+        with open(f'{self.test_outbound}{os.path.sep}{sender_id}.json', 'r') as file:
+            return json.loads(file.read()).get('query_result', {})
+
+    def send_test_support_msg(self, msg: dict):
+
+        sender_id = msg['payload']['sender_id']
+
+        if not os.path.exists(self.test_inbound):
+            os.makedirs(self.test_inbound)
+
+        with open(f'{self.test_inbound}{os.path.sep}{sender_id}.json', 'w') as message:
+            message.write(json.dumps(msg))
+        with open(f'{self.test_inbound}{os.path.sep}{sender_id}.smp', 'w') as semaphore:
+            semaphore.write('')
+
+    def wait_for_test_message_reply(self, sender_id, retries=10) -> bool:
+        """Wait for an expected reply to a test support message"""
+
+        expected_file = f'{self.test_outbound}{os.path.sep}{sender_id}.json'
+
+        while retries > 0:
+            if os.path.exists(expected_file):
+                return True
+            retries -= 1
+            sleep(1)
+
+        return False
+
+    @staticmethod
+    def message(message_id: int, sender='test_sqlq') -> bytes:
+        return json.dumps(
+            {
+                "message_id": message_id,
+                "sender": sender,
+                "sender_id": message_id,
+                "action": "ActionDummy",
+                "payload": {"index": message_id},
+                "sent": "Thursday lunchtime"
+            }
+        ).encode()
+
+    # The tests
+    def test_shared_queue(self):
+        """Confirm the cursor only moves forward and data_version skips polls until another connection commits."""
+
+        sender = self.shared_queue('sender')
+        receiver = self.shared_queue('UnitTest', retain=True)
+
+        self.assertTrue(receiver.changed(), 'expected the first poll to read the queue')
+        self.assertEqual([], receiver.read(10))
+        self.assertFalse(receiver.changed(), 'expected an idle poll to skip the queue')
+
+        sender.append([('UnitTest', self.message(i)) for i in range(1, 6)] + [('someone_else', self.message(6))])
+        self.assertTrue(receiver.changed())
+        batch = receiver.read(3)
+        self.assertEqual([self.message(i) for i in range(1, 4)], [data for _, data in batch])
+        receiver.advance(batch[-1][0])
+
+        # Our own commit doesn't count as a change, but the rest of the backlog does
+        self.assertTrue(receiver.changed())
+        self.assertEqual([self.message(i) for i in range(4, 6)], [data for _, data in receiver.read(3)])
+
+        # A cursor can't be moved back, and survives a reconnect
+        receiver.advance(1)
+        receiver.close()
+        receiver = self.shared_queue('UnitTest')
+        self.assertEqual([self.message(i) for i in range(4, 6)], [data for _, data in receiver.read()])
+        receiver.advance(receiver.read()[-1][0])
+        self.assertEqual([], receiver.read())
+
+        counts = sqlite3.connect(self.queue_path).execute('SELECT recipient, COUNT(*) FROM queue GROUP BY recipient')
+        self.assertEqual([('someone_else', 1)], counts.fetchall(), 'expected the rows read to be deleted')
+        sender.close()
+        receiver.close()
+
+    def test_shared_queue_users(self):
+        """Confirm the connection shared by the inbound and outbound actions stays open until both let go."""
+
+        properties = {
+            'runtime': {'run_dir': self.test_archive},
+            'comms': {'sqlq': {'path': self.queue_path, 'name': 'UnitTest'}}
+        }
+        shared_queue = open_queue(properties)
+        self.assertIs(shared_queue, use_queue(properties, 'ActionIoSqlqInbound'))
+        self.assertIs(shared_queue, use_queue(properties, 'ActionIoSqlqOutbound'))
+
+        release_queue(properties, 'ActionIoSqlqOutbound')
+        self.assertIs(shared_queue, get_queue(properties), 'expected the queue to stay open for the inbound action')
+        self.assertEqual([], shared_queue.read())
+
+        release_queue(properties, 'ActionIoSqlqInbound')
+        self.assertIsNone(get_queue(properties), 'expected the queue to be closed once neither action uses it')
+        with self.assertRaises(sqlite3.ProgrammingError):
+            shared_queue.read()
+
+    def test_inbound_sqlq_sqlite3(self):
+        """Test that ActionIoSqlqInbound reads the rows queued for it into the messages table.
+
+        More rows are queued than fit in one tick's batch, and each should be inserted exactly once.
+        """
+
+        sender_id = 1
+        count = 50
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.sqlq.actions')
+        ism.start()
+
+        sender = self.shared_queue('sender')
+        for message_id in range(1, count + 1, 10):
+            sender.append([('UnitTest', self.message(i)) for i in range(message_id, message_id + 10)])
+        sender.close()
+
+        # Test support actions can answer during the STARTING phase, so give the inbound action time to run
+        sleep(1)
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT COUNT(*), COUNT(DISTINCT message_id) FROM messages WHERE sender = 'test_sqlq'",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual([count, count], result[0], 'expected each message to be inserted exactly once')
+
+        queue_db = sqlite3.connect(self.queue_path)
+        self.assertEqual((count,), queue_db.execute("SELECT seq FROM cursors WHERE consumer = 'UnitTest'").fetchone())
+        self.assertEqual((0,), queue_db.execute('SELECT COUNT(*) FROM queue').fetchone())
+        queue_db.close()
+
+        self.stop(ism)
+
+    def test_inbound_sqlq_failed_insert_sqlite3(self):
+        """Confirm that ActionIoSqlqInbound doesn't move its cursor past rows that failed to insert.
+
+        The insert fails once, as if the database were locked, and every row should still
+        be inserted from the queue on a following tick.
+        """
+
+        sender_id = 3
+        count = 10
+
+        insert_many = MessageStore.insert_many
+        failed = []
+
+        def insert_many_once(store, rows, logger):
+            if not failed and any(row[1] == 'test_sqlq' for row in rows):
+                failed.append(len(rows))
+                return [False] * len(rows)
+            return insert_many(store, rows, logger)
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        with mock.patch.object(MessageStore, 'insert_many', insert_many_once):
+            ism = ISM(args)
+            ism.import_action_pack('ism.tests.support')
+            ism.import_action_pack('ism_comms.sqlq.actions')
+            ism.start()
+
+            sender = self.shared_queue('sender')
+            sender.append([('UnitTest', self.message(i)) for i in range(1, count + 1)])
+            sender.close()
+
+            sleep(1)
+            msg = {
+                "action": "ActionRunSqlQuery",
+                "payload": {
+                    "sql": "SELECT COUNT(*) FROM messages WHERE sender = 'test_sqlq'",
+                    "sender_id": sender_id
+                }
+            }
+            result = self.query_test_support_pack(msg)
+            self.assertEqual([count], failed, 'expected the first insert to fail')
+            self.assertEqual([count], result[0], 'expected the rows read again once the insert succeeds')
+
+            queue_db = sqlite3.connect(self.queue_path)
+            cursor = queue_db.execute("SELECT seq FROM cursors WHERE consumer = 'UnitTest'").fetchone()
+            self.assertEqual((count,), cursor, 'expected the cursor moved past every row once they were stored')
+            queue_db.close()
+
+            self.stop(ism)
+
+    def test_outbound_sqlq_sqlite3(self):
+        """Confirm that ActionIoSqlqOutbound appends a pending outbound message to the queue for its recipient.
+
+        A message without a recipient, which can't be queued, is left pending without holding up the other.
+        """
+
+        sender_id = 2
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['sqlq'].update({'name': 'ism_a', 'inbound': False})
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.sqlq.actions')
+        # Test action pack contains insert into messages table.
+        ism.import_action_pack('ism_comms.file.tests.test_file_io_outbound')
+        ism.dao.execute_sql_statement(
+            "INSERT INTO messages VALUES(100, NULL, 'ActionIoSqlqOutbound', 100, "
+            "'ActionDummy', '{}', 12345, 0, 'outbound', 0, 5)"
+        )
+        ism.start()
+
+        sleep(1)
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT recipient, processed FROM messages WHERE direction = 'outbound' ORDER BY message_id",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual([['UnitTest', 1], [None, 0]], result, 'expected the addressed message to be marked processed')
+
+        receiver = self.shared_queue('UnitTest')
+        queued = receiver.read()
+        self.assertEqual(1, len(queued))
+        message = json.loads(queued[0][1])
+        self.assertEqual('UnitTest', message['recipient'])
+        self.assertEqual({'test_msg': 'test value'}, message['payload'])
+        receiver.close()
+
+        self.stop(ism)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,13 +7,110 @@ from unittest.suite import TestSuite
 
 from ism_comms.file.tests.test_ism_io_file import TestIsmIoFile
 
+# The optional packs' tests are left out of the suite when their dependencies aren't installed
+try:
+    from ism_comms.zmq.tests.test_ism_io_zmq import TestIsmIoZmq
+except ImportError:
+    TestIsmIoZmq = None
+try:
+    from ism_comms.api.tests.test_ism_io_api import TestIsmIoApi
+except ImportError:
+    TestIsmIoApi = None
+try:
+    from ism_comms.sftp.tests.test_ism_io_sftp import TestIsmIoSftp
+except ImportError:
+    TestIsmIoSftp = None
+try:
+    from ism_comms.sqlq.tests.test_ism_io_sqlq import TestIsmIoSqlq
+except ImportError:
+    TestIsmIoSqlq = None
+try:
+    from ism_comms.benchmarks.tests.test_benchmarks import TestBenchmarks
+except ImportError:
+    TestBenchmarks = None
+
 
 def suite():
     test_suite: TestSuite = unittest.TestSuite()
     test_suite.addTest(TestIsmIoFile('test_import_comms_before_file_actions_sqlite3'))
     test_suite.addTest(TestIsmIoFile('test_import_comms_before_file_actions_mysql'))
     test_suite.addTest(TestIsmIoFile('test_inbound_msg_file_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_inbound_msg_file_batch_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_inbound_msg_file_failed_retry_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_inbound_msg_file_orphaned_semaphore_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_inbound_msg_file_duplicate_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_inbound_msg_file_dedup_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_inbound_msg_file_blobs_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_inbound_msg_file_inotify_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_inbound_msg_file_sharded_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_inbound_claims'))
+    test_suite.addTest(TestIsmIoFile('test_inbound_claims_sqlite3'))
     test_suite.addTest(TestIsmIoFile('test_outbound_msg_file'))
+    test_suite.addTest(TestIsmIoFile('test_outbound_msg_file_atomic'))
+    test_suite.addTest(TestIsmIoFile('test_outbound_msg_file_batch_routes_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_outbound_msg_file_unroutable_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_batch_files'))
+    test_suite.addTest(TestIsmIoFile('test_archive_processed_messages_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_dispatch_inbound_msg_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_dispatch_coalesce_list_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_dispatch_coalesce_reject_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_codecs_round_trip'))
+    test_suite.addTest(TestIsmIoFile('test_inbound_msg_file_msgpack_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_segment_writer_reader'))
+    test_suite.addTest(TestIsmIoFile('test_inbound_msg_file_workers_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_inbound_msg_file_worker_processes_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_decode_pool_back_pressure'))
+    test_suite.addTest(TestIsmIoFile('test_archive_bundles_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_archive_bundles_batch_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_bundle_archiver'))
+    test_suite.addTest(TestIsmIoFile('test_metrics_export_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_metrics'))
+    test_suite.addTest(TestIsmIoFile('test_message_store_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_message_store_upgrade_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_adaptive_polling'))
+    test_suite.addTest(TestIsmIoFile('test_adaptive_polling_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_dedup_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_blob_store'))
+    test_suite.addTest(TestIsmIoFile('test_priority_lanes_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_priority_dispatch_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_segment_inbound_outbound_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_segment_inbound_failed_insert_sqlite3'))
+    test_suite.addTest(TestIsmIoFile('test_outbound_durability_crash_injection'))
+    if TestIsmIoZmq is not None:
+        test_suite.addTest(TestIsmIoZmq('test_inbound_push_pull_ipc_sqlite3'))
+        test_suite.addTest(TestIsmIoZmq('test_outbound_push_pull_ipc_sqlite3'))
+        test_suite.addTest(TestIsmIoZmq('test_router_dealer_inproc_sqlite3'))
+        test_suite.addTest(TestIsmIoZmq('test_router_dealer_unreachable_sqlite3'))
+        test_suite.addTest(TestIsmIoZmq('test_release_sockets'))
+    if TestIsmIoApi is not None:
+        test_suite.addTest(TestIsmIoApi('test_inbound_api_sqlite3'))
+        test_suite.addTest(TestIsmIoApi('test_server_responses'))
+        test_suite.addTest(TestIsmIoApi('test_outbound_api_sqlite3'))
+        test_suite.addTest(TestIsmIoApi('test_outbound_api_dead_server_sqlite3'))
+        test_suite.addTest(TestIsmIoApi('test_batch_queue'))
+        test_suite.addTest(TestIsmIoApi('test_runtime_concurrent_connections'))
+        test_suite.addTest(TestIsmIoApi('test_runtime_api_sqlite3'))
+        test_suite.addTest(TestIsmIoApi('test_runtime_stop_in_flight_sqlite3'))
+    if TestIsmIoSftp is not None:
+        test_suite.addTest(TestIsmIoSftp('test_session_pool_transfers'))
+        test_suite.addTest(TestIsmIoSftp('test_check_routes'))
+        test_suite.addTest(TestIsmIoSftp('test_inbound_sftp_sqlite3'))
+        test_suite.addTest(TestIsmIoSftp('test_inbound_sftp_failed_retry_sqlite3'))
+        test_suite.addTest(TestIsmIoSftp('test_outbound_sftp_sqlite3'))
+        test_suite.addTest(TestIsmIoSftp('test_outbound_sftp_dead_host_sqlite3'))
+    if TestIsmIoSqlq is not None:
+        test_suite.addTest(TestIsmIoSqlq('test_shared_queue'))
+        test_suite.addTest(TestIsmIoSqlq('test_shared_queue_users'))
+        test_suite.addTest(TestIsmIoSqlq('test_inbound_sqlq_sqlite3'))
+        test_suite.addTest(TestIsmIoSqlq('test_inbound_sqlq_failed_insert_sqlite3'))
+        test_suite.addTest(TestIsmIoSqlq('test_outbound_sqlq_sqlite3'))
+    if TestBenchmarks is not None:
+        test_suite.addTest(TestBenchmarks('test_percentiles'))
+        test_suite.addTest(TestBenchmarks('test_benchmark_sqlite3'))
+        test_suite.addTest(TestBenchmarks('test_benchmark_blobs_sqlite3'))
+        test_suite.addTest(TestBenchmarks('test_benchmark_cross_process_sqlite3'))
+        test_suite.addTest(TestBenchmarks('test_benchmark_durability_sqlite3'))
+        test_suite.addTest(TestBenchmarks('test_benchmark_sftp_sessions'))
 
     return test_suite
 
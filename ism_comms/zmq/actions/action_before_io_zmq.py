@@ -0,0 +1,60 @@
+"""Open the ZeroMQ sockets before running the zmq messaging actions"""
+
+# Application imports
+from ism.core.base_action import BaseAction
+from ism_comms.core.store import MessageStore
+from ism_comms.zmq.sockets import open_sockets, resolve_endpoint
+
+
+class ActionBeforeIoZmq(BaseAction):
+    """Bind or connect the sockets defined under [comms][zmq] in the properties file.
+
+    e.g.
+        comms:
+          zmq:
+            pattern: push_pull
+            hwm: 1000
+            inbound:
+              endpoint: ipc://inbound.ipc
+              bind: true
+            outbound:
+              endpoint: tcp://localhost:5556
+
+    Relative ipc:// endpoints are created under the run root, and the properties are
+    updated with the resolved endpoints. The inbound and outbound actions are activated
+    for whichever sides are configured. See ism_comms.zmq.sockets for the patterns.
+    """
+
+    def execute(self):
+
+        if self.active():
+
+            try:
+                settings = self.properties['comms']['zmq']
+            except KeyError as e:
+                self.logger.error(f'Failed to read [comms][zmq] entries from properties. KeyError ({e})')
+                raise
+
+            for side in ('inbound', 'outbound'):
+                if settings.get(side):
+                    settings[side]['endpoint'] = resolve_endpoint(
+                        settings[side]['endpoint'],
+                        self.properties['runtime']['run_dir']
+                    )
+
+            try:
+                sockets = open_sockets(self.properties)
+            except Exception as err:
+                self.logger.error(f'Error opening the ZeroMQ sockets ({err}).')
+                raise
+
+            if sockets.inbound is not None:
+                self.activate('ActionIoZmqInbound')
+            if sockets.outbound is not None:
+                self.activate('ActionIoZmqOutbound')
+
+            # Bring a messages table made by an earlier release up to date, see ism_comms.core.store
+            MessageStore(self.dao, self.properties['database']['rdbms']).upgrade(self.logger)
+
+            # Job done so disable this action, or we'd be stuck in the STARTING phase
+            self.deactivate()
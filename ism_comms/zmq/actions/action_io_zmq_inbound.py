@@ -0,0 +1,65 @@
+"""Action drains the inbound ZeroMQ socket into the messages table"""
+
+# Application imports
+from ism.core.base_action import BaseAction
+from ism_comms.core.blobs import get_blob_settings
+from ism_comms.core.codecs import get_codec
+from ism_comms.core.dedup import get_filter
+from ism_comms.core.metrics import get_metrics
+from ism_comms.core.scheduler import wake
+from ism_comms.core.store import DUPLICATE, INSERTED, MessageStore, inbound_row
+from ism_comms.zmq.sockets import get_sockets, release_sockets
+
+
+class ActionIoZmqInbound(BaseAction):
+    """Receive messages waiting on the inbound socket and insert them into the messages table.
+
+    The socket is drained without blocking, up to [comms][zmq][inbound_budget] messages
+    per tick (default 1000), and the batch is inserted in one transaction. Anything
+    left waits in the socket's queue, which is bounded by [comms][zmq][hwm]. Messages
+    that can't be decoded or inserted are logged and dropped, there's no way to hand
+    them back to the sender. Messages already received from the same (sender,
+    sender_id) are counted as duplicates and dropped, see ism_comms.core.dedup.
+
+    The action is activated by ActionBeforeIoZmq when an inbound endpoint is set.
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.started = False
+
+    def execute(self):
+
+        if self.active():
+
+            sockets = get_sockets(self.properties)
+            if sockets is None:
+                return
+            self.started = True
+
+            settings = self.properties['comms']['zmq']
+            frames = sockets.receive(settings.get('inbound_budget', 1000))
+            if not frames:
+                return
+
+            codec = get_codec(settings.get('codec', 'json'))
+            priorities = self.properties['comms'].get('priority')
+            blobs = get_blob_settings(self.properties)
+            rows = []
+            for data in frames:
+                try:
+                    rows.append(inbound_row(codec.decode(data, blobs), priorities, blobs))
+                except Exception as e:
+                    self.logger.error(f'Dropped ZeroMQ message that could not be decoded as ({codec.name}). ({e})')
+
+            if rows:
+                store = MessageStore(self.dao, self.properties['database']['rdbms'])
+                statuses = store.insert_unique(rows, self.logger, get_filter(self.properties, store))
+                get_metrics(self.properties).count('duplicates', self.action_name, statuses.count(DUPLICATE))
+                if INSERTED in statuses:
+                    wake(self.properties, 'inbound')
+
+        elif self.started:
+            # Deactivated, or the phase has moved on from RUNNING. Leave the other direction's socket open.
+            release_sockets(self.properties, 'inbound')
+            self.started = False
@@ -0,0 +1,84 @@
+"""Action sends outbound messages from the messages table over ZeroMQ"""
+
+# Standard library imports
+import time
+
+# Third party imports
+import zmq
+
+# Application imports
+from ism.core.base_action import BaseAction
+from ism_comms.core.codecs import get_codec
+from ism_comms.core.scheduler import AdaptivePolling
+from ism_comms.core.store import MessageStore
+from ism_comms.zmq.sockets import get_sockets, release_sockets
+
+
+class ActionIoZmqOutbound(AdaptivePolling, BaseAction):
+    """Send pending outbound messages from the outbound socket.
+
+    Up to [comms][zmq][outbound_batch_size] messages (default 0, no limit) are sent per
+    tick without blocking, then the ones sent are marked processed in bulk. Sending
+    stops for the tick when the socket reaches its high-water mark, and the rest go on
+    a later tick. With the router_dealer pattern, messages for a recipient that isn't
+    connected stay pending until it is. They're left out of the batch fetched for
+    [comms][zmq][retry_interval] seconds (default 1) before it's tried again, so they
+    don't hold up the messages for the recipients that are connected.
+
+    The action is activated by ActionBeforeIoZmq when there's a socket to send from.
+    Polling adapts to the traffic when [comms][polling] is set, see
+    ism_comms.core.scheduler.
+    """
+
+    poll_topic = 'outbound'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.started = False
+        self.retry_at = {}
+
+    def execute(self):
+
+        if self.active():
+
+            sockets = get_sockets(self.properties)
+            if sockets is None or sockets.outbound is None:
+                return
+            self.started = True
+            self.poll(lambda: self.send_messages(sockets))
+
+        elif self.started:
+            # Deactivated, or the phase has moved on from RUNNING. Leave the other direction's socket open.
+            release_sockets(self.properties, 'outbound')
+            self.started = False
+
+    def send_messages(self, sockets) -> int:
+        """Send a batch of pending outbound messages, returning the number sent"""
+
+        settings = self.properties['comms']['zmq']
+        store = MessageStore(self.dao, self.properties['database']['rdbms'])
+        now = time.monotonic()
+        unreachable = [recipient for recipient, retry_at in self.retry_at.items() if retry_at > now]
+        results = store.fetch_pending('outbound', settings.get('outbound_batch_size', 0), exclude=unreachable)
+        if not results:
+            return 0
+
+        codec = get_codec(settings.get('codec', 'json'))
+        send_time = int(time.time())
+        sent = []
+        for record in results:
+            data = codec.encode(record.message(send_time))
+            try:
+                sockets.send(record.recipient, data)
+            except zmq.Again:
+                # High-water mark reached, try again next tick
+                break
+            except zmq.ZMQError as e:
+                if e.errno != zmq.EHOSTUNREACH:
+                    raise
+                self.retry_at[record.recipient] = now + settings.get('retry_interval', 1)
+                continue
+            sent.append(record.message_id)
+
+        store.mark_processed(sent, sent=send_time)
+        return len(sent)
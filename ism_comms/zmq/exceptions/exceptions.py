@@ -0,0 +1,8 @@
+"""Custom Exceptions for the state machine ism_comms.zmq actions"""
+
+
+class ZmqPatternNotRecognised(Exception):
+
+    def __init__(self, message='ZeroMQ socket pattern not recognised'):
+        self.message = message
+        super().__init__(self.message)
@@ -0,0 +1,166 @@
+"""ZeroMQ sockets shared by the zmq actions of one state machine.
+
+ActionBeforeIoZmq opens the sockets from the [comms][zmq] properties and the inbound and
+outbound actions look them up by the run directory, so several state machines can run
+in one process. Each action closes only its own socket when it stops, and the context
+is terminated once neither socket is open. With an inproc:// endpoint the sockets are
+made from the shared zmq.Context.instance() instead, so tests and co-located producers
+can reach them, and it's left for them to terminate.
+
+Patterns, set by [comms][zmq][pattern]:
+    * push_pull - (default) Messages arrive on a PULL socket and are sent from a PUSH socket.
+    * router_dealer - Messages arrive on a ROUTER socket from DEALER peers, whose socket
+    identity is their address. Outbound messages are routed back through the ROUTER to
+    the peer named by the recipient, unless an outbound endpoint is set, in which case
+    they are sent from a DEALER connected to it.
+
+Each message is a single frame encoded with the codec named in [comms][zmq][codec]
+(default json, see ism_comms.core.codecs).
+"""
+
+# Standard library imports
+import os
+
+# Third party imports
+import zmq
+
+# Application imports
+from ism_comms.zmq.exceptions.exceptions import ZmqPatternNotRecognised
+
+# Socket types for the inbound and outbound side of each pattern
+PATTERNS = {
+    'push_pull': (zmq.PULL, zmq.PUSH),
+    'router_dealer': (zmq.ROUTER, zmq.DEALER)
+}
+
+_sockets = {}
+
+
+def resolve_endpoint(endpoint: str, run_dir: str) -> str:
+    """Place a relative ipc:// endpoint under the run directory and create its directory"""
+
+    if not endpoint.startswith('ipc://'):
+        return endpoint
+    path = endpoint[len('ipc://'):]
+    if not os.path.isabs(path):
+        path = f'{run_dir}{os.path.sep}comms{os.path.sep}zmq{os.path.sep}{path}'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return f'ipc://{path}'
+
+
+def open_sockets(properties: dict):
+    """Open the sockets described by [comms][zmq] for this run"""
+
+    key = properties['runtime']['run_dir']
+    close_sockets(properties)
+    _sockets[key] = ZmqSockets(properties['comms']['zmq'])
+    return _sockets[key]
+
+
+def get_sockets(properties: dict):
+    """Return the sockets opened for this run, or None"""
+    return _sockets.get(properties['runtime']['run_dir'])
+
+
+def release_sockets(properties: dict, direction: str):
+    """Close the inbound or outbound socket for this run, closing the rest once neither is open"""
+
+    sockets = get_sockets(properties)
+    if sockets is None:
+        return
+    sockets.close(direction)
+    if sockets.inbound is None and sockets.outbound is None:
+        close_sockets(properties)
+
+
+def close_sockets(properties: dict):
+    sockets = _sockets.pop(properties['runtime']['run_dir'], None)
+    if sockets is not None:
+        sockets.close()
+
+
+class ZmqSockets:
+    """The inbound and outbound sockets of one state machine.
+
+    :param settings The [comms][zmq] properties, with the endpoints already resolved.
+    """
+
+    def __init__(self, settings: dict):
+        self.pattern = settings.get('pattern', 'push_pull')
+        try:
+            inbound_type, outbound_type = PATTERNS[self.pattern]
+        except KeyError:
+            raise ZmqPatternNotRecognised(f'ZeroMQ pattern ({self.pattern}) not recognised')
+        self.settings = settings
+        self.shared = any(
+            (settings.get(side) or {}).get('endpoint', '').startswith('inproc://') for side in ('inbound', 'outbound')
+        )
+        self.context = zmq.Context.instance() if self.shared else zmq.Context()
+        self.inbound = self.open(inbound_type, settings.get('inbound'))
+        self.outbound = self.open(outbound_type, settings.get('outbound'))
+
+        # Route replies back through the ROUTER if there's no DEALER of our own
+        self.routed = self.pattern == 'router_dealer' and self.outbound is None
+        if self.routed:
+            self.outbound = self.inbound
+
+    def open(self, socket_type: int, endpoint: dict):
+        """Create, configure and bind or connect one socket"""
+
+        if not endpoint:
+            return None
+        socket = self.context.socket(socket_type)
+        hwm = self.settings.get('hwm', 1000)
+        socket.setsockopt(zmq.SNDHWM, hwm)
+        socket.setsockopt(zmq.RCVHWM, hwm)
+        socket.setsockopt(zmq.LINGER, self.settings.get('linger', 1000))
+        if socket_type == zmq.ROUTER:
+            # Raise EHOSTUNREACH for a recipient that isn't connected rather than drop the message
+            socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        if socket_type == zmq.DEALER and self.settings.get('identity'):
+            socket.setsockopt(zmq.IDENTITY, self.settings['identity'].encode())
+        if endpoint.get('bind', socket_type in (zmq.PULL, zmq.ROUTER)):
+            socket.bind(endpoint['endpoint'])
+        else:
+            socket.connect(endpoint['endpoint'])
+        return socket
+
+    def close(self, direction=None):
+        """Close the inbound or outbound socket, or both, terminating our own context once neither is open.
+
+        A routed ROUTER is both, so it's kept until both are closed.
+        """
+
+        for side in ('inbound', 'outbound') if direction is None else (direction,):
+            socket = getattr(self, side)
+            setattr(self, side, None)
+            if socket is not None and socket is not self.inbound and socket is not self.outbound:
+                socket.close()
+        if self.inbound is None and self.outbound is None and not self.shared and not self.context.closed:
+            self.context.term()
+
+    def receive(self, budget: int) -> list:
+        """Drain up to budget waiting messages without blocking.
+
+        :return The message frames, without any routing envelope.
+        """
+
+        messages = []
+        socket = self.inbound
+        if socket is None:
+            return messages
+        while len(messages) < budget and socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            messages.append(socket.recv_multipart(zmq.NOBLOCK)[-1])
+        return messages
+
+    def send(self, recipient: str, data: bytes):
+        """Send one message without blocking.
+
+        :raises zmq.Again if the high-water mark has been reached.
+        :raises zmq.ZMQError with errno EHOSTUNREACH if a routed recipient isn't connected.
+        """
+
+        if self.routed:
+            self.outbound.send_multipart([recipient.encode(), data], zmq.NOBLOCK)
+        else:
+            self.outbound.send(data, zmq.NOBLOCK)
@@ -0,0 +1,334 @@
+"""This module tests the ZeroMQ ism_comms.zmq action pack for the python state machine.
+
+
+"""
+
+# Standard library imports
+import json
+import os
+import shutil
+from time import sleep
+import unittest
+import yaml
+
+# Third party imports
+import zmq
+
+# Local application imports
+from ism.ISM import ISM
+from ism_comms.zmq.sockets import close_sockets, get_sockets, open_sockets, release_sockets, resolve_endpoint
+
+
+class TestIsmIoZmq(unittest.TestCase):
+    """This action pack implements ZeroMQ based IO.
+
+    The tests run over ipc:// and inproc:// endpoints, so need no network.
+    """
+    path_sep = os.path.sep
+    dir = os.path.dirname(os.path.abspath(__file__))
+    sqlite3_properties = f'{dir}{path_sep}resources{path_sep}sqlite3_properties.yaml'
+
+    # Test support methods
+    def setUp(self):
+        self.properties = self.get_properties(self.sqlite3_properties)
+        self.test_inbound = self.properties['test']['support']['inbound']
+        self.test_outbound = self.properties['test']['support']['outbound']
+        self.test_archive = self.properties['test']['support']['archive']
+        self.context = zmq.Context.instance()
+
+    def tearDown(self):
+        self.clear_test_files(self.test_inbound)
+        self.clear_test_files(self.test_outbound)
+        self.clear_test_files(self.test_archive)
+
+    @staticmethod
+    def clear_test_files(directory):
+        if not os.path.exists(directory):
+            return
+        for filename in os.listdir(directory):
+            file_path = os.path.join(directory, filename)
+            try:
+                if os.path.isfile(file_path) or os.path.islink(file_path):
+                    os.unlink(file_path)
+                elif os.path.isdir(file_path):
+                    shutil.rmtree(file_path)
+            except Exception as e:
+                print('Failed to delete %s. Reason: %s' % (file_path, e))
+
+    @staticmethod
+    def get_properties(properties_file: str) -> dict:
+        """Read in the properties file"""
+        with open(properties_file, 'r') as file:
+            return yaml.safe_load(file)
+
+    @staticmethod
+    def stop(ism):
+        """Stop the ISM and release its sockets once the main loop has exited"""
+        ism.stop()
+        ism.ism_thread.join(5)
+        close_sockets(ism.properties)
+
+    def query_test_support_pack(self, msg: dict) -> list:
+
+        sender_id = msg['payload']['sender_id']
+
+        self.send_test_support_msg(msg)
+
+        # Wait for the reply.
+        self.assertTrue(
+            self.wait_for_test_message_reply(sender_id),
+            'Failed to find expected reply to test support message.'
+        )
+
+        with open(f'{self.test_outbound}{os.path.sep}{sender_id}.json', 'r') as file:
+            return json.loads(file.read()).get('query_result', {})
+
+    def send_test_support_msg(self, msg: dict):
+
+        sender_id = msg['payload']['sender_id']
+
+        if not os.path.exists(self.test_inbound):
+            os.makedirs(self.test_inbound)
+
+        with open(f'{self.test_inbound}{os.path.sep}{sender_id}.json', 'w') as message:
+            message.write(json.dumps(msg))
+        with open(f'{self.test_inbound}{os.path.sep}{sender_id}.smp', 'w') as semaphore:
+            semaphore.write('')
+
+    def wait_for_test_message_reply(self, sender_id, retries=10) -> bool:
+        """Wait for an expected reply to a test support message"""
+
+        expected_file = f'{self.test_outbound}{os.path.sep}{sender_id}.json'
+
+        while retries > 0:
+            if os.path.exists(expected_file):
+                return True
+            retries -= 1
+            sleep(1)
+
+        return False
+
+    @staticmethod
+    def wait_for_endpoint(ism, side: str) -> str:
+        """ActionBeforeIoZmq resolves relative ipc:// endpoints under the run directory"""
+
+        retries = 500
+        while ism.properties['comms']['zmq'][side]['endpoint'].startswith('ipc://') and \
+                not os.path.isabs(ism.properties['comms']['zmq'][side]['endpoint'][len('ipc://'):]) and retries:
+            retries -= 1
+            sleep(.01)
+        return ism.properties['comms']['zmq'][side]['endpoint']
+
+    @staticmethod
+    def message(message_id: int, sender='test_zmq') -> bytes:
+        return json.dumps(
+            {
+                "message_id": message_id,
+                "sender": sender,
+                "sender_id": message_id,
+                "action": "ActionDummy",
+                "payload": {"index": message_id},
+                "sent": "Thursday lunchtime"
+            }
+        ).encode()
+
+    # The tests
+    def test_inbound_push_pull_ipc_sqlite3(self):
+        """Test that ActionIoZmqInbound drains a PULL socket into the messages table.
+
+        More messages are pushed than fit in one tick's budget, and each should be
+        inserted exactly once.
+        """
+
+        sender_id = 1
+        count = 50
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['zmq']['inbound_budget'] = 20
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.zmq.actions')
+        ism.start()
+
+        push = self.context.socket(zmq.PUSH)
+        push.connect(self.wait_for_endpoint(ism, 'inbound'))
+        for message_id in range(1, count + 1):
+            push.send(self.message(message_id))
+
+        # Test support actions can answer during the STARTING phase, so give the inbound action time to run
+        sleep(1)
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT COUNT(*), COUNT(DISTINCT message_id) FROM messages WHERE sender = 'test_zmq'",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual([count, count], result[0], 'expected each message to be inserted exactly once')
+
+        push.close(0)
+        self.stop(ism)
+
+    def test_outbound_push_pull_ipc_sqlite3(self):
+        """Confirm that ActionIoZmqOutbound sends a pending outbound message from the PUSH socket."""
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.zmq.actions')
+        # Test action pack contains insert into messages table.
+        ism.import_action_pack('ism_comms.file.tests.test_file_io_outbound')
+        ism.start()
+
+        pull = self.context.socket(zmq.PULL)
+        pull.connect(self.wait_for_endpoint(ism, 'outbound'))
+        self.assertTrue(pull.poll(5000), 'expected an outbound message')
+        msg = json.loads(pull.recv())
+
+        self.assertEqual('UnitTest', msg['recipient'])
+        self.assertEqual({'test_msg': 'test value'}, msg['payload'])
+
+        pull.close(0)
+        self.stop(ism)
+
+    def test_router_dealer_inproc_sqlite3(self):
+        """Confirm that a DEALER peer can send to the ISM's ROUTER and be routed its outbound messages.
+
+        The outbound message for UnitTest is only sent once a DEALER with that identity connects.
+        """
+
+        sender_id = 3
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['zmq'] = {
+            'pattern': 'router_dealer',
+            'inbound': {'endpoint': f'inproc://ism_router_{id(ism)}'}
+        }
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.zmq.actions')
+        ism.import_action_pack('ism_comms.file.tests.test_file_io_outbound')
+        ism.start()
+
+        # Give the unroutable message a few ticks before the recipient connects
+        sleep(.5)
+        dealer = self.context.socket(zmq.DEALER)
+        dealer.setsockopt(zmq.IDENTITY, b'UnitTest')
+        dealer.connect(ism.properties['comms']['zmq']['inbound']['endpoint'])
+        dealer.send(self.message(100, sender='UnitTest'))
+
+        self.assertTrue(dealer.poll(5000), 'expected the outbound message to be routed to the DEALER')
+        self.assertEqual('ActionDummy', json.loads(dealer.recv())['action'])
+
+        sleep(1)
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT sender, (SELECT processed FROM messages WHERE direction = 'outbound') "
+                       "FROM messages WHERE direction = 'inbound'",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual([['UnitTest', 1]], result, 'expected the inbound message and the outbound one processed')
+
+        dealer.close(0)
+        self.stop(ism)
+
+    def test_router_dealer_unreachable_sqlite3(self):
+        """Confirm that messages for a recipient that isn't connected don't hold up those for one that is.
+
+        The unconnected recipient's messages have the higher priority and outnumber the
+        batch size, so they would fill every batch if they were fetched while it's skipped.
+        """
+
+        sender_id = 4
+
+        args = {
+            'properties_file': self.sqlite3_properties
+        }
+        ism = ISM(args)
+        ism.properties['comms']['zmq'] = {
+            'pattern': 'router_dealer',
+            'inbound': {'endpoint': f'inproc://ism_router_{id(ism)}'},
+            'outbound_batch_size': 2,
+            'retry_interval': .2
+        }
+
+        ism.import_action_pack('ism.tests.support')
+        ism.import_action_pack('ism_comms.zmq.actions')
+        ism.import_action_pack('ism_comms.file.tests.test_file_io_outbound')
+        for message_id in range(2, 7):
+            ism.dao.execute_sql_statement(
+                f"INSERT INTO messages VALUES({message_id}, 'Gone', 'ActionIoZmqOutbound', {message_id}, "
+                f"'ActionDummy', '{{}}', 12345, 0, 'outbound', 0, 5)"
+            )
+        ism.start()
+
+        # Connect once the outbound action has found the recipients unreachable and retried them
+        sleep(.5)
+        dealer = self.context.socket(zmq.DEALER)
+        dealer.setsockopt(zmq.IDENTITY, b'UnitTest')
+        dealer.connect(ism.properties['comms']['zmq']['inbound']['endpoint'])
+
+        self.assertTrue(dealer.poll(5000), 'expected the message for the connected recipient to be sent')
+        self.assertEqual('ActionDummy', json.loads(dealer.recv())['action'])
+
+        sleep(1)
+        msg = {
+            "action": "ActionRunSqlQuery",
+            "payload": {
+                "sql": "SELECT recipient, processed, COUNT(*) FROM messages WHERE direction = 'outbound' "
+                       "GROUP BY recipient, processed ORDER BY recipient",
+                "sender_id": sender_id
+            }
+        }
+        result = self.query_test_support_pack(msg)
+        self.assertEqual([['Gone', 0, 5], ['UnitTest', 1, 1]], result)
+
+        dealer.close(0)
+        self.stop(ism)
+
+    def test_release_sockets(self):
+        """Confirm that each direction closes only its own socket, and the context goes once neither is open."""
+
+        run_dir = self.test_archive
+        properties = {
+            'runtime': {'run_dir': run_dir},
+            'comms': {
+                'zmq': {
+                    'inbound': {'endpoint': resolve_endpoint('ipc://release_in.ipc', run_dir)},
+                    'outbound': {'endpoint': resolve_endpoint('ipc://release_out.ipc', run_dir), 'bind': True}
+                }
+            }
+        }
+        sockets = open_sockets(properties)
+        pull = self.context.socket(zmq.PULL)
+        pull.connect(properties['comms']['zmq']['outbound']['endpoint'])
+
+        release_sockets(properties, 'inbound')
+        self.assertIsNone(sockets.inbound)
+        self.assertIs(sockets, get_sockets(properties), 'expected the outbound socket to stay open')
+        self.assertTrue(sockets.outbound.poll(5000, zmq.POLLOUT), 'expected the PULL socket to connect')
+        sockets.send('UnitTest', b'still sending')
+        self.assertTrue(pull.poll(5000), 'expected the outbound socket to keep sending')
+        self.assertEqual(b'still sending', pull.recv())
+
+        release_sockets(properties, 'outbound')
+        self.assertIsNone(get_sockets(properties))
+        self.assertTrue(sockets.context.closed, 'expected the context to be terminated once neither socket is open')
+        pull.close(0)
+
+
+if __name__ == '__main__':
+    unittest.main()